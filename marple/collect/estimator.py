@@ -0,0 +1,272 @@
+# -------------------------------------------------------------
+# estimator.py - projects the cost of a collection before running it
+# October 2018
+# -------------------------------------------------------------
+
+"""
+Pre-flight estimate of data volume and overhead.
+
+Runs a short, cheap probe of the system: `perf stat` counts of the events
+the collecters would record, how busy the CPUs are, and how many processes
+are running.
+Each collecter turns the probe into a rate of records (see
+:meth:`Collecter.estimate_rate`); together with its rough cost per record,
+this projects the number of records, the output size and the CPU overhead of
+a collection of the requested duration.
+Interfaces over the targets get a recommendation, e.g. a lower sampling
+frequency.
+
+"""
+
+__all__ = (
+    'Probe',
+    'Estimate',
+    'probe',
+    'estimate',
+    'report',
+)
+
+import asyncio
+import logging
+import os
+import typing
+
+from marple.collect.interface import tracefs
+from marple.common import util
+
+logger = logging.getLogger(__name__)
+logger.debug('Entered module: %s', __name__)
+
+
+class Probe(typing.NamedTuple):
+    """
+    The activity of the system over a short probe.
+
+    .. attribute:: rates:
+        The rate of each perf event counted, in events per second, by name.
+    .. attribute:: cpus:
+        The number of online CPUs.
+    .. attribute:: busy_cpus:
+        The average number of CPUs that were busy.
+    .. attribute:: processes:
+        The number of processes running.
+
+    """
+    rates: dict
+    cpus: int
+    busy_cpus: float
+    processes: int
+
+
+class Estimate(typing.NamedTuple):
+    """
+    The projected cost of collecting with one interface.
+
+    The projections are None if the collecter cannot estimate its rate.
+
+    .. attribute:: interface:
+        The name of the interface.
+    .. attribute:: rate:
+        The records produced per second.
+    .. attribute:: records:
+        The records produced over the collection.
+    .. attribute:: output_bytes:
+        The bytes of output from the collection tool.
+    .. attribute:: cpu_percent:
+        The CPU overhead, in percent of one CPU.
+    .. attribute:: recommendation:
+        A suggested change to keep within the targets, or None.
+
+    """
+    interface: str
+    rate: typing.Optional[float]
+    records: typing.Optional[int]
+    output_bytes: typing.Optional[int]
+    cpu_percent: typing.Optional[float]
+    recommendation: typing.Optional[str]
+
+
+def _read_cpu_times():
+    """ :return: The busy and total CPU time from /proc/stat, in ticks. """
+    with open("/proc/stat") as file_:
+        fields = [int(field) for field in file_.readline().split()[1:]]
+    # idle and iowait are the fourth and fifth fields
+    total = sum(fields)
+    return total - fields[3] - fields[4], total
+
+
+def _count_processes():
+    """ :return: The number of processes in /proc. """
+    return sum(1 for name in os.listdir("/proc") if name.isdigit())
+
+
+def _available(event):
+    """
+    :return:
+        Whether a perf event can be counted: tracepoints must exist in
+        tracefs, other events are left for perf to judge.
+
+    """
+    if ":" not in event:
+        return True
+    try:
+        root = tracefs._find_tracefs()
+    except FileNotFoundError:
+        return True
+    return os.path.isdir(os.path.join(root, "events", *event.split(":", 1)))
+
+
+def _parse_perf_stat(output, seconds):
+    """
+    Parse the CSV output of perf stat (`-x ,`).
+
+    :param output:
+        The decoded stderr of perf stat.
+    :param seconds:
+        The number of seconds counted for.
+    :return:
+        A dict of the rate of each event counted, in events per second.
+
+    """
+    rates = {}
+    for line in output.splitlines():
+        fields = line.split(",")
+        if line.startswith("#") or len(fields) < 3:
+            continue
+        # Events perf could not count are reported as <not supported> etc.
+        try:
+            count = float(fields[0])
+        except ValueError:
+            logger.info("perf stat could not count %s: %s", fields[2],
+                        fields[0])
+            continue
+        rates[fields[2]] = count / seconds
+    return rates
+
+
+@util.log(logger)
+async def probe(events, seconds):
+    """
+    Probe the system for a short time.
+
+    :param events:
+        The perf events to count, system-wide.
+    :param seconds:
+        The length of the probe.
+    :return:
+        A :class:`Probe`.
+
+    """
+    events = sorted(event for event in set(events) if _available(event))
+    busy_before, total_before = _read_cpu_times()
+
+    rates = {}
+    if events:
+        command = ["perf", "stat", "-a", "-x", ","]
+        for event in events:
+            command.extend(("-e", event))
+        command.extend(("--", "sleep", str(seconds)))
+        sub_process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+        _, err = await sub_process.communicate()
+        if sub_process.returncode != 0:
+            logger.error("perf stat failed: %s", err.decode())
+        else:
+            rates = _parse_perf_stat(err.decode(), seconds)
+    else:
+        await asyncio.sleep(seconds)
+
+    busy_after, total_after = _read_cpu_times()
+    cpus = os.cpu_count() or 1
+    busy = busy_after - busy_before
+    total = total_after - total_before
+    busy_cpus = cpus * busy / total if total else 0.0
+    return Probe(rates, cpus, busy_cpus, _count_processes())
+
+
+def estimate(collecters, system, duration, max_cpu_percent,
+             max_output_bytes):
+    """
+    Project the cost of collecting with each collecter.
+
+    :param collecters:
+        The collecters to estimate for.
+    :param system:
+        The :class:`Probe` of the system.
+    :param duration:
+        The length of the collection, in seconds.
+    :param max_cpu_percent:
+        The CPU overhead per interface above which a change is recommended.
+    :param max_output_bytes:
+        The output size per interface above which a change is recommended.
+    :return:
+        A list of :class:`Estimate` objects, in the order of the collecters.
+
+    """
+    estimates = []
+    for collecter in collecters:
+        name = type(collecter).__name__
+        rate = collecter.estimate_rate(system)
+        if rate is None:
+            estimates.append(Estimate(name, None, None, None, None, None))
+            continue
+
+        records = int(rate * duration)
+        output_bytes = records * collecter.RECORD_BYTES
+        cpu_percent = 100 * rate * collecter.RECORD_CPU_TIME
+
+        scale = 1.0
+        if max_cpu_percent and cpu_percent > max_cpu_percent:
+            scale = min(scale, max_cpu_percent / cpu_percent)
+        if max_output_bytes and output_bytes > max_output_bytes:
+            scale = min(scale, max_output_bytes / output_bytes)
+        recommendation = None
+        if scale < 1:
+            recommendation = collecter.recommend(scale) or \
+                "reduce the collection time, or collect without it"
+
+        estimates.append(Estimate(name, rate, records, output_bytes,
+                                  cpu_percent, recommendation))
+    return estimates
+
+
+def report(estimates, system, duration, seconds):
+    """
+    Format estimates for the user.
+
+    :param estimates:
+        The :class:`Estimate` objects.
+    :param system:
+        The :class:`Probe` they were made from.
+    :param duration:
+        The length of the collection, in seconds.
+    :param seconds:
+        The length of the probe, in seconds.
+    :return:
+        A list of lines.
+
+    """
+    lines = [
+        "Estimate for {} s, from a {} s probe ({} CPUs, {:.1f} busy, {} "
+        "processes):".format(duration, seconds, system.cpus, system.busy_cpus,
+                             system.processes),
+        "{:<20} {:>12} {:>12} {:>10} {:>7}".format(
+            "Interface", "Records/s", "Records", "Output", "CPU"),
+    ]
+    for item in estimates:
+        if item.rate is None:
+            lines.append("{:<20} {:>12}".format(item.interface,
+                                                "not estimated"))
+            continue
+        lines.append("{:<20} {:>12.1f} {:>12} {:>7.1f} MB {:>6.1f}%".format(
+            item.interface, item.rate, item.records,
+            item.output_bytes / 2 ** 20, item.cpu_percent))
+
+    recommendations = [item for item in estimates
+                       if item.recommendation is not None]
+    if recommendations:
+        lines.append("Recommendations:")
+        lines.extend("  {}: {}".format(item.interface, item.recommendation)
+                     for item in recommendations)
+    return lines
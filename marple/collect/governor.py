@@ -0,0 +1,448 @@
+# -------------------------------------------------------------
+# governor.py - keeps collection within a CPU and memory budget
+# October 2018
+# -------------------------------------------------------------
+
+"""
+Resource governor for collection.
+
+Confines marple and the collection tools it runs to a CPU and memory budget,
+using a cgroup v2 where possible, and otherwise lowering the CPU and I/O
+priority and limiting the data size of the processes.
+While collecting, it monitors the actual usage of marple and its children;
+when the budget is exceeded it first makes the collecters sample less often
+and then drops interfaces, one at a time. A back-off only takes effect in the
+next collection of the collecter, so while it is pending the collecter is not
+backed off again, and staying over budget drops an interface instead.
+In adaptive mode, it also enlarges the tracing buffers of collecters that
+lost too many samples or events, optionally collecting again straight away.
+What it did is recorded in the header of each section, under `annotations`,
+together with the overhead of the collection itself (see
+:mod:`marple.collect.overhead`), which is also totalled per interface.
+
+"""
+
+__all__ = (
+    'Governor',
+)
+
+import asyncio
+import datetime
+import logging
+import os
+import resource
+import subprocess
+
+from marple.collect import overhead
+from marple.common import util
+
+logger = logging.getLogger(__name__)
+logger.debug('Entered module: %s', __name__)
+
+# Root of the cgroup v2 hierarchy
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# Period of the CPU bandwidth limit, in microseconds
+_CPU_PERIOD_US = 100000
+
+# Number of monitoring intervals to wait after acting, before acting again
+_COOLDOWN = 5
+
+
+class Governor:
+    """
+    Confines and monitors collection.
+
+    A budget of 0 is unlimited; with no budget at all the governor does
+    nothing.
+
+    """
+
+    def __init__(self, cpu_percent=0, memory_bytes=0, interval=1,
+                 max_loss_ratio=0, loss_retries=0):
+        """
+        Initialise the governor.
+
+        :param cpu_percent:
+            The CPU budget, in percent of one CPU.
+        :param memory_bytes:
+            The memory budget, in bytes.
+        :param interval:
+            The number of seconds between checks of the usage.
+        :param max_loss_ratio:
+            The proportion of samples or events a collecter may lose before
+            its buffers are enlarged; 0 never enlarges them.
+        :param loss_retries:
+            The number of times to collect again with the enlarged buffers.
+
+        """
+        self.cpu_percent = cpu_percent
+        self.memory_bytes = memory_bytes
+        self.interval = interval
+        self.max_loss_ratio = max_loss_ratio
+        self.loss_retries = loss_retries
+
+        # How the budget is enforced, set by confine()
+        self.confinement = None
+        self.cgroup = None
+        # The actions taken, as dictionaries, in order
+        self.actions = []
+        self.dropped = set()
+        # The collecters backed off since their last collection started
+        self._backed_off = set()
+        # The total overhead of each interface, by interface name
+        self.overhead = {}
+        # The collection running for each collecter or copy of one, and the
+        # collecter it is run for
+        self._tasks = {}
+        self._monitor = None
+
+    @property
+    def enabled(self):
+        """ Whether there is a budget to keep to. """
+        return bool(self.cpu_percent or self.memory_bytes)
+
+    @util.log(logger)
+    def confine(self):
+        """
+        Place this process, and so every collection tool it starts, under the
+        budget.
+
+        :return:
+            A description of the mechanism used.
+
+        """
+        if not self.enabled:
+            return None
+        try:
+            self._confine_cgroup()
+        except OSError as ose:
+            logger.info("Cannot use a cgroup, falling back to rlimits: %s",
+                        ose)
+            self._confine_process()
+        return self.confinement
+
+    def _confine_cgroup(self):
+        """
+        Create a cgroup v2 with the budget and move into it.
+
+        If the cgroup cannot be set up, it is removed again before the error
+        is raised.
+
+        """
+        with open(os.path.join(CGROUP_ROOT, "cgroup.controllers")) as file_:
+            controllers = file_.read().split()
+        if "cpu" not in controllers or "memory" not in controllers:
+            raise OSError("cpu and memory controllers not available")
+        # The limits are only available in the cgroups below the root once
+        # the controllers are enabled for them
+        self._write(CGROUP_ROOT, "cgroup.subtree_control", "+cpu +memory")
+
+        cgroup = os.path.join(CGROUP_ROOT, "marple-{}".format(os.getpid()))
+        os.makedirs(cgroup, exist_ok=True)
+        try:
+            if self.cpu_percent:
+                quota = self.cpu_percent * _CPU_PERIOD_US // 100
+                self._write(cgroup, "cpu.max",
+                            "{} {}".format(quota, _CPU_PERIOD_US))
+            if self.memory_bytes:
+                self._write(cgroup, "memory.max", str(self.memory_bytes))
+            self._write(cgroup, "cgroup.procs", str(os.getpid()))
+        except OSError:
+            try:
+                os.rmdir(cgroup)
+            except OSError as ose:
+                logger.error("Failed to remove cgroup %s: %s", cgroup, ose)
+            raise
+
+        self.cgroup = cgroup
+        self.confinement = "cgroup " + cgroup
+
+    @staticmethod
+    def _write(cgroup, name, value):
+        """ Write a value to a cgroup interface file. """
+        with open(os.path.join(cgroup, name), "w") as file_:
+            file_.write(value)
+
+    def _confine_process(self):
+        """ Lower the priority and limit the data size of this process. """
+        mechanisms = []
+        if self.cpu_percent:
+            os.nice(10)
+            # Idle I/O class; ionice may not be installed
+            if subprocess.call(["ionice", "-c", "3", "-p", str(os.getpid())],
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL) == 0:
+                mechanisms.append("nice 10, ionice idle")
+            else:
+                mechanisms.append("nice 10")
+        if self.memory_bytes:
+            # Limits each process rather than the total
+            resource.setrlimit(resource.RLIMIT_DATA,
+                               (self.memory_bytes, self.memory_bytes))
+            mechanisms.append("RLIMIT_DATA {}".format(self.memory_bytes))
+        self.confinement = ", ".join(mechanisms)
+
+    def release(self):
+        """ Remove the cgroup, if one was created. """
+        if self.cgroup is None:
+            return
+        # A cgroup can only be removed once empty, so move back to the root
+        try:
+            self._write(CGROUP_ROOT, "cgroup.procs", str(os.getpid()))
+            os.rmdir(self.cgroup)
+        except OSError as ose:
+            logger.error("Failed to remove cgroup %s: %s", self.cgroup, ose)
+        self.cgroup = None
+
+    def usage(self):
+        """
+        :return:
+            The CPU time used so far, in seconds, and the memory currently
+            used, in bytes, by marple and its children.
+
+        """
+        if self.cgroup is not None:
+            with open(os.path.join(self.cgroup, "cpu.stat")) as file_:
+                stats = dict(line.split() for line in file_)
+            with open(os.path.join(self.cgroup, "memory.current")) as file_:
+                memory = int(file_.read())
+            return int(stats["usage_usec"]) / 1e6, memory
+
+        # Running processes, plus the children that have exited
+        cpu, memory = _process_tree_usage(os.getpid())
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return cpu + children.ru_utime + children.ru_stime, memory
+
+    def _act(self, collecters, reason):
+        """
+        Reduce the overhead of the collecters: back off every one that can
+        and has no back-off pending, otherwise drop the last one still
+        running.
+
+        :return:
+            Whether anything was done.
+
+        """
+        active = [collecter for collecter in collecters
+                  if collecter not in self.dropped]
+        changes = []
+        for collecter in active:
+            if collecter in self._backed_off:
+                continue
+            change = collecter.back_off()
+            if change is not None:
+                self._backed_off.add(collecter)
+                changes.append((collecter, "back off: " + change))
+        if not changes and len(active) > 1:
+            collecter = active[-1]
+            self.dropped.add(collecter)
+            for original, task in self._tasks.values():
+                if original is collecter:
+                    task.cancel()
+            changes.append((collecter, "dropped"))
+
+        for collecter, action in changes:
+            self._record(collecter, reason, action)
+        return bool(changes)
+
+    def _record(self, collecter, reason, action):
+        """ Log an action, and keep it for the section headers. """
+        logger.warning("%s: %s %s", reason, type(collecter).__name__, action)
+        self.actions.append({
+            "time": str(datetime.datetime.now()),
+            "reason": reason,
+            "collecter": type(collecter).__name__,
+            "action": action,
+        })
+
+    def _adapt(self, collecter, data):
+        """
+        Enlarge the buffers of a collecter if its data lost too much.
+
+        Buffers are not enlarged while over the memory budget.
+
+        :return:
+            Whether the buffers were enlarged.
+
+        """
+        loss = data.annotations.get("loss")
+        if not self.max_loss_ratio or loss is None or \
+                loss["ratio"] <= self.max_loss_ratio:
+            return False
+        if self.memory_bytes and self.usage()[1] > self.memory_bytes:
+            return False
+        change = collecter.scale_buffers(loss["ratio"])
+        if change is None:
+            return False
+        self._record(collecter, "lost {:.1%} of samples, over {:.1%}".format(
+            loss["ratio"], self.max_loss_ratio), "buffers: " + change)
+        return True
+
+    def _over_budget(self, cpu_percent, memory):
+        """ :return: The reason the usage is over budget, or None. """
+        if self.cpu_percent and cpu_percent > self.cpu_percent:
+            return "CPU {:.0f}% over budget of {}%".format(cpu_percent,
+                                                          self.cpu_percent)
+        if self.memory_bytes and memory > self.memory_bytes:
+            return "memory {} bytes over budget of {}".format(
+                memory, self.memory_bytes)
+        return None
+
+    async def _run_monitor(self, collecters):
+        """ Check the usage every interval, acting when over budget. """
+        loop = asyncio.get_event_loop()
+        last_time, (last_cpu, _) = loop.time(), self.usage()
+        wait = 0
+        while True:
+            await asyncio.sleep(self.interval)
+            now, (cpu, memory) = loop.time(), self.usage()
+            cpu_percent = 100 * (cpu - last_cpu) / (now - last_time)
+            last_time, last_cpu = now, cpu
+
+            if wait > 0:
+                wait -= 1
+                continue
+            reason = self._over_budget(cpu_percent, memory)
+            if reason is not None and self._act(collecters, reason):
+                # Give the change time to take effect
+                wait = _COOLDOWN
+
+    def start(self, collecters):
+        """
+        Start monitoring the usage, in the current event loop.
+
+        :param collecters:
+            The collecters to back off or drop, least important last.
+
+        """
+        if self.enabled:
+            self._monitor = asyncio.ensure_future(
+                self._run_monitor(collecters))
+
+    def stop(self):
+        """ Stop monitoring the usage. """
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+
+    async def collect(self, collecter, original=None):
+        """
+        Collect data from a collecter, unless it has been dropped.
+
+        If the collecter lost too much, its buffers are enlarged and, up to
+        the number of retries, its data is collected again.
+        The data is annotated with the confinement and the actions taken so
+        far, the overhead of the collection, and the scope it was limited to.
+
+        :param collecter:
+            The collecter to collect data from.
+        :param original:
+            If the collecter is a copy (see :meth:`Collecter.clone`), the
+            collecter it was copied from, which is the one monitored: dropping
+            it cancels the copy, and its buffers are the ones enlarged, a
+            retry collecting from a new copy.
+        :return:
+            The data object, or None if the collecter was dropped.
+
+        """
+        if original is None:
+            original = collecter
+        attempt = 0
+        while True:
+            data = await self._collect_once(collecter, original)
+            if data is None:
+                return None
+            if not self._adapt(original, data) or \
+                    attempt >= self.loss_retries:
+                break
+            attempt += 1
+            if collecter is not original:
+                collecter = original.clone()
+            logger.info("Collecting again with %s", collecter)
+
+        data.annotations["overhead"] = collecter.overhead.as_dict()
+        if not collecter.scope.system_wide:
+            data.annotations["scope"] = collecter.scope.as_dict()
+        if self.enabled or self.actions:
+            data.annotations["governor"] = {
+                "confinement": self.confinement,
+                "actions": list(self.actions),
+            }
+        return data
+
+    async def _collect_once(self, collecter, original):
+        """
+        Collect data from a collecter, unless it (or the collecter it is a
+        copy of) is or gets dropped.
+
+        :return:
+            The data object, or None if the collecter was dropped.
+
+        """
+        if original in self.dropped:
+            return None
+        # This collection uses the options backed off to so far
+        self._backed_off.discard(original)
+        collecter.overhead = overhead.Overhead()
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        task = asyncio.ensure_future(collecter.collect())
+        self._tasks[collecter] = (original, task)
+        try:
+            data = await task
+        except asyncio.CancelledError:
+            if task.cancelled() and original in self.dropped:
+                return None
+            raise
+        finally:
+            del self._tasks[collecter]
+
+        collecter.overhead.finish(loop.time() - start)
+        self.overhead.setdefault(data.interface.value, overhead.Overhead()) \
+            .add(collecter.overhead)
+        return data
+
+    def overhead_summary(self):
+        """
+        :return:
+            A line for each interface, with the total overhead of its
+            collections so far.
+
+        """
+        return ["{}: {}".format(interface, total)
+                for interface, total in sorted(self.overhead.items())]
+
+
+def _process_tree_usage(pid):
+    """
+    Get the CPU time and memory used by a process and its descendants.
+
+    :param pid:
+        The process ID of the root of the tree.
+    :return:
+        The CPU time, in seconds, and the resident memory, in bytes.
+
+    """
+    clock_ticks = os.sysconf("SC_CLK_TCK")
+    page_size = resource.getpagesize()
+    cpu, memory = 0.0, 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open("/proc/{}/stat".format(pid)) as file_:
+                # Skip the command name, which may contain spaces
+                fields = file_.read().rsplit(")", 1)[1].split()
+            with open("/proc/{}/statm".format(pid)) as file_:
+                memory += int(file_.read().split()[1]) * page_size
+            for tid in os.listdir("/proc/{}/task".format(pid)):
+                with open("/proc/{}/task/{}/children".format(pid, tid)) \
+                        as file_:
+                    pids.extend(int(child) for child in file_.read().split())
+        except (OSError, IndexError, ValueError):
+            # The process exited meanwhile
+            continue
+        # utime and stime are fields 14 and 15 of the stat file
+        cpu += (int(fields[11]) + int(fields[12])) / clock_ticks
+    return cpu, memory
@@ -4,7 +4,163 @@
 # -------------------------------------------------------------
 
 from typing import NamedTuple
+import asyncio
+import copy
 import datetime
+import itertools
+import os
+import signal
+
+from marple.collect import governor, overhead
+
+# Numbers the copies of collecters made by Collecter.clone
+_copy_ids = itertools.count(1)
+
+
+class Scope(NamedTuple):
+    """
+    The processes a collection is limited to; empty is system-wide.
+
+    Each collecter translates the scope into the native filter of its tool.
+    The processes and the cgroup, when both given, must both match.
+
+    .. attribute:: pids:
+        The IDs of the processes to collect from.
+    .. attribute:: cgroup:
+        A cgroup v2 to collect from, as its path below the cgroup root.
+    .. attribute:: comm:
+        The command name the processes were chosen by, if any; see
+        :meth:`resolve`.
+
+    """
+    pids: tuple = ()
+    cgroup: str = None
+    comm: str = None
+
+    @property
+    def system_wide(self):
+        """ Whether the scope does not limit collection. """
+        return not self.pids and self.cgroup is None
+
+    def cgroup_path(self):
+        """ :return: The path of the cgroup directory, or None. """
+        if self.cgroup is None:
+            return None
+        return os.path.join(governor.CGROUP_ROOT, self.cgroup.strip("/"))
+
+    def resolve(self):
+        """
+        Add the processes currently running the command name to the pids.
+
+        :return:
+            The resolved scope.
+        :raises ValueError:
+            If no process is running the command.
+
+        """
+        if self.comm is None:
+            return self
+        matches = set()
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                with open(os.path.join("/proc", name, "comm")) as file_:
+                    comm = file_.read().rstrip("\n")
+            except OSError:
+                # The process exited meanwhile
+                continue
+            if comm == self.comm:
+                matches.add(int(name))
+        if not matches:
+            raise ValueError("No process named {}".format(self.comm))
+        return self._replace(pids=tuple(sorted(matches | set(self.pids))))
+
+    def processes(self):
+        """
+        :return:
+            A sorted list of the IDs of the processes currently in scope, for
+            tools that cannot follow a cgroup themselves.
+
+        """
+        pids = set(self.pids)
+        if self.cgroup is not None:
+            with open(os.path.join(self.cgroup_path(), "cgroup.procs")) \
+                    as file_:
+                members = {int(pid) for pid in file_.read().split()}
+            pids = pids & members if pids else members
+        return sorted(pids)
+
+    def threads(self):
+        """ :return: The IDs of the threads of the processes in scope. """
+        tids = []
+        for pid in self.processes():
+            try:
+                tids.extend(int(tid) for tid in
+                            os.listdir("/proc/{}/task".format(pid)))
+            except OSError:
+                # The process exited meanwhile
+                continue
+        return sorted(tids)
+
+    def as_dict(self):
+        """ :return: The scope, as a dictionary for a section header. """
+        return {"pids": list(self.pids), "cgroup": self.cgroup,
+                "comm": self.comm}
+
+
+def kill_process_tree(pid):
+    """
+    Kill a process and all its descendants, e.g. the tool run by sudo or a
+    shell.
+
+    The whole tree is found before anything is killed, as the children of a
+    killed process are moved to init.
+
+    :param pid:
+        The process ID of the root of the tree.
+
+    """
+    pids = [pid]
+    for parent in pids:
+        try:
+            for tid in os.listdir("/proc/{}/task".format(parent)):
+                with open("/proc/{}/task/{}/children".format(parent, tid)) \
+                        as file_:
+                    pids.extend(int(child) for child in file_.read().split())
+        except OSError:
+            # The process exited meanwhile
+            continue
+    for process in pids:
+        try:
+            os.kill(process, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+async def await_tool(sub_process, awaitable):
+    """
+    Await an operation on a collection tool, such as its communicate().
+
+    If the collection is cancelled meanwhile, e.g. when the governor drops
+    the collecter, the tool and the processes it started are killed and
+    reaped before the cancellation is passed on, so that nothing keeps
+    tracing.
+
+    :param sub_process:
+        The asyncio subprocess running the tool.
+    :param awaitable:
+        The operation to await.
+    :return:
+        The result of the operation.
+
+    """
+    try:
+        return await awaitable
+    except asyncio.CancelledError:
+        kill_process_tree(sub_process.pid)
+        await sub_process.wait()
+        raise
 
 
 class Collecter:
@@ -18,10 +174,25 @@ class Collecter:
     A set of default options should also ideally be specified.
     The data collection functionality should be carried out in the collect()
     method.
+    CPU-heavy conversion of the raw data can be declared as a parse function
+    (see :meth:`_parse`), so that it runs off the event loop.
 
     """
     _DEFAULT_OPTIONS = None
 
+    # Picklable (module-level) function converting the raw data to a list of
+    # datum objects, called as `_PARSE_FUNCTION(raw_data, options)`.
+    # Must be wrapped in staticmethod().
+    _PARSE_FUNCTION = None
+
+    # perf events (e.g. tracepoints) each of which becomes about one record,
+    # counted by the pre-flight estimator
+    PROBE_EVENTS = ()
+    # Rough cost of each record: the bytes of output from the collection
+    # tool, and the seconds of CPU time to trace and parse it
+    RECORD_BYTES = 0
+    RECORD_CPU_TIME = 0.0
+
     # Start and end times of data recording
     start_time: datetime.datetime
     end_time: datetime.datetime
@@ -38,6 +209,15 @@ class Collecter:
         """
         self.time = time
         self.options = options
+        # Executor to run the parse function in, shared between collecters;
+        # None uses the event loop's default executor
+        self.executor = None
+        # The cost of collection, charged by the collecter as it runs
+        self.overhead = overhead.Overhead()
+        # The processes to collect from
+        self.scope = Scope()
+        # 0 for a collecter, a unique number for each copy made by clone()
+        self.copy_id = 0
 
     class Options(NamedTuple):
         """ Any options that may be passed in to the collecter."""
@@ -50,6 +230,109 @@ class Collecter:
         """ Convert the raw data to standard datum types and yield it """
         pass
 
+    async def _parse(self, raw_data):
+        """
+        Convert the raw data to standard datum types in the executor.
+
+        Runs the parse function in :attr:`executor`, so that the event loop can
+        keep serving the other collecters meanwhile, and several collecters
+        can parse in parallel when the executor is a process pool.
+        The CPU time taken is charged to :attr:`overhead`.
+
+        :param raw_data:
+            The (picklable) raw data from the collection tool.
+        :return:
+            A list of datum objects.
+
+        """
+        loop = asyncio.get_event_loop()
+        datums, cpu_time = await loop.run_in_executor(
+            self.executor, overhead.run_timed, self._PARSE_FUNCTION, raw_data,
+            self.options)
+        self.overhead.add_parse_time(cpu_time)
+        return datums
+
+    def estimate_rate(self, probe):
+        """
+        Estimate how many records a second collection would produce.
+
+        By default, the sum of the rates of the probe events; if any of them
+        could not be counted, there is no estimate.
+
+        :param probe:
+            The `estimator.Probe` of the system's activity.
+        :return:
+            The number of records a second, or None if the collecter cannot
+            tell.
+
+        """
+        if not self.PROBE_EVENTS or \
+                any(event not in probe.rates for event in self.PROBE_EVENTS):
+            return None
+        return sum(probe.rates[event] for event in self.PROBE_EVENTS)
+
+    def recommend(self, scale):
+        """
+        Suggest options for collection to produce fewer records.
+
+        Called by the pre-flight estimator; the options are not changed.
+
+        :param scale:
+            The proportion of the records currently estimated to aim for.
+        :return:
+            A description of the suggested options, or None if there are no
+            options to tune.
+
+        """
+        return None
+
+    def back_off(self):
+        """
+        Reduce the overhead of later collections, e.g. by sampling less often.
+
+        Called by the resource governor when collection exceeds its budget.
+
+        :return:
+            A description of the change, or None if the collecter cannot back
+            off (any further).
+
+        """
+        return None
+
+    def scale_buffers(self, loss_ratio):
+        """
+        Enlarge the tracing buffers of later collections, so that fewer
+        samples or events are lost.
+
+        Called by the resource governor when a collection lost too many.
+
+        :param loss_ratio:
+            The proportion of samples or events lost in the last collection.
+        :return:
+            A description of the change, or None if the collecter has no
+            buffers to enlarge (any further).
+
+        """
+        return None
+
+    def clone(self):
+        """
+        Make a copy of the collecter, with its current time, options and
+        scope, that can collect while the collecter (or another copy) is still
+        collecting or processing its data.
+
+        Collecters using a fixed resource, such as a file, give each copy its
+        own, according to :attr:`copy_id`.
+
+        :return:
+            The copy.
+
+        """
+        copy_ = copy.copy(self)
+        copy_.copy_id = next(_copy_ids)
+        copy_.overhead = overhead.Overhead()
+        return copy_
+
     async def collect(self):
         """
         Overall collection: collect data asynchronously and return it as
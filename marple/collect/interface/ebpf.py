@@ -9,16 +9,21 @@ Interacts with the several bcc tools to collect data using eBPF
 """
 
 __all__ = (
+    "DiskLatencyHistogram",
+    "MallocSession",
     "MallocStacks",
     "Memleak",
-    "TCPTracer"
+    "TCPTracer",
+    "share_malloc_session"
 )
 
 import asyncio
 import datetime
 import logging
+import math
 import os
 import re
+import shlex
 import signal
 import typing
 from io import StringIO
@@ -32,43 +37,210 @@ logger.debug('Entered module: %s', __name__)
 
 BCC_TOOLS_PATH = paths.MARPLE_DIR + "/collect/tools/bcc-tools/"
 
+# Largest stack map the malloc tools are scaled up to, in entries
+MAX_STACK_STORAGE_SIZE = 1 << 16
+
+# Sparsest sampling mallocstacks backs off to, in calls and in bytes
+MAX_SAMPLE_RATE = 1 << 10
+MAX_SAMPLE_BYTES = 1 << 24
+
+# Matches the warning of the malloc tools when their stack map was full
+_missing_stacks = re.compile(r"WARNING: (?P<missing>\d+) stack traces could "
+                             r"not be displayed")
+
+# Matches the count of the allocations memleak and mallocshared traced, and
+# of those missing from the snapshots because their maps were full
+_allocation_counts = re.compile(r"Counted (?P<counted>\d+) allocations, "
+                                r"lost (?P<lost>\d+)")
+
+
+def _scope_args(scope):
+    """
+    :param scope:
+        The :class:`collecter.Scope` of a collection.
+    :return:
+        The arguments limiting the bcc tools to the scope: a list of PIDs,
+        and a cgroup, which are checked in-kernel.
+
+    """
+    args = []
+    if scope.pids:
+        args.extend(('-p', ",".join(map(str, scope.pids))))
+    if scope.cgroup is not None:
+        args.extend(('--cgroup', scope.cgroup_path()))
+    return args
+
+
+def _snapshots(time, options):
+    """
+    :param time:
+        The length of time (in seconds) of the collection.
+    :param options:
+        The :class:`Memleak.Options` of the collection.
+    :return:
+        The interval between snapshots of the outstanding allocations, and
+        their number, the last one being at the end of the collection time.
+
+    """
+    interval = max(1, min(options.snapshot_interval, time))
+    return interval, max(1, math.ceil(time / interval))
+
+
+async def _read_lines(sub_process, account):
+    """
+    Read the output of a tool line by line as it is printed, and wait for the
+    tool to exit.
+
+    :param sub_process:
+        The asyncio subprocess running the tool.
+    :param account:
+        The :class:`overhead.Overhead` to charge the output to.
+    :return:
+        The decoded lines of stdout, and the stderr as bytes.
+
+    """
+    err_future = asyncio.ensure_future(sub_process.stderr.read())
+    lines = []
+    while True:
+        line = await sub_process.stdout.readline()
+        if not line:
+            break
+        account.add_output(len(line))
+        lines.append(line.decode())
+
+    await sub_process.wait()
+    return lines, await err_future
+
+
+def _count_missing_stacks(err):
+    """
+    :param err:
+        The stderr of mallocstacks or mallocshared.
+    :return:
+        The number of stacks the tool could not store.
+
+    """
+    match = _missing_stacks.search(err)
+    return int(match.group("missing")) if match else 0
+
+
+def _count_allocations(err):
+    """
+    :param err:
+        The stderr of memleak or mallocshared.
+    :return:
+        The number of allocations counted in the snapshots, and the number
+        lost; None if the tool did not report them.
+
+    """
+    match = _allocation_counts.search(err)
+    if match is None:
+        return None
+    return int(match.group("counted")), int(match.group("lost"))
+
 
 class MallocStacks(collecter.Collecter):
     """
     Class that interacts with Brendan Gregg's mallocstacks tool.
 
     Collects allocations done by malloc calls and shows the call stack.
+    Calls can be sampled in-kernel to reduce the overhead on allocation-heavy
+    processes; the weights are scaled back up by the tool.
 
     """
 
     class Options(typing.NamedTuple):
-        """ No options for this collecter class. """
-        pass
+        """
+        Options to use in the collection:
+            - sample_rate: only record every N-th malloc call of each thread
+            - sample_bytes: if nonzero, record a stack each time a thread
+                            crosses a multiple of this many allocated bytes
+                            (takes precedence over sample_rate)
+            - stack_storage_size: the number of stacks the tool can store
 
-    _DEFAULT_OPTIONS = None
+        """
+        sample_rate: int
+        sample_bytes: int
+        stack_storage_size: int = 2048
+
+    _DEFAULT_OPTIONS = Options(sample_rate=1, sample_bytes=0,
+                               stack_storage_size=2048)
 
     @util.check_kernel_version("4.6")
     def __init__(self, time, options=_DEFAULT_OPTIONS):
         """ Initialise the collecter (see superclass). """
         super().__init__(time, options)
+        # Set by share_malloc_session when running alongside Memleak
+        self.session = None
+        # Stacks lost in the last collection because the stack map was full
+        self.lost = 0
+
+    @util.Override(collecter.Collecter)
+    def back_off(self):
+        """ Halve the sampling rate, down to a limit (see superclass). """
+        if self.options.sample_bytes > 0:
+            field, limit = "sample_bytes", MAX_SAMPLE_BYTES
+        else:
+            field, limit = "sample_rate", MAX_SAMPLE_RATE
+        value = getattr(self.options, field)
+        if value >= limit:
+            return None
+        scaled = min(value * 2, limit)
+        self.options = self.options._replace(**{field: scaled})
+        if self.session is not None:
+            self.session.stacks_options = self.options
+        return "{} {} -> {}".format(field, value, scaled)
+
+    @util.Override(collecter.Collecter)
+    def scale_buffers(self, loss_ratio):
+        """ Enlarge the stack map (see superclass). """
+        size = self.options.stack_storage_size
+        # At least double, or enough to have held the stacks lost
+        scaled = min(max(2 * size, int(size / max(1 - loss_ratio, 0.01))),
+                     MAX_STACK_STORAGE_SIZE)
+        if scaled <= size:
+            return None
+        self.options = self.options._replace(stack_storage_size=scaled)
+        if self.session is not None:
+            self.session.stacks_options = self.options
+        return "stack_storage_size {} -> {}".format(size, scaled)
 
     @util.log(logger)
     @util.Override(collecter.Collecter)
     async def _get_raw_data(self):
         """ Collect raw data asynchronously using the mallockstacks module. """
+        if self.session is not None:
+            raw_data = await self.session.get_raw_data(
+                InterfaceTypes.MALLOCSTACKS, self.overhead)
+            self.start_time = self.session.start_time
+            self.end_time = self.session.end_time
+            self.lost = self.session.missing_stacks
+            return raw_data
+
         self.start_time = datetime.datetime.now()
 
+        if self.options.sample_bytes > 0:
+            sample_args = ('-b', str(self.options.sample_bytes))
+        else:
+            sample_args = ('-s', str(self.options.sample_rate))
+
         sub_process = await asyncio.create_subprocess_exec(
             'sudo', 'python', BCC_TOOLS_PATH + 'mallocstacks.py', '-f',
+            *sample_args, '--stack-storage-size',
+            str(self.options.stack_storage_size), *_scope_args(self.scope),
             str(self.time),
             stderr=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
         )
-        out, err = await sub_process.communicate()
+        self.overhead.track(sub_process)
+        out, err = await collecter.await_tool(sub_process,
+                                              sub_process.communicate())
+        self.overhead.add_output(len(out))
 
         self.end_time = datetime.datetime.now()
         if sub_process.returncode != 0:
             raise exceptions.SubprocessedErorred(err.decode())
 
+        self.lost = _count_missing_stacks(err.decode())
         return StringIO(out.decode())
 
     @util.log(logger)
@@ -94,10 +266,13 @@ class MallocStacks(collecter.Collecter):
             return data_io.StackData(None, -1, -1,
                                      InterfaceTypes.MALLOCSTACKS, None)
 
+        recorded = raw_data.getvalue().count("\n")
         data = self._get_generator(raw_data)
         data_options = data_io.StackData.DataOptions("kilobytes")
-        return data_io.StackData(data, self.start_time, self.end_time,
+        data = data_io.StackData(data, self.start_time, self.end_time,
                                  InterfaceTypes.MALLOCSTACKS, data_options)
+        data.record_loss(self.lost, recorded)
+        return data
 
 
 class Memleak(collecter.Collecter):
@@ -107,6 +282,8 @@ class Memleak(collecter.Collecter):
     Collects all the top 'top_processes' processes with outstanding allocations,
     together with their sizes. Only collects outstanding alocations that happen
     after the collection begins.
+    A snapshot is taken every 'snapshot_interval' seconds and read as soon as
+    memleak prints it; the time of each snapshot is the base of its stacks.
 
     """
 
@@ -114,35 +291,57 @@ class Memleak(collecter.Collecter):
         """
         Options to use in the collection:
             - top_processes: how many processes to be displayed
+            - snapshot_interval: seconds between snapshots
 
         """
         top_processes: int
+        snapshot_interval: int
 
-    _DEFAULT_OPTIONS = Options(top_processes=10)
+    _DEFAULT_OPTIONS = Options(top_processes=10, snapshot_interval=5)
 
     @util.check_kernel_version("4.2")
     def __init__(self, time, options=_DEFAULT_OPTIONS):
         """ Initialise the collecter (see superclass). """
         super().__init__(time, options)
+        # Set by share_malloc_session when running alongside MallocStacks
+        self.session = None
+        # The allocations counted and lost in the last collection, if known
+        self.allocations = None
 
     @util.log(logger)
     @util.Override(collecter.Collecter)
     async def _get_raw_data(self):
         """ Get raw data asynchronously using memleak.py """
+        if self.session is not None:
+            raw_data = await self.session.get_raw_data(InterfaceTypes.MEMLEAK,
+                                                        self.overhead)
+            self.start_time = self.session.start_time
+            self.end_time = self.session.end_time
+            self.allocations = self.session.allocations
+            return raw_data
+
+        interval, count = _snapshots(self.time, self.options)
+
         self.start_time = datetime.datetime.now()
 
         sub_process = await asyncio.create_subprocess_exec(
             'sudo', 'python', BCC_TOOLS_PATH + 'memleak.py',
-            '-t', str(self.time), '-T', str(self.options.top_processes),
+            '-T', str(self.options.top_processes), *_scope_args(self.scope),
+            '-d', str(max(self.time, interval)), str(interval), str(count),
             stderr=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
         )
+        self.overhead.track(sub_process)
 
-        out, err = await sub_process.communicate()
+        # Drain the snapshots as they are printed, rather than buffering the
+        # whole output until memleak exits
+        lines, err = await collecter.await_tool(
+            sub_process, _read_lines(sub_process, self.overhead))
         self.end_time = datetime.datetime.now()
         if sub_process.returncode != 0:
             raise exceptions.SubprocessedErorred(err.decode())
 
-        return StringIO(out.decode())
+        self.allocations = _count_allocations(err.decode())
+        return lines
 
     @util.log(logger)
     @util.Override(collecter.Collecter)
@@ -163,9 +362,290 @@ class Memleak(collecter.Collecter):
                                      InterfaceTypes.MEMLEAK, None)
 
         data = self._get_generator(raw_data)
-        data_options = data_io.StackData.DataOptions("kilobytes")
-        return data_io.StackData(data, self.start_time, self.end_time,
+        # Each snapshot holds all the allocations outstanding at its time
+        data_options = data_io.StackData.DataOptions("kilobytes",
+                                                     snapshots=True)
+        data = data_io.StackData(data, self.start_time, self.end_time,
                                  InterfaceTypes.MEMLEAK, data_options)
+        if self.allocations is not None:
+            counted, lost = self.allocations
+            data.record_loss(lost, counted)
+        return data
+
+
+class MallocSession:
+    """
+    A single bcc session tracing the libc allocator on behalf of both the
+    :class:`MallocStacks` and :class:`Memleak` collecters.
+
+    Uses the mallocshared tool, which installs one set of uprobes/uretprobes
+    and reports both the bytes allocated by stack and the outstanding
+    allocations by process, so every allocation only traps once.
+    Each collection runs the tool once: the first collecter to ask for its
+    data starts a run, and the other collecter waits for the same run. Once
+    the run is over, the next request starts a new one.
+
+    """
+    # Lines introducing each section of the mallocshared output
+    _SECTION_MARKERS = {
+        "[" + InterfaceTypes.MALLOCSTACKS.value + "]":
+            InterfaceTypes.MALLOCSTACKS,
+        "[" + InterfaceTypes.MEMLEAK.value + "]": InterfaceTypes.MEMLEAK,
+    }
+
+    def __init__(self, time, stacks_options, memleak_options,
+                 scope=collecter.Scope()):
+        """
+        Initialise the session.
+
+        :param time:
+            The length of time (in seconds) for which data should be collected.
+        :param stacks_options:
+            The :class:`MallocStacks.Options` for the stack report.
+        :param memleak_options:
+            The :class:`Memleak.Options` for the outstanding allocations report.
+        :param scope:
+            The :class:`collecter.Scope` of the processes to trace.
+
+        """
+        self.time = time
+        self.stacks_options = stacks_options
+        self.memleak_options = memleak_options
+        self.scope = scope
+        self.start_time = None
+        self.end_time = None
+        # Stacks lost because the stack map was full
+        self.missing_stacks = 0
+        # The allocations counted and lost in the snapshots, if known
+        self.allocations = None
+        self._task = None
+        # The number of collecters waiting for the tool
+        self._waiting = 0
+
+    async def _run(self, account):
+        """
+        Run the mallocshared tool and split its output by section.
+
+        :param account:
+            The :class:`overhead.Overhead` to charge the tool to.
+
+        :return:
+            A dict mapping interface types to the raw output lines for them.
+
+        """
+        if self.stacks_options.sample_bytes > 0:
+            sample_args = ('-b', str(self.stacks_options.sample_bytes))
+        else:
+            sample_args = ('-s', str(self.stacks_options.sample_rate))
+        interval, count = _snapshots(self.time, self.memleak_options)
+
+        self.start_time = datetime.datetime.now()
+        sub_process = await asyncio.create_subprocess_exec(
+            'sudo', 'python', BCC_TOOLS_PATH + 'mallocshared.py',
+            *sample_args, '-T', str(self.memleak_options.top_processes),
+            '--stack-storage-size',
+            str(self.stacks_options.stack_storage_size),
+            '-i', str(interval), '-c', str(count), *_scope_args(self.scope),
+            str(max(self.time, interval)),
+            stderr=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+        )
+        account.track(sub_process)
+        out, err = await collecter.await_tool(sub_process,
+                                              sub_process.communicate())
+        account.add_output(len(out))
+
+        self.end_time = datetime.datetime.now()
+        if sub_process.returncode != 0:
+            raise exceptions.SubprocessedErorred(err.decode())
+
+        self.missing_stacks = _count_missing_stacks(err.decode())
+        self.allocations = _count_allocations(err.decode())
+        return self._split_sections(out.decode())
+
+    @classmethod
+    def _split_sections(cls, output):
+        """
+        Split the mallocshared output into its sections.
+
+        :param output:
+            The decoded stdout of the tool.
+        :return:
+            A dict mapping interface types to lists of lines.
+
+        """
+        sections = {interface: [] for interface in
+                    cls._SECTION_MARKERS.values()}
+        current = None
+        for line in output.splitlines(keepends=True):
+            marker = line.strip()
+            if marker in cls._SECTION_MARKERS:
+                current = sections[cls._SECTION_MARKERS[marker]]
+            elif current is not None and marker:
+                current.append(line)
+        return sections
+
+    @util.log(logger)
+    async def get_raw_data(self, interface, account):
+        """
+        Get the raw data for one of the collecters sharing the session.
+
+        Starts the tool unless a run is already in progress, charging it to
+        the caller's account; calls made during the run wait for it, so a
+        finished run is never handed out again.
+        A caller being cancelled only stops the tool if no other collecter is
+        waiting for it.
+
+        :param interface:
+            The interface type of the collecter asking for its data.
+        :param account:
+            The :class:`overhead.Overhead` of the collecter.
+        :return:
+            The raw output for that interface, as a StringIO object.
+
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run(account))
+        self._waiting += 1
+        try:
+            sections = await asyncio.shield(self._task)
+        except asyncio.CancelledError:
+            if self._waiting == 1:
+                self._task.cancel()
+            raise
+        finally:
+            self._waiting -= 1
+        return StringIO("".join(sections[interface]))
+
+
+def share_malloc_session(collecters):
+    """
+    Make the malloc-tracing collecters share a single bcc session.
+
+    If both a :class:`MallocStacks` and a :class:`Memleak` collecter are to be
+    run, they are given the same :class:`MallocSession`; otherwise nothing
+    changes.
+
+    :param collecters:
+        The collecter instances that will be run together.
+
+    """
+    stacks = [collecter_ for collecter_ in collecters
+              if isinstance(collecter_, MallocStacks)]
+    memleaks = [collecter_ for collecter_ in collecters
+                if isinstance(collecter_, Memleak)]
+    if not stacks or not memleaks:
+        return
+
+    session = MallocSession(stacks[0].time, stacks[0].options,
+                            memleaks[0].options, stacks[0].scope)
+    for collecter_ in stacks + memleaks:
+        collecter_.session = session
+
+
+class DiskLatencyHistogram(collecter.Collecter):
+    """
+    Collect disk latency histograms using the disklathist tool.
+
+    Latencies are counted in-kernel in log2 (or linear) histograms keyed by
+    time bucket, disk and process, which are drained as each bucket
+    completes. Each histogram slot becomes one weighted datapoint, so the
+    amount of data does not depend on the number of I/Os.
+
+    """
+
+    class Options(typing.NamedTuple):
+        """
+        Options to use in the collection:
+            - interval: size of the time buckets, in seconds
+            - linear_us: if nonzero, use linear latency slots of this many
+                         microseconds rather than log2 slots
+
+        """
+        interval: int
+        linear_us: int
+
+    _DEFAULT_OPTIONS = Options(interval=1, linear_us=0)
+
+    # Latencies are counted in-kernel, so the output does not grow with them
+    PROBE_EVENTS = ("block:block_rq_complete",)
+    RECORD_CPU_TIME = 2e-6
+
+    @util.check_kernel_version("4.1")
+    def __init__(self, time, options=_DEFAULT_OPTIONS):
+        """ Initialise the collecter (see superclass). """
+        super().__init__(time, options)
+
+    @util.log(logger)
+    @util.Override(collecter.Collecter)
+    async def _get_raw_data(self):
+        """ Get raw data asynchronously using disklathist.py """
+        self.start_time = datetime.datetime.now()
+
+        sub_process = await asyncio.create_subprocess_exec(
+            'sudo', 'python', BCC_TOOLS_PATH + 'disklathist.py',
+            '-i', str(self.options.interval), '-L', str(self.options.linear_us),
+            *_scope_args(self.scope), str(self.time),
+            stderr=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+        )
+        self.overhead.track(sub_process)
+
+        # Each time bucket is printed once complete, so read it then
+        lines, err = await collecter.await_tool(
+            sub_process, _read_lines(sub_process, self.overhead))
+        self.end_time = datetime.datetime.now()
+        if sub_process.returncode != 0:
+            raise exceptions.SubprocessedErorred(err.decode())
+
+        return lines
+
+    @util.log(logger)
+    @util.Override(collecter.Collecter)
+    def _get_generator(self, raw_data):
+        """ Convert raw data to standard datatypes and yield it """
+        for line in raw_data:
+            yield data_io.PointDatum.from_string(line)
+
+    @util.log(logger)
+    @util.Override(collecter.Collecter)
+    async def collect(self):
+        """ Collect data asynchronously using disklathist.py """
+        try:
+            raw_data = await self._get_raw_data()
+        except exceptions.SubprocessedErorred as se:
+            logger.error(str(se))
+            return data_io.PointData(None, -1, -1,
+                                     InterfaceTypes.DISKLATENCY, None)
+
+        data = self._get_generator(raw_data)
+        # Unlike the per-request DISKLATENCY data, each datum is a count
+        data_options = data_io.PointData.DataOptions(
+            x_label="Time bucket", y_label="Latency", x_units="s",
+            y_units="ms", x_bucket=self.options.interval)
+        return data_io.PointData(data, self.start_time, self.end_time,
+                                 InterfaceTypes.DISKLATENCY, data_options)
+
+
+def _resolve_tcp_events(raw_data, options):
+    """
+    Convert raw tcptracer data to events.
+
+    Traverse the data once to build up a dictionary mapping ports to
+    PIDs/comms.
+    Traverse the data again using that dictionary to output events with
+    well-resolved PIDs/comms for ports (hopefully).
+    Print and log error messages when ports cannot be resolved.
+
+    :param raw_data:
+        The raw tcptracer data, as a StringIO object.
+    :param options:
+        The options of the :class:`TCPTracer` collecter.
+    :return:
+        A list of :class:`EventDatum` objects.
+
+    """
+    port_lookup_dict = TCPTracer._generate_dict(raw_data, options)
+    return list(TCPTracer._generate_events(raw_data, port_lookup_dict,
+                                           options))
 
 
 class TCPTracer(collecter.Collecter):
@@ -192,6 +672,15 @@ class TCPTracer(collecter.Collecter):
 
     _DEFAULT_OPTIONS = None
 
+    # Resolve the ports off the event loop
+    _PARSE_FUNCTION = staticmethod(_resolve_tcp_events)
+
+    # Connects, accepts and closes each change the state of a socket, as do
+    # the other steps of a connection; roughly half are reported
+    PROBE_EVENTS = ("sock:inet_sock_set_state",)
+    RECORD_BYTES = 75
+    RECORD_CPU_TIME = 10e-6
+
     @util.check_kernel_version("4.2")
     def __init__(self, time, options=_DEFAULT_OPTIONS):
         """ Initialise the collecter (see superclass). """
@@ -209,22 +698,27 @@ class TCPTracer(collecter.Collecter):
 
         """
         cmd = BCC_TOOLS_PATH + 'tcptracer ' + '-tv'
+        # The command is run by the shell, so the arguments are quoted
+        cmd += "".join(" " + shlex.quote(arg)
+                       for arg in _scope_args(self.scope))
 
         self.start_time = datetime.datetime.now()
         sub_process = await asyncio.create_subprocess_shell(
             cmd, stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE, preexec_fn=os.setsid
         )
+        self.overhead.track(sub_process)
 
         # Timeout the subprocess
-        _, pending = await asyncio.wait(
+        _, pending = await collecter.await_tool(sub_process, asyncio.wait(
             [asyncio.ensure_future(sub_process.communicate())],
             timeout=self.time
-        )
+        ))
         self.end_time = datetime.datetime.now()
         os.killpg(sub_process.pid, signal.SIGINT)
 
-        out, err = await (pending.pop())
+        out, err = await collecter.await_tool(sub_process, pending.pop())
+        self.overhead.add_output(len(out))
         # Check for unexpected errors
         # We expect tcptracer to print a stack trace on termination -
         # anything more than that must be logged
@@ -236,26 +730,6 @@ class TCPTracer(collecter.Collecter):
 
         return StringIO(out.decode())
 
-    @util.log(logger)
-    @util.Override(collecter.Collecter)
-    def _get_generator(self, raw_data):
-        """
-        Convert raw data to standard datatypes and yield it.
-
-        Traverse the data once to build up a dictionary mapping ports to
-        PIDs/comms.
-        Traverse the data again using that dictionary to output events with
-        well-resolved PIDs/comms for ports (hopefully).
-        Print and log error messages when ports cannot be resolved.
-
-        :return:
-            A generator of :class:`EventDatum` objects.
-
-        """
-
-        port_lookup_dict = self._generate_dict(raw_data)
-        return self._generate_events(raw_data, port_lookup_dict)
-
     @util.log(logger)
     @util.Override(collecter.Collecter)
     async def collect(self):
@@ -272,17 +746,20 @@ class TCPTracer(collecter.Collecter):
             return data_io.EventData(None, -1, -1,
                                      InterfaceTypes.TCPTRACE, None)
 
-        data = self._get_generator(raw_data)
+        data = iter(await self._parse(raw_data))
         return data_io.EventData(data, self.start_time, self.end_time,
                                  InterfaceTypes.TCPTRACE)
 
+    @staticmethod
     @util.log(logger)
-    def _generate_dict(self, data):
+    def _generate_dict(data, options):
         """
         Generate a dictionary mapping ports to sets of (PID, comm) pairs.
 
         :param data:
             The raw tcptracer data.
+        :param options:
+            The options of the collecter, used to filter by net namespace.
         :return:
             The port-mapping dictionary.
 
@@ -309,7 +786,7 @@ class TCPTracer(collecter.Collecter):
             # net namespace
             if not source_addr.startswith("127.") or \
                not dest_addr.startswith("127.") or \
-               self.options and self.options.net_ns != net_ns:
+               options and options.net_ns != net_ns:
                 continue
 
             # Add the port data to port_lookup dictionary
@@ -322,8 +799,9 @@ class TCPTracer(collecter.Collecter):
 
         return port_lookup
 
+    @staticmethod
     @util.log(logger)
-    def _generate_events(self, data, port_lookup):
+    def _generate_events(data, port_lookup, options):
         """
         Generate EventDatum objects using tcptracer data and the port-mapping
         generated from that data by _generate_dict
@@ -333,6 +811,8 @@ class TCPTracer(collecter.Collecter):
         :param port_lookup:
             The port-mapping dictionary generated from the raw data by
             _generate_dict
+        :param options:
+            The options of the collecter, used to filter by net namespace.
         :return:
             A generator of :class:`EventDatum` objects.
 
@@ -358,7 +838,7 @@ class TCPTracer(collecter.Collecter):
             # Discard external TCP
             if not source_addr.startswith("127.") or \
                not dest_addr.startswith("127.") or \
-               self.options and self.options.net_ns != net_ns:
+               options and options.net_ns != net_ns:
                 continue
 
             # Get destination PIDs from port_lookup dictionary
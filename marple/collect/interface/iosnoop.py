@@ -6,7 +6,8 @@
 """
 Interacts with the iosnoop tracing tool.
 
-Calls iosnoop to collect disk latency data and format it.
+Calls iosnoop to collect disk latency data and format it, streaming its
+output through a parsing pipeline.
 
 """
 __all__ = (
@@ -16,10 +17,9 @@ __all__ = (
 import asyncio
 import datetime
 import logging
-from io import StringIO
 from typing import NamedTuple
 
-from marple.collect.interface import collecter
+from marple.collect.interface import collecter, pipeline
 from marple.common import data_io, util, paths, exceptions
 from marple.common.consts import InterfaceTypes
 
@@ -29,6 +29,32 @@ logger.debug('Entered module: %s', __name__)
 IOSNOOP_SCRIPT = paths.MARPLE_DIR + "/collect/tools/perf-tools/iosnoop"
 
 
+def _parse_lines(lines, options):
+    """
+    Convert a batch of iosnoop output lines to datum objects.
+
+    :param lines:
+        A list of lines; the header and footer lines are skipped.
+    :param options:
+        Unused.
+    :return:
+        A list of :class:`data_io.PointDatum` objects.
+
+    """
+    datums = []
+    for line in lines:
+        values = line.split()
+        if len(values) < 9:
+            continue  # skip footer lines
+        try:
+            datum = data_io.PointDatum(x=float(values[1]),
+                                       y=float(values[8]), info=values[3])
+        except ValueError:
+            continue  # skip the column headings
+        datums.append(datum)
+    return datums
+
+
 class DiskLatency(collecter.Collecter):
     """ Collect disk latency data using iosnoop. """
 
@@ -52,30 +78,25 @@ class DiskLatency(collecter.Collecter):
         sub_process = await asyncio.create_subprocess_exec(
             IOSNOOP_SCRIPT, '-ts', str(self.time),
             stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        self.overhead.track(sub_process)
 
-        out, err = await sub_process.communicate()
+        sink = pipeline.SpoolSink(data_io.PointDatum)
+        err = await pipeline.run_process(
+            sub_process,
+            [pipeline.Transform(_parse_lines, executor=self.executor)],
+            sink, self.overhead)
 
         self.end_time = datetime.datetime.now()
         if sub_process.returncode != 0:
             raise exceptions.SubprocessedErorred(err.decode())
 
-        return StringIO(out.decode())
+        return sink
 
     @util.log(logger)
     @util.Override(collecter.Collecter)
     def _get_generator(self, raw_data):
-        """ Convert raw data to standard datatypes and yield it. """
-        # Skip two lines of header
-        raw_data.readline()
-        raw_data.readline()
-
-        # Process rest of file
-        for line in raw_data:
-            values = line.split()
-            if len(values) < 9:
-                continue  # skip footer lines
-            yield data_io.PointDatum(x=float(values[1]), y=float(values[8]),
-                                     info=values[3])
+        """ Read the parsed data back from the spool and yield it. """
+        return raw_data.datums()
 
     @util.log(logger)
     @util.Override(collecter.Collecter)
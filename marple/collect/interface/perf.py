@@ -24,10 +24,9 @@ import datetime
 import logging
 import os
 import re
-from io import StringIO
 from typing import NamedTuple
 
-from marple.collect.interface import collecter
+from marple.collect.interface import collecter, pipeline
 from marple.common import data_io, util, exceptions
 from marple.common.consts import InterfaceTypes
 
@@ -38,8 +37,330 @@ logger.debug('Entered module: %s', __name__)
 INCLUDE_TID = False
 INCLUDE_PID = False
 
+# Pages in perf's ring buffer per CPU by default (516kB, less one page for
+# the header), and the most the ring buffers are scaled up to
+_DEFAULT_MMAP_PAGES = 128
+_MAX_MMAP_PAGES = 8192
 
-class MemoryEvents(collecter.Collecter):
+# Samples a second per CPU that perf record takes of an event by default
+_DEFAULT_FREQUENCY = 4000
+
+
+def _collapse_stacks(raw_data, event_filter=""):
+    """
+    Fold the stacks in the output of perf script.
+
+    Defined at module level (rather than as a method) so that it can be
+    pickled and run in a worker process.
+
+    :param raw_data:
+        Lines of output from perf script, ending on a stack boundary.
+    :param event_filter:
+        The event type to keep; empty defaults to the first one encountered.
+    :return:
+        A pair: a list of :class:`data_io.StackDatum` objects, and the event
+        type that was kept.
+
+    """
+    stack_parser = StackParser(raw_data, event_filter)
+    return list(stack_parser.stack_collapse()), stack_parser.event_filter
+
+
+def _is_blank(line):
+    """ Check whether a line of perf script output ends a stack. """
+    return not line.strip()
+
+
+class _StackCollapse(pipeline.Transform):
+    """
+    Pipeline stage folding batches of stacks from perf script.
+
+    Batches are folded in the executor one at a time; the event type the
+    first batch defaulted to is passed on as the options of the later ones,
+    so that they are filtered in the same way.
+
+    """
+
+    def __init__(self, executor):
+        """
+        Initialise the stage.
+
+        :param executor:
+            The executor to fold the stacks in.
+
+        """
+        super().__init__(_collapse_stacks, options="", executor=executor,
+                         name="collapse stacks")
+
+    @util.Override(pipeline.Transform)
+    async def process(self, batch):
+        """ Fold a batch of lines, keeping the event type for the next. """
+        stacks, self.options = await super().process(batch)
+        return stacks
+
+
+class _LostCounter(pipeline.Transform):
+    """
+    Pipeline stage removing the records of lost samples from perf script
+    output, and counting the samples lost.
+
+    Runs on the event loop, as it only looks for a substring in most lines.
+
+    """
+
+    _lost = re.compile(r"PERF_RECORD_LOST(_SAMPLES)?\s+lost\s+(?P<lost>\d+)")
+    # Matches a record of lost samples, printed with --show-lost-events
+    #   e.g. "perf 0 [001] 0.000000: PERF_RECORD_LOST lost 1224"
+
+    def __init__(self):
+        """ Initialise the stage. """
+        super().__init__(None, name="count lost samples")
+        self.lost = 0
+
+    @util.Override(pipeline.Transform)
+    async def process(self, batch):
+        """ Remove the records of lost samples from a batch of lines. """
+        kept = []
+        for line in batch:
+            match = self._lost.search(line) \
+                if "PERF_RECORD_LOST" in line else None
+            if match is None:
+                kept.append(line)
+            else:
+                self.lost += int(match.group("lost"))
+        return kept
+
+
+async def _run_script(command, transform, datum_class, account,
+                      boundary=None):
+    """
+    Run perf script and stream its output through a parsing pipeline.
+
+    The output is read only as fast as it is parsed and spooled to disk, so
+    perf is throttled rather than all of its output being held in memory.
+    Samples lost by perf record are counted rather than parsed.
+
+    :param command:
+        The perf script command line.
+    :param transform:
+        The :class:`pipeline.Transform` converting lines to datum objects.
+    :param datum_class:
+        The class of the datum objects.
+    :param account:
+        The :class:`overhead.Overhead` to charge perf script, its output and
+        the parsing to.
+    :param boundary:
+        See :class:`pipeline.LineSource`.
+    :raises exceptions.SubprocessedErorred:
+        If perf fails.
+    :return:
+        A :class:`pipeline.SpoolSink` holding the datum objects, and the
+        number of samples lost.
+
+    """
+    sub_process = await asyncio.create_subprocess_shell(
+        command + " --show-lost-events",
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    account.track(sub_process)
+
+    lost_counter = _LostCounter()
+    sink = pipeline.SpoolSink(datum_class)
+    err = await pipeline.run_process(sub_process, [lost_counter, transform],
+                                     sink, account, boundary)
+    if sub_process.returncode != 0:
+        raise exceptions.SubprocessedErorred(err.decode())
+
+    return sink, lost_counter.lost
+
+
+class _PerfCollecter(collecter.Collecter):
+    """
+    Base class for the collecters using perf record.
+
+    Keeps count of the samples perf loses, and can enlarge perf's ring
+    buffers when it loses too many.
+
+    """
+
+    def __init__(self, time, options):
+        """ Initialise the collecter (see superclass). """
+        super().__init__(time, options)
+        # Pages in perf's ring buffer per CPU; None for the perf default
+        self.mmap_pages = None
+        # Samples lost in the last collection
+        self.lost = 0
+
+    @property
+    def _data_file(self):
+        """ The name of the perf data file, distinct for each copy. """
+        if not self.copy_id:
+            return self._PERF_FILE_NAME
+        return "{}.{}".format(self._PERF_FILE_NAME, self.copy_id)
+
+    def _mmap_option(self):
+        """ :return: The perf record option sizing the ring buffers. """
+        if self.mmap_pages is None:
+            return ""
+        return " -m " + str(self.mmap_pages)
+
+    def _scope_options(self, system_wide="-a"):
+        """
+        Translate the scope into perf record options.
+
+        Processes are followed with -p, limited to the cgroup if both are
+        given; a cgroup alone is followed by perf itself, system-wide.
+
+        :param system_wide:
+            The target option when not limited to processes.
+        :return:
+            The target option, and the cgroup option (or an empty string),
+            which must follow the events it applies to.
+
+        """
+        if self.scope.pids:
+            pids = self.scope.processes()
+            if not pids:
+                raise exceptions.SubprocessedErorred(
+                    "No process of {} in cgroup {}".format(
+                        self.scope.pids, self.scope.cgroup))
+            return "-p " + ",".join(map(str, pids)), ""
+        if self.scope.cgroup is not None:
+            return system_wide, " -G " + self.scope.cgroup.strip("/")
+        return system_wide, ""
+
+    @util.Override(collecter.Collecter)
+    def scale_buffers(self, loss_ratio):
+        """ Enlarge perf's ring buffers (see superclass). """
+        pages = self.mmap_pages or _DEFAULT_MMAP_PAGES
+        # Enough to have held the samples lost, rounded up to a power of two
+        # as perf requires
+        factor = 2
+        while factor * (1 - loss_ratio) < 1:
+            factor *= 2
+        scaled = min(pages * factor, _MAX_MMAP_PAGES)
+        if scaled <= pages:
+            return None
+        self.mmap_pages = scaled
+        return "mmap pages {} -> {}".format(pages, scaled)
+
+    async def _script(self, command, transform, datum_class, boundary=None):
+        """
+        Run perf script through a parsing pipeline, counting the lost samples
+        in :attr:`lost` (see :func:`_run_script`).
+
+        :return:
+            A :class:`pipeline.SpoolSink` holding the datum objects.
+
+        """
+        try:
+            spool, self.lost = await _run_script(
+                command, transform, datum_class, self.overhead, boundary)
+        except asyncio.CancelledError:
+            self._discard_data_file()
+            raise
+        return spool
+
+    async def _communicate(self, sub_process):
+        """
+        Wait for a perf command to finish; if cancelled, perf is killed and
+        the data file removed (see :func:`collecter.await_tool`).
+
+        :param sub_process:
+            The asyncio subprocess running perf.
+        :return:
+            The stdout and stderr of perf.
+
+        """
+        try:
+            return await collecter.await_tool(sub_process,
+                                              sub_process.communicate())
+        except asyncio.CancelledError:
+            self._discard_data_file()
+            raise
+
+    def _remove_data_file(self):
+        """ Remove the perf data file, charging its size as output. """
+        path = os.getcwd() + "/" + self._data_file
+        self.overhead.add_output(os.path.getsize(path))
+        os.remove(path)
+
+    def _discard_data_file(self):
+        """ Remove the perf data file of a collection that was cancelled. """
+        try:
+            os.remove(os.getcwd() + "/" + self._data_file)
+        except FileNotFoundError:
+            pass
+
+    async def _collapse_script(self):
+        """
+        Run perf script on the recorded stacks.
+
+        :return:
+            A :class:`pipeline.SpoolSink` holding the folded stacks.
+
+        """
+        return await self._script("perf script -i " + self._data_file,
+                                  _StackCollapse(self.executor),
+                                  data_io.StackDatum, boundary=_is_blank)
+
+    def _record_loss(self, data, raw_data):
+        """ Record the samples lost in the header of the data. """
+        data.record_loss(self.lost, raw_data.stats.items_in)
+        return data
+
+
+def _parse_sched_events(raw_data, options=None):
+    """
+    Convert the output of perf sched script to event data.
+
+    :param raw_data:
+        Lines of output from perf sched script.
+    :param options:
+        The options of the collecter (unused).
+    :return:
+        A list of :class:`data_io.EventDatum` objects.
+
+    """
+    events = []
+    for event_data in raw_data:
+        # e.g.   perf a  6997 [003] 363654.881950:       sched:sched_wakeup:
+
+        event_data = event_data.strip()
+
+        match = re.match(r"\s*"
+                         r"(?P<name>\S+(\s+\S+)*)\s+"
+                         r"(?P<pid>\d+)\s+"
+                         r"\[(?P<cpu>\d+)\]\s+"
+                         r"(?P<time>\d+.\d+):\s+"
+                         r"(?P<event>\S+)", event_data)
+
+        # If it did not match, log it but continue
+        if match is None:
+            logger.error("Failed to parse event data: %s Expected "
+                         "format: name pid cpu time event",
+                         event_data)
+            continue
+
+        # Convert time format to us. Perf output: [seconds].[us]
+        time_str = match.group("time").split(".")
+        time_int = int(time_str[0]) * 1000000 + int(time_str[1])
+
+        specific_datum = {'pid': match.group("pid"),
+                          'comm': match.group('name'),
+                          'cpu': match.group('cpu')}
+
+        # Connected is none to specify we have a standalone event with no
+        # connections
+        event = data_io.EventDatum(specific_datum=specific_datum,
+                                   time=time_int, connected=None,
+                                   type=match.group("event"))
+        events.append(event)
+
+    return events
+
+
+class MemoryEvents(_PerfCollecter):
     """ Collect memory load/store events using perf. """
 
     class Options(NamedTuple):
@@ -51,47 +372,62 @@ class MemoryEvents(collecter.Collecter):
     # Name for the file perf generates
     _PERF_FILE_NAME = "memevent_perf.data"
 
+    PROBE_EVENTS = ("mem-loads", "mem-stores")
+
+    # Samples are recorded with call stacks, and symbolised by perf script
+    RECORD_BYTES = 1500
+    RECORD_CPU_TIME = 30e-6
+
     @util.check_kernel_version("2.6")
     def __init__(self, time, options=_DEFAULT_OPTIONS):
         """ Initialise the collecter (see superclass)."""
         super().__init__(time, options)
 
+    @util.Override(collecter.Collecter)
+    def estimate_rate(self, probe):
+        """
+        Estimate the samples a second (see superclass).
+
+        perf samples each event at most at its default frequency, on the
+        CPUs that are busy.
+
+        """
+        rate = super().estimate_rate(probe)
+        if rate is None:
+            return None
+        limit = len(self.PROBE_EVENTS) * _DEFAULT_FREQUENCY * probe.busy_cpus
+        return min(rate, limit)
+
     @util.log(logger)
     @util.Override(collecter.Collecter)
     async def _get_raw_data(self):
         """ Collect raw data asynchronously using perf """
         self.start_time = datetime.datetime.now()
 
+        target, cgroup = self._scope_options()
         sub_process = await asyncio.create_subprocess_shell(
-            "perf record -ag -o " + self._PERF_FILE_NAME +
-            " -e '{mem-loads,mem-stores}' sleep " +
-            str(self.time), stderr=asyncio.subprocess.PIPE
+            "perf record " + target + " -g" + self._mmap_option() + " -o " +
+            self._data_file + " -e '{mem-loads,mem-stores}'" + cgroup +
+            " sleep " + str(self.time), stderr=asyncio.subprocess.PIPE
         )
+        self.overhead.track(sub_process)
 
-        _, err = await sub_process.communicate()
+        _, err = await self._communicate(sub_process)
         self.end_time = datetime.datetime.now()
         if sub_process.returncode != 0:
             raise exceptions.SubprocessedErorred(err.decode())
 
-        sub_process = await asyncio.create_subprocess_shell(
-            "perf script -i " + self._PERF_FILE_NAME,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        out, err = await sub_process.communicate()
-        if sub_process.returncode != 0:
-            raise exceptions.SubprocessedErorred(err.decode())
+        spool = await self._collapse_script()
 
-        os.remove(os.getcwd() + "/" + self._PERF_FILE_NAME)
+        self._remove_data_file()
 
-        return StringIO(out.decode())
+        return spool
 
     @util.log(logger)
     @util.Override(collecter.Collecter)
     def _get_generator(self, raw_data):
-        """ Convert raw data into standard datatypes and yield it """
-        stack_parser = StackParser(raw_data)
-        return stack_parser.stack_collapse()
+        """ Read the parsed data back from the spool and yield it """
+        return raw_data.datums()
 
     @util.log(logger)
     @util.Override(collecter.Collecter)
@@ -113,12 +449,14 @@ class MemoryEvents(collecter.Collecter):
 
         data = self._get_generator(raw_data)
         data_options = data_io.StackData.DataOptions("samples")
-        return data_io.StackData(data, self.start_time, self.end_time,
-                                 InterfaceTypes.MEMEVENTS, data_options)
+        return self._record_loss(
+            data_io.StackData(data, self.start_time, self.end_time,
+                              InterfaceTypes.MEMEVENTS, data_options),
+            raw_data)
 
 
 # TODO: Decide what to do with this, deprecated
-class MemoryMalloc(collecter.Collecter):
+class MemoryMalloc(_PerfCollecter):
     """ Collect malloc stacks using perf. """
 
     class Options(NamedTuple):
@@ -142,44 +480,42 @@ class MemoryMalloc(collecter.Collecter):
         sub_process = await asyncio.create_subprocess_shell(
             "perf probe -q --del *malloc*", stderr=asyncio.subprocess.PIPE
         )
-        _, err = await sub_process.communicate()
+        self.overhead.track(sub_process)
+        _, err = await self._communicate(sub_process)
 
         sub_process = await asyncio.create_subprocess_shell(
             "perf probe -qx /lib*/*/libc.so.* malloc:1 size=%di",
             stderr=asyncio.subprocess.PIPE
         )
-        _, err = await sub_process.communicate()
+        self.overhead.track(sub_process)
+        _, err = await self._communicate(sub_process)
 
         # Record perf data
         self.start_time = datetime.datetime.now()
+        target, cgroup = self._scope_options()
         sub_process = await asyncio.create_subprocess_shell(
-            "perf record -ag -o " + self._PERF_FILE_NAME +
-            " -e probe_libc:malloc: sleep " + str(self.time),
+            "perf record " + target + " -g" + self._mmap_option() + " -o " +
+            self._data_file + " -e probe_libc:malloc:" + cgroup +
+            " sleep " + str(self.time),
             stderr=asyncio.subprocess.PIPE
         )
-        _, err = await sub_process.communicate()
+        self.overhead.track(sub_process)
+        _, err = await self._communicate(sub_process)
         self.end_time = datetime.datetime.now()
         if sub_process.returncode != 0:
             raise exceptions.SubprocessedErorred(err.decode())
 
-        sub_process = await asyncio.create_subprocess_shell(
-            "perf script -i " + self._PERF_FILE_NAME,
-            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-        )
-        out, err = await sub_process.communicate()
-        if sub_process.returncode != 0:
-            raise exceptions.SubprocessedErorred(err.decode())
+        spool = await self._collapse_script()
 
-        os.remove(os.getcwd() + "/" + self._PERF_FILE_NAME)
+        self._remove_data_file()
 
-        return StringIO(out.decode())
+        return spool
 
     @util.log(logger)
     @util.Override(collecter.Collecter)
     def _get_generator(self, raw_data):
-        """ Convert raw data to standard datatypes and yield it"""
-        stack_parser = StackParser(raw_data)
-        return stack_parser.stack_collapse()
+        """ Read the parsed data back from the spool and yield it """
+        return raw_data.datums()
 
     @util.log(logger)
     @util.Override(collecter.Collecter)
@@ -201,11 +537,13 @@ class MemoryMalloc(collecter.Collecter):
 
         data = self._get_generator(raw_data)
         data_options = data_io.StackData.DataOptions("kilobytes")
-        return data_io.StackData(data, self.start_time, self.end_time,
-                                 InterfaceTypes.PERF_MALLOC, data_options)
+        return self._record_loss(
+            data_io.StackData(data, self.start_time, self.end_time,
+                              InterfaceTypes.PERF_MALLOC, data_options),
+            raw_data)
 
 
-class StackTrace(collecter.Collecter):
+class StackTrace(_PerfCollecter):
     """ Collect stack traces using perf. """
 
     class Options(NamedTuple):
@@ -226,46 +564,80 @@ class StackTrace(collecter.Collecter):
 
     _PERF_FILE_NAME = "stacktrace_perf.data"
 
+    # Samples are recorded with call stacks, and symbolised by perf script
+    RECORD_BYTES = 1500
+    RECORD_CPU_TIME = 30e-6
+
     @util.check_kernel_version("2.6")
     def __init__(self, time, options=_DEFAULT_OPTIONS):
         """ Initialise the collecter (see superclass). """
         super().__init__(time, options)
 
+    @util.Override(collecter.Collecter)
+    def estimate_rate(self, probe):
+        """
+        Estimate the samples a second (see superclass).
+
+        Only the CPUs that are busy are sampled, as idle CPUs do not count
+        cycles.
+
+        """
+        return self.options.frequency * probe.busy_cpus
+
+    @util.Override(collecter.Collecter)
+    def recommend(self, scale):
+        """ Suggest a lower sampling frequency (see superclass). """
+        frequency = max(1, int(self.options.frequency * scale))
+        if frequency >= self.options.frequency:
+            return None
+        return "frequency {} -> {} Hz".format(self.options.frequency,
+                                              frequency)
+
+    @util.Override(collecter.Collecter)
+    def back_off(self):
+        """ Halve the sampling frequency (see superclass). """
+        if self.options.frequency <= 1:
+            return None
+        frequency = self.options.frequency // 2
+        change = "frequency {} -> {} Hz".format(self.options.frequency,
+                                                frequency)
+        self.options = self.options._replace(frequency=frequency)
+        return change
+
     @util.log(logger)
     @util.Override(collecter.Collecter)
     async def _get_raw_data(self):
         """ Collect raw data asynchronously using perf """
         self.start_time = datetime.datetime.now()
+        target, cgroup = self._scope_options(self.options.cpufilter)
+        if cgroup:
+            # perf only limits the events given before the cgroup
+            cgroup = " -e cpu-clock" + cgroup
         sub_process = await asyncio.create_subprocess_shell(
             "perf record -F " + str(self.options.frequency) + " " +
-            self.options.cpufilter + " -g -o " + self._PERF_FILE_NAME +
+            target + " -g" + self._mmap_option() + " -o " +
+            self._data_file + cgroup +
             " -- sleep " + str(self.time),
             stderr=asyncio.subprocess.PIPE
         )
+        self.overhead.track(sub_process)
 
-        _, err = await sub_process.communicate()
+        _, err = await self._communicate(sub_process)
         self.end_time = datetime.datetime.now()
         if sub_process.returncode != 0:
             raise exceptions.SubprocessedErorred(err.decode())
 
-        sub_process = await asyncio.create_subprocess_shell(
-            "perf script -i " + self._PERF_FILE_NAME,
-            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-        )
-        out, err = await sub_process.communicate()
-        if sub_process.returncode != 0:
-            raise exceptions.SubprocessedErorred(err.decode())
+        spool = await self._collapse_script()
 
-        os.remove(os.getcwd() + "/" + self._PERF_FILE_NAME)
+        self._remove_data_file()
 
-        return StringIO(out.decode())
+        return spool
 
     @util.log(logger)
     @util.Override(collecter.Collecter)
     def _get_generator(self, raw_data):
-        """ Convert raw data to standard datatypes and yield it """
-        stack_parser = StackParser(raw_data)
-        return stack_parser.stack_collapse()
+        """ Read the parsed data back from the spool and yield it """
+        return raw_data.datums()
 
     @util.log(logger)
     @util.Override(collecter.Collecter)
@@ -287,11 +659,13 @@ class StackTrace(collecter.Collecter):
 
         data = self._get_generator(raw_data)
         data_options = data_io.StackData.DataOptions("samples")
-        return data_io.StackData(data, self.start_time, self.end_time,
-                                 InterfaceTypes.CALLSTACK, data_options)
+        return self._record_loss(
+            data_io.StackData(data, self.start_time, self.end_time,
+                              InterfaceTypes.CALLSTACK, data_options),
+            raw_data)
 
 
-class SchedulingEvents(collecter.Collecter):
+class SchedulingEvents(_PerfCollecter):
     """ Collect scheduling events using perf. """
 
     class Options(NamedTuple):
@@ -302,6 +676,16 @@ class SchedulingEvents(collecter.Collecter):
 
     _PERF_FILE_NAME = "sched_perf.data"
 
+    # The main events recorded by perf sched record
+    PROBE_EVENTS = ("sched:sched_switch", "sched:sched_wakeup",
+                    "sched:sched_wakeup_new", "sched:sched_migrate_task",
+                    "sched:sched_process_fork", "sched:sched_stat_runtime")
+    RECORD_BYTES = 250
+    RECORD_CPU_TIME = 5e-6
+
+    # Match the events with regular expressions off the event loop
+    _PARSE_FUNCTION = staticmethod(_parse_sched_events)
+
     @util.check_kernel_version("2.6")
     def __init__(self, time, options=_DEFAULT_OPTIONS):
         """ Initialise the collecter (see superclass). """
@@ -312,66 +696,36 @@ class SchedulingEvents(collecter.Collecter):
     async def _get_raw_data(self):
         """ Collect raw data asynchronously using perf """
         self.start_time = datetime.datetime.now()
+        # perf sched record adds -a and its events before these options
+        target, cgroup = self._scope_options(system_wide="")
         sub_process = await asyncio.create_subprocess_shell(
-            "perf sched record -o " + self._PERF_FILE_NAME +
+            "perf sched record" + (" " + target if target else "") +
+            self._mmap_option() + " -o " + self._data_file + cgroup +
             " sleep " + str(self.time),
             stderr=asyncio.subprocess.PIPE
         )
-        _, err = await sub_process.communicate()
+        self.overhead.track(sub_process)
+        _, err = await self._communicate(sub_process)
         self.end_time = datetime.datetime.now()
         if sub_process.returncode != 0:
             raise exceptions.SubprocessedErorred(err.decode())
 
-        sub_process = await asyncio.create_subprocess_shell(
-            "perf sched script -i " + self._PERF_FILE_NAME +
+        spool = await self._script(
+            "perf sched script -i " + self._data_file +
             " -F 'comm,pid,cpu,time,event'",
-            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-        )
-        out, err = await sub_process.communicate()
-        if sub_process.returncode != 0:
-            raise exceptions.SubprocessedErorred(err.decode())
+            pipeline.Transform(self._PARSE_FUNCTION, self.options,
+                               self.executor),
+            data_io.EventDatum)
 
-        os.remove(os.getcwd() + "/" + self._PERF_FILE_NAME)
+        self._remove_data_file()
 
-        return StringIO(out.decode())
+        return spool
 
     @util.log(logger)
     @util.Override(collecter.Collecter)
     def _get_generator(self, raw_data):
-        """ Convert raw data to standard datatypes and yield it """
-        for event_data in raw_data:
-            # e.g.   perf a  6997 [003] 363654.881950:       sched:sched_wakeup:
-
-            event_data = event_data.strip()
-
-            match = re.match(r"\s*"
-                             r"(?P<name>\S+(\s+\S+)*)\s+"
-                             r"(?P<pid>\d+)\s+"
-                             r"\[(?P<cpu>\d+)\]\s+"
-                             r"(?P<time>\d+.\d+):\s+"
-                             r"(?P<event>\S+)", event_data)
-
-            # If it did not match, log it but continue
-            if match is None:
-                logger.error("Failed to parse event data: %s Expected "
-                             "format: name pid cpu time event",
-                             event_data)
-                continue
-
-            # Convert time format to us. Perf output: [seconds].[us]
-            time_str = match.group("time").split(".")
-            time_int = int(time_str[0]) * 1000000 + int(time_str[1])
-
-            specific_datum = {'pid': match.group("pid"),
-                              'comm': match.group('name'),
-                              'cpu': match.group('cpu')}
-
-            # Connected is none to specify we have a standalone event with no
-            # connections
-            event = data_io.EventDatum(specific_datum=specific_datum,
-                                       time=time_int, connected=None,
-                                       type=match.group("event"))
-            yield event
+        """ Read the parsed data back from the spool and yield it """
+        return raw_data.datums()
 
     @util.log(logger)
     @util.Override(collecter.Collecter)
@@ -392,11 +746,13 @@ class SchedulingEvents(collecter.Collecter):
                                      InterfaceTypes.SCHEDEVENTS, None)
 
         data = self._get_generator(raw_data)
-        return data_io.EventData(data, self.start_time, self.end_time,
-                                 InterfaceTypes.SCHEDEVENTS)
+        return self._record_loss(
+            data_io.EventData(data, self.start_time, self.end_time,
+                              InterfaceTypes.SCHEDEVENTS),
+            raw_data)
 
 
-class DiskBlockRequests(collecter.Collecter):
+class DiskBlockRequests(_PerfCollecter):
     """ Collect requests for disk blocks using perf. """
 
     class Options(NamedTuple):
@@ -407,6 +763,12 @@ class DiskBlockRequests(collecter.Collecter):
 
     _PERF_FILE_NAME = "diskblockrq_perf.data"
 
+    PROBE_EVENTS = ("block:block_rq_insert",)
+
+    # Samples are recorded with call stacks, and symbolised by perf script
+    RECORD_BYTES = 1500
+    RECORD_CPU_TIME = 30e-6
+
     @util.check_kernel_version("2.6")
     def __init__(self, time, options=_DEFAULT_OPTIONS):
         """ Initialise the collecter (see superclass). """
@@ -417,34 +779,30 @@ class DiskBlockRequests(collecter.Collecter):
     async def _get_raw_data(self):
         """ Collect raw data asynchronously using perf """
         self.start_time = datetime.datetime.now()
+        target, cgroup = self._scope_options()
         sub_process = await asyncio.create_subprocess_shell(
-            "perf record -ag -o " + self._PERF_FILE_NAME +
-            " -e block:block_rq_insert sleep " + str(self.time),
+            "perf record " + target + " -g" + self._mmap_option() + " -o " +
+            self._data_file + " -e block:block_rq_insert" + cgroup +
+            " sleep " + str(self.time),
             stderr=asyncio.subprocess.PIPE
         )
-        _, err = await sub_process.communicate()
+        self.overhead.track(sub_process)
+        _, err = await self._communicate(sub_process)
         self.end_time = datetime.datetime.now()
         if sub_process.returncode != 0:
             raise exceptions.SubprocessedErorred(err.decode())
 
-        sub_process = await asyncio.create_subprocess_shell(
-            "perf script -i " + self._PERF_FILE_NAME,
-            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-        )
-        out, err = await sub_process.communicate()
-        if sub_process.returncode != 0:
-            raise exceptions.SubprocessedErorred(err.decode())
+        spool = await self._collapse_script()
 
-        os.remove(os.getcwd() + "/" + self._PERF_FILE_NAME)
+        self._remove_data_file()
 
-        return StringIO(out.decode())
+        return spool
 
     @util.log(logger)
     @util.Override(collecter.Collecter)
     def _get_generator(self, raw_data):
-        """ Convert raw data to standard datatypes and yield it """
-        stack_parser = StackParser(raw_data)
-        return stack_parser.stack_collapse()
+        """ Read the parsed data back from the spool and yield it """
+        return raw_data.datums()
 
     @util.log(logger)
     @util.Override(collecter.Collecter)
@@ -466,8 +824,10 @@ class DiskBlockRequests(collecter.Collecter):
 
         data = self._get_generator(raw_data)
         data_options = data_io.StackData.DataOptions("samples")
-        return data_io.StackData(data, self.start_time, self.end_time,
-                                 InterfaceTypes.DISKBLOCK, data_options)
+        return self._record_loss(
+            data_io.StackData(data, self.start_time, self.end_time,
+                              InterfaceTypes.DISKBLOCK, data_options),
+            raw_data)
 
 
 class StackParser:
@@ -0,0 +1,447 @@
+# -------------------------------------------------------------
+# pipeline.py - bounded asyncio pipelines for collecting data
+# October 2018
+# -------------------------------------------------------------
+
+"""
+Staged pipelines for collecting data.
+
+A :class:`Pipeline` connects a source, any number of transform stages and a
+sink with bounded asyncio queues. Items flow between the stages in batches
+(lists).
+When a stage falls behind, the queue in front of it fills up and the stage
+before it blocks on putting its output; this propagates back to the source,
+which stops reading from the collection tool, so that the tool's own buffers
+fill and throttle it rather than data being buffered without bound.
+
+Each stage keeps a :class:`StageStats` with its throughput and the depth of
+its input queue.
+:func:`run_process` streams the output of a subprocess through a pipeline.
+
+"""
+
+__all__ = (
+    'StageStats',
+    'Source',
+    'LineSource',
+    'Transform',
+    'Sink',
+    'SpoolSink',
+    'Pipeline',
+    'run_process',
+)
+
+import abc
+import asyncio
+import logging
+import tempfile
+import time
+
+from marple.collect import overhead
+from marple.collect.interface import collecter
+from marple.common import util
+
+logger = logging.getLogger(__name__)
+logger.debug('Entered module: %s', __name__)
+
+# Default maximum number of batches waiting between two stages
+QUEUE_SIZE = 16
+
+# Default number of lines in each batch read by a LineSource
+BATCH_LINES = 1024
+
+# Put on a queue after the last batch
+_DONE = object()
+
+
+class StageStats:
+    """
+    Counters for a single stage of a pipeline.
+
+    .. attribute:: name:
+        The name of the stage.
+    .. attribute:: items_in, items_out:
+        The number of items the stage has taken in and put out.
+    .. attribute:: batches:
+        The number of batches the stage has processed.
+    .. attribute:: busy_time:
+        The time spent processing batches, in seconds.
+    .. attribute:: cpu_time:
+        The CPU time spent processing batches in an executor, in seconds.
+    .. attribute:: max_queue_depth:
+        The largest number of batches seen waiting in the stage's input queue.
+
+    """
+    def __init__(self, name):
+        """
+        Initialise the counters.
+
+        :param name:
+            The name of the stage.
+
+        """
+        self.name = name
+        self.items_in = 0
+        self.items_out = 0
+        self.batches = 0
+        self.busy_time = 0.0
+        self.cpu_time = 0.0
+        self.max_queue_depth = 0
+
+    def throughput(self):
+        """
+        :return:
+            The number of items taken in per second spent processing.
+
+        """
+        if self.busy_time == 0:
+            return 0.0
+        return self.items_in / self.busy_time
+
+    def __str__(self):
+        return "{}: {} in, {} out, {} batches, {:.3f}s busy ({:.0f} items/s), " \
+               "max queue depth {}".format(self.name, self.items_in,
+                                           self.items_out, self.batches,
+                                           self.busy_time, self.throughput(),
+                                           self.max_queue_depth)
+
+
+class _Stage:
+    """ Base class for the stages of a pipeline. """
+
+    def __init__(self, name=None):
+        """
+        Initialise the stage.
+
+        :param name:
+            The name used for the stage's statistics; defaults to the class
+            name.
+
+        """
+        self.stats = StageStats(name or type(self).__name__)
+
+
+class Source(_Stage, abc.ABC):
+    """
+    The first stage of a pipeline, producing batches of items.
+
+    Subclasses implement :meth:`batches` as an asynchronous generator.
+
+    """
+
+    @abc.abstractmethod
+    async def batches(self):
+        """ Asynchronously generate lists of items. """
+
+
+class LineSource(Source):
+    """
+    Reads lines from an asyncio stream, e.g. the stdout of a subprocess.
+
+    Lines are decoded and grouped into batches; nothing more is read while
+    the next stage's queue is full.
+    The number of bytes read is counted in :attr:`nbytes`.
+
+    """
+
+    def __init__(self, stream, batch_lines=BATCH_LINES, boundary=None,
+                 name=None):
+        """
+        Initialise the source.
+
+        :param stream:
+            An :class:`asyncio.StreamReader` to read lines from.
+        :param batch_lines:
+            The number of lines after which a batch is complete.
+        :param boundary:
+            An optional function taking a line; if given, a batch is only
+            ended after a line for which it is true, so that records spanning
+            several lines are never split between batches.
+        :param name:
+            See superclass.
+
+        """
+        super().__init__(name)
+        self.stream = stream
+        self.batch_lines = batch_lines
+        self.boundary = boundary
+        self.nbytes = 0
+
+    @util.Override(Source)
+    async def batches(self):
+        """ Asynchronously generate lists of lines. """
+        batch = []
+        while True:
+            line = await self.stream.readline()
+            if not line:
+                break
+            self.nbytes += len(line)
+            line = line.decode()
+            batch.append(line)
+            if len(batch) >= self.batch_lines and \
+                    (self.boundary is None or self.boundary(line)):
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+class Transform(_Stage):
+    """
+    A stage converting each batch into a new batch.
+
+    The function is called as `function(batch, options)` and must return a
+    list; returning fewer items filters the batch.
+    It is run in an executor, so a picklable function can be given a process
+    pool to keep CPU-heavy work off the event loop.
+
+    """
+
+    def __init__(self, function, options=None, executor=None, name=None):
+        """
+        Initialise the stage.
+
+        :param function:
+            The function applied to each batch.
+        :param options:
+            Passed as the second argument of the function.
+        :param executor:
+            The executor to run the function in; None uses the event loop's
+            default executor.
+        :param name:
+            See superclass; defaults to the name of the function.
+
+        """
+        super().__init__(name or getattr(function, "__name__", None))
+        self.function = function
+        self.options = options
+        self.executor = executor
+
+    async def process(self, batch):
+        """
+        Convert a batch.
+
+        :param batch:
+            The list of input items.
+        :return:
+            The list of output items.
+
+        """
+        loop = asyncio.get_event_loop()
+        result, cpu_time = await loop.run_in_executor(
+            self.executor, overhead.run_timed, self.function, batch,
+            self.options)
+        self.stats.cpu_time += cpu_time
+        return result
+
+
+class Sink(_Stage, abc.ABC):
+    """
+    The last stage of a pipeline, consuming batches of items.
+
+    Subclasses implement :meth:`consume`.
+
+    """
+
+    @abc.abstractmethod
+    async def consume(self, batch):
+        """ Consume a list of items. """
+
+
+class SpoolSink(Sink):
+    """
+    Writes datum objects to a temporary file as they arrive.
+
+    The file uses the standard string representation of the datum objects,
+    so the data takes no memory once written and is read back lazily with
+    :meth:`datums`, e.g. as the generator of a `data_io.Data` object.
+
+    """
+
+    def __init__(self, datum_class, name=None):
+        """
+        Initialise the sink.
+
+        :param datum_class:
+            The class of the datum objects, used to read them back.
+        :param name:
+            See superclass.
+
+        """
+        super().__init__(name)
+        self.datum_class = datum_class
+        self.file = tempfile.TemporaryFile("w+", encoding="utf-8")
+
+    @util.Override(Sink)
+    async def consume(self, batch):
+        """ Append a list of datum objects to the spool file. """
+        self.file.writelines(str(datum) + "\n" for datum in batch)
+
+    def datums(self):
+        """
+        Read the datum objects back, closing the file once done.
+
+        :return:
+            A generator of datum objects, in the order they were consumed.
+
+        """
+        self.file.seek(0)
+        try:
+            for line in self.file:
+                yield self.datum_class.from_string(line)
+        finally:
+            self.file.close()
+
+
+class Pipeline:
+    """
+    Runs a source, transforms and a sink connected by bounded queues.
+
+    Each stage runs as its own task, so a slow stage only holds up the stages
+    before it once the queues in between are full.
+
+    """
+
+    def __init__(self, source, transforms, sink, queue_size=QUEUE_SIZE):
+        """
+        Initialise the pipeline.
+
+        :param source:
+            A :class:`Source`.
+        :param transforms:
+            A sequence of :class:`Transform` objects, applied in order.
+        :param sink:
+            A :class:`Sink`.
+        :param queue_size:
+            The maximum number of batches waiting between two stages.
+
+        """
+        self.source = source
+        self.transforms = list(transforms)
+        self.sink = sink
+        self.queue_size = queue_size
+
+    @property
+    def stats(self):
+        """ The :class:`StageStats` of each stage, in order. """
+        return [stage.stats for stage in
+                [self.source] + self.transforms + [self.sink]]
+
+    @staticmethod
+    async def _put(queue, batch, consumer):
+        """ Put a batch on a queue, recording its depth for the consumer. """
+        await queue.put(batch)
+        consumer.stats.max_queue_depth = max(consumer.stats.max_queue_depth,
+                                             queue.qsize())
+
+    async def _run_source(self, out_queue, consumer):
+        """ Put the batches from the source on its output queue. """
+        async for batch in self.source.batches():
+            self.source.stats.batches += 1
+            self.source.stats.items_out += len(batch)
+            await self._put(out_queue, batch, consumer)
+        await out_queue.put(_DONE)
+
+    async def _run_transform(self, transform, in_queue, out_queue, consumer):
+        """ Convert the batches from the input queue onto the output queue. """
+        while True:
+            batch = await in_queue.get()
+            if batch is _DONE:
+                break
+            start = time.perf_counter()
+            result = await transform.process(batch)
+            transform.stats.busy_time += time.perf_counter() - start
+            transform.stats.batches += 1
+            transform.stats.items_in += len(batch)
+            transform.stats.items_out += len(result)
+            if result:
+                await self._put(out_queue, result, consumer)
+        await out_queue.put(_DONE)
+
+    async def _run_sink(self, in_queue):
+        """ Consume the batches from the input queue. """
+        while True:
+            batch = await in_queue.get()
+            if batch is _DONE:
+                break
+            start = time.perf_counter()
+            await self.sink.consume(batch)
+            self.sink.stats.busy_time += time.perf_counter() - start
+            self.sink.stats.batches += 1
+            self.sink.stats.items_in += len(batch)
+
+    @util.log(logger)
+    async def run(self):
+        """
+        Run the pipeline until the source is exhausted and every batch has
+        reached the sink.
+
+        If any stage raises an exception, the other stages are cancelled and
+        the exception is raised again.
+
+        :return:
+            The sink.
+
+        """
+        queues = [asyncio.Queue(self.queue_size)
+                  for _ in range(len(self.transforms) + 1)]
+        consumers = self.transforms + [self.sink]
+
+        coroutines = [self._run_source(queues[0], consumers[0])]
+        for index, transform in enumerate(self.transforms):
+            coroutines.append(self._run_transform(
+                transform, queues[index], queues[index + 1],
+                consumers[index + 1]))
+        coroutines.append(self._run_sink(queues[-1]))
+
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        for stats in self.stats:
+            logger.info("Pipeline stage %s", stats)
+        return self.sink
+
+
+async def run_process(sub_process, transforms, sink, account, boundary=None):
+    """
+    Stream the stdout of a subprocess through a pipeline.
+
+    The output is read only as fast as it is parsed and spooled, so the
+    subprocess is throttled rather than all of its output being held in
+    memory. The subprocess, and any processes it started, are killed if the
+    pipeline fails or is cancelled, and it is always reaped.
+
+    :param sub_process:
+        An asyncio subprocess with its stdout and stderr piped.
+    :param transforms:
+        See :class:`Pipeline`.
+    :param sink:
+        See :class:`Pipeline`.
+    :param account:
+        The :class:`overhead.Overhead` to charge the output and the parsing
+        to.
+    :param boundary:
+        See :class:`LineSource`.
+    :return:
+        The stderr of the subprocess, as bytes.
+
+    """
+    err_future = asyncio.ensure_future(sub_process.stderr.read())
+    source = LineSource(sub_process.stdout, boundary=boundary)
+    try:
+        await Pipeline(source, transforms, sink).run()
+    except BaseException:
+        collecter.kill_process_tree(sub_process.pid)
+        raise
+    finally:
+        await sub_process.wait()
+        account.add_output(source.nbytes)
+        account.add_parse_time(sum(transform.stats.cpu_time
+                                   for transform in transforms))
+
+    return await err_future
@@ -52,10 +52,25 @@ class MemoryGraph(collecter.Collecter):
     _DEFAULT_OPTIONS = Options(mode="name", frequency=0.5)
     modes = ["command", "name", "pid"]
 
+    # smem reads the memory maps of every process for each refresh
+    RECORD_BYTES = 40
+    RECORD_CPU_TIME = 500e-6
+
     @util.check_kernel_version("2.6.27")
     def __init__(self, time_, options=_DEFAULT_OPTIONS):
         super().__init__(time_, options)
 
+    @util.Override(collecter.Collecter)
+    def estimate_rate(self, probe):
+        """ Estimate a record per process per refresh (see superclass). """
+        return probe.processes / self.options.frequency
+
+    @util.Override(collecter.Collecter)
+    def recommend(self, scale):
+        """ Suggest refreshing less often (see superclass). """
+        return "refresh every {} -> {:.1f} s".format(
+            self.options.frequency, self.options.frequency / scale)
+
     @util.log(logger)
     @util.Override(collecter.Collecter)
     async def _get_raw_data(self):
@@ -71,13 +86,23 @@ class MemoryGraph(collecter.Collecter):
                 raise ValueError(
                     "mode {} not supported.".format(self.options.mode))
 
+            # When scoped, the processes are filtered by the PID in the first
+            # column, and those in scope are taken afresh every refresh
+            columns = self.options.mode + " pss"
+            pids = None
+            if not self.scope.system_wide:
+                pids = set(self.scope.processes())
+                if self.options.mode != "pid":
+                    columns = "pid " + columns
             smem = await asyncio.create_subprocess_shell(
-                "smem -c \"{} pss\"".format(self.options.mode),
+                "smem -c \"{}\"".format(columns),
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE
             )
+            self.overhead.track(smem)
 
-            out, err = await smem.communicate()
+            out, err = await collecter.await_tool(smem, smem.communicate())
+            self.overhead.add_output(len(out))
             if smem.returncode != 0:
                 # Set an end_time
                 raise exceptions.SubprocessedErorred(err.decode())
@@ -99,6 +124,11 @@ class MemoryGraph(collecter.Collecter):
 
                 label = match.group("label")
                 memory = float(match.group("memory")) / 1024.0
+                if pids is not None:
+                    pid, _, scoped_label = label.partition(" ")
+                    if int(pid) not in pids:
+                        continue
+                    label = scoped_label or pid
 
                 if label in datapoints[current_time]:
                     memory += float(datapoints[current_time][label])
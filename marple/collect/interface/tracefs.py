@@ -0,0 +1,378 @@
+# -------------------------------------------------------------
+# tracefs.py - collects data directly from the kernel tracefs
+# October 2018
+# -------------------------------------------------------------
+
+"""
+Collects data directly from the kernel's tracing filesystem.
+
+Enables tracepoints in a private ftrace instance, reads its trace_pipe and
+converts the events to standard datatypes in Python, without going through
+external tracing scripts.
+
+"""
+
+__all__ = (
+    'BlockTraceParser',
+    'DiskLatency',
+)
+
+import asyncio
+import datetime
+import logging
+import os
+import re
+from typing import NamedTuple
+
+from marple.collect import overhead
+from marple.collect.interface import collecter
+from marple.common import data_io, util
+from marple.common.consts import InterfaceTypes
+
+logger = logging.getLogger(__name__)
+logger.debug('Entered module: %s', __name__)
+
+# Possible mount points of tracefs, newest first
+TRACEFS_PATHS = ("/sys/kernel/tracing", "/sys/kernel/debug/tracing")
+
+# Name of the ftrace instance used by marple, so that the global trace buffer
+# and any other tracers are left alone; formatted with the process ID, so that
+# concurrent runs of marple do not share an instance; the copies of a
+# collecter running at once add their copy number
+INSTANCE_NAME = "marple-{}"
+
+# Size of each read from trace_pipe
+READ_SIZE = 1 << 20
+
+# Time to wait when trace_pipe has no data, in seconds
+POLL_INTERVAL = 0.1
+
+# Largest per-CPU trace buffer the buffers are scaled up to, in kilobytes
+MAX_BUFFER_SIZE_KB = 1 << 18
+
+
+def _find_tracefs():
+    """
+    Find the mount point of tracefs.
+
+    :raises FileNotFoundError:
+        If tracefs is not mounted.
+    :return:
+        The path of the tracefs mount point.
+
+    """
+    for path in TRACEFS_PATHS:
+        if os.path.isdir(os.path.join(path, "instances")):
+            return path
+    raise FileNotFoundError("tracefs not found in any of {}"
+                            .format(", ".join(TRACEFS_PATHS)))
+
+
+class BlockTraceParser:
+    """
+    Matches block request issue and completion events into disk latencies.
+
+    Takes the text of trace_pipe with the block_rq_issue and block_rq_complete
+    events enabled, and pairs each completion with the issue of the same
+    request, identified by its device and sector.
+    Input can be fed in arbitrary chunks; partial lines are kept until the
+    rest of them arrives.
+    The events traced, and those lost when the trace buffer overflowed, are
+    counted in :attr:`events` and :attr:`lost`.
+
+    """
+    # ---------------------------------------------------------
+    # Regular expressions to match lines of trace_pipe:
+
+    _event = re.compile(
+        r"^\s*(?P<task>.+?)-(?P<pid>\d+)\s+(?:\(\s*\S+\)\s+)?"
+        r"\[(?P<cpu>\d+)\]\s+(?:\S+\s+)?(?P<time>\d+\.\d+):\s+"
+        r"(?P<event>block_rq_issue|block_rq_complete):\s+"
+        r"(?P<dev>\d+,\d+)\s+(?P<args>.*)$")
+    # Matches an issue or complete event, with an optional tgid column and
+    # an optional column of irq/preempt flags
+    # e.g. "dd-2837  [001] d..1  5423.873546: block_rq_issue: 8,0 W 4096 ()
+    #       2048 + 8 [dd]"
+
+    _request = re.compile(r"(?P<sector>\d+)\s+\+\s+(?P<nr_sector>\d+)")
+    # Matches the sector and size of the request, e.g. "2048 + 8"
+
+    _comm = re.compile(r"\[(?P<comm>[^\]]*)\]\s*$")
+    # Matches the command name at the end of an issue event, e.g. "[dd]"
+
+    _lost = re.compile(r"\[LOST (?P<lost>\d+) EVENTS\]")
+    # Matches the marker of events lost by a CPU's buffer,
+    #   e.g. "CPU:2 [LOST 4096 EVENTS]"
+
+    # --------------------------------------------------------
+
+    def __init__(self):
+        """ Initialise the parser. """
+        # Requests issued but not completed yet:
+        #   (dev, sector) -> (issue time in seconds, comm)
+        self._issued = {}
+        # Part of a line left at the end of the last chunk
+        self._partial = ""
+        self.events = 0
+        self.lost = 0
+
+    def _parse_line(self, line):
+        """
+        Parse a single line of trace_pipe.
+
+        :param line:
+            The line to parse.
+        :return:
+            A :class:`data_io.PointDatum` if the line completes an issued
+            request, None otherwise.
+
+        """
+        match = self._event.match(line)
+        if match is None:
+            lost = self._lost.search(line)
+            if lost is not None:
+                self.lost += int(lost.group("lost"))
+            else:
+                logger.debug("Unrecognized line: %s", line)
+            return None
+        self.events += 1
+
+        request = self._request.search(match.group("args"))
+        # Requests without sectors (e.g. flushes) cannot be matched up
+        if request is None or request.group("nr_sector") == "0":
+            return None
+
+        key = (match.group("dev"), request.group("sector"))
+        time = float(match.group("time"))
+
+        if match.group("event") == "block_rq_issue":
+            comm = self._comm.search(match.group("args"))
+            comm = comm.group("comm") if comm else match.group("task")
+            self._issued[key] = (time, comm)
+            return None
+
+        try:
+            issue_time, comm = self._issued.pop(key)
+        except KeyError:
+            # Issued before tracing started
+            return None
+
+        # Completion time in seconds, latency in milliseconds
+        return data_io.PointDatum(x=time, y=(time - issue_time) * 1000,
+                                  info=comm)
+
+    def feed(self, text):
+        """
+        Parse a chunk of trace_pipe text.
+
+        :param text:
+            The chunk, which need not end on a line boundary.
+        :return:
+            A generator of :class:`data_io.PointDatum` objects, one per
+            completed request.
+
+        """
+        lines = (self._partial + text).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            datum = self._parse_line(line)
+            if datum is not None:
+                yield datum
+
+    def flush(self):
+        """
+        Parse any partial line left over at the end of the input.
+
+        :return:
+            A generator of :class:`data_io.PointDatum` objects.
+
+        """
+        yield from self.feed("\n")
+
+
+class DiskLatency(collecter.Collecter):
+    """
+    Collect disk latency data from the block tracepoints in tracefs.
+
+    Enables block_rq_issue and block_rq_complete in a private ftrace instance
+    and reads its trace_pipe in large chunks while collecting, matching up the
+    requests as the data arrives.
+    A scope is applied as an ftrace filter on the threads issuing requests,
+    taken when collection starts; completions run in interrupt context, so
+    are matched up with the issues that passed the filter.
+
+    """
+
+    class Options(NamedTuple):
+        """
+        .. attribute:: buffer_size_kb:
+            The per-CPU trace buffer size, in kilobytes.
+
+        """
+        buffer_size_kb: int
+
+    _DEFAULT_OPTIONS = Options(buffer_size_kb=4096)
+
+    _EVENTS = ("block/block_rq_issue", "block/block_rq_complete")
+    # The event run by the thread making the request
+    _ISSUE_EVENT = "block/block_rq_issue"
+
+    # A record is made of an issue and a completion, each a trace_pipe line
+    PROBE_EVENTS = ("block:block_rq_complete",)
+    RECORD_BYTES = 250
+    RECORD_CPU_TIME = 5e-6
+
+    @util.check_kernel_version("3.16")
+    def __init__(self, time, options=_DEFAULT_OPTIONS):
+        """ Initialise the collecter (see superclass). """
+        super().__init__(time, options)
+        # Parser of the last collection, which counts the events
+        self.parser = None
+
+    @staticmethod
+    def _write(path, value):
+        """ Write a value to a tracefs control file. """
+        with open(path, "w") as control:
+            control.write(value)
+
+    def _setup_instance(self):
+        """
+        Create the ftrace instance and enable the block events in it.
+
+        :return:
+            The path of the instance.
+
+        """
+        name = INSTANCE_NAME.format(os.getpid())
+        if self.copy_id:
+            name += "-{}".format(self.copy_id)
+        instance = os.path.join(_find_tracefs(), "instances", name)
+        if not os.path.isdir(instance):
+            os.mkdir(instance)
+        self._write(os.path.join(instance, "buffer_size_kb"),
+                    str(self.options.buffer_size_kb))
+        if not self.scope.system_wide:
+            # A filter matching no thread if the scope is empty
+            tids = self.scope.threads() or [0]
+            self._write(os.path.join(instance, "events", self._ISSUE_EVENT,
+                                     "filter"),
+                        " || ".join("common_pid == {}".format(tid)
+                                    for tid in tids))
+        for event in self._EVENTS:
+            self._write(os.path.join(instance, "events", event, "enable"), "1")
+        return instance
+
+    @util.Override(collecter.Collecter)
+    def scale_buffers(self, loss_ratio):
+        """ Enlarge the trace buffers (see superclass). """
+        size = self.options.buffer_size_kb
+        # At least double, or enough to have held the events lost
+        scaled = min(max(2 * size, int(size / max(1 - loss_ratio, 0.01))),
+                     MAX_BUFFER_SIZE_KB)
+        if scaled <= size:
+            return None
+        self.options = self.options._replace(buffer_size_kb=scaled)
+        return "buffer_size_kb {} -> {}".format(size, scaled)
+
+    def _disable_events(self, instance):
+        """ Stop tracing the block events in the ftrace instance. """
+        for event in self._EVENTS:
+            self._write(os.path.join(instance, "events", event, "enable"), "0")
+
+    def _teardown_instance(self, instance):
+        """ Disable the block events and remove the ftrace instance. """
+        self._disable_events(instance)
+        if not self.scope.system_wide:
+            self._write(os.path.join(instance, "events", self._ISSUE_EVENT,
+                                     "filter"), "0")
+        os.rmdir(instance)
+
+    @util.log(logger)
+    @util.Override(collecter.Collecter)
+    async def _get_raw_data(self):
+        """
+        Collect raw data asynchronously from trace_pipe.
+
+        :return:
+            A list of the completed requests, as :class:`data_io.PointDatum`
+            objects.
+
+        """
+        parser = BlockTraceParser()
+        self.parser = parser
+        datapoints = []
+
+        def read_chunk():
+            """ Parse the next chunk of trace_pipe, if there is one. """
+            try:
+                chunk = os.read(fd, READ_SIZE)
+            except BlockingIOError:
+                return False
+            if not chunk:
+                return False
+            self.overhead.add_output(len(chunk))
+            points, cpu_time = overhead.run_timed(
+                list, parser.feed(chunk.decode(errors="replace")))
+            self.overhead.add_parse_time(cpu_time)
+            datapoints.extend(points)
+            return True
+
+        instance = self._setup_instance()
+        try:
+            fd = os.open(os.path.join(instance, "trace_pipe"),
+                         os.O_RDONLY | os.O_NONBLOCK)
+            try:
+                self.start_time = datetime.datetime.now()
+                end = self.start_time + datetime.timedelta(seconds=self.time)
+                while datetime.datetime.now() < end:
+                    if read_chunk():
+                        # Under heavy I/O there is always more to read, so
+                        # let the other collecters run between chunks
+                        await asyncio.sleep(0)
+                    else:
+                        await asyncio.sleep(POLL_INTERVAL)
+                self.end_time = datetime.datetime.now()
+
+                # Stop tracing, then read the events still buffered, which
+                # removing the instance would discard
+                self._disable_events(instance)
+                while read_chunk():
+                    pass
+            finally:
+                os.close(fd)
+        finally:
+            self._teardown_instance(instance)
+
+        datapoints.extend(parser.flush())
+        return datapoints
+
+    @util.log(logger)
+    @util.Override(collecter.Collecter)
+    def _get_generator(self, raw_data):
+        """ Convert raw data to standard datatypes and yield it. """
+        yield from raw_data
+
+    @util.log(logger)
+    @util.Override(collecter.Collecter)
+    async def collect(self):
+        """
+        Collect data asynchronously from tracefs.
+
+        :return:
+            a `data_io.PointData` object that encapsulates the collected
+            data
+        """
+        try:
+            raw_data = await self._get_raw_data()
+        except OSError as ose:
+            logger.error(str(ose))
+            return data_io.PointData(None, -1, -1,
+                                     InterfaceTypes.DISKLATENCY, None)
+
+        data = self._get_generator(raw_data)
+        data_options = data_io.PointData.DataOptions(
+            x_label="Time", y_label="Latency", x_units="s", y_units="ms")
+        data = data_io.PointData(data, self.start_time, self.end_time,
+                                 InterfaceTypes.DISKLATENCY, data_options)
+        data.record_loss(self.parser.lost, self.parser.events)
+        return data
@@ -18,6 +18,7 @@ __all__ = (
 
 import argparse
 import asyncio
+import concurrent.futures
 import logging
 import os
 import textwrap
@@ -31,16 +32,39 @@ from marple.common import (
     exceptions
 )
 from marple.collect.interface import (
+    collecter,
     perf,
-    iosnoop,
     smem,
-    ebpf
+    ebpf,
+    iosnoop,
+    tracefs
+)
+from marple.collect import (
+    estimator,
+    governor,
+    recorder,
+    scheduler
 )
 
 logger = logging.getLogger(__name__)
 logger.debug('Entered module: %s', __name__)
 
 
+def _pid_list(value):
+    """
+    Parse a comma-separated list of process IDs.
+
+    :param value: the argument given by the user
+    :return: a tuple of the process IDs
+
+    """
+    try:
+        return tuple(int(pid) for pid in value.split(","))
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(
+            "{} is not a comma-separated list of PIDs".format(value)) from err
+
+
 @util.log(logger)
 def _args_parse(argv):
     """
@@ -122,28 +146,94 @@ def _args_parse(argv):
     collection_time = parser.add_argument_group()
     collection_time.add_argument(
         "-t", "--time", type=int, help="specify the duration for data "
-                                       "collection (in seconds).")
+                                       "collection (in seconds).\n"
+                                       "With --flight-recorder, the number "
+                                       "of seconds of data kept.")
+
+    # Add flag for flight-recorder mode
+    flight_recorder = parser.add_argument_group()
+    flight_recorder.add_argument(
+        "--flight-recorder", action="store_true",
+        help="collect continuously, keeping only the most recent data, and\n"
+             "dump it to a new data file on SIGUSR1, on a command to the\n"
+             "control socket, or when the load average reaches the\n"
+             "threshold (see the FlightRecorder section of the config).\n"
+             "Runs until interrupted.")
+
+    # Add flag and parameter for duty-cycled mode
+    every = parser.add_argument_group()
+    every.add_argument(
+        "--every", type=int, metavar="PERIOD",
+        help="collect for the collection time every PERIOD seconds, until\n"
+             "interrupted. Windows are appended to rolling data files\n"
+             "(see the DutyCycle section of the config).")
+
+    # Add flag for estimate mode
+    estimate = parser.add_argument_group()
+    estimate.add_argument(
+        "--estimate", action="store_true",
+        help="instead of collecting, probe the system briefly and estimate\n"
+             "the data volume and overhead of the collection, with\n"
+             "recommended settings (see the Estimate section of the\n"
+             "config).")
+
+    # Add flags limiting collection to some processes
+    scope = parser.add_argument_group()
+    scope.add_argument(
+        "--pid", type=_pid_list, default=(), metavar="PIDS",
+        help="collect from these processes only (comma-separated).")
+    scope.add_argument(
+        "--cgroup", metavar="PATH",
+        help="collect from the processes in this cgroup v2 only, given by\n"
+             "its path below the cgroup root.")
+    scope.add_argument(
+        "--comm", metavar="NAME",
+        help="collect from the processes with this command name only,\n"
+             "as running when collection starts.")
 
     return parser.parse_args(argv)
 
 
+def _get_scope(args):
+    """
+    Get the processes to collect from, as chosen by the user.
+
+    :param args: the parsed command line arguments
+    :return: a resolved `collecter.Scope`
+    :raises ValueError: if the cgroup or command name does not exist
+
+    """
+    scope = collecter.Scope(args.pid, args.cgroup, args.comm)
+    if scope.cgroup is not None and not os.path.isdir(scope.cgroup_path()):
+        raise ValueError("No cgroup {}".format(scope.cgroup_path()))
+    return scope.resolve()
+
+
 @util.log(logger)
-def _get_collecters(subcommands, collection_time):
+def _get_collecters(subcommands, collection_time,
+                    scope=collecter.Scope()):
     """
     Calls the relevant functions that user chose and stores output in file.
 
+    The collecters are in the order the interfaces were given, aliases
+    expanded in place, so that the resource governor drops the last ones
+    given first.
+
     :param subcommands:
         The subcommands that tell which collecters to get
     :param collection_time:
         The time for collection
+    :param scope:
+        The `collecter.Scope` of the processes to collect from
 
 
     """
-    # Determine all arguments specifying collecter interfaces
-    args_seen = set()
+    # Determine all arguments specifying collecter interfaces, in order and
+    # without duplicates
+    args_seen = {}
     for subcommand in subcommands:
         if subcommand in consts.interfaces_argnames:
-            args_seen.add(subcommand)
+            args_seen[subcommand] = None
         else:
             # Check for aliases
             if not config.config.has_option("Aliases", subcommand):
@@ -151,9 +241,9 @@ def _get_collecters(subcommands, collection_time):
                     subcommand
                 ))
             # Look for aliases
-            alias_args = set(config.get_option_from_section(
-                "Aliases", subcommand).split(','))
-            args_seen = args_seen.union(alias_args)
+            alias_args = config.get_option_from_section(
+                "Aliases", subcommand).split(',')
+            args_seen.update(dict.fromkeys(alias_args))
 
     collecter_instances = []
     for arg in args_seen:
@@ -164,8 +254,12 @@ def _get_collecters(subcommands, collection_time):
                           "{} needs kernel version "
                           "{} or above!".format(arg, nse.required_kernel))
         else:
+            instance.scope = scope
             collecter_instances.append(instance)
 
+    # Collecters tracing malloc share one set of uprobes if run together
+    ebpf.share_malloc_session(collecter_instances)
+
     return collecter_instances
 
 
@@ -188,11 +282,39 @@ def _get_collecter_instance(interface_name, collection_time):
     if interface is interfaces.SCHEDEVENTS:
         collecter = perf.SchedulingEvents(collection_time)
     elif interface is interfaces.DISKLATENCY:
-        collecter = iosnoop.DiskLatency(collection_time)
+        if config.get_option_from_section(interfaces.DISKLATENCY.value,
+                                          "histogram", "bool"):
+            options = ebpf.DiskLatencyHistogram.Options(
+                config.get_option_from_section(interfaces.DISKLATENCY.value,
+                                               "histogram_interval", "int"),
+                config.get_option_from_section(interfaces.DISKLATENCY.value,
+                                               "histogram_linear_us", "int"))
+            collecter = ebpf.DiskLatencyHistogram(collection_time, options)
+        elif config.get_option_from_section(interfaces.DISKLATENCY.value,
+                                            "iosnoop", "bool"):
+            collecter = iosnoop.DiskLatency(collection_time)
+        else:
+            options = tracefs.DiskLatency.Options(
+                config.get_option_from_section(interfaces.DISKLATENCY.value,
+                                               "buffer_size_kb", "int"))
+            try:
+                collecter = tracefs.DiskLatency(collection_time, options)
+            except exceptions.NotSupportedException:
+                # ftrace instances are too new; iosnoop uses the global trace
+                # buffer instead
+                logger.info("Falling back to iosnoop for disk latency")
+                collecter = iosnoop.DiskLatency(collection_time)
     elif interface is interfaces.TCPTRACE:
         collecter = ebpf.TCPTracer(collection_time)
     elif interface is interfaces.MALLOCSTACKS:
-        collecter = ebpf.MallocStacks(collection_time)
+        options = ebpf.MallocStacks.Options(
+            config.get_option_from_section(interfaces.MALLOCSTACKS.value,
+                                           "sample_rate", "int"),
+            config.get_option_from_section(interfaces.MALLOCSTACKS.value,
+                                           "sample_bytes", "int"),
+            config.get_option_from_section(interfaces.MALLOCSTACKS.value,
+                                           "stack_storage_size", "int"))
+        collecter = ebpf.MallocStacks(collection_time, options)
     elif interface is interfaces.MEMTIME:
         collecter = smem.MemoryGraph(collection_time)
     elif interface is interfaces.CALLSTACK:
@@ -205,7 +327,9 @@ def _get_collecter_instance(interface_name, collection_time):
     elif interface is interfaces.MEMLEAK:
         options = ebpf.Memleak.Options(
             config.get_option_from_section(interfaces.MEMLEAK.value,
-                                           "top_processes", "int"))
+                                           "top_processes", "int"),
+            config.get_option_from_section(interfaces.MEMLEAK.value,
+                                           "snapshot_interval", "int"))
         collecter = ebpf.Memleak(collection_time, options)
     elif interface is interfaces.MEMEVENTS:
         collecter = perf.MemoryEvents(collection_time)
@@ -244,33 +368,104 @@ async def _loading_bar(collection_time):
 
 
 @util.log(logger)
-def _collect_results(collecters, collection_time):
+def _get_governor():
+    """
+    Create the resource governor from the config.
+
+    :returns:
+        a `governor.Governor` with the configured budget
+
+    """
+    section = "Governor"
+    return governor.Governor(
+        config.get_option_from_section(section, "cpu_percent", "int"),
+        config.get_option_from_section(section, "memory_mb", "int") *
+        1024 * 1024,
+        config.get_option_from_section(section, "interval", "int"),
+        config.get_option_from_section(section, "max_loss_ratio", "float"),
+        config.get_option_from_section(section, "loss_retries", "int"))
+
+
+async def _governed(resource_governor, collecters, coroutine):
+    """
+    Run a coroutine while the governor monitors the collecters.
+
+    :param resource_governor: the `governor.Governor` to monitor with
+    :param collecters: the collecter instances that we use to collect data
+    :param coroutine: the coroutine collecting the data
+    :return: the result of the coroutine
+
+    """
+    resource_governor.start(collecters)
+    try:
+        return await coroutine
+    finally:
+        resource_governor.stop()
+
+
+async def _write_as_completed(collecters, writer, resource_governor):
+    """
+    Collect data from all the collecters, writing each section as soon as its
+    collecter finishes.
+
+    Each data object is dropped once written, so that its raw data can be
+    freed while the slower collecters are still running.
+
+    :param collecters: the collecter instances that we use to collect data
+    :param writer: the `data_io.Writer` the sections are written to
+    :param resource_governor: the `governor.Governor` to collect through
+    :return: the data objects of the collecters that errored
+
+    """
+    errored = []
+    for future in asyncio.as_completed([resource_governor.collect(collecter)
+                                        for collecter in collecters]):
+        data = await future
+        # The governor dropped the collecter to keep within budget
+        if data is None:
+            continue
+        # If a result has its `datum_generator` field None we know it errored
+        if data.datum_generator is None:
+            errored.append(data)
+        else:
+            writer.write_section(data)
+        del data
+    return errored
+
+
+@util.log(logger)
+def _collect_results(collecters, collection_time, writer, resource_governor):
     """
     Helper function that async collects all the data using the asyncio lib
 
+    Sections are written as each collecter completes, rather than once they
+    have all finished.
+    The collecters parse their raw data in a shared pool of worker processes,
+    so that parsing does not hold up the event loop.
+
     :param collecters: the collecter instances that we use to collect data
     :param collection_time: the collection time used by the collectors
-    :return: the data gathered as a list of data objects
+    :param writer: the `data_io.Writer` used to write the data
+    :param resource_governor: the `governor.Governor` keeping collection
+        within budget
 
     """
     # Create event loop to collect and write data
     ioloop = asyncio.get_event_loop()
 
-    # Begin async collection
-    futures = tuple(collecter.collect() for collecter in collecters)
-    results = ioloop.run_until_complete(
-        asyncio.gather(*futures, _loading_bar(collection_time))
-    )
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        for collecter in collecters:
+            collecter.executor = executor
+
+        # Begin async collection
+        errored, _ = ioloop.run_until_complete(_governed(
+            resource_governor, collecters,
+            asyncio.gather(_write_as_completed(collecters, writer,
+                                               resource_governor),
+                           _loading_bar(collection_time))
+        ))
     ioloop.close()
 
-    results = results[:-1]  # Get rid of the loading bar, not relevant
-
-    # Now, if a result has its `datum_generator` field None we know it errored
-    errored = list(filter(lambda res: res.datum_generator is None,
-                          results))
-    not_errored = list(filter(lambda res: res.datum_generator is not None,
-                              results))
-
     # We deal with the errored collecters
     if errored:
         output.error_("Error while collecting data",
@@ -281,8 +476,98 @@ def _collect_results(collecters, collection_time):
                                                data.interface.value,
                                                errored)))))
 
-    # Return only the unerrored results
-    return not_errored
+
+@util.log(logger)
+def _estimate(collecters, collection_time):
+    """
+    Probe the system and print the estimated cost of the collection.
+
+    :param collecters: the collecter instances that would collect data
+    :param collection_time: the collection time used by the collecters
+
+    """
+    section = "Estimate"
+    probe_time = config.get_option_from_section(section, "probe_time", "int")
+
+    ioloop = asyncio.get_event_loop()
+    events = [event for collecter in collecters
+              for event in collecter.PROBE_EVENTS]
+    system = ioloop.run_until_complete(estimator.probe(events, probe_time))
+    ioloop.close()
+
+    estimates = estimator.estimate(
+        collecters, system, collection_time,
+        config.get_option_from_section(section, "cpu_percent", "float"),
+        config.get_option_from_section(section, "output_mb", "int") *
+        1024 * 1024)
+    for line in estimator.report(estimates, system, collection_time,
+                                 probe_time):
+        output.print_(line)
+
+
+@util.log(logger)
+def _record_flight(collecters, window, resource_governor):
+    """
+    Run the collecters in flight-recorder mode until interrupted.
+
+    :param collecters: the collecter instances that we use to collect data
+    :param window: the number of seconds of data to keep
+    :param resource_governor: the `governor.Governor` keeping collection
+        within budget
+
+    """
+    section = "FlightRecorder"
+    flight_recorder = recorder.FlightRecorder(
+        collecters, window,
+        config.get_option_from_section(section, "segment_time", "int"),
+        config.get_option_from_section(section, "memory_cap_mb", "int") *
+        1024 * 1024,
+        config.get_option_from_section(section, "socket") or None,
+        config.get_option_from_section(section, "load_threshold", "float"),
+        resource_governor)
+
+    _run_resident(collecters, flight_recorder.run(), resource_governor)
+
+
+@util.log(logger)
+def _collect_periodically(collecters, period, resource_governor):
+    """
+    Run the collecters every period until interrupted.
+
+    :param collecters: the collecter instances that we use to collect data
+    :param period: the number of seconds between the starts of collections
+    :param resource_governor: the `governor.Governor` keeping collection
+        within budget
+
+    """
+    section = "DutyCycle"
+    duty_cycle = scheduler.DutyCycle(
+        collecters, period,
+        config.get_option_from_section(section, "rotate_mb", "int") *
+        1024 * 1024,
+        config.get_option_from_section(section, "rotate_minutes", "int") * 60,
+        config.get_option_from_section(section, "disk_budget_mb", "int") *
+        1024 * 1024,
+        resource_governor)
+    _run_resident(collecters, duty_cycle.run(), resource_governor)
+
+
+def _run_resident(collecters, coroutine, resource_governor):
+    """
+    Run a long-running collection mode to completion.
+
+    :param collecters: the collecter instances that we use to collect data
+    :param coroutine: the coroutine running the mode
+    :param resource_governor: the `governor.Governor` monitoring collection
+
+    """
+    ioloop = asyncio.get_event_loop()
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        for collecter in collecters:
+            collecter.executor = executor
+        ioloop.run_until_complete(
+            _governed(resource_governor, collecters, coroutine))
+    ioloop.close()
 
 
 @util.log(logger)
@@ -302,6 +587,60 @@ def main(argv):
     # Parse arguments
     args = _args_parse(argv)
 
+    # Use user specified time for data collection, otherwise config value
+    collection_time = args.time if args.time else config.get_default_time()
+
+    # Confine collection to the budget before starting any collection tools
+    resource_governor = _get_governor()
+    resource_governor.confine()
+    try:
+        _collect(args, collection_time, resource_governor)
+    finally:
+        resource_governor.release()
+
+    for line in resource_governor.overhead_summary():
+        output.print_("Overhead of " + line)
+    output.print_("Done.")
+
+
+def _collect(args, collection_time, resource_governor):
+    """
+    Collect data in the mode chosen by the user.
+
+    :param args: the parsed command line arguments
+    :param collection_time: the collection time used by the collecters
+    :param resource_governor: the `governor.Governor` keeping collection
+        within budget
+
+    """
+
+    try:
+        scope = _get_scope(args)
+    except ValueError as ve:
+        output.error_("Invalid scope", str(ve))
+        exit(1)
+
+    if args.estimate:
+        _estimate(_get_collecters(args.subcommands, collection_time, scope),
+                  collection_time)
+        return
+
+    # In the resident modes, files are named by date as they are written
+    if args.flight_recorder or args.every:
+        if args.outfile:
+            output.warn_("Ignoring output file",
+                         "Files are named by date in this mode.")
+        collecters = _get_collecters(args.subcommands, collection_time, scope)
+        if args.flight_recorder:
+            output.print_("Recording. Send SIGUSR1 to process {} to dump, or "
+                          "interrupt to stop.".format(os.getpid()))
+            _record_flight(collecters, collection_time, resource_governor)
+        else:
+            output.print_("Collecting every {} seconds. Interrupt to stop."
+                          .format(args.every))
+            _collect_periodically(collecters, args.every, resource_governor)
+        return
+
     # Use user output filename specified, otherwise create a unique one
     if args.outfile:
         if os.path.isfile(args.outfile):
@@ -318,16 +657,10 @@ def main(argv):
     # Save latest filename to temporary file for display module
     filename.export_filename()
 
-    # Use user specified time for data collection, otherwise config value
-    collection_time = args.time if args.time else config.get_default_time()
-
     # Get collecter interfaces
-    collecters = _get_collecters(args.subcommands, collection_time)
-
-    # Asynchronously collect everything
-    results = _collect_results(collecters, collection_time)
+    collecters = _get_collecters(args.subcommands, collection_time, scope)
 
+    # Asynchronously collect everything, writing each section once collected
     with marple.common.data_io.Writer(str(filename)) as writer:
-        writer.write(results)
-
-    output.print_("Done.")
+        _collect_results(collecters, collection_time, writer,
+                         resource_governor)
@@ -0,0 +1,250 @@
+# -------------------------------------------------------------
+# overhead.py - accounts for the cost of collection itself
+# October 2018
+# -------------------------------------------------------------
+
+"""
+Self-overhead accounting for collection.
+
+Each collecter keeps an :class:`Overhead` account of what its collection
+cost: the CPU time, peak resident memory and context switches of the
+collection tools it ran, the bytes those tools produced, and the CPU time of
+its own parsing stages.
+The usage of the tools is sampled from /proc while they run, leaving
+asyncio's child watcher as it is; it includes the usage of their own
+descendants (e.g. perf run through sudo). As it is sampled, the usage in the
+last interval before a tool exits may be missed.
+
+"""
+
+__all__ = (
+    'run_timed',
+    'Overhead',
+)
+
+import asyncio
+import logging
+import os
+import resource
+
+logger = logging.getLogger(__name__)
+logger.debug('Entered module: %s', __name__)
+
+# Seconds between samples of the usage of a collection tool
+SAMPLE_INTERVAL = 0.1
+
+
+class _ToolUsage:
+    """
+    The usage of a collection tool and its descendants, as last sampled.
+
+    .. attribute:: measured:
+        Whether the tool was sampled at all.
+    .. attribute:: cpu_time:
+        The CPU time, in seconds, including that of the descendants that
+        have exited.
+    .. attribute:: max_rss:
+        The largest peak resident memory of any of the processes, in bytes.
+
+    """
+
+    def __init__(self, pid):
+        """
+        Initialise the usage.
+
+        :param pid:
+            The process ID of the tool.
+
+        """
+        self.pid = pid
+        self.measured = False
+        self.cpu_time = 0.0
+        self.max_rss = 0
+        # The context switches of each process seen, as last sampled
+        self._switches = {}
+
+    @property
+    def context_switches(self):
+        """ The context switches of the processes seen. """
+        return sum(self._switches.values())
+
+    def sample(self):
+        """
+        Read the usage of the tool's process tree from /proc.
+
+        :return:
+            Whether the tool is still running.
+
+        """
+        clock_ticks = os.sysconf("SC_CLK_TCK")
+        cpu = 0.0
+        running = True
+        pids = [self.pid]
+        for pid in pids:
+            try:
+                with open("/proc/{}/stat".format(pid)) as file_:
+                    # Skip the command name, which may contain spaces
+                    fields = file_.read().rsplit(")", 1)[1].split()
+                with open("/proc/{}/status".format(pid)) as file_:
+                    status = dict(line.split(":", 1) for line in file_)
+            except (OSError, IndexError, ValueError):
+                if pid == self.pid:
+                    # The tool has been reaped
+                    return False
+                # The process exited meanwhile
+                continue
+            try:
+                for tid in os.listdir("/proc/{}/task".format(pid)):
+                    with open("/proc/{}/task/{}/children".format(pid, tid)) \
+                            as file_:
+                        pids.extend(int(child)
+                                    for child in file_.read().split())
+            except OSError:
+                pass
+            if pid == self.pid:
+                # A zombie has exited, and its times are final
+                running = fields[0] not in "ZX"
+            # utime, stime, cutime and cstime are fields 14 to 17 of the stat
+            # file; the last two are the times of the children reaped
+            cpu += sum(int(field) for field in fields[11:15]) / clock_ticks
+            if "VmHWM" in status:
+                # In kilobytes; absent once the process has exited
+                self.max_rss = max(self.max_rss,
+                                   int(status["VmHWM"].split()[0]) * 1024)
+            self._switches[pid] = \
+                int(status["voluntary_ctxt_switches"]) + \
+                int(status["nonvoluntary_ctxt_switches"])
+
+        self.measured = True
+        self.cpu_time = max(self.cpu_time, cpu)
+        return running
+
+    async def run(self):
+        """ Sample the usage every interval, until the tool has exited. """
+        while self.sample():
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+
+def run_timed(function, *args):
+    """
+    Call a function, measuring the CPU time of the calling thread.
+
+    Picklable, so that it can be run in a process pool.
+
+    :param function:
+        The function to call.
+    :param args:
+        The arguments to call it with.
+    :return:
+        The result of the function, and the CPU time it took in seconds.
+
+    """
+    before = resource.getrusage(resource.RUSAGE_THREAD)
+    result = function(*args)
+    after = resource.getrusage(resource.RUSAGE_THREAD)
+    return result, (after.ru_utime - before.ru_utime +
+                    after.ru_stime - before.ru_stime)
+
+
+class Overhead:
+    """ The cost of one or more collections by a collecter. """
+
+    def __init__(self):
+        """ Initialise an empty account. """
+        # Seconds of collection
+        self.wall_time = 0.0
+        # Usage of the collection tools, that have been measured
+        self.subprocesses = 0
+        self.cpu_time = 0.0
+        self.max_rss = 0
+        self.context_switches = 0
+        # Bytes of output read from the collection tools
+        self.output_bytes = 0
+        # CPU time of marple's parsing stages
+        self.parse_time = 0.0
+        # The usage of the tools tracked, and the tasks sampling it
+        self._tools = []
+
+    def track(self, sub_process):
+        """
+        Charge a collection tool to this account, sampling its usage until it
+        exits.
+
+        Must be called from a coroutine, as soon as the tool has started.
+
+        :param sub_process:
+            The asyncio subprocess running the tool.
+
+        """
+        usage = _ToolUsage(sub_process.pid)
+        self._tools.append((usage, asyncio.ensure_future(usage.run())))
+
+    def add_output(self, nbytes):
+        """ Count bytes of output read from a collection tool. """
+        self.output_bytes += nbytes
+
+    def add_parse_time(self, seconds):
+        """ Count CPU time spent parsing. """
+        self.parse_time += seconds
+
+    def finish(self, wall_time):
+        """
+        Complete the account of a collection, taking the usage of the tools
+        tracked.
+
+        :param wall_time:
+            The number of seconds the collection took.
+
+        """
+        self.wall_time += wall_time
+        tools, self._tools = self._tools, []
+        for usage, task in tools:
+            task.cancel()
+            if not usage.measured:
+                continue
+            self.subprocesses += 1
+            self.cpu_time += usage.cpu_time
+            self.max_rss = max(self.max_rss, usage.max_rss)
+            self.context_switches += usage.context_switches
+
+    def add(self, other):
+        """ Add the cost of another account to this one. """
+        self.wall_time += other.wall_time
+        self.subprocesses += other.subprocesses
+        self.cpu_time += other.cpu_time
+        self.max_rss = max(self.max_rss, other.max_rss)
+        self.context_switches += other.context_switches
+        self.output_bytes += other.output_bytes
+        self.parse_time += other.parse_time
+
+    def cpu_percent(self):
+        """
+        :return:
+            The CPU time of the tools and the parsing, in percent of one CPU
+            over the collection time.
+
+        """
+        if self.wall_time == 0:
+            return 0.0
+        return 100 * (self.cpu_time + self.parse_time) / self.wall_time
+
+    def as_dict(self):
+        """ :return: The account, as a dictionary for a section header. """
+        return {
+            "wall_seconds": round(self.wall_time, 3),
+            "subprocesses": self.subprocesses,
+            "subprocess_cpu_seconds": round(self.cpu_time, 3),
+            "subprocess_max_rss_bytes": self.max_rss,
+            "subprocess_context_switches": self.context_switches,
+            "output_bytes": self.output_bytes,
+            "parse_cpu_seconds": round(self.parse_time, 3),
+            "cpu_percent": round(self.cpu_percent(), 2),
+        }
+
+    def __str__(self):
+        return "{:.1f}% of one CPU ({:.2f}s tools, {:.2f}s parsing), " \
+               "max RSS {:.1f} MB, {} context switches, {:.1f} MB " \
+               "produced".format(self.cpu_percent(), self.cpu_time,
+                                 self.parse_time, self.max_rss / 2 ** 20,
+                                 self.context_switches,
+                                 self.output_bytes / 2 ** 20)
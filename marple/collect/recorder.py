@@ -0,0 +1,419 @@
+# -------------------------------------------------------------
+# recorder.py - continuous collection into bounded ring buffers
+# October 2018
+# -------------------------------------------------------------
+
+"""
+Flight-recorder mode: collect continuously, keep only recent data.
+
+The collecters are run over and over in short segments. The data of each
+segment is kept in a :class:`RingBuffer` per interface, which evicts segments
+older than the recording window and, oldest first, whatever exceeds the
+memory cap.
+On a trigger (SIGUSR1, a `dump` command on the control socket, or the load
+average reaching a threshold) the buffered data is dumped to a new data file.
+
+Each segment is collected by fresh copies of the collecters (see
+:meth:`Collecter.clone`), and the next segment starts as soon as the last one
+has been recording for the segment time: the next segment records while the
+data of the last one is processed (e.g. by perf script), so the recording is
+continuous. At most one segment is processed while another records; should
+processing take longer than recording, the time left unrecorded between
+segments is measured, and reported by the `status` command.
+
+"""
+
+__all__ = (
+    'RingBuffer',
+    'FlightRecorder',
+)
+
+import asyncio
+import collections
+import datetime
+import logging
+import os
+import signal
+import sys
+import typing
+
+from marple.collect.governor import Governor
+from marple.collect.interface import ebpf
+from marple.common import (
+    data_io,
+    file,
+    output,
+    util
+)
+
+logger = logging.getLogger(__name__)
+logger.debug('Entered module: %s', __name__)
+
+
+class _Segment(typing.NamedTuple):
+    """
+    The data collected by one collecter in one segment.
+
+    .. attribute:: start_time, end_time:
+        The times the segment was recorded between.
+    .. attribute:: lines:
+        The datum objects, in their string representation.
+    .. attribute:: nbytes:
+        The memory used by the lines, in bytes.
+
+    """
+    start_time: datetime.datetime
+    end_time: datetime.datetime
+    lines: list
+    nbytes: int
+
+
+class RingBuffer:
+    """
+    Holds the most recent segments of data from one collecter.
+
+    Datum objects are held as the strings they are written to file as; the
+    memory used is accounted for by the size of the string objects, including
+    their overhead.
+
+    """
+
+    def __init__(self, window, max_bytes):
+        """
+        Initialise the buffer.
+
+        :param window:
+            The number of seconds of data to keep.
+        :param max_bytes:
+            The maximum memory used by the buffered lines, in bytes.
+
+        """
+        self.window = datetime.timedelta(seconds=window)
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.dropped = 0
+        self._segments = collections.deque()
+
+    def add(self, start_time, end_time, datums):
+        """
+        Add a segment of data, evicting old data to make room for it.
+
+        If the segment on its own exceeds the memory cap, the datum objects
+        that do not fit are dropped and counted in :attr:`dropped`.
+
+        :param start_time, end_time:
+            The times the segment was recorded between.
+        :param datums:
+            An iterable of datum objects.
+
+        """
+        lines, nbytes = [], 0
+        for datum in datums:
+            line = str(datum)
+            size = sys.getsizeof(line)
+            if nbytes + size > self.max_bytes:
+                self.dropped += 1
+                continue
+            lines.append(line)
+            nbytes += size
+
+        self._segments.append(_Segment(start_time, end_time, lines, nbytes))
+        self.nbytes += nbytes
+        self.evict(end_time)
+
+    def evict(self, now):
+        """
+        Remove the segments that ended before the window, or that do not fit
+        in the memory cap.
+
+        :param now:
+            The current time.
+
+        """
+        while self._segments and \
+                (self._segments[0].end_time < now - self.window or
+                 self.nbytes > self.max_bytes):
+            self.nbytes -= self._segments.popleft().nbytes
+
+    def segments(self, since=None):
+        """
+        :param since:
+            If given, only return the segments that ended after this time.
+        :return:
+            A list of the buffered segments, oldest first.
+
+        """
+        return [segment for segment in self._segments
+                if since is None or segment.end_time > since]
+
+
+class FlightRecorder:
+    """
+    Runs collecters continuously and dumps their recent data on demand.
+
+    .. attribute:: unrecorded:
+        The total number of seconds between the end of one segment's
+        recording and the start of the next, when they do not overlap.
+
+    """
+
+    def __init__(self, collecters, window, segment_time, memory_cap,
+                 socket_path=None, load_threshold=0, governor=None):
+        """
+        Initialise the recorder.
+
+        :param collecters:
+            The collecters to run copies of; their time is set to the segment
+            time.
+        :param window:
+            The number of seconds of data kept and dumped.
+        :param segment_time:
+            The number of seconds each collecter runs for at a time.
+            Data is evicted one segment at a time.
+        :param memory_cap:
+            The maximum number of bytes of buffered data, shared equally
+            between the collecters.
+        :param socket_path:
+            The path of a Unix socket accepting commands, or None; the socket
+            is only accessible by its owner.
+        :param load_threshold:
+            Dump when the 1-minute load average reaches this value; 0 never
+            dumps on load.
+        :param governor:
+            The :class:`Governor` to collect through; by default there is no
+            budget.
+
+        """
+        self.collecters = collecters
+        self.window = window
+        self.segment_time = segment_time
+        self.socket_path = socket_path
+        self.load_threshold = load_threshold
+        self.governor = governor if governor is not None else Governor()
+
+        max_bytes = memory_cap // max(len(collecters), 1)
+        self.buffers = [RingBuffer(window, max_bytes) for _ in collecters]
+        # The data class, interface, data options and annotations of each
+        # collecter, as last collected
+        self._templates = [None] * len(collecters)
+        self._last_threshold_dump = None
+        self._stopped = None
+        self.unrecorded = 0.0
+
+    @util.log(logger)
+    def dump(self, seconds=None):
+        """
+        Write the buffered data to a new data file.
+
+        :param seconds:
+            If given, only dump the segments of the last this many seconds.
+        :return:
+            The name of the file written.
+
+        """
+        since = None
+        if seconds is not None:
+            since = datetime.datetime.now() - \
+                    datetime.timedelta(seconds=seconds)
+
+        filename = file.DataFileName()
+        with data_io.Writer(str(filename)) as writer:
+            for buffer, template in zip(self.buffers, self._templates):
+                segments = buffer.segments(since)
+                if template is None or not segments:
+                    continue
+                data_class, interface, data_options, annotations = template
+                datums = (data_class.datum_class.from_string(line)
+                          for segment in segments for line in segment.lines)
+                data = data_class(datums, segments[0].start_time,
+                                  segments[-1].end_time, interface,
+                                  data_options)
+                data.annotations = annotations
+                writer.write_section(data)
+        filename.export_filename()
+
+        output.print_("Dumped flight recorder data to {}".format(filename))
+        return str(filename)
+
+    def _store(self, index, data, start_time, end_time):
+        """
+        Add the data from one collecter's segment to its buffer.
+
+        The segment is stamped with the times the collecter recorded between,
+        where it gives them.
+
+        """
+        # The governor dropped the collecter to keep within budget
+        if data is None:
+            return
+        if data.datum_generator is None:
+            logger.error("Interface %s errored while recording",
+                         data.interface.value)
+            return
+        self._templates[index] = (type(data), data.interface,
+                                  data.data_options, data.annotations)
+        if isinstance(data.start_time, datetime.datetime):
+            start_time = data.start_time
+        if isinstance(data.end_time, datetime.datetime):
+            end_time = data.end_time
+        self.buffers[index].add(start_time, end_time, data.datum_generator)
+
+    async def _record_segment(self, previous=None):
+        """
+        Run a copy of every collecter for one segment and buffer their data.
+
+        The data is buffered after that of the previous segment; the time
+        between the end of the previous segment's recording and the start of
+        this one, if any, is added to :attr:`unrecorded`.
+
+        :param previous:
+            The future of the previous segment, which may still be running.
+        :return:
+            The times the segment started, and its recording ended.
+
+        """
+        start_time = datetime.datetime.now()
+        copies = []
+        for collecter in self.collecters:
+            collecter.time = self.segment_time
+            copies.append(collecter.clone())
+        # The copies tracing malloc share a session of their own
+        ebpf.share_malloc_session(copies)
+        results = await asyncio.gather(*[
+            self.governor.collect(copy_, collecter)
+            for copy_, collecter in zip(copies, self.collecters)])
+        end_time = datetime.datetime.now()
+
+        # The collecters stop recording before processing their data
+        recorded_ends = [data.end_time for data in results
+                         if data is not None and
+                         isinstance(data.end_time, datetime.datetime)]
+        recorded_until = max(recorded_ends, default=end_time)
+
+        if previous is not None:
+            _, previous_until = await previous
+            gap = (start_time - previous_until).total_seconds()
+            if gap > 0:
+                self.unrecorded += gap
+                logger.debug("%f seconds unrecorded between segments", gap)
+        for index, data in enumerate(results):
+            self._store(index, data, start_time, end_time)
+        return start_time, recorded_until
+
+    def _check_threshold(self):
+        """ Dump if the load average has reached the threshold. """
+        if not self.load_threshold:
+            return
+        now = datetime.datetime.now()
+        # Dump at most once per window, so that a sustained load does not
+        # write the same data over and over
+        if self._last_threshold_dump is not None and \
+                now - self._last_threshold_dump < \
+                datetime.timedelta(seconds=self.window):
+            return
+        load = os.getloadavg()[0]
+        if load >= self.load_threshold:
+            logger.info("Load average %f reached threshold", load)
+            self._last_threshold_dump = now
+            self.dump()
+
+    async def _handle_command(self, reader, writer):
+        """
+        Serve a connection to the control socket.
+
+        Each line is a command: `dump [seconds]` dumps and replies with the
+        file name, `status` replies with the memory used by each buffer and
+        the time left unrecorded between segments.
+
+        """
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line.decode().split()
+            if not command:
+                continue
+            if command[0] == "dump" and len(command) <= 2:
+                try:
+                    seconds = int(command[1]) if len(command) == 2 else None
+                except ValueError:
+                    reply = "Invalid number of seconds: " + command[1]
+                else:
+                    reply = self.dump(seconds)
+            elif command == ["status"]:
+                reply = ", ".join(
+                    "{}: {} bytes".format(
+                        collecter.__class__.__name__, buffer.nbytes)
+                    for collecter, buffer in zip(self.collecters,
+                                                 self.buffers))
+                reply += ", {:.1f} s unrecorded".format(self.unrecorded)
+            else:
+                reply = "Unknown command: " + " ".join(command)
+            writer.write((reply + "\n").encode())
+            await writer.drain()
+        writer.close()
+
+    def stop(self):
+        """ Stop recording after the current segments. """
+        self._stopped.set()
+
+    async def _start_server(self):
+        """
+        Listen on the control socket, which only its owner can connect to.
+
+        :return:
+            The :class:`asyncio.AbstractServer`.
+
+        """
+        # Create the socket without group or other permissions, rather than
+        # changing them once others may have connected
+        old_umask = os.umask(0o177)
+        try:
+            return await asyncio.start_unix_server(self._handle_command,
+                                                   path=self.socket_path)
+        finally:
+            os.umask(old_umask)
+
+    @util.log(logger)
+    async def run(self):
+        """
+        Record until stopped, by :meth:`stop`, SIGINT or SIGTERM.
+
+        SIGUSR1 dumps the buffered data.
+
+        """
+        loop = asyncio.get_event_loop()
+        self._stopped = asyncio.Event()
+        loop.add_signal_handler(signal.SIGUSR1, self.dump)
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+
+        server = None
+        if self.socket_path:
+            server = await self._start_server()
+        segment = None
+        try:
+            while not self._stopped.is_set():
+                started = loop.time()
+                previous, segment = segment, asyncio.ensure_future(
+                    self._record_segment(segment))
+                if previous is not None:
+                    await previous
+                    self._check_threshold()
+                # Start the next segment once this one has recorded for the
+                # segment time, while its data is processed
+                await asyncio.wait(
+                    [segment],
+                    timeout=max(0, started + self.segment_time - loop.time()))
+            if segment is not None:
+                await segment
+                self._check_threshold()
+        finally:
+            if segment is not None and not segment.done():
+                segment.cancel()
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+                os.remove(self.socket_path)
+            for signum in (signal.SIGUSR1, signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signum)
@@ -0,0 +1,176 @@
+# -------------------------------------------------------------
+# scheduler.py - duty-cycled periodic collection
+# October 2018
+# -------------------------------------------------------------
+
+"""
+Duty-cycled mode: collect for a while at regular intervals.
+
+The process stays resident, so the collecters are set up once, and every
+period runs them for the collection time.
+Each window of data is appended to the current data file as new sections;
+the file is closed and a new one started once it reaches a size or age
+limit, and the oldest files written are deleted to keep within a disk budget.
+The budget counts the file being written, which is never deleted: after each
+window the files take at most the larger of the budget and the size of the
+current file, which is at most the rotation size plus one window of data.
+
+"""
+
+__all__ = (
+    'DutyCycle',
+)
+
+import asyncio
+import contextlib
+import logging
+import os
+import signal
+
+from marple.collect.governor import Governor
+from marple.common import (
+    data_io,
+    file,
+    util
+)
+
+logger = logging.getLogger(__name__)
+logger.debug('Entered module: %s', __name__)
+
+
+class DutyCycle:
+    """ Runs collecters periodically, writing to rolling data files. """
+
+    def __init__(self, collecters, period, rotate_bytes, rotate_seconds,
+                 disk_budget, governor=None):
+        """
+        Initialise the scheduler.
+
+        :param collecters:
+            The collecters to run, each for its own collection time.
+        :param period:
+            The number of seconds from the start of one collection to the
+            start of the next.
+        :param rotate_bytes:
+            Start a new file once the current one is this large.
+        :param rotate_seconds:
+            Start a new file once the current one is this old.
+        :param disk_budget:
+            The maximum number of bytes of the files written, including the
+            current one; the oldest closed files are deleted to keep within
+            it.
+        :param governor:
+            The :class:`Governor` to collect through; by default there is no
+            budget.
+
+        """
+        self.collecters = collecters
+        self.period = period
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.disk_budget = disk_budget
+        self.governor = governor if governor is not None else Governor()
+
+        # The files closed so far, oldest first
+        self.files = []
+        # Holds the writer of the current file open across collections
+        self._file_stack = contextlib.ExitStack()
+        self._writer = None
+        self._filename = None
+        self._opened = None
+        self._stopped = None
+
+    def _open(self, now):
+        """ Start a new data file. """
+        self._filename = file.DataFileName()
+        self._writer = self._file_stack.enter_context(
+            data_io.Writer(str(self._filename)))
+        self._opened = now
+        logger.info("Writing to %s", self._filename)
+
+    def _close(self):
+        """ Finish the current data file and enforce the disk budget. """
+        self._file_stack.close()
+        self._filename.export_filename()
+        self.files.append(str(self._filename))
+        self._writer = None
+        self._enforce_budget()
+
+    def _enforce_budget(self):
+        """
+        Delete the oldest closed files until the files written, including the
+        current one, fit in the disk budget.
+
+        The current file, or once closed the newest file, is kept even if it
+        alone exceeds the budget.
+
+        """
+        if self._writer is not None:
+            current_size = self._writer.file.tell()
+            kept = 0
+        else:
+            current_size = 0
+            kept = 1
+        sizes = [os.path.getsize(filename) for filename in self.files]
+        while len(self.files) > kept and \
+                current_size + sum(sizes) > self.disk_budget:
+            filename = self.files.pop(0)
+            sizes.pop(0)
+            logger.info("Removing %s to keep within the disk budget",
+                        filename)
+            os.remove(filename)
+
+    async def _collect_window(self):
+        """ Run the collecters once, writing each section as it completes. """
+        for future in asyncio.as_completed([self.governor.collect(collecter)
+                                            for collecter in self.collecters]):
+            data = await future
+            # The governor dropped the collecter to keep within budget
+            if data is None:
+                continue
+            if data.datum_generator is None:
+                logger.error("Interface %s errored", data.interface.value)
+            else:
+                self._writer.write_section(data)
+            del data
+
+    def stop(self):
+        """ Stop after the current collection. """
+        self._stopped.set()
+
+    @util.log(logger)
+    async def run(self):
+        """
+        Collect every period until stopped, by :meth:`stop`, SIGINT or
+        SIGTERM.
+
+        """
+        loop = asyncio.get_event_loop()
+        self._stopped = asyncio.Event()
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+
+        try:
+            while not self._stopped.is_set():
+                start = loop.time()
+                if self._writer is None:
+                    self._open(start)
+                await self._collect_window()
+
+                if self._writer.file.tell() >= self.rotate_bytes or \
+                        loop.time() - self._opened >= self.rotate_seconds:
+                    self._close()
+                else:
+                    self._enforce_budget()
+
+                # Sleep for the rest of the period, unless stopped
+                try:
+                    await asyncio.wait_for(self._stopped.wait(),
+                                           start + self.period - loop.time())
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if self._writer is not None:
+                self._close()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signum)
@@ -0,0 +1,104 @@
+# -------------------------------------------------------------
+# test_collecter.py - tests for the collecter base class
+# October 2018
+# -------------------------------------------------------------
+
+""" Test limiting collection to a scope of processes, and stopping tools. """
+
+import asyncio
+import os
+import signal
+import tempfile
+import unittest
+from unittest import mock
+
+import asynctest
+
+from marple.collect.interface import collecter
+
+
+class ScopeTest(unittest.TestCase):
+    """ Test resolving the processes in scope. """
+
+    def test_system_wide(self):
+        self.assertTrue(collecter.Scope().system_wide)
+        self.assertFalse(collecter.Scope(pids=(1,)).system_wide)
+        self.assertFalse(collecter.Scope(cgroup="a").system_wide)
+
+    def test_resolve_comm(self):
+        with open("/proc/self/comm") as file_:
+            comm = file_.read().rstrip("\n")
+
+        scope = collecter.Scope(pids=(1,), comm=comm).resolve()
+
+        self.assertIn(os.getpid(), scope.pids)
+        self.assertIn(1, scope.pids)
+        self.assertEqual(comm, scope.comm)
+
+    def test_resolve_no_match(self):
+        with self.assertRaises(ValueError):
+            collecter.Scope(comm="no such command").resolve()
+
+    def test_cgroup_processes(self):
+        """ Test that the processes and the cgroup must both match. """
+        with tempfile.TemporaryDirectory() as root, \
+                mock.patch("marple.collect.governor.CGROUP_ROOT", root):
+            os.makedirs(os.path.join(root, "a", "b"))
+            with open(os.path.join(root, "a", "b", "cgroup.procs"), "w") \
+                    as file_:
+                file_.write("3\n1\n")
+
+            self.assertEqual(os.path.join(root, "a", "b"),
+                             collecter.Scope(cgroup="/a/b").cgroup_path())
+            self.assertEqual([1, 3],
+                             collecter.Scope(cgroup="a/b").processes())
+            self.assertEqual([1], collecter.Scope(pids=(1, 2),
+                                                  cgroup="a/b").processes())
+
+    def test_threads(self):
+        scope = collecter.Scope(pids=(os.getpid(),))
+        self.assertIn(os.getpid(), scope.threads())
+
+    def test_as_dict(self):
+        self.assertEqual({"pids": [1, 2], "cgroup": None, "comm": "dd"},
+                         collecter.Scope((1, 2), None, "dd").as_dict())
+
+
+def _children(pid):
+    with open("/proc/{0}/task/{0}/children".format(pid)) as file_:
+        return [int(child) for child in file_.read().split()]
+
+
+def _running(pid):
+    """ Whether a process exists and is not a zombie. """
+    try:
+        with open("/proc/{}/stat".format(pid)) as file_:
+            return file_.read().rsplit(")", 1)[1].split()[0] not in "ZX"
+    except FileNotFoundError:
+        return False
+
+
+class AwaitToolTest(asynctest.TestCase):
+    """ Test stopping a tool when its collection is cancelled. """
+
+    async def test_cancel(self):
+        """ Test that the tool and the process it started are killed. """
+        sub_process = await asyncio.create_subprocess_exec(
+            "sh", "-c", "sleep 60 & wait")
+        while not _children(sub_process.pid):
+            await asyncio.sleep(0.01)
+        child, = _children(sub_process.pid)
+
+        task = asyncio.ensure_future(
+            collecter.await_tool(sub_process, sub_process.wait()))
+        await asyncio.sleep(0)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+        self.assertEqual(-signal.SIGKILL, sub_process.returncode)
+        for _ in range(100):
+            if not _running(child):
+                break
+            await asyncio.sleep(0.01)
+        self.assertFalse(_running(child))
@@ -10,7 +10,7 @@ import asynctest
 from io import StringIO
 
 
-from marple.collect.interface import ebpf
+from marple.collect.interface import collecter, ebpf
 from marple.common import data_io, consts
 
 
@@ -21,13 +21,18 @@ class Mallocstacks(asynctest.TestCase):
     """
     time = 5
 
-    async def mock(self, out):
+    async def mock(self, out, options=ebpf.MallocStacks._DEFAULT_OPTIONS,
+                   sample_args=('-s', '1')):
         """
         Helper method for mocking the mallocstqqacks.py subprocess.
         Also tests that the appropriate subprocess call is made.
 
         :param out:
             Desired stdout output for the subprocess.
+        :param options:
+            The options passed to the collecter.
+        :param sample_args:
+            The sampling arguments expected to be passed to the tool.
         :return:
             A generator of StackDatum objects created from the desired output.
 
@@ -46,11 +51,13 @@ class Mallocstacks(asynctest.TestCase):
             pipe_mock = async_mock.subprocess.PIPE
 
             # Run collecter
-            gen = await ebpf.MallocStacks(self.time).collect()
+            gen = await ebpf.MallocStacks(self.time, options).collect()
             create_mock.assert_has_calls([
                 asynctest.call(
                     'sudo', 'python', ebpf.BCC_TOOLS_PATH + 'mallocstacks.py',
-                    '-f', str(self.time), stderr=pipe_mock, stdout=pipe_mock
+                    '-f', *sample_args, '--stack-storage-size', '2048',
+                    str(self.time), stderr=pipe_mock,
+                    stdout=pipe_mock
                 ),
                 asynctest.call().communicate()
             ])
@@ -92,6 +99,404 @@ class Mallocstacks(asynctest.TestCase):
         output = await self.mock(mock_return_popen_stdout)
         self.assertEqual(output, expected)
 
+    async def test_sampling_options(self):
+        """
+        Test that the sampling options are passed on to the tool, with byte
+        sampling taking precedence over call sampling
+
+        """
+        mock_return_popen_stdout = str.encode(consts.field_separator.join(
+            ["1048576", "proc1", "func1"]) + "\n")
+        expected = [data_io.StackDatum(1048576, ("proc1", "func1"))]
+
+        options = ebpf.MallocStacks.Options(sample_rate=10, sample_bytes=0)
+        output = await self.mock(mock_return_popen_stdout, options,
+                                 ('-s', '10'))
+        self.assertEqual(expected, output)
+
+        options = ebpf.MallocStacks.Options(sample_rate=10,
+                                            sample_bytes=524288)
+        output = await self.mock(mock_return_popen_stdout, options,
+                                 ('-b', '524288'))
+        self.assertEqual(expected, output)
+
+    @asynctest.patch('marple.common.util.platform.release')
+    def test_back_off(self, release_mock):
+        """ Test that backing off doubles the sampling rate in use. """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+
+        collecter = ebpf.MallocStacks(self.time)
+        self.assertEqual("sample_rate 1 -> 2", collecter.back_off())
+
+        collecter = ebpf.MallocStacks(
+            self.time, ebpf.MallocStacks.Options(1, 4096))
+        self.assertEqual("sample_bytes 4096 -> 8192", collecter.back_off())
+        self.assertEqual(ebpf.MallocStacks.Options(1, 8192), collecter.options)
+
+    @asynctest.patch('marple.common.util.platform.release')
+    def test_back_off_cap(self, release_mock):
+        """ Test that backing off stops at the sparsest sampling. """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+
+        collecter = ebpf.MallocStacks(self.time, ebpf.MallocStacks.Options(
+            ebpf.MAX_SAMPLE_RATE // 2 + 1, 0))
+        self.assertEqual("sample_rate {} -> {}".format(
+            ebpf.MAX_SAMPLE_RATE // 2 + 1, ebpf.MAX_SAMPLE_RATE),
+            collecter.back_off())
+        self.assertIsNone(collecter.back_off())
+        self.assertEqual(ebpf.MAX_SAMPLE_RATE, collecter.options.sample_rate)
+
+    @asynctest.patch('marple.common.util.platform.release')
+    def test_scale_buffers(self, release_mock):
+        """ Test that the stack map is enlarged, up to the maximum. """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+
+        collecter = ebpf.MallocStacks(self.time)
+        self.assertEqual("stack_storage_size 2048 -> 8192",
+                         collecter.scale_buffers(0.75))
+        self.assertEqual(8192, collecter.options.stack_storage_size)
+
+        collecter.options = collecter.options._replace(
+            stack_storage_size=ebpf.MAX_STACK_STORAGE_SIZE)
+        self.assertIsNone(collecter.scale_buffers(0.75))
+
+    async def test_missing_stacks(self):
+        """ Test that stacks the tool could not store are recorded. """
+        with asynctest.patch('marple.collect.interface.ebpf.asyncio') \
+                as async_mock, \
+                asynctest.patch('marple.common.util.platform.release') \
+                as release_mock:
+            release_mock.return_value = "100.0.0"
+            create_mock = asynctest.CoroutineMock()
+            async_mock.create_subprocess_exec = create_mock
+            create_mock.return_value.returncode = 0
+            create_mock.return_value.communicate = asynctest.CoroutineMock(
+                return_value=(
+                    str.encode(consts.field_separator.join(
+                        ["123", "proc1", "func1"]) + "\n"),
+                    b"WARNING: 3 stack traces could not be displayed."))
+
+            data = await ebpf.MallocStacks(self.time).collect()
+
+        self.assertEqual({"lost": 3, "recorded": 1, "ratio": 0.75},
+                         data.annotations["loss"])
+
+
+class MemleakTest(asynctest.TestCase):
+    """
+    Class that tests the memusage (memleak) interface
+
+    """
+    time = 10
+
+    @asynctest.patch('marple.common.util.platform.release')
+    async def test_snapshots_streamed(self, release_mock):
+        """
+        Test that the time-stamped snapshots are read from the tool's output
+
+        """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+
+        stdout, stderr = asyncio.StreamReader(), asyncio.StreamReader()
+        stdout.feed_data(str.encode("\n".join([
+            consts.field_separator.join(["1024", "5s", "proc1(42)"]),
+            consts.field_separator.join(["4096", "10s", "proc1(42)"]),
+            ""
+        ])))
+        stdout.feed_eof()
+        stderr.feed_eof()
+
+        with asynctest.patch('marple.collect.interface.ebpf.asyncio.'
+                             'create_subprocess_exec') as create_mock:
+            process_mock = create_mock.return_value
+            process_mock.stdout, process_mock.stderr = stdout, stderr
+            process_mock.wait = asynctest.CoroutineMock()
+            process_mock.returncode = 0
+
+            options = ebpf.Memleak.Options(top_processes=5,
+                                           snapshot_interval=5)
+            data = await ebpf.Memleak(self.time, options).collect()
+
+            create_mock.assert_called_once_with(
+                'sudo', 'python', ebpf.BCC_TOOLS_PATH + 'memleak.py',
+                '-T', '5', '-d', '10', '5', '2',
+                stderr=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+            )
+
+        expected = [data_io.StackDatum(1024, ("5s", "proc1(42)")),
+                    data_io.StackDatum(4096, ("10s", "proc1(42)"))]
+        self.assertEqual(expected, list(data.datum_generator))
+        self.assertTrue(data.data_options.snapshots)
+
+    @asynctest.patch('marple.common.util.platform.release')
+    async def test_lost_allocations(self, release_mock):
+        """
+        Test that the allocations missing from the snapshots are recorded as
+        lost
+
+        """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+
+        stdout, stderr = asyncio.StreamReader(), asyncio.StreamReader()
+        stdout.feed_eof()
+        stderr.feed_data(b"Counted 300 allocations, lost 100\n")
+        stderr.feed_eof()
+
+        with asynctest.patch('marple.collect.interface.ebpf.asyncio.'
+                             'create_subprocess_exec') as create_mock:
+            process_mock = create_mock.return_value
+            process_mock.stdout, process_mock.stderr = stdout, stderr
+            process_mock.wait = asynctest.CoroutineMock()
+            process_mock.returncode = 0
+
+            data = await ebpf.Memleak(self.time).collect()
+
+        self.assertEqual({"lost": 100, "recorded": 300, "ratio": 0.25},
+                         data.annotations["loss"])
+
+    @asynctest.patch('marple.common.util.platform.release')
+    async def test_last_snapshot_at_end(self, release_mock):
+        """
+        Test that the last snapshot is taken at the end of a collection time
+        that is not a multiple of the interval
+
+        """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+
+        stdout, stderr = asyncio.StreamReader(), asyncio.StreamReader()
+        stdout.feed_eof()
+        stderr.feed_eof()
+
+        with asynctest.patch('marple.collect.interface.ebpf.asyncio.'
+                             'create_subprocess_exec') as create_mock:
+            process_mock = create_mock.return_value
+            process_mock.stdout, process_mock.stderr = stdout, stderr
+            process_mock.wait = asynctest.CoroutineMock()
+            process_mock.returncode = 0
+
+            options = ebpf.Memleak.Options(top_processes=5,
+                                           snapshot_interval=5)
+            await ebpf.Memleak(7, options).collect()
+
+            create_mock.assert_called_once_with(
+                'sudo', 'python', ebpf.BCC_TOOLS_PATH + 'memleak.py',
+                '-T', '5', '-d', '7', '5', '2',
+                stderr=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+            )
+
+
+class MallocSessionTest(asynctest.TestCase):
+    """
+    Class that tests running mallocstacks and memusage in a shared session
+
+    """
+    time = 5
+
+    out = str.encode("\n".join([
+        "[mallocstacks]",
+        consts.field_separator.join(["2048", "proc1", "func1", "func2"]),
+        "[memusage]",
+        consts.field_separator.join(["1024", "5s", "proc1(42)"]),
+        ""
+    ]))
+
+    @asynctest.patch('marple.common.util.platform.release')
+    async def test_shared_collect(self, release_mock):
+        """
+        Test that both collecters get their section from a single run
+
+        """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+
+        with asynctest.patch('marple.collect.interface.ebpf.asyncio.'
+                             'create_subprocess_exec') as create_mock:
+            create_mock.return_value.returncode = 0
+            create_mock.return_value.communicate = asynctest.CoroutineMock(
+                return_value=(self.out, b''))
+
+            stacks = ebpf.MallocStacks(self.time)
+            memleak = ebpf.Memleak(self.time)
+            ebpf.share_malloc_session([stacks, memleak])
+            self.assertIs(stacks.session, memleak.session)
+
+            stacks_data, memleak_data = await asyncio.gather(
+                stacks.collect(), memleak.collect())
+
+            create_mock.assert_called_once_with(
+                'sudo', 'python', ebpf.BCC_TOOLS_PATH + 'mallocshared.py',
+                '-s', '1', '-T', '10', '--stack-storage-size', '2048',
+                '-i', '5', '-c', '1', str(self.time),
+                stderr=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+            )
+
+        self.assertEqual([data_io.StackDatum(2048,
+                                             ("proc1", "func1", "func2"))],
+                         list(stacks_data.datum_generator))
+        self.assertEqual([data_io.StackDatum(1024, ("5s", "proc1(42)"))],
+                         list(memleak_data.datum_generator))
+        self.assertEqual(consts.InterfaceTypes.MALLOCSTACKS,
+                         stacks_data.interface)
+        self.assertEqual(consts.InterfaceTypes.MEMLEAK, memleak_data.interface)
+
+    @asynctest.patch('marple.common.util.platform.release')
+    async def test_scoped_session(self, release_mock):
+        """
+        Test that the shared session is limited to the collecters' scope
+
+        """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+        scope = collecter.Scope(pids=(42, 43), cgroup="db")
+
+        with asynctest.patch('marple.collect.interface.ebpf.asyncio.'
+                             'create_subprocess_exec') as create_mock:
+            create_mock.return_value.returncode = 0
+            create_mock.return_value.communicate = asynctest.CoroutineMock(
+                return_value=(self.out, b''))
+
+            stacks = ebpf.MallocStacks(self.time)
+            memleak = ebpf.Memleak(self.time)
+            stacks.scope = memleak.scope = scope
+            ebpf.share_malloc_session([stacks, memleak])
+            await stacks.collect()
+
+            create_mock.assert_called_once_with(
+                'sudo', 'python', ebpf.BCC_TOOLS_PATH + 'mallocshared.py',
+                '-s', '1', '-T', '10', '--stack-storage-size', '2048',
+                '-i', '5', '-c', '1', '-p', '42,43', '--cgroup',
+                scope.cgroup_path(),
+                str(self.time),
+                stderr=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+            )
+
+    @asynctest.patch('marple.common.util.platform.release')
+    async def test_snapshots(self, release_mock):
+        """
+        Test that the shared session keeps the periodic memusage snapshots
+
+        """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+        out = str.encode("\n".join([
+            "[memusage]",
+            consts.field_separator.join(["1024", "2s", "proc1(42)"]),
+            "[memusage]",
+            consts.field_separator.join(["2048", "7s", "proc1(42)"]),
+            "[mallocstacks]",
+            consts.field_separator.join(["2048", "proc1", "func1"]),
+            ""
+        ]))
+
+        with asynctest.patch('marple.collect.interface.ebpf.asyncio.'
+                             'create_subprocess_exec') as create_mock:
+            create_mock.return_value.returncode = 0
+            create_mock.return_value.communicate = asynctest.CoroutineMock(
+                return_value=(out, b''))
+
+            stacks = ebpf.MallocStacks(7)
+            memleak = ebpf.Memleak(7, ebpf.Memleak.Options(
+                top_processes=10, snapshot_interval=5))
+            ebpf.share_malloc_session([stacks, memleak])
+            stacks_data, memleak_data = await asyncio.gather(
+                stacks.collect(), memleak.collect())
+
+            create_mock.assert_called_once_with(
+                'sudo', 'python', ebpf.BCC_TOOLS_PATH + 'mallocshared.py',
+                '-s', '1', '-T', '10', '--stack-storage-size', '2048',
+                '-i', '5', '-c', '2', '7',
+                stderr=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+            )
+
+        self.assertEqual([data_io.StackDatum(1024, ("2s", "proc1(42)")),
+                          data_io.StackDatum(2048, ("7s", "proc1(42)"))],
+                         list(memleak_data.datum_generator))
+        self.assertEqual([data_io.StackDatum(2048, ("proc1", "func1"))],
+                         list(stacks_data.datum_generator))
+
+    @asynctest.patch('marple.common.util.platform.release')
+    async def test_repeated_collect(self, release_mock):
+        """
+        Test that each collection gets a new run of the shared tool
+
+        """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+
+        with asynctest.patch('marple.collect.interface.ebpf.asyncio.'
+                             'create_subprocess_exec') as create_mock:
+            create_mock.return_value.returncode = 0
+            create_mock.return_value.communicate = asynctest.CoroutineMock(
+                return_value=(self.out, b''))
+
+            stacks = ebpf.MallocStacks(self.time)
+            memleak = ebpf.Memleak(self.time)
+            ebpf.share_malloc_session([stacks, memleak])
+
+            for _ in range(3):
+                await asyncio.gather(stacks.collect(), memleak.collect())
+            self.assertEqual(3, create_mock.call_count)
+
+            # A collecter collecting again on its own, as on a retry, does not
+            # get the finished run back
+            await stacks.collect()
+            self.assertEqual(4, create_mock.call_count)
+
+    @asynctest.patch('marple.common.util.platform.release')
+    def test_not_shared_alone(self, release_mock):
+        """
+        Test that a lone malloc collecter keeps its own tool
+
+        """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+
+        stacks = ebpf.MallocStacks(self.time)
+        ebpf.share_malloc_session([stacks])
+        self.assertIsNone(stacks.session)
+
+
+class DiskLatencyHistogramTest(asynctest.TestCase):
+    """
+    Class that tests the disk latency histogram interface
+
+    """
+    time = 10
+
+    @asynctest.patch('marple.common.util.platform.release')
+    async def test_weighted_points(self, release_mock):
+        """
+        Test that histogram slots are read as weighted datapoints
+
+        """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+
+        stdout, stderr = asyncio.StreamReader(), asyncio.StreamReader()
+        stdout.feed_data(str.encode("\n".join([
+            consts.field_separator.join(["0.0", "0.768", "sda dd(42)", "120"]),
+            consts.field_separator.join(["1.0", "1.536", "sda dd(42)", "7"]),
+            ""
+        ])))
+        stdout.feed_eof()
+        stderr.feed_eof()
+
+        with asynctest.patch('marple.collect.interface.ebpf.asyncio.'
+                             'create_subprocess_exec') as create_mock:
+            process_mock = create_mock.return_value
+            process_mock.stdout, process_mock.stderr = stdout, stderr
+            process_mock.wait = asynctest.CoroutineMock()
+            process_mock.returncode = 0
+
+            options = ebpf.DiskLatencyHistogram.Options(interval=1,
+                                                        linear_us=0)
+            data = await ebpf.DiskLatencyHistogram(self.time, options).collect()
+
+            create_mock.assert_called_once_with(
+                'sudo', 'python', ebpf.BCC_TOOLS_PATH + 'disklathist.py',
+                '-i', '1', '-L', '0', '10',
+                stderr=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+            )
+
+        expected = [data_io.PointDatum(0.0, 0.768, "sda dd(42)", 120),
+                    data_io.PointDatum(1.0, 1.536, "sda dd(42)", 7)]
+        self.assertEqual(expected, list(data.datum_generator))
+        self.assertEqual(1, data.data_options.x_bucket)
+
 
 class TCPTracerTest(asynctest.TestCase):
     time = 5
@@ -211,17 +616,16 @@ class TCPTracerTest(asynctest.TestCase):
 
     def test_generate_dict_empty(self):
         """ Test _generate_dict with empty data"""
-        tracer = object.__new__(ebpf.TCPTracer)
+        options = None
         data = StringIO(
             "header1\nheader2\n"
         )
-        result = tracer._generate_dict(data)
+        result = ebpf.TCPTracer._generate_dict(data, options)
         self.assertEqual({}, result)
 
     def test_generate_dict_single(self):
         """ Test _generate_dict with single entries for each port """
-        tracer = object.__new__(ebpf.TCPTracer)
-        tracer.options = None
+        options = None
         data = StringIO(
             "header1\n"
             "time type pid comm   ip  s_addr d_addr s_port d_port size netns\n"
@@ -231,7 +635,7 @@ class TCPTracerTest(asynctest.TestCase):
         )
 
         expected = {3: {(2, 'comm1')}, 4: {(7, 'comm2')}}
-        result = tracer._generate_dict(data)
+        result = ebpf.TCPTracer._generate_dict(data, options)
         self.assertEqual(expected, result)
 
     def test_generate_dict_single_ns(self):
@@ -240,8 +644,7 @@ class TCPTracerTest(asynctest.TestCase):
         only a single namespace
 
         """
-        tracer = object.__new__(ebpf.TCPTracer)
-        tracer.options = ebpf.TCPTracer.Options(5)
+        options = ebpf.TCPTracer.Options(5)
         data = StringIO(
             "header1\n"
             "time type pid comm   ip  s_addr d_addr s_port d_port size netns\n"
@@ -252,13 +655,12 @@ class TCPTracerTest(asynctest.TestCase):
         )
 
         expected = {3: {(2, 'comm1')}, 4: {(7, 'comm2')}}
-        result = tracer._generate_dict(data)
+        result = ebpf.TCPTracer._generate_dict(data, options)
         self.assertEqual(expected, result)
 
     def test_generate_dict_multiple(self):
         """ Test _generate_dict with multiple entries for a port """
-        tracer = object.__new__(ebpf.TCPTracer)
-        tracer.options = None
+        options = None
         data = StringIO(
             "header1\n"
             "time type pid comm   ip  s_addr d_addr s_port d_port size netns\n"
@@ -269,7 +671,7 @@ class TCPTracerTest(asynctest.TestCase):
         )
 
         expected = {3: {(2, 'comm1')}, 4: {(7, 'comm2'), (8, 'comm4')}}
-        result = tracer._generate_dict(data)
+        result = ebpf.TCPTracer._generate_dict(data, options)
         self.assertEqual(expected, result)
 
     def test_generate_dict_multiple_ns(self):
@@ -278,8 +680,7 @@ class TCPTracerTest(asynctest.TestCase):
         only a single namespace
 
         """
-        tracer = object.__new__(ebpf.TCPTracer)
-        tracer.options = ebpf.TCPTracer.Options(5)
+        options = ebpf.TCPTracer.Options(5)
         data = StringIO(
             "header1\n"
             "time type pid comm   ip  s_addr d_addr s_port d_port size netns\n"
@@ -291,7 +692,7 @@ class TCPTracerTest(asynctest.TestCase):
         )
 
         expected = {3: {(2, 'comm1')}, 4: {(7, 'comm2'), (8, 'comm4')}}
-        result = tracer._generate_dict(data)
+        result = ebpf.TCPTracer._generate_dict(data, options)
         self.assertEqual(expected, result)
 
     def test_generate_events_empty_data(self):
@@ -299,11 +700,12 @@ class TCPTracerTest(asynctest.TestCase):
         Test _generate_events with no data
 
         """
-        tracer = object.__new__(ebpf.TCPTracer)
+        options = None
         data = StringIO(
             "header1\nheader2\n"
         )
-        result = list(tracer._generate_events(data, {4: (1, 'comm')}))
+        result = list(ebpf.TCPTracer._generate_events(
+            data, {4: (1, 'comm')}, options))
         self.assertEqual([], result)
 
     @asynctest.patch('marple.collect.interface.ebpf.output')
@@ -312,8 +714,7 @@ class TCPTracerTest(asynctest.TestCase):
         Test _generate_events with no dict - tests failure to find port mapping
 
         """
-        tracer = object.__new__(ebpf.TCPTracer)
-        tracer.options = None
+        options = None
         data = StringIO(
             "header1\n"
             "time type pid comm   ip  s_addr d_addr s_port d_port size netns\n"
@@ -321,7 +722,8 @@ class TCPTracerTest(asynctest.TestCase):
             "6    B    7   comm2  4   127.   127.   4      3         1     5\n"
             "1    A    2   comm3  4   x      x      3      4         1     5\n"
         )
-        result = list(tracer._generate_events(data, {}))
+        result = list(ebpf.TCPTracer._generate_events(
+            data, {}, options))
         self.assertEqual([], result)
         expected_errors = [
             asynctest.call(
@@ -348,8 +750,7 @@ class TCPTracerTest(asynctest.TestCase):
         Test _generate_events under normal operation, using all net namespaces
 
         """
-        tracer = object.__new__(ebpf.TCPTracer)
-        tracer.options = None
+        options = None
         data = StringIO(
             "header1\n"
             "time type pid comm   ip  s_addr d_addr s_port d_port size netns\n"
@@ -358,7 +759,8 @@ class TCPTracerTest(asynctest.TestCase):
             "1    A    2   comm3  4   x      x      3      4         1     5\n"
         )
         port_dict = {4: {('pid1', 'test1')}, 3: {('pid2', 'test2')}}
-        result = list(tracer._generate_events(data, port_dict))
+        result = list(ebpf.TCPTracer._generate_events(
+            data, port_dict, options))
         expected = [
             data_io.EventDatum(
                 time=1, type='A', connected=[('source_', 'dest_')],
@@ -395,8 +797,7 @@ class TCPTracerTest(asynctest.TestCase):
         Test _generate_events under normal operation, using all net namespaces
 
         """
-        tracer = object.__new__(ebpf.TCPTracer)
-        tracer.options = None
+        options = None
         data = StringIO(
             "header1\n"
             "time type pid comm   ip  s_addr d_addr s_port d_port size netns\n"
@@ -406,7 +807,8 @@ class TCPTracerTest(asynctest.TestCase):
         )
         port_dict = {4: {('pid1', 'test1')},
                      3: {('pid2', 'test2'), ('pid3', 'test3')}}
-        result = list(tracer._generate_events(data, port_dict))
+        result = list(ebpf.TCPTracer._generate_events(
+            data, port_dict, options))
         expected = [
             data_io.EventDatum(
                 time=1, type='A', connected=[('source_', 'dest_')],
@@ -5,6 +5,8 @@
 
 """ Test iosnoop interactions. """
 
+import asyncio
+
 import asynctest
 
 from marple.collect.interface import iosnoop
@@ -28,11 +30,18 @@ class DiskLatencyTest(asynctest.TestCase):
             async_mock.create_subprocess_exec = create_mock
             async_mock.create_subprocess_exec.return_value.returncode = 0
 
-            # Mock communicate()
-            comm_mock = asynctest.CoroutineMock()
-            comm_mock.side_effect = [(b'\n\nA 1.0 B test_info D E F G 2.0',
-                                      b'test_err')]
-            create_mock.return_value.communicate = comm_mock
+            # Mock the output streamed from iosnoop
+            stdout = asyncio.StreamReader()
+            stdout.feed_data(b'Tracing block I/O. Ctrl-C to end.\n'
+                             b'STARTs ENDs COMM PID TYPE DEV BLOCK BYTES '
+                             b'LATms\n'
+                             b'A 1.0 B test_info D E F G 2.0\n'
+                             b'\nEnding tracing...\n')
+            stdout.feed_eof()
+            create_mock.return_value.stdout = stdout
+            create_mock.return_value.stderr.read = \
+                asynctest.CoroutineMock(return_value=b'test_err')
+            create_mock.return_value.wait = asynctest.CoroutineMock()
 
             self.log_mock = log_mock
             self.pipe_mock = async_mock.subprocess.PIPE
@@ -51,8 +60,7 @@ class DiskLatencyTest(asynctest.TestCase):
         self.async_mock.create_subprocess_exec.assert_has_calls([
             asynctest.call(
                 iosnoop.IOSNOOP_SCRIPT, '-ts', str(self.time),
-                stdout=self.pipe_mock, stderr=self.pipe_mock),
-            asynctest.call().communicate()
+                stdout=self.pipe_mock, stderr=self.pipe_mock)
         ])
 
         # self.log_mock.error.assert_called_once_with('test_err')
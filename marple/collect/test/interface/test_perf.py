@@ -5,9 +5,11 @@
 
 """ Test perf interactions and stack parsing. """
 
+import asyncio
 import asynctest
+import concurrent.futures
 from io import StringIO
-from marple.collect.interface import perf
+from marple.collect.interface import collecter, perf
 from marple.common import data_io
 
 
@@ -16,27 +18,31 @@ class _PerfCollecterBaseTest(asynctest.TestCase):
     Base test for perf data collection testing.
 
     Mocks out subprocess and logging for all tests by overriding run().
+    The output of perf script is read from a real stream, fed with
+    :attr:`script_out`.
     Sets useful class variables.
 
     """
 
     time = 5
-    async_mock, log_mock, pipe_mock, create_mock, strio_mock, os_mock = \
-        None, None, None, None, None, None
+    script_out = b""
+    async_mock, log_mock, pipe_mock, create_mock, os_mock = \
+        None, None, None, None, None
 
     def run(self, result=None):
         with asynctest.patch('marple.collect.interface.perf.asyncio') as async_mock, \
              asynctest.patch('marple.collect.interface.perf.logger') as log_mock, \
-             asynctest.patch('marple.collect.interface.perf.os') as os_mock, \
-             asynctest.patch('marple.collect.interface.perf.StringIO') as strio_mock:
+             asynctest.patch('marple.collect.interface.perf.os') as os_mock:
             self.async_mock = async_mock
+            async_mock.ensure_future = asyncio.ensure_future
+            async_mock.CancelledError = asyncio.CancelledError
 
             # Set up subprocess mocks
             self.create_mock = asynctest.CoroutineMock()
             async_mock.create_subprocess_shell = self.create_mock
             async_mock.create_subprocess_shell.return_value.returncode = 0
 
-            # Set up communicate mocks
+            # Set up communicate mocks, for the recording subprocesses
             comm_mock = asynctest.CoroutineMock()
             comm_mock.side_effect = [(b"test_out1", b"test_err1"),
                                      (b"test_out2", b"test_err2"),
@@ -44,62 +50,82 @@ class _PerfCollecterBaseTest(asynctest.TestCase):
                                      (b"test_out4", b"test_err4")]
             self.create_mock.return_value.communicate = comm_mock
 
+            # Set up mocks for the perf script subprocess
+            self.create_mock.return_value.stderr.read = \
+                asynctest.CoroutineMock(return_value=b"")
+            self.create_mock.return_value.wait = asynctest.CoroutineMock()
+
             # Set up other mocks
             self.log_mock = log_mock
             self.pipe_mock = async_mock.subprocess.PIPE
             self.os_mock = os_mock
-            self.strio_mock = strio_mock
 
             super().run(result)
 
+    def setUp(self):
+        """ Feed the output of perf script to the subprocess mock. """
+        stdout = asyncio.StreamReader()
+        stdout.feed_data(self.script_out)
+        stdout.feed_eof()
+        self.create_mock.return_value.stdout = stdout
+
+
+# Output of perf script with two stacks of different events
+_SCRIPT_OUT = \
+    b"swapper     0 [003] 687886.672908:  108724462 cycles:ppp:\n" \
+    b"ffffffffa099768b intel_idle ([kernel.kallsyms])\n" \
+    b"ffffffffa07e5ce4 cpuidle_enter_state ([kernel.kallsyms])\n" \
+    b"\n" \
+    b"java 12688 [002] 6544038.708352: cpu-clock:\n" \
+    b"ffffffffa00d299c do_idle ([kernel.kallsyms])\n" \
+    b"\n"
+
+_SCRIPT_STACKS = [data_io.StackDatum(
+    weight=1, stack=("swapper", "cpuidle_enter_state", "intel_idle"))]
+
 
 class MemoryEventsTest(_PerfCollecterBaseTest):
     """ Test memory event collection. """
-    @asynctest.patch('marple.collect.interface.perf.StackParser')
+    script_out = _SCRIPT_OUT
+
     @asynctest.patch('marple.common.util.platform.release')
-    async def test(self, release_mock, stack_parse_mock):
-        release_mock.return_value = "100.0.0"  # so we ignore the kernel check  # so we ignore the kernel check
+    async def test(self, release_mock):
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
 
         collecter = perf.MemoryEvents(self.time, None)
-        await collecter.collect()
+        data = await collecter.collect()
 
         self.create_mock.assert_has_calls([
             asynctest.call(
-                "perf record -ag -o " + perf.MemoryEvents._PERF_FILE_NAME +
+                "perf record -a -g -o " + perf.MemoryEvents._PERF_FILE_NAME +
                 " -e '{mem-loads,mem-stores}' sleep " +
                 str(self.time), stderr=self.pipe_mock),
             asynctest.call().communicate(),
             asynctest.call(
-                "perf script -i " + perf.MemoryEvents._PERF_FILE_NAME,
+                "perf script -i " + perf.MemoryEvents._PERF_FILE_NAME +
+                " --show-lost-events",
                 stdout=self.pipe_mock,
                 stderr=self.pipe_mock),
-            asynctest.call().communicate()
         ])
 
-        # self.log_mock.error.assert_has_calls([
-        #     asynctest.call('test_err1'),
-        #     asynctest.call('test_err2')
-        # ])
-
         self.os_mock.remove.assert_called_once_with(
             self.os_mock.getcwd.return_value + "/" +
             perf.MemoryEvents._PERF_FILE_NAME
         )
 
-        self.strio_mock.assert_called_once_with('test_out2')
-        stack_parse_mock.assert_called_once_with(self.strio_mock('test_out2'))
-        stack_parse_mock.return_value.stack_collapse.assert_called_once_with()
+        self.assertEqual(_SCRIPT_STACKS, list(data.datum_generator))
 
 
 class MemoryMallocTest(_PerfCollecterBaseTest):
     """ Test memory malloc probe collection. """
-    @asynctest.patch('marple.collect.interface.perf.StackParser')
+    script_out = _SCRIPT_OUT
+
     @asynctest.patch('marple.common.util.platform.release')
-    async def test(self, release_mock, stack_parse_mock):
+    async def test(self, release_mock):
         release_mock.return_value = "100.0.0"  # so we ignore the kernel check
 
         collecter = perf.MemoryMalloc(self.time, None)
-        await collecter.collect()
+        data = await collecter.collect()
 
         self.create_mock.assert_has_calls([
             asynctest.call(
@@ -110,43 +136,35 @@ class MemoryMallocTest(_PerfCollecterBaseTest):
                 stderr=self.pipe_mock),
             asynctest.call().communicate(),
             asynctest.call(
-                "perf record -ag -o " + perf.MemoryMalloc._PERF_FILE_NAME +
+                "perf record -a -g -o " + perf.MemoryMalloc._PERF_FILE_NAME +
                 " -e probe_libc:malloc: sleep " + str(self.time),
                 stderr=self.pipe_mock),
             asynctest.call().communicate(),
             asynctest.call(
-                "perf script -i " + perf.MemoryMalloc._PERF_FILE_NAME,
+                "perf script -i " + perf.MemoryMalloc._PERF_FILE_NAME +
+                " --show-lost-events",
                 stdout=self.pipe_mock, stderr=self.pipe_mock),
-            asynctest.call().communicate()
         ])
 
-        # self.log_mock.error.assert_has_calls([
-        #     asynctest.call("test_err1"),
-        #     asynctest.call("test_err2"),
-        #     asynctest.call("test_err3"),
-        #     asynctest.call("test_err4")
-        # ])
-
         self.os_mock.remove.assert_called_once_with(
             self.os_mock.getcwd.return_value + "/" +
             perf.MemoryMalloc._PERF_FILE_NAME
         )
 
-        self.strio_mock.assert_called_once_with('test_out4')
-        stack_parse_mock.assert_called_once_with(self.strio_mock('test_out4'))
-        stack_parse_mock.return_value.stack_collapse.assert_called_once_with()
+        self.assertEqual(_SCRIPT_STACKS, list(data.datum_generator))
 
 
 class StackTraceTest(_PerfCollecterBaseTest):
     """ Test stack trace collection. """
-    @asynctest.patch('marple.collect.interface.perf.StackParser')
+    script_out = _SCRIPT_OUT
+
     @asynctest.patch('marple.common.util.platform.release')
-    async def test(self, release_mock, stack_parse_mock):
+    async def test(self, release_mock):
         release_mock.return_value = "100.0.0"  # so we ignore the kernel check
 
         options = perf.StackTrace.Options(frequency=1, cpufilter="filter")
         collecter = perf.StackTrace(self.time, options)
-        await collecter.collect()
+        data = await collecter.collect()
 
         self.create_mock.assert_has_calls([
             asynctest.call(
@@ -156,35 +174,125 @@ class StackTraceTest(_PerfCollecterBaseTest):
                 stderr=self.pipe_mock),
             asynctest.call().communicate(),
             asynctest.call(
-                "perf script -i " + perf.StackTrace._PERF_FILE_NAME,
+                "perf script -i " + perf.StackTrace._PERF_FILE_NAME +
+                " --show-lost-events",
                 stdout=self.pipe_mock, stderr=self.pipe_mock),
-            asynctest.call().communicate()
         ])
 
-        # self.log_mock.error.assert_has_calls([
-        #     asynctest.call('test_err1'),
-        #     asynctest.call('test_err2')
-        # ])
+        self.os_mock.remove.assert_called_once_with(
+            self.os_mock.getcwd.return_value + "/" +
+            perf.StackTrace._PERF_FILE_NAME
+        )
+
+        self.assertEqual(_SCRIPT_STACKS, list(data.datum_generator))
+
+    @asynctest.patch('marple.collect.interface.collecter.kill_process_tree')
+    @asynctest.patch('marple.common.util.platform.release')
+    async def test_cancel(self, release_mock, kill_mock):
+        """ Test that cancelling kills perf and removes its data file. """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+        recording = asyncio.Event()
+
+        async def record():
+            recording.set()
+            await asyncio.sleep(10)
 
+        self.create_mock.return_value.communicate.side_effect = record
+        task = asyncio.ensure_future(perf.StackTrace(self.time).collect())
+        await recording.wait()
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+        kill_mock.assert_called_once_with(self.create_mock.return_value.pid)
+        self.create_mock.return_value.wait.assert_called_once_with()
         self.os_mock.remove.assert_called_once_with(
             self.os_mock.getcwd.return_value + "/" +
             perf.StackTrace._PERF_FILE_NAME
         )
 
-        self.strio_mock.assert_called_once_with('test_out2')
-        stack_parse_mock.assert_called_once_with(self.strio_mock('test_out2'))
-        stack_parse_mock.return_value.stack_collapse.assert_called_once_with()
+    @asynctest.patch('marple.common.util.platform.release')
+    async def test_scope_pids(self, release_mock):
+        """ Test that processes in scope replace the CPU filter. """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+
+        options = perf.StackTrace.Options(frequency=1, cpufilter="-a")
+        collecter_ = perf.StackTrace(self.time, options)
+        collecter_.scope = collecter.Scope(pids=(2, 1))
+        await collecter_.collect()
+
+        self.create_mock.assert_any_call(
+            "perf record -F 1 -p 1,2 -g -o " +
+            perf.StackTrace._PERF_FILE_NAME + " -- sleep " + str(self.time),
+            stderr=self.pipe_mock)
+
+    @asynctest.patch('marple.common.util.platform.release')
+    async def test_scope_cgroup(self, release_mock):
+        """ Test that a cgroup follows an event for perf to limit. """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+
+        options = perf.StackTrace.Options(frequency=1, cpufilter="-a")
+        collecter_ = perf.StackTrace(self.time, options)
+        collecter_.scope = collecter.Scope(cgroup="/system.slice/db")
+        await collecter_.collect()
+
+        self.create_mock.assert_any_call(
+            "perf record -F 1 -a -g -o " + perf.StackTrace._PERF_FILE_NAME +
+            " -e cpu-clock -G system.slice/db -- sleep " + str(self.time),
+            stderr=self.pipe_mock)
+
+    @asynctest.patch('marple.common.util.platform.release')
+    async def test_script_error(self, release_mock):
+        """ Test that a failure of perf script errors the collecter. """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+        self.create_mock.return_value.wait.side_effect = \
+            lambda: setattr(self.create_mock.return_value, "returncode", 1)
+        self.create_mock.return_value.stderr.read.return_value = b"failed"
+
+        collecter = perf.StackTrace(self.time)
+        data = await collecter.collect()
+
+        self.assertIsNone(data.datum_generator)
+        self.log_mock.error.assert_called_with("failed")
+
+    @asynctest.patch('marple.common.util.platform.release')
+    def test_back_off(self, release_mock):
+        """ Test that backing off halves the frequency, down to 1 Hz. """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+
+        options = perf.StackTrace.Options(frequency=3, cpufilter="-a")
+        collecter = perf.StackTrace(self.time, options)
+
+        self.assertEqual("frequency 3 -> 1 Hz", collecter.back_off())
+        self.assertEqual(1, collecter.options.frequency)
+        self.assertIsNone(collecter.back_off())
+
+    @asynctest.patch('marple.common.util.platform.release')
+    def test_clone(self, release_mock):
+        """ Test that copies record to data files of their own. """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+
+        collecter = perf.StackTrace(self.time)
+        copies = [collecter.clone(), collecter.clone()]
+
+        names = {collecter._data_file} | {copy_._data_file
+                                          for copy_ in copies}
+        self.assertEqual(3, len(names))
+        self.assertEqual(perf.StackTrace._PERF_FILE_NAME,
+                         collecter._data_file)
+        self.assertEqual(collecter.options, copies[0].options)
 
 
 class SchedulingEventsTest(_PerfCollecterBaseTest):
     """ Test scheduling event collection. """
+    script_out = b"test_out2\n"
+
     @asynctest.patch('marple.collect.interface.perf.re')
     @asynctest.patch('marple.common.util.platform.release')
     async def test_success(self, release_mock, re_mock):
         """ Test successful regex matching. """
         # Set up mocks
         release_mock.return_value = "100.0.0"  # so we ignore the kernel check
-        self.strio_mock.return_value = StringIO('test_out2')
         match_mock = re_mock.match.return_value
         match_mock.group.side_effect = [
             "111.999",
@@ -207,16 +315,11 @@ class SchedulingEventsTest(_PerfCollecterBaseTest):
             asynctest.call(
                 "perf sched script -i " +
                 perf.SchedulingEvents._PERF_FILE_NAME +
-                " -F 'comm,pid,cpu,time,event'",
+                " -F 'comm,pid,cpu,time,event'"
+                " --show-lost-events",
                 stdout=self.pipe_mock, stderr=self.pipe_mock),
-            asynctest.call().communicate()
         ])
 
-        # self.log_mock.error.assert_has_calls([
-        #     asynctest.call("test_err1"),
-        #     asynctest.call("test_err2")
-        # ])
-
         self.os_mock.remove.assert_called_once_with(
             self.os_mock.getcwd.return_value + "/" +
             perf.SchedulingEvents._PERF_FILE_NAME
@@ -232,7 +335,6 @@ class SchedulingEventsTest(_PerfCollecterBaseTest):
 
         expected_event = data_io.EventDatum(
             specific_datum={'pid': 'test_pid', 'cpu': '4', 'comm': 'test_name'},
-        #"test_name (pid: test_pid)", "cpu 4"),
             time=111000999, type="test_event", connected=None
         )
 
@@ -244,7 +346,6 @@ class SchedulingEventsTest(_PerfCollecterBaseTest):
         """ Test failed regex matching. """
         # Set up mocks
         release_mock.return_value = "100.0.0"  # so we ignore the kernel check
-        self.strio_mock.return_value = StringIO('test_out2')
         re_mock.match.return_value = None
 
         collecter = perf.SchedulingEvents(self.time, None)
@@ -260,16 +361,11 @@ class SchedulingEventsTest(_PerfCollecterBaseTest):
             asynctest.call(
                 "perf sched script -i " +
                 perf.SchedulingEvents._PERF_FILE_NAME +
-                " -F 'comm,pid,cpu,time,event'",
+                " -F 'comm,pid,cpu,time,event'"
+                " --show-lost-events",
                 stdout=self.pipe_mock, stderr=self.pipe_mock),
-            asynctest.call().communicate()
         ])
 
-        # self.log_mock.error.assert_has_calls([
-        #     asynctest.call("test_err1"),
-        #     asynctest.call("test_err2")
-        # ])
-
         self.os_mock.remove.assert_called_once_with(
             self.os_mock.getcwd.return_value + "/" +
             perf.SchedulingEvents._PERF_FILE_NAME
@@ -288,39 +384,104 @@ class SchedulingEventsTest(_PerfCollecterBaseTest):
 
 class DiskBlockRequestsTest(_PerfCollecterBaseTest):
     """ Test disk block request data collection. """
-    @asynctest.patch('marple.collect.interface.perf.StackParser')
+    script_out = _SCRIPT_OUT
+
     @asynctest.patch('marple.common.util.platform.release')
-    async def test(self, release_mock, stack_parse_mock):
+    async def test(self, release_mock):
         release_mock.return_value = "100.0.0"  # so we ignore the kernel check
 
         collecter = perf.DiskBlockRequests(self.time, None)
-        await collecter.collect()
+        data = await collecter.collect()
 
         self.create_mock.assert_has_calls([
             asynctest.call(
-                "perf record -ag -o " + perf.DiskBlockRequests._PERF_FILE_NAME +
+                "perf record -a -g -o " + perf.DiskBlockRequests._PERF_FILE_NAME +
                 " -e block:block_rq_insert sleep " + str(self.time),
                 stderr=self.pipe_mock),
             asynctest.call().communicate(),
             asynctest.call(
-                "perf script -i " + perf.DiskBlockRequests._PERF_FILE_NAME,
+                "perf script -i " + perf.DiskBlockRequests._PERF_FILE_NAME +
+                " --show-lost-events",
                 stdout=self.pipe_mock, stderr=self.pipe_mock),
-            asynctest.call().communicate()
         ])
 
-        # self.log_mock.error.assert_has_calls([
-        #     asynctest.call("test_err1"),
-        #     asynctest.call("test_err2")
-        # ])
-
         self.os_mock.remove.assert_called_once_with(
             self.os_mock.getcwd.return_value + "/" +
             perf.DiskBlockRequests._PERF_FILE_NAME
         )
 
-        self.strio_mock.assert_called_once_with('test_out2')
-        stack_parse_mock.assert_called_once_with(self.strio_mock('test_out2'))
-        stack_parse_mock.return_value.stack_collapse.assert_called_once_with()
+        self.assertEqual(_SCRIPT_STACKS, list(data.datum_generator))
+
+
+class StackCollapseTest(asynctest.TestCase):
+    """ Test folding stacks in batches. """
+
+    async def test_event_filter_kept(self):
+        """ Test that later batches keep the event type of the first. """
+        lines = _SCRIPT_OUT.decode().splitlines(keepends=True)
+        stage = perf._StackCollapse(None)
+
+        first = await stage.process(lines[:4])
+        second = await stage.process(lines[4:])
+
+        self.assertEqual(_SCRIPT_STACKS, first)
+        self.assertEqual([], second)
+        self.assertEqual("cycles:ppp", stage.options)
+
+
+class LostCounterTest(asynctest.TestCase):
+    """ Test counting the samples perf lost. """
+
+    async def test_process(self):
+        stage = perf._LostCounter()
+        lines = ["java 12688 [002] 6544038.708352: cpu-clock:\n",
+                 "perf 0 [001] 0.000000: PERF_RECORD_LOST lost 100\n",
+                 "perf 0 [001] 0.000000: PERF_RECORD_LOST_SAMPLES lost 24\n"]
+
+        self.assertEqual(lines[:1], await stage.process(lines))
+        self.assertEqual(124, stage.lost)
+
+
+class ScaleBuffersTest(asynctest.TestCase):
+    """ Test enlarging perf's ring buffers. """
+
+    @asynctest.patch('marple.common.util.platform.release')
+    def test_scale_buffers(self, release_mock):
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+        collecter = perf.StackTrace(5)
+        self.assertEqual("", collecter._mmap_option())
+
+        # Losing 80% of samples needs more than 4 times the buffer
+        self.assertEqual("mmap pages 128 -> 1024",
+                         collecter.scale_buffers(0.8))
+        self.assertEqual(" -m 1024", collecter._mmap_option())
+        self.assertEqual("mmap pages 1024 -> 2048",
+                         collecter.scale_buffers(0.1))
+
+    @asynctest.patch('marple.common.util.platform.release')
+    def test_scale_buffers_cap(self, release_mock):
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+        collecter = perf.StackTrace(5)
+        collecter.mmap_pages = perf._MAX_MMAP_PAGES
+
+        self.assertIsNone(collecter.scale_buffers(0.5))
+
+
+class LostSamplesTest(_PerfCollecterBaseTest):
+    """ Test that lost samples are recorded in the data. """
+    script_out = _SCRIPT_OUT + \
+        b"perf 0 [001] 0.000000: PERF_RECORD_LOST lost 3\n"
+
+    @asynctest.patch('marple.common.util.platform.release')
+    async def test(self, release_mock):
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+
+        collecter = perf.StackTrace(self.time)
+        data = await collecter.collect()
+
+        self.assertEqual(_SCRIPT_STACKS, list(data.datum_generator))
+        self.assertEqual(3, collecter.lost)
+        self.assertEqual(3, data.annotations["loss"]["lost"])
 
 
 class StackParserTest(asynctest.TestCase):
@@ -455,3 +616,26 @@ class StackParserTest(asynctest.TestCase):
         events = list(self.stack_parser.stack_collapse())
 
         self.assertEqual(expected, events)
+
+
+class ParseInExecutorTest(asynctest.TestCase):
+    """ Test parse functions run in a pool of worker processes. """
+
+    time = 5
+
+    @asynctest.patch('marple.common.util.platform.release')
+    async def test_process_pool(self, release_mock):
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+
+        raw_data = StringIO(
+            "perf 6997 [003] 363654.881950: sched:sched_wakeup:\n")
+        expected = [data_io.EventDatum(
+            specific_datum={'pid': '6997', 'comm': 'perf', 'cpu': '003'},
+            time=363654881950, type="sched:sched_wakeup:", connected=None)]
+
+        collecter = perf.SchedulingEvents(self.time)
+        with concurrent.futures.ProcessPoolExecutor(1) as executor:
+            collecter.executor = executor
+            actual = await collecter._parse(raw_data)
+
+        self.assertEqual(expected, actual)
@@ -0,0 +1,143 @@
+# -------------------------------------------------------------
+# test_pipeline.py - tests for bounded collection pipelines
+# October 2018
+# -------------------------------------------------------------
+
+""" Test pipeline stages, batching and backpressure. """
+
+import asyncio
+import inspect
+import asynctest
+
+from marple.collect.interface import pipeline
+from marple.common import data_io
+
+
+def _double(batch, options):
+    return [item * 2 for item in batch]
+
+
+def _fail(batch, options):
+    raise ValueError("bad batch")
+
+
+class _ListSource(pipeline.Source):
+    """ Source producing given batches, recording how many it produced. """
+
+    def __init__(self, batches):
+        super().__init__()
+        self._batches = batches
+        self.produced = 0
+
+    async def batches(self):
+        for batch in self._batches:
+            self.produced += 1
+            yield batch
+
+
+class _ListSink(pipeline.Sink):
+    """ Sink collecting batches, optionally blocking until released. """
+
+    def __init__(self):
+        super().__init__()
+        self.items = []
+        self.released = asyncio.Event()
+        self.released.set()
+
+    async def consume(self, batch):
+        await self.released.wait()
+        self.items.extend(batch)
+
+
+class LineSourceTest(asynctest.TestCase):
+    """ Test reading batches of lines from a stream. """
+
+    def _stream(self, data):
+        stream = asyncio.StreamReader()
+        stream.feed_data(data)
+        stream.feed_eof()
+        return stream
+
+    async def _batches(self, source):
+        return [batch async for batch in source.batches()]
+
+    async def test_batch_size(self):
+        source = pipeline.LineSource(self._stream(b"a\nb\nc\n"), batch_lines=2)
+        self.assertEqual([["a\n", "b\n"], ["c\n"]],
+                         await self._batches(source))
+
+    async def test_boundary(self):
+        """ Test that batches are only cut after a boundary line. """
+        source = pipeline.LineSource(self._stream(b"a\nb\n\nc\n\n"),
+                                     batch_lines=1,
+                                     boundary=lambda line: line == "\n")
+        self.assertEqual([["a\n", "b\n", "\n"], ["c\n", "\n"]],
+                         await self._batches(source))
+
+    def test_abstract(self):
+        """ Test that a source must implement batches. """
+        self.assertTrue(inspect.isabstract(pipeline.Source))
+        self.assertEqual({"batches"}, pipeline.Source.__abstractmethods__)
+        self.assertFalse(inspect.isabstract(_ListSource))
+
+
+class PipelineTest(asynctest.TestCase):
+    """ Test running pipelines. """
+
+    async def test_transform(self):
+        sink = _ListSink()
+        pipe = pipeline.Pipeline(_ListSource([[1, 2], [3]]),
+                                 [pipeline.Transform(_double)], sink)
+        result = await pipe.run()
+
+        self.assertIs(sink, result)
+        self.assertEqual([2, 4, 6], sink.items)
+
+        source_stats, transform_stats, sink_stats = pipe.stats
+        self.assertEqual((2, 3), (source_stats.batches, source_stats.items_out))
+        self.assertEqual("_double", transform_stats.name)
+        self.assertEqual((2, 3, 3), (transform_stats.batches,
+                                     transform_stats.items_in,
+                                     transform_stats.items_out))
+        self.assertEqual(3, sink_stats.items_in)
+
+    async def test_backpressure(self):
+        """ Test that the source stops while the sink is blocked. """
+        source = _ListSource([[n] for n in range(10)])
+        sink = _ListSink()
+        sink.released.clear()
+        pipe = pipeline.Pipeline(source, [], sink, queue_size=2)
+
+        task = asyncio.ensure_future(pipe.run())
+        for _ in range(20):
+            await asyncio.sleep(0)
+
+        # The sink holds one batch and the queue two; the source has produced
+        # one more, which it is blocked on putting
+        self.assertEqual(4, source.produced)
+        self.assertEqual(2, sink.stats.max_queue_depth)
+
+        sink.released.set()
+        await task
+        self.assertEqual(list(range(10)), sink.items)
+
+    async def test_error(self):
+        """ Test that an error in a stage is raised from run(). """
+        pipe = pipeline.Pipeline(_ListSource([[1]]),
+                                 [pipeline.Transform(_fail)], _ListSink())
+        with self.assertRaises(ValueError):
+            await pipe.run()
+
+
+class SpoolSinkTest(asynctest.TestCase):
+    """ Test spooling datum objects to disk. """
+
+    async def test_round_trip(self):
+        datums = [data_io.PointDatum(1.0, 2.0, "a"),
+                  data_io.PointDatum(3.0, 4.0, "b", 5)]
+        sink = pipeline.SpoolSink(data_io.PointDatum)
+        await sink.consume(datums[:1])
+        await sink.consume(datums[1:])
+
+        self.assertEqual(datums, list(sink.datums()))
+        self.assertTrue(sink.file.closed)
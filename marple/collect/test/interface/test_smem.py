@@ -7,7 +7,7 @@
 
 import asynctest
 
-from marple.collect.interface import smem
+from marple.collect.interface import collecter, smem
 from marple.common import data_io
 
 
@@ -85,3 +85,36 @@ class SmemTest(asynctest.TestCase):
                     data_io.PointDatum(x=1.0, y=2.0, info='E'),
                     data_io.PointDatum(x=1.0, y=2.0, info='D')]
         self.assertEqual(expected, datapoints)
+
+
+class ScopedSmemTest(asynctest.TestCase):
+    """ Test memtime data collection limited to some processes. """
+
+    @asynctest.patch('marple.collect.interface.smem.time.monotonic')
+    @asynctest.patch('marple.common.util.platform.release')
+    async def test_scope(self, release_mock, mono_patch):
+        mono_patch.side_effect = [0, 1]  # so we get exactly 1 collection
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+
+        with asynctest.patch('marple.collect.interface.smem.asyncio') as \
+                async_mock:
+            create_mock = asynctest.CoroutineMock()
+            async_mock.create_subprocess_shell = create_mock
+            create_mock.return_value.returncode = 0
+            create_mock.return_value.communicate = asynctest.CoroutineMock(
+                return_value=(b"  PID Name                   PSS\n"
+                              b"    1 init                  1024\n"
+                              b"   42 dd                    2048\n", b""))
+            async_mock.sleep = asynctest.CoroutineMock()
+
+            collecter_ = smem.MemoryGraph(1)
+            collecter_.scope = collecter.Scope(pids=(42,))
+            data = await collecter_.collect()
+
+            create_mock.assert_called_once_with(
+                "smem -c \"pid name pss\"",
+                stdout=async_mock.subprocess.PIPE,
+                stderr=async_mock.subprocess.PIPE)
+
+        self.assertEqual([data_io.PointDatum(x=0.0, y=2.0, info='dd')],
+                         list(data.datum_generator))
@@ -0,0 +1,178 @@
+# -------------------------------------------------------------
+# test_tracefs.py - tests for collection from tracefs
+# October 2018
+# -------------------------------------------------------------
+
+""" Test tracefs collection and trace_pipe parsing. """
+
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import asynctest
+
+from marple.collect.interface import collecter, tracefs
+from marple.common import data_io
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "example_trace_pipe.txt")
+
+
+class BlockTraceParserTest(unittest.TestCase):
+    """ Test matching up block request events from trace_pipe. """
+
+    # Requests completed in the fixture, in order of completion
+    expected = [
+        data_io.PointDatum(x=5423.874046, y=0.5, info='dd'),
+        data_io.PointDatum(x=5423.902, y=2.0, info='jbd2/sda1-8'),
+        data_io.PointDatum(x=5423.90035, y=0.25, info='java'),
+    ]
+
+    def _assert_points(self, actual):
+        """ Compare points, allowing for floating point latencies. """
+        self.assertEqual(len(self.expected), len(actual))
+        for expected, point in zip(self.expected, actual):
+            self.assertAlmostEqual(expected.x, point.x)
+            self.assertAlmostEqual(expected.y, point.y)
+            self.assertEqual(expected.info, point.info)
+
+    def test_fixture(self):
+        """
+        Test a captured trace_pipe: flushes and requests issued before
+        tracing are dropped, and both trace line formats are understood.
+
+        """
+        with open(FIXTURE) as fixture:
+            text = fixture.read()
+
+        parser = tracefs.BlockTraceParser()
+        actual = list(parser.feed(text)) + list(parser.flush())
+        self._assert_points(actual)
+
+    def test_chunked(self):
+        """ Test that lines split across reads are reassembled. """
+        with open(FIXTURE) as fixture:
+            text = fixture.read()
+
+        parser = tracefs.BlockTraceParser()
+        actual = []
+        for start in range(0, len(text), 37):
+            actual.extend(parser.feed(text[start:start + 37]))
+        actual.extend(parser.flush())
+        self._assert_points(actual)
+
+    def test_unrecognised(self):
+        """ Test that other lines are ignored. """
+        parser = tracefs.BlockTraceParser()
+        actual = list(parser.feed("CPU:2 [LOST 12 EVENTS]\n\n"))
+        self.assertEqual([], actual)
+
+    def test_lost(self):
+        """ Test that the events traced and lost are counted. """
+        with open(FIXTURE) as fixture:
+            text = fixture.read()
+
+        parser = tracefs.BlockTraceParser()
+        list(parser.feed(text + "CPU:2 [LOST 12 EVENTS]\n"))
+        self.assertEqual(12, parser.lost)
+        self.assertGreater(parser.events, 0)
+
+
+class DiskLatencyTest(unittest.TestCase):
+    """ Test sizing the trace buffers. """
+
+    def test_scale_buffers(self):
+        collecter = tracefs.DiskLatency(5, tracefs.DiskLatency.Options(
+            buffer_size_kb=1024))
+        self.assertEqual("buffer_size_kb 1024 -> 4096",
+                         collecter.scale_buffers(0.75))
+
+        collecter = tracefs.DiskLatency(5, tracefs.DiskLatency.Options(
+            buffer_size_kb=tracefs.MAX_BUFFER_SIZE_KB))
+        self.assertIsNone(collecter.scale_buffers(0.75))
+
+    def test_scope_filter(self):
+        """ Test that only the issues of the threads in scope are traced. """
+        with tempfile.TemporaryDirectory() as root, \
+                mock.patch("marple.collect.interface.tracefs._find_tracefs",
+                           return_value=root):
+            instance = os.path.join(root, "instances",
+                                    tracefs.INSTANCE_NAME.format(os.getpid()))
+            for event in tracefs.DiskLatency._EVENTS:
+                os.makedirs(os.path.join(instance, "events", event))
+
+            collecter_ = tracefs.DiskLatency(5)
+            collecter_.scope = collecter.Scope(pids=(os.getpid(),))
+            collecter_._setup_instance()
+
+            with open(os.path.join(instance, "events", "block",
+                                   "block_rq_issue", "filter")) as file_:
+                conditions = file_.read().split(" || ")
+            self.assertIn("common_pid == {}".format(os.getpid()), conditions)
+            self.assertFalse(os.path.exists(os.path.join(
+                instance, "events", "block", "block_rq_complete", "filter")))
+
+
+class ReadTest(asynctest.TestCase):
+    """ Test reading trace_pipe while it always has data. """
+
+    @mock.patch("marple.collect.interface.tracefs.os.close")
+    @mock.patch("marple.collect.interface.tracefs.os.read")
+    @mock.patch("marple.collect.interface.tracefs.os.open")
+    async def test_busy_pipe(self, open_mock, read_mock, close_mock):
+        """ Test that the other coroutines still run between chunks. """
+        read_mock.return_value = b"no events here\n"
+        collecter_ = tracefs.DiskLatency(0.2)
+        collecter_._setup_instance = mock.MagicMock(return_value="instance")
+        collecter_._teardown_instance = mock.MagicMock()
+        # Once tracing stops, the buffer runs dry
+        collecter_._disable_events = mock.MagicMock(
+            side_effect=lambda instance: setattr(read_mock, "side_effect",
+                                                 BlockingIOError))
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0)
+
+        ticker = asyncio.ensure_future(tick())
+        try:
+            await collecter_._get_raw_data()
+        finally:
+            ticker.cancel()
+
+        self.assertGreater(read_mock.call_count, 1)
+        self.assertGreaterEqual(ticks, read_mock.call_count - 2)
+        close_mock.assert_called_once_with(open_mock.return_value)
+
+    @mock.patch("marple.collect.interface.tracefs.os.close")
+    @mock.patch("marple.collect.interface.tracefs.os.read")
+    @mock.patch("marple.collect.interface.tracefs.os.open")
+    async def test_drain(self, open_mock, read_mock, close_mock):
+        """
+        Test that the events still buffered when the time is up are read
+        after tracing stops, before the instance is removed.
+
+        """
+        with open(FIXTURE, "rb") as fixture:
+            text = fixture.read()
+        calls = []
+        read_mock.side_effect = BlockingIOError
+        collecter_ = tracefs.DiskLatency(0)
+        collecter_._setup_instance = mock.MagicMock(return_value="instance")
+
+        def disable(instance):
+            calls.append("disable")
+            read_mock.side_effect = [text, BlockingIOError()]
+
+        collecter_._disable_events = mock.MagicMock(side_effect=disable)
+        collecter_._teardown_instance = mock.MagicMock(
+            side_effect=lambda instance: calls.append("teardown"))
+
+        datapoints = await collecter_._get_raw_data()
+
+        self.assertEqual(["disable", "teardown"], calls)
+        self.assertEqual(3, len(datapoints))
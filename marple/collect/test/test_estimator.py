@@ -0,0 +1,120 @@
+# --------------------------------------------------------------------
+# test_estimator.py - test the pre-flight estimator
+# October 2018
+# --------------------------------------------------------------------
+
+""" Test probing the system and projecting the cost of collection. """
+
+from unittest import mock
+
+import asynctest
+
+from marple.collect import estimator
+from marple.collect.interface import perf, smem, tracefs
+
+# perf stat -x , output for a 2 second probe
+_PERF_STAT = \
+    "# started on Thu Oct 18 10:00:00 2018\n" \
+    "\n" \
+    "2000,,sched:sched_switch,4000123456,100.00,,\n" \
+    "<not supported>,,mem-loads,0,100.00,,\n" \
+    "60,,block:block_rq_complete,4000123456,100.00,,\n"
+
+
+def _probe(**rates):
+    return estimator.Probe(rates, cpus=8, busy_cpus=2.0, processes=300)
+
+
+class ProbeTest(asynctest.TestCase):
+    """ Test probing the system. """
+
+    def test_parse_perf_stat(self):
+        self.assertEqual({"sched:sched_switch": 1000.0,
+                          "block:block_rq_complete": 30.0},
+                         estimator._parse_perf_stat(_PERF_STAT, 2))
+
+    @asynctest.patch("marple.collect.estimator._available",
+                     return_value=True)
+    @asynctest.patch("marple.collect.estimator.asyncio."
+                     "create_subprocess_exec")
+    async def test_probe(self, create_mock, _):
+        create_mock.return_value.returncode = 0
+        create_mock.return_value.communicate = asynctest.CoroutineMock(
+            return_value=(b"", _PERF_STAT.encode()))
+
+        system = await estimator.probe(["sched:sched_switch",
+                                        "block:block_rq_complete",
+                                        "sched:sched_switch"], 2)
+
+        create_mock.assert_called_once_with(
+            "perf", "stat", "-a", "-x", ",",
+            "-e", "block:block_rq_complete", "-e", "sched:sched_switch",
+            "--", "sleep", "2", stdout=mock.ANY, stderr=mock.ANY)
+        self.assertEqual(1000.0, system.rates["sched:sched_switch"])
+        self.assertGreater(system.processes, 0)
+        self.assertLessEqual(system.busy_cpus, system.cpus)
+
+
+class EstimateTest(asynctest.TestCase):
+    """ Test projecting the cost of each interface. """
+
+    @asynctest.patch('marple.common.util.platform.release')
+    def test_estimate(self, release_mock):
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+        collecters = [
+            perf.StackTrace(60, perf.StackTrace.Options(1000, "-a")),
+            tracefs.DiskLatency(60),
+            perf.MemoryMalloc(60),
+        ]
+
+        estimates = estimator.estimate(
+            collecters, _probe(**{"block:block_rq_complete": 30.0}), 60,
+            max_cpu_percent=5, max_output_bytes=2 ** 30)
+
+        callstack, disklat, malloc = estimates
+        # 1000 Hz on 2 busy CPUs, at 30us a sample
+        self.assertEqual(2000.0, callstack.rate)
+        self.assertEqual(120000, callstack.records)
+        self.assertAlmostEqual(6.0, callstack.cpu_percent)
+        self.assertEqual("frequency 1000 -> 833 Hz", callstack.recommendation)
+
+        self.assertEqual(1800, disklat.records)
+        self.assertEqual(1800 * 250, disklat.output_bytes)
+        self.assertIsNone(disklat.recommendation)
+
+        self.assertIsNone(malloc.rate)
+
+    @asynctest.patch('marple.common.util.platform.release')
+    def test_uncounted_event(self, release_mock):
+        """ Test that there is no estimate if an event was not counted. """
+        release_mock.return_value = "100.0.0"  # so we ignore the kernel check
+        collecter = perf.MemoryEvents(60)
+
+        self.assertIsNone(collecter.estimate_rate(
+            _probe(**{"mem-loads": 100.0})))
+        self.assertEqual(300.0, collecter.estimate_rate(
+            _probe(**{"mem-loads": 100.0, "mem-stores": 200.0})))
+
+    def test_smem(self):
+        collecter = smem.MemoryGraph(60)
+        self.assertEqual(600.0, collecter.estimate_rate(_probe()))
+        self.assertEqual("refresh every 0.5 -> 2.0 s",
+                         collecter.recommend(0.25))
+
+    def test_report(self):
+        estimates = [
+            estimator.Estimate("StackTrace", 10.0, 600, 2 ** 20, 0.5, None),
+            estimator.Estimate("MemoryMalloc", None, None, None, None, None),
+            estimator.Estimate("SchedulingEvents", 1.0, 60, 0, 9.0,
+                               "reduce the collection time"),
+        ]
+        lines = estimator.report(estimates, _probe(), 60, 1)
+
+        self.assertEqual("Estimate for 60 s, from a 1 s probe (8 CPUs, 2.0 "
+                         "busy, 300 processes):", lines[0])
+        self.assertEqual("StackTrace                   10.0          600 "
+                         "    1.0 MB    0.5%", lines[2])
+        self.assertIn("not estimated", lines[3])
+        self.assertEqual(["Recommendations:",
+                          "  SchedulingEvents: reduce the collection time"],
+                         lines[-2:])
@@ -0,0 +1,256 @@
+# --------------------------------------------------------------------
+# test_governor.py - test the resource governor
+# October 2018
+# --------------------------------------------------------------------
+
+""" Test confining collection, and backing off when over budget. """
+
+import asyncio
+import os
+import tempfile
+from unittest import mock
+
+import asynctest
+
+from marple.collect import governor
+from marple.collect.interface import collecter
+from marple.common import consts, data_io
+
+
+def _data():
+    return data_io.PointData(iter(()), None, None,
+                             consts.InterfaceTypes.DISKLATENCY)
+
+
+class ConfineTest(asynctest.TestCase):
+    """ Test placing marple under the budget. """
+
+    def test_disabled(self):
+        self.assertIsNone(governor.Governor().confine())
+
+    def test_cgroup(self):
+        with tempfile.TemporaryDirectory() as root, \
+                mock.patch("marple.collect.governor.CGROUP_ROOT", root):
+            with open(os.path.join(root, "cgroup.controllers"), "w") as file_:
+                file_.write("cpuset cpu io memory pids\n")
+
+            resource_governor = governor.Governor(50, 1024)
+            resource_governor.confine()
+
+            cgroup = os.path.join(root, "marple-{}".format(os.getpid()))
+            self.assertEqual("cgroup " + cgroup, resource_governor.confinement)
+            for name, value in (("cpu.max", "50000 100000"),
+                                ("memory.max", "1024"),
+                                ("cgroup.procs", str(os.getpid()))):
+                with open(os.path.join(cgroup, name)) as file_:
+                    self.assertEqual(value, file_.read())
+            with open(os.path.join(root, "cgroup.subtree_control")) as file_:
+                self.assertEqual("+cpu +memory", file_.read())
+
+    @mock.patch("marple.collect.governor.resource.setrlimit")
+    @mock.patch("marple.collect.governor.subprocess.call")
+    @mock.patch("marple.collect.governor.os.nice")
+    def test_cgroup_failure(self, nice_mock, call_mock, setrlimit_mock):
+        """ Test that a cgroup that cannot be limited is removed. """
+        def write(cgroup, name, value):
+            if name == "cpu.max":
+                raise PermissionError("cpu.max")
+
+        with tempfile.TemporaryDirectory() as root, \
+                mock.patch("marple.collect.governor.CGROUP_ROOT", root), \
+                mock.patch.object(governor.Governor, "_write",
+                                  side_effect=write):
+            with open(os.path.join(root, "cgroup.controllers"), "w") as file_:
+                file_.write("cpu memory\n")
+
+            resource_governor = governor.Governor(50, 1024)
+            resource_governor.confine()
+
+            self.assertEqual(["cgroup.controllers"], os.listdir(root))
+        self.assertIsNone(resource_governor.cgroup)
+        nice_mock.assert_called_once_with(10)
+
+    @mock.patch("marple.collect.governor.resource.setrlimit")
+    @mock.patch("marple.collect.governor.subprocess.call")
+    @mock.patch("marple.collect.governor.os.nice")
+    def test_fallback(self, nice_mock, call_mock, setrlimit_mock):
+        call_mock.return_value = 0
+        with mock.patch("marple.collect.governor.CGROUP_ROOT", "/nonexistent"):
+            resource_governor = governor.Governor(50, 1024)
+            resource_governor.confine()
+
+        nice_mock.assert_called_once_with(10)
+        setrlimit_mock.assert_called_once_with(
+            governor.resource.RLIMIT_DATA, (1024, 1024))
+        self.assertEqual("nice 10, ionice idle, RLIMIT_DATA 1024",
+                         resource_governor.confinement)
+
+    def test_process_tree_usage(self):
+        cpu, memory = governor._process_tree_usage(os.getpid())
+        self.assertGreater(cpu, 0)
+        self.assertGreater(memory, 0)
+
+
+class BackOffTest(asynctest.TestCase):
+    """ Test backing off and dropping collecters. """
+
+    def setUp(self):
+        self.resource_governor = governor.Governor(cpu_percent=50)
+        self.resource_governor.confinement = "test"
+        self.rate = mock.MagicMock()
+        self.rate.back_off.side_effect = ["rate 1 -> 2", None, None]
+        self.fixed = mock.MagicMock()
+        self.fixed.back_off.return_value = None
+
+    def test_over_budget(self):
+        self.assertIsNone(self.resource_governor._over_budget(40, 10 ** 9))
+        self.assertEqual("CPU 60% over budget of 50%",
+                         self.resource_governor._over_budget(60, 0))
+
+    async def test_escalation(self):
+        collecters = [self.rate, self.fixed]
+        self.assertTrue(self.resource_governor._act(collecters, "reason"))
+        self.assertTrue(self.resource_governor._act(collecters, "reason"))
+        # The last collecter standing is never dropped
+        self.assertFalse(self.resource_governor._act(collecters, "reason"))
+
+        self.assertEqual({self.fixed}, self.resource_governor.dropped)
+        self.assertEqual(
+            ["back off: rate 1 -> 2", "dropped"],
+            [action["action"] for action in self.resource_governor.actions])
+        self.assertIsNone(await self.resource_governor.collect(self.fixed))
+
+    async def test_drop_while_backed_off(self):
+        """
+        Test that a collecter whose back-off is still pending is not backed
+        off again, so a single collection can still drop an interface.
+
+        """
+        self.rate.back_off.side_effect = None
+        self.rate.back_off.return_value = "rate 1 -> 2"
+        collecters = [self.rate, self.fixed]
+        self.resource_governor._act(collecters, "reason")
+        self.resource_governor._act(collecters, "reason")
+
+        self.assertEqual(1, self.rate.back_off.call_count)
+        self.assertEqual({self.fixed}, self.resource_governor.dropped)
+
+        # The next collection uses the new options, so it can back off again
+        self.rate.collect = asynctest.CoroutineMock(return_value=_data())
+        await self.resource_governor.collect(self.rate)
+        self.assertTrue(self.resource_governor._act(collecters, "reason"))
+        self.assertEqual(2, self.rate.back_off.call_count)
+
+    async def test_annotations(self):
+        self.rate.collect = asynctest.CoroutineMock(return_value=_data())
+        self.resource_governor._act([self.rate], "reason")
+
+        data = await self.resource_governor.collect(self.rate)
+
+        annotations = data.header_dict()["annotations"]["governor"]
+        self.assertEqual("test", annotations["confinement"])
+        self.assertEqual("back off: rate 1 -> 2",
+                         annotations["actions"][0]["action"])
+
+    async def test_drop_while_collecting(self):
+        """ Test that a collecter dropped mid-collection is cancelled. """
+        started = asyncio.Event()
+
+        async def collect():
+            started.set()
+            await asyncio.sleep(10)
+
+        self.fixed.collect = collect
+        future = asyncio.ensure_future(
+            self.resource_governor.collect(self.fixed))
+        await started.wait()
+        self.resource_governor._act([self.rate, self.fixed], "reason")
+        self.resource_governor._act([self.rate, self.fixed], "reason")
+
+        self.assertIsNone(await future)
+
+    async def test_drop_copy(self):
+        """ Test that dropping a collecter cancels its copies. """
+        started = asyncio.Event()
+
+        async def collect():
+            started.set()
+            await asyncio.sleep(10)
+
+        copy_ = mock.MagicMock()
+        copy_.collect = collect
+        future = asyncio.ensure_future(
+            self.resource_governor.collect(copy_, self.fixed))
+        await started.wait()
+        self.resource_governor._act([self.rate, self.fixed], "reason")
+        self.resource_governor._act([self.rate, self.fixed], "reason")
+
+        self.assertIsNone(await future)
+        self.assertIsNone(
+            await self.resource_governor.collect(mock.MagicMock(), self.fixed))
+
+    async def test_unlimited(self):
+        """ Test that without a budget, only the overhead is annotated. """
+        collecter = mock.MagicMock()
+        collecter.collect = asynctest.CoroutineMock(return_value=_data())
+
+        resource_governor = governor.Governor()
+        data = await resource_governor.collect(collecter)
+
+        self.assertEqual({"overhead"}, set(data.header_dict()["annotations"]))
+        self.assertEqual(1, len(resource_governor.overhead_summary()))
+
+
+    async def test_scope(self):
+        """ Test that a scoped collection records its scope. """
+        collecter_ = mock.MagicMock()
+        collecter_.collect = asynctest.CoroutineMock(return_value=_data())
+        collecter_.scope = collecter.Scope(pids=(42,), comm="dd")
+
+        data = await governor.Governor().collect(collecter_)
+
+        self.assertEqual({"pids": [42], "cgroup": None, "comm": "dd"},
+                         data.header_dict()["annotations"]["scope"])
+
+
+class AdaptTest(asynctest.TestCase):
+    """ Test enlarging the buffers of collecters that lose data. """
+
+    def setUp(self):
+        self.collecter = mock.MagicMock()
+        self.collecter.scale_buffers.return_value = "size 1 -> 2"
+        self.losses = [(50, 50), (0, 100)]
+        self.collecter.collect = asynctest.CoroutineMock(
+            side_effect=self._collect)
+
+    async def _collect(self):
+        data = _data()
+        data.record_loss(*self.losses.pop(0))
+        return data
+
+    async def test_retry(self):
+        resource_governor = governor.Governor(max_loss_ratio=0.1,
+                                              loss_retries=1)
+        data = await resource_governor.collect(self.collecter)
+
+        self.collecter.scale_buffers.assert_called_once_with(0.5)
+        self.assertEqual(2, self.collecter.collect.call_count)
+        self.assertEqual(0.0, data.annotations["loss"]["ratio"])
+        self.assertEqual(
+            "buffers: size 1 -> 2",
+            data.annotations["governor"]["actions"][0]["action"])
+
+    async def test_no_retry(self):
+        """ Test that without retries, the buffers are only enlarged. """
+        resource_governor = governor.Governor(max_loss_ratio=0.1)
+        data = await resource_governor.collect(self.collecter)
+
+        self.collecter.scale_buffers.assert_called_once_with(0.5)
+        self.assertEqual(1, self.collecter.collect.call_count)
+        self.assertEqual(0.5, data.annotations["loss"]["ratio"])
+
+    async def test_disabled(self):
+        data = await governor.Governor().collect(self.collecter)
+
+        self.collecter.scale_buffers.assert_not_called()
+        self.assertNotIn("governor", data.annotations)
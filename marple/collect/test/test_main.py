@@ -4,11 +4,14 @@
 # --------------------------------------------------------------------
 
 
+import asyncio
 import unittest
 from unittest import mock
 
+from marple.collect import governor
 from marple.collect import main as collect
-from marple.common import consts
+from marple.collect.interface import collecter
+from marple.common import consts, exceptions
 
 
 class _ParseTest(unittest.TestCase):
@@ -27,6 +30,7 @@ class _ParseTest(unittest.TestCase):
 class MainTest(unittest.TestCase):
     """Class that tests the main function calls are correct"""
 
+    @mock.patch('marple.collect.test.test_main.collect._get_governor')
     @mock.patch('marple.common.data_io.Writer')
     @mock.patch('marple.collect.test.test_main.collect.config')
     @mock.patch('marple.collect.test.test_main.collect.output')
@@ -34,14 +38,104 @@ class MainTest(unittest.TestCase):
     @mock.patch('marple.collect.test.test_main.collect._get_collecters')
     @mock.patch('marple.collect.test.test_main.collect._collect_results')
     def test_main(self, collect_mock, getc_mock, file_mock, outpt_mock,
-                  config_mock, writer_mock):
+                  config_mock, writer_mock, governor_mock):
         command = ['cpusched', 'memtime', '-o', 'out', '-t', '10']
         collect.main(command)
 
         file_mock.DataFileName.assert_called_once_with(given_name='out')
         file_mock.DataFileName().export_filename.assert_called_once()
-        getc_mock.assert_called_once_with(['cpusched', 'memtime'], 10)
+        getc_mock.assert_called_once_with(['cpusched', 'memtime'], 10,
+                                          collecter.Scope())
         collect_mock.assert_called_once()
+        governor_mock.return_value.confine.assert_called_once_with()
+        governor_mock.return_value.release.assert_called_once_with()
+
+    @mock.patch('marple.collect.test.test_main.collect._get_governor')
+    @mock.patch('marple.collect.test.test_main.collect.output')
+    @mock.patch('marple.collect.test.test_main.collect._collect')
+    def test_overhead_summary(self, collect_mock, output_mock, governor_mock):
+        """ Test that the overhead of each interface is reported. """
+        governor_mock.return_value.overhead_summary.return_value = [
+            "perf_stack_trace: 1.0% of one CPU"]
+        collect.main(['callstack', '-t', '5'])
+
+        output_mock.print_.assert_has_calls([
+            mock.call("Overhead of perf_stack_trace: 1.0% of one CPU"),
+            mock.call("Done.")])
+
+    @mock.patch('marple.collect.test.test_main.collect._get_governor')
+    @mock.patch('marple.collect.test.test_main.collect.config')
+    @mock.patch('marple.collect.test.test_main.collect.output')
+    @mock.patch('marple.collect.test.test_main.collect.file')
+    @mock.patch('marple.collect.test.test_main.collect._get_collecters')
+    @mock.patch('marple.collect.test.test_main.collect._collect_results')
+    @mock.patch('marple.collect.test.test_main.collect._record_flight')
+    def test_flight_recorder(self, record_mock, collect_mock, getc_mock,
+                             file_mock, outpt_mock, config_mock,
+                             governor_mock):
+        command = ['cpusched', '--flight-recorder', '-t', '30']
+        collect.main(command)
+
+        getc_mock.assert_called_once_with(['cpusched'], 30, collecter.Scope())
+        record_mock.assert_called_once_with(getc_mock.return_value, 30,
+                                            governor_mock.return_value)
+        collect_mock.assert_not_called()
+        file_mock.DataFileName.assert_not_called()
+
+    @mock.patch('marple.collect.test.test_main.collect._get_governor')
+    @mock.patch('marple.collect.test.test_main.collect.config')
+    @mock.patch('marple.collect.test.test_main.collect.output')
+    @mock.patch('marple.collect.test.test_main.collect.file')
+    @mock.patch('marple.collect.test.test_main.collect._get_collecters')
+    @mock.patch('marple.collect.test.test_main.collect._collect_results')
+    @mock.patch('marple.collect.test.test_main.collect._collect_periodically')
+    def test_every(self, periodic_mock, collect_mock, getc_mock, file_mock,
+                   outpt_mock, config_mock, governor_mock):
+        command = ['callstack', '--every', '60', '-t', '5']
+        collect.main(command)
+
+        getc_mock.assert_called_once_with(['callstack'], 5, collecter.Scope())
+        periodic_mock.assert_called_once_with(getc_mock.return_value, 60,
+                                              governor_mock.return_value)
+        collect_mock.assert_not_called()
+        file_mock.DataFileName.assert_not_called()
+
+
+    @mock.patch('marple.collect.test.test_main.collect._get_governor')
+    @mock.patch('marple.collect.test.test_main.collect.file')
+    @mock.patch('marple.collect.test.test_main.collect._get_collecters')
+    @mock.patch('marple.collect.test.test_main.collect._collect_results')
+    @mock.patch('marple.collect.test.test_main.collect._estimate')
+    def test_estimate(self, estimate_mock, collect_mock, getc_mock, file_mock,
+                      governor_mock):
+        collect.main(['callstack', 'cpusched', '--estimate', '-t', '60'])
+
+        estimate_mock.assert_called_once_with(getc_mock.return_value, 60)
+        collect_mock.assert_not_called()
+        file_mock.DataFileName.assert_not_called()
+
+
+    @mock.patch('marple.collect.test.test_main.collect._get_governor')
+    @mock.patch('marple.collect.test.test_main.collect.output')
+    @mock.patch('marple.collect.test.test_main.collect._get_collecters')
+    @mock.patch('marple.collect.test.test_main.collect._record_flight')
+    def test_scope(self, record_mock, getc_mock, output_mock, governor_mock):
+        collect.main(['callstack', '--flight-recorder', '-t', '5',
+                      '--pid', '1,2'])
+
+        getc_mock.assert_called_once_with(['callstack'], 5,
+                                          collecter.Scope(pids=(1, 2)))
+
+    @mock.patch('marple.collect.test.test_main.collect._get_governor')
+    @mock.patch('marple.collect.test.test_main.collect.output')
+    @mock.patch('marple.collect.test.test_main.collect._get_collecters')
+    def test_invalid_scope(self, getc_mock, output_mock, governor_mock):
+        with self.assertRaises(SystemExit):
+            collect.main(['callstack', '--comm', 'no such command'])
+
+        output_mock.error_.assert_called_once_with(
+            "Invalid scope", "No process named no such command")
+        getc_mock.assert_not_called()
 
 
 class HelperFunctionsTest(unittest.TestCase):
@@ -52,13 +146,19 @@ class HelperFunctionsTest(unittest.TestCase):
     def test_get_collecters(self, has_opt, get_opt_mock, coll_inst_mock):
         # We patch the function from within the test module since it's here we
         # call it
-        coll_inst_mock.side_effect = lambda com, time: com
+        coll_inst_mock.side_effect = lambda com, time: mock.Mock(interface=com)
         has_opt.side_effect = [True, False]
-        get_opt_mock.side_effect = ['disklat,mallocstacks']
-
-        answ = collect._get_collecters(['cpusched', 'memtime', 'alias'], 10)
-        self.assertListEqual(sorted(answ), sorted(['cpusched', 'memtime',
-                                                   'disklat', 'mallocstacks']))
+        get_opt_mock.side_effect = ['disklat,cpusched,mallocstacks']
+        scope = collecter.Scope(pids=(1,))
+
+        answ = collect._get_collecters(['cpusched', 'memtime', 'alias'], 10,
+                                       scope)
+        # In the order given, aliases expanded in place, without duplicates
+        self.assertListEqual([instance.interface for instance in answ],
+                             ['cpusched', 'memtime', 'disklat',
+                              'mallocstacks'])
+        for instance in answ:
+            self.assertEqual(scope, instance.scope)
 
         with self.assertRaises(ValueError):
             collect._get_collecters(['INVALID'], 10)
@@ -66,14 +166,14 @@ class HelperFunctionsTest(unittest.TestCase):
     @mock.patch("marple.collect.main.config.get_option_from_section")
     @mock.patch("marple.collect.test.test_main.collect.perf")
     @mock.patch("marple.collect.test.test_main.collect.ebpf")
-    @mock.patch("marple.collect.test.test_main.collect.iosnoop")
+    @mock.patch("marple.collect.test.test_main.collect.tracefs")
     @mock.patch("marple.collect.test.test_main.collect.smem")
-    def test_get_collecter_instance(self, smem_mock, iosnoop_mock,
+    def test_get_collecter_instance(self, smem_mock, tracefs_mock,
                                     ebpf_mock, perf_mock, get_opt_mock):
 
         inter_to_mock = {
             'cpusched': perf_mock.SchedulingEvents,
-            'disklat': iosnoop_mock.DiskLatency,
+            'disklat': tracefs_mock.DiskLatency,
             'mallocstacks': ebpf_mock.MallocStacks,
             'memusage': ebpf_mock.Memleak,
             'memtime': smem_mock.MemoryGraph,
@@ -84,6 +184,69 @@ class HelperFunctionsTest(unittest.TestCase):
             'perf_malloc': perf_mock.MemoryMalloc,
         }
 
+        # Use the default (per-event) disk latency collecter
+        get_opt_mock.return_value = 0
+
         for cmd in consts.interfaces_argnames:
             collect._get_collecter_instance(cmd, 10)
             inter_to_mock[cmd].assert_called()
+
+        # Histogram mode for disk latency
+        get_opt_mock.return_value = 1
+        collect._get_collecter_instance('disklat', 10)
+        ebpf_mock.DiskLatencyHistogram.assert_called()
+
+    @mock.patch("marple.collect.main.config.get_option_from_section")
+    @mock.patch("marple.collect.test.test_main.collect.iosnoop")
+    @mock.patch("marple.collect.test.test_main.collect.tracefs")
+    def test_iosnoop_fallback(self, tracefs_mock, iosnoop_mock, get_opt_mock):
+        """ Test selecting iosnoop, and falling back to it. """
+        # Not in histogram mode, iosnoop selected
+        get_opt_mock.side_effect = [False, True]
+        collect._get_collecter_instance('disklat', 10)
+        iosnoop_mock.DiskLatency.assert_called_once_with(10)
+        tracefs_mock.DiskLatency.assert_not_called()
+
+        # Neither selected, on a kernel without ftrace instances
+        get_opt_mock.side_effect = [False, False, 4096]
+        tracefs_mock.DiskLatency.side_effect = \
+            exceptions.NotSupportedException("too old", "3.16")
+        collecter_ = collect._get_collecter_instance('disklat', 10)
+        self.assertIs(iosnoop_mock.DiskLatency.return_value, collecter_)
+
+
+class CollectResultsTest(unittest.TestCase):
+    """Class that tests sections are written as collecters finish"""
+
+    @staticmethod
+    def _collecter(delay, datum_generator, interface):
+        """Create a collecter mock that takes `delay` seconds to collect"""
+        data = mock.MagicMock(datum_generator=datum_generator)
+        data.interface.value = interface
+
+        async def collect():
+            await asyncio.sleep(delay)
+            return data
+
+        return mock.MagicMock(collect=collect), data
+
+    @mock.patch('marple.collect.test.test_main.collect.output')
+    @mock.patch('marple.collect.test.test_main.collect._loading_bar')
+    def test_written_as_completed(self, bar_mock, output_mock):
+        async def no_bar(collection_time):
+            pass
+        bar_mock.side_effect = no_bar
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+        slow, slow_data = self._collecter(0.02, iter(()), 'cpusched')
+        fast, fast_data = self._collecter(0, iter(()), 'memtime')
+        failed, _ = self._collecter(0.01, None, 'disklat')
+        writer_mock = mock.MagicMock()
+
+        collect._collect_results([slow, fast, failed], 1, writer_mock,
+                                 governor.Governor())
+
+        self.assertEqual([mock.call(fast_data), mock.call(slow_data)],
+                         writer_mock.write_section.call_args_list)
+        output_mock.error_.assert_called_once()
+        self.assertIn('disklat', output_mock.error_.call_args[0][1])
@@ -0,0 +1,76 @@
+# --------------------------------------------------------------------
+# test_overhead.py - test the self-overhead accounting
+# October 2018
+# --------------------------------------------------------------------
+
+""" Test recording the usage of collection tools and parsing. """
+
+import asyncio
+import sys
+from unittest import mock
+
+import asynctest
+
+from marple.collect import overhead
+
+# Burns CPU for half a second and prints 1000 bytes, run through a shell as
+# the tools run through sudo are
+_TOOL = "import time\n" \
+        "start = time.process_time()\n" \
+        "while time.process_time() - start < 0.5:\n" \
+        "    pass\n" \
+        "print('x' * 999)"
+
+
+class SamplingTest(asynctest.TestCase):
+    """ Test sampling the usage of collection tools. """
+
+    async def test_usage(self):
+        account = overhead.Overhead()
+        sub_process = await asyncio.create_subprocess_shell(
+            "{} -c \"{}\"; true".format(sys.executable, _TOOL),
+            stdout=asyncio.subprocess.PIPE)
+        account.track(sub_process)
+        out, _ = await sub_process.communicate()
+        account.add_output(len(out))
+        account.finish(2.0)
+
+        self.assertEqual(0, sub_process.returncode)
+        self.assertEqual(1, account.subprocesses)
+        # The CPU time of the child of the shell, up to the last sample
+        self.assertGreater(account.cpu_time, 0.3)
+        self.assertGreater(account.max_rss, 0)
+        self.assertGreater(account.context_switches, 0)
+        self.assertEqual(1000, account.output_bytes)
+
+    def test_unmeasured(self):
+        """ Test that a tool reaped before it was sampled is not counted. """
+        account = overhead.Overhead()
+        account.track(mock.MagicMock(pid=-1))
+        account.finish(1.0)
+        self.assertEqual(0, account.subprocesses)
+
+
+class OverheadTest(asynctest.TestCase):
+    """ Test adding up and reporting overhead. """
+
+    def test_run_timed(self):
+        result, cpu_time = overhead.run_timed(sum, range(10 ** 6))
+        self.assertEqual(sum(range(10 ** 6)), result)
+        self.assertGreater(cpu_time, 0)
+
+    def test_add(self):
+        total = overhead.Overhead()
+        for max_rss in (2 ** 20, 3 * 2 ** 20):
+            account = overhead.Overhead()
+            account.wall_time = 10.0
+            account.cpu_time = 0.5
+            account.parse_time = 0.5
+            account.max_rss = max_rss
+            total.add(account)
+
+        self.assertEqual(10.0, total.cpu_percent())
+        self.assertEqual(3 * 2 ** 20, total.as_dict()
+                         ["subprocess_max_rss_bytes"])
+        self.assertTrue(str(total).startswith(
+            "10.0% of one CPU (1.00s tools, 1.00s parsing), max RSS 3.0 MB"))
@@ -0,0 +1,203 @@
+# --------------------------------------------------------------------
+# test_recorder.py - test the flight recorder
+# October 2018
+# --------------------------------------------------------------------
+
+""" Test the ring buffers and triggers of the flight recorder. """
+
+import asyncio
+import datetime
+import os
+import stat
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import asynctest
+
+from marple.collect import recorder
+from marple.common import consts, data_io
+
+_T0 = datetime.datetime(2018, 10, 1)
+
+
+def _seconds(n):
+    return _T0 + datetime.timedelta(seconds=n)
+
+
+def _points(*xs):
+    return [data_io.PointDatum(float(x), 1.0, "info") for x in xs]
+
+
+class RingBufferTest(unittest.TestCase):
+    """ Test eviction from ring buffers. """
+
+    def test_window(self):
+        buffer = recorder.RingBuffer(10, 1000)
+        for n in range(4):
+            buffer.add(_seconds(5 * n), _seconds(5 * n + 5), _points(n))
+
+        # The first segment ended 15s before the last, so is outside the
+        # window
+        self.assertEqual([_seconds(10), _seconds(15), _seconds(20)],
+                         [segment.end_time for segment in buffer.segments()])
+        self.assertEqual([_seconds(20)],
+                         [segment.end_time
+                          for segment in buffer.segments(_seconds(15))])
+
+    def test_memory_cap(self):
+        line_length = sys.getsizeof(str(_points(0)[0]))
+        buffer = recorder.RingBuffer(100, 3 * line_length)
+
+        buffer.add(_seconds(0), _seconds(1), _points(0, 0))
+        buffer.add(_seconds(1), _seconds(2), _points(1, 1))
+
+        # The oldest segment is evicted to keep within the cap
+        self.assertEqual(2 * line_length, buffer.nbytes)
+        self.assertEqual([_seconds(2)],
+                         [segment.end_time for segment in buffer.segments()])
+
+    def test_oversized_segment(self):
+        line_length = sys.getsizeof(str(_points(0)[0]))
+        buffer = recorder.RingBuffer(100, 2 * line_length)
+
+        buffer.add(_seconds(0), _seconds(1), _points(0, 1, 2))
+
+        self.assertEqual(1, buffer.dropped)
+        self.assertEqual([["0.0$$$1.0$$$info", "1.0$$$1.0$$$info"]],
+                         [segment.lines for segment in buffer.segments()])
+
+
+class FlightRecorderTest(asynctest.TestCase):
+    """ Test recording segments and dumping them. """
+
+    def setUp(self):
+        self.collecter = mock.MagicMock()
+        self.collecter.collect = asynctest.CoroutineMock(side_effect=[
+            data_io.PointData(iter(_points(n)), None, None,
+                              consts.InterfaceTypes.DISKLATENCY)
+            for n in range(3)])
+        self.collecter.clone.return_value = self.collecter
+        self.flight_recorder = recorder.FlightRecorder(
+            [self.collecter], window=60, segment_time=5, memory_cap=10000)
+
+    @mock.patch("marple.collect.recorder.output")
+    @mock.patch("marple.collect.recorder.file")
+    async def test_dump(self, file_mock, output_mock):
+        for _ in range(3):
+            await self.flight_recorder._record_segment()
+        self.assertEqual(5, self.collecter.time)
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "dump.marple")
+            file_mock.DataFileName.return_value.__str__.return_value = \
+                filename
+            self.assertEqual(filename, self.flight_recorder.dump())
+
+            with data_io.Reader(filename) as reader:
+                data, = reader.get_interface_data("disklat")
+                self.assertEqual(_points(0, 1, 2), list(data.datum_generator))
+        file_mock.DataFileName.return_value.export_filename \
+            .assert_called_once_with()
+
+    @mock.patch("marple.collect.recorder.os.getloadavg")
+    async def test_threshold(self, load_mock):
+        self.flight_recorder.load_threshold = 2.0
+        self.flight_recorder.dump = mock.MagicMock()
+
+        load_mock.return_value = (1.0, 0, 0)
+        self.flight_recorder._check_threshold()
+        self.flight_recorder.dump.assert_not_called()
+
+        load_mock.return_value = (3.0, 0, 0)
+        self.flight_recorder._check_threshold()
+        self.flight_recorder._check_threshold()
+        # Only dumped once within the window
+        self.flight_recorder.dump.assert_called_once_with()
+
+    async def test_socket_commands(self):
+        self.flight_recorder.dump = mock.MagicMock(return_value="file")
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"dump 10\nstatus\nfoo\n")
+        reader.feed_eof()
+        writer = mock.MagicMock()
+        writer.drain = asynctest.CoroutineMock()
+
+        await self.flight_recorder._handle_command(reader, writer)
+
+        self.flight_recorder.dump.assert_called_once_with(10)
+        self.assertEqual([mock.call(b"file\n"),
+                          mock.call(b"MagicMock: 0 bytes, 0.0 s unrecorded\n"),
+                          mock.call(b"Unknown command: foo\n")],
+                         writer.write.call_args_list)
+        writer.close.assert_called_once_with()
+
+    async def test_unrecorded(self):
+        """ Test that the time between recordings is measured. """
+        recorded_end = datetime.datetime.now() - datetime.timedelta(seconds=2)
+        self.collecter.collect.side_effect = [
+            data_io.PointData(iter(_points(n)), None, recorded_end,
+                              consts.InterfaceTypes.DISKLATENCY)
+            for n in range(2)]
+        first = asyncio.ensure_future(self.flight_recorder._record_segment())
+        await first
+        self.assertEqual(0, self.flight_recorder.unrecorded)
+
+        await self.flight_recorder._record_segment(first)
+        self.assertGreaterEqual(self.flight_recorder.unrecorded, 2)
+        # The segment is stamped with the time it was recorded until
+        self.assertEqual(
+            [recorded_end] * 2,
+            [segment.end_time
+             for segment in self.flight_recorder.buffers[0].segments()])
+
+    async def test_overlap(self):
+        """
+        Test that the next segment records while the last one is processed.
+
+        """
+        recording = []
+
+        async def collect():
+            start_time = datetime.datetime.now()
+            recording.append(start_time)
+            await asyncio.sleep(0.2)
+            end_time = datetime.datetime.now()
+            # Processing the data takes almost as long as recording it
+            await asyncio.sleep(0.15)
+            if len(recording) == 3:
+                self.flight_recorder.stop()
+            return data_io.PointData(iter(_points(len(recording))),
+                                     start_time, end_time,
+                                     consts.InterfaceTypes.DISKLATENCY)
+
+        def clone():
+            copy_ = mock.MagicMock()
+            copy_.collect = collect
+            return copy_
+
+        self.collecter.clone = clone
+        self.flight_recorder.segment_time = 0.2
+        await self.flight_recorder.run()
+
+        self.assertEqual(3, len(recording))
+        # Each segment started while the last was processed, as its recording
+        # ended
+        self.assertLess(self.flight_recorder.unrecorded, 0.1)
+        self.assertLess(recording[-1] - recording[0],
+                        datetime.timedelta(seconds=0.6))
+        self.assertEqual(
+            3, len(self.flight_recorder.buffers[0].segments()))
+
+    async def test_socket_permissions(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.flight_recorder.socket_path = \
+                os.path.join(directory, "recorder.sock")
+            server = await self.flight_recorder._start_server()
+            try:
+                mode = os.stat(self.flight_recorder.socket_path).st_mode
+                self.assertEqual(0o600, stat.S_IMODE(mode))
+            finally:
+                server.close()
+                await server.wait_closed()
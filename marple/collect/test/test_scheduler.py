@@ -0,0 +1,91 @@
+# --------------------------------------------------------------------
+# test_scheduler.py - test duty-cycled collection
+# October 2018
+# --------------------------------------------------------------------
+
+""" Test rotating data files and keeping within the disk budget. """
+
+import os
+import tempfile
+from unittest import mock
+
+import asynctest
+
+from marple.collect import scheduler
+from marple.common import consts, data_io
+
+
+class DutyCycleTest(asynctest.TestCase):
+    """ Test running collections on a duty cycle. """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.names = iter(os.path.join(self.directory.name,
+                                       "{}.marple".format(n))
+                          for n in range(10))
+
+        self.collecter = mock.MagicMock()
+        self.collecter.collect = asynctest.CoroutineMock(
+            side_effect=self._collect)
+        self.windows = 0
+        self.duty_cycle = None
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    async def _collect(self):
+        """ Collect one point, stopping after three windows. """
+        self.windows += 1
+        if self.windows == 3:
+            self.duty_cycle.stop()
+        return data_io.PointData(iter([data_io.PointDatum(1.0, 2.0, "a")]),
+                                 None, None, consts.InterfaceTypes.DISKLATENCY)
+
+    def _file_name(self):
+        name = mock.MagicMock()
+        name.__str__.return_value = next(self.names)
+        return name
+
+    @mock.patch("marple.collect.scheduler.file")
+    async def test_no_rotation(self, file_mock):
+        file_mock.DataFileName.side_effect = self._file_name
+        self.duty_cycle = scheduler.DutyCycle([self.collecter], 0, 10 ** 6,
+                                              3600, 10 ** 6)
+        await self.duty_cycle.run()
+
+        self.assertEqual([os.path.join(self.directory.name, "0.marple")],
+                         self.duty_cycle.files)
+        with data_io.Reader(self.duty_cycle.files[0]) as reader:
+            self.assertEqual(3, len(reader.metaheader))
+
+    @mock.patch("marple.collect.scheduler.file")
+    async def test_rotation_and_budget(self, file_mock):
+        """ Test one file per window, keeping only the newest in budget. """
+        file_mock.DataFileName.side_effect = self._file_name
+        self.duty_cycle = scheduler.DutyCycle([self.collecter], 0, 0, 3600, 1)
+        await self.duty_cycle.run()
+
+        self.assertEqual(3, self.windows)
+        self.assertEqual([os.path.join(self.directory.name, "2.marple")],
+                         self.duty_cycle.files)
+        self.assertEqual(["2.marple"], os.listdir(self.directory.name))
+
+    def test_budget_counts_open_file(self):
+        """ Test that the file being written counts towards the budget. """
+        self.duty_cycle = scheduler.DutyCycle([self.collecter], 0, 10 ** 6,
+                                              3600, 25)
+        for name in ("0.marple", "1.marple"):
+            with open(os.path.join(self.directory.name, name), "w") as file_:
+                file_.write("x" * 10)
+            self.duty_cycle.files.append(
+                os.path.join(self.directory.name, name))
+        self.duty_cycle._writer = mock.MagicMock()
+        self.duty_cycle._writer.file.tell.return_value = 15
+
+        self.duty_cycle._enforce_budget()
+        self.assertEqual(["1.marple"], os.listdir(self.directory.name))
+
+        # The open file is kept even when it exceeds the budget on its own
+        self.duty_cycle._writer.file.tell.return_value = 30
+        self.duty_cycle._enforce_budget()
+        self.assertEqual([], self.duty_cycle.files)
@@ -0,0 +1,234 @@
+#!/usr/bin/python
+#
+# disklathist   Summarize block device I/O latency as histograms, keyed by
+#               time bucket, disk and process.
+#               For Linux, uses BCC, eBPF.
+#
+# USAGE: disklathist [-h] [-i INTERVAL] [-L WIDTH] [-p PIDS]
+#                    [--cgroup CGROUP] [duration]
+#
+# The histograms are built in-kernel and drained every interval, so the
+# amount of output and the tracing overhead in user space do not depend on
+# the number of I/Os.
+# Output lines are "time$$$latency$$$disk comm(pid)$$$count", with the time
+# of the start of the bucket in seconds since tracing began and the
+# representative latency of the histogram slot in milliseconds. Where the
+# kernel can read and delete map entries atomically, everything counted so far
+# is drained, so the count of a slot may be printed in several lines, to be
+# added up.
+#
+# Based on biolatency (Copyright (c) 2015 Brendan Gregg).
+# Licensed under the Apache License, Version 2.0 (the "License")
+
+from __future__ import print_function
+from bcc import BPF
+from time import sleep
+import argparse
+import signal
+import sys
+
+from scope import pid_list, scope_declarations, scope_filter, set_cgroup
+
+
+# arg validation
+def positive_int(val):
+    try:
+        ival = int(val)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be an integer")
+
+    if ival < 0:
+        raise argparse.ArgumentTypeError("must be positive")
+    return ival
+
+def positive_nonzero_int(val):
+    ival = positive_int(val)
+    if ival == 0:
+        raise argparse.ArgumentTypeError("must be nonzero")
+    return ival
+
+# arguments
+examples = """examples:
+    ./disklathist 10          # log2 histograms every second, for 10 seconds
+    ./disklathist -i 5 60     # one time bucket every 5 seconds, for a minute
+    ./disklathist -L 100 10   # linear histograms with 100 usec slots
+"""
+parser = argparse.ArgumentParser(
+    description="Summarize block device I/O latency as histograms",
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    epilog=examples)
+parser.add_argument("-i", "--interval", default=1, type=positive_nonzero_int,
+    help="size of the time buckets, in seconds; each bucket is drained "
+         "once it is complete")
+parser.add_argument("-L", "--linear", default=0, type=positive_int,
+    help="use linear latency slots of this many microseconds rather than "
+         "log2 slots")
+parser.add_argument("-p", "--pid", type=pid_list,
+    help="trace these processes only (comma-separated PIDs)")
+parser.add_argument("--cgroup",
+    help="trace the processes in this cgroup v2 directory and below "
+         "only")
+parser.add_argument("duration", nargs="?", default=99999999,
+    type=positive_nonzero_int,
+    help="duration of trace, in seconds")
+args = parser.parse_args()
+duration = int(args.duration)
+interval = args.interval
+debug = 0
+
+# signal handler
+def signal_ignore(signal, frame):
+    print()
+
+# define BPF program
+bpf_text = """
+#include <uapi/linux/ptrace.h>
+#include <linux/blkdev.h>
+
+struct start_t {
+    u64 ts;
+    u32 pid;
+    char name[TASK_COMM_LEN];
+};
+
+struct hist_key_t {
+    u64 bucket;
+    u64 slot;
+    u32 pid;
+    char disk[DISK_NAME_LEN];
+    char name[TASK_COMM_LEN];
+};
+
+BPF_HASH(start, struct request *, struct start_t);
+BPF_HASH(dist, struct hist_key_t, u64);
+
+// record the issue time and the issuing process
+int trace_req_start(struct pt_regs *ctx, struct request *req) {
+    if (!(SCOPE_FILTER)) {
+        return 0;
+    }
+
+    struct start_t s = {};
+    s.ts = bpf_ktime_get_ns();
+    s.pid = bpf_get_current_pid_tgid() >> 32;
+    bpf_get_current_comm(&s.name, sizeof(s.name));
+    start.update(&req, &s);
+    return 0;
+}
+
+// count the latency in the histogram of its time bucket
+int trace_req_done(struct pt_regs *ctx, struct request *req) {
+    struct start_t *s = start.lookup(&req);
+    if (s == 0) {
+        return 0;   // missed issue
+    }
+
+    u64 now = bpf_ktime_get_ns();
+    u64 delta = (now - s->ts) / 1000;
+    struct hist_key_t key = {};
+    u64 zero = 0, *count;
+
+    key.bucket = (now - START_NS) / INTERVAL_NS;
+    key.slot = SLOT;
+    key.pid = s->pid;
+    __builtin_memcpy(&key.name, s->name, sizeof(key.name));
+    bpf_probe_read(&key.disk, sizeof(key.disk), req->rq_disk->disk_name);
+
+    count = dist.lookup_or_init(&key, &zero);
+    (*count)++;
+    start.delete(&req);
+    return 0;
+}
+"""
+
+# buckets are relative to the start of tracing, on the clock of
+# bpf_ktime_get_ns
+start_ns = BPF.monotonic_time()
+bpf_text = bpf_text.replace('START_NS', '%dULL' % start_ns)
+bpf_text = bpf_text.replace('INTERVAL_NS', '%dULL' % (interval * 1000000000))
+bpf_text = scope_declarations(args.cgroup) + bpf_text
+bpf_text = bpf_text.replace('SCOPE_FILTER',
+                            scope_filter(args.pid, args.cgroup))
+
+# set latency slots
+if args.linear > 0:
+    bpf_text = bpf_text.replace('SLOT', 'delta / %d' % args.linear)
+else:
+    bpf_text = bpf_text.replace('SLOT', 'bpf_log2l(delta)')
+
+if (debug):
+    print(bpf_text)
+
+# initialize BPF
+b = BPF(text=bpf_text)
+set_cgroup(b, args.cgroup)
+if BPF.get_kprobe_functions(b'blk_start_request'):
+    b.attach_kprobe(event="blk_start_request", fn_name="trace_req_start")
+b.attach_kprobe(event="blk_mq_start_request", fn_name="trace_req_start")
+b.attach_kprobe(event="blk_account_io_done", fn_name="trace_req_done")
+
+dist = b.get_table("dist")
+
+
+def slot_latency_ms(slot):
+    """ The representative latency of a histogram slot, in milliseconds. """
+    if args.linear > 0:
+        low, high = slot * args.linear, (slot + 1) * args.linear
+    else:
+        # log2 slot n holds latencies in [2^(n-1), 2^n) microseconds
+        low, high = (1 << slot) >> 1, 1 << slot
+    return (low + high) / 2000.0
+
+
+def print_counts(items):
+    """ Print histogram slots, as (key, count) pairs. """
+    for k, v in items:
+        print("%f$$$%f$$$%s %s(%d)$$$%d" % (k.bucket * interval,
+                                             slot_latency_ms(k.slot),
+                                             k.disk.decode(), k.name.decode(),
+                                             k.pid, v.value))
+    sys.stdout.flush()
+
+
+# lookup-and-delete in batches needs bcc 0.20 and Linux 5.6
+can_batch = hasattr(dist, "items_lookup_and_delete_batch")
+
+
+def drain(final):
+    """ Print and remove the histograms counted so far. """
+    global can_batch
+    if can_batch:
+        try:
+            # each entry is read and removed in one step, so no count added
+            # meanwhile is lost
+            items = list(dist.items_lookup_and_delete_batch())
+        except Exception:
+            can_batch = False
+        else:
+            print_counts(items)
+            return
+
+    # Otherwise only remove the buckets that ended over an interval ago,
+    # which no completion can be counted in any more; the last drain is made
+    # once the probes are detached
+    current = (BPF.monotonic_time() - start_ns) // (interval * 1000000000)
+    items = [(k, v) for k, v in dist.items()
+             if final or k.bucket < current - 1]
+    print_counts(items)
+    for k, _ in items:
+        del dist[k]
+
+
+remaining = duration
+try:
+    while remaining > 0:
+        sleep(min(interval, remaining))
+        remaining -= interval
+        drain(False)
+except KeyboardInterrupt:
+    # as cleanup can take many seconds, trap Ctrl-C:
+    signal.signal(signal.SIGINT, signal_ignore)
+
+# stop counting, so that the last drain sees the final counts
+b.detach_kprobe(event="blk_account_io_done")
+drain(True)
@@ -0,0 +1,501 @@
+#!/usr/bin/python
+#
+# mallocshared  Trace libc allocations once and report both the bytes
+#               allocated by stack (as mallocstacks) and the outstanding
+#               allocations by process (as memleak).
+#               For Linux, uses BCC, eBPF.
+#
+# USAGE: mallocshared [-h] [-s SAMPLE_RATE | -b SAMPLE_BYTES] [-T TOP]
+#                     [-o OLDER] [-i INTERVAL] [-c COUNT]
+#                     [--stack-storage-size STACK_STORAGE_SIZE]
+#                     [-p PIDS] [--cgroup CGROUP] [duration]
+#
+# A single set of uprobes/uretprobes is installed on the libc allocator, so
+# running both reports does not make every allocation trap twice. The
+# outstanding allocations are traced through the same allocator functions as
+# memleak, and counted the same way.
+# Output is always folded, in sections introduced by the lines
+# "[mallocstacks]" and "[memusage]". As in memleak, a time-stamped snapshot of
+# the outstanding allocations is printed every interval, the last one at the
+# end of the duration, each in its own "[memusage]" section; the bytes by
+# stack are printed once, at the end.
+#
+# Based on mallocstacks (Copyright 2016 Netflix, Inc.) and memleak
+# (Copyright (C) 2016 Sasha Goldshtein, Copyright (C) 2018 Andrei Diaconu).
+# Licensed under the Apache License, Version 2.0 (the "License")
+
+from __future__ import print_function
+from bcc import BPF
+from sys import stderr
+from time import sleep
+import argparse
+import errno
+import signal
+import os
+import sys
+
+from scope import pid_list, scope_declarations, scope_filter, set_cgroup
+
+
+class Allocation(object):
+    def __init__(self, size, name, pid):
+        self.count = 1
+        self.size = size
+        self.name = name
+        self.pid = pid
+
+    def update(self, size):
+        self.count += 1
+        self.size += size
+
+
+# arg validation
+def positive_int(val):
+    try:
+        ival = int(val)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be an integer")
+
+    if ival < 0:
+        raise argparse.ArgumentTypeError("must be positive")
+    return ival
+
+def positive_nonzero_int(val):
+    ival = positive_int(val)
+    if ival == 0:
+        raise argparse.ArgumentTypeError("must be nonzero")
+    return ival
+
+# arguments
+examples = """examples:
+    ./mallocshared 5           # trace for 5 seconds
+    ./mallocshared -s 10 5     # only record every 10th malloc() stack
+    ./mallocshared -T 25 5     # report the top 25 outstanding processes
+    ./mallocshared -i 5 -c 12 60
+                               # snapshot the outstanding allocations every
+                               # 5 seconds, for a minute
+"""
+parser = argparse.ArgumentParser(
+    description="Summarize libc malloc() bytes by stack trace and "
+                "outstanding allocations by process",
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    epilog=examples)
+sample_group = parser.add_mutually_exclusive_group()
+sample_group.add_argument("-s", "--sample-rate", default=1,
+    type=positive_nonzero_int,
+    help="record the stack of every N-th malloc() per thread; byte counts "
+         "are scaled back up by N (outstanding allocations are not sampled)")
+sample_group.add_argument("-b", "--sample-bytes", default=0,
+    type=positive_int,
+    help="record a stack each time a thread crosses a multiple of this many "
+         "allocated bytes, attributing the multiple to that stack")
+parser.add_argument("-T", "--top", type=positive_nonzero_int, default=10,
+    help="display only this many top processes with outstanding allocations")
+parser.add_argument("-o", "--older", default=500, type=positive_int,
+    help="prune allocations younger than this age in milliseconds")
+parser.add_argument("-i", "--interval", type=positive_nonzero_int,
+    help="seconds between snapshots of the outstanding allocations "
+         "(default: the duration)")
+parser.add_argument("-c", "--count", default=1, type=positive_nonzero_int,
+    help="number of snapshots, the last one at the end of the duration")
+parser.add_argument("--stack-storage-size", default=2048,
+    type=positive_nonzero_int,
+    help="the number of unique stack traces that can be stored and "
+         "displayed (default 2048)")
+parser.add_argument("-p", "--pid", type=pid_list,
+    help="trace these processes only (comma-separated PIDs)")
+parser.add_argument("--cgroup",
+    help="trace the processes in this cgroup v2 directory and below "
+         "only")
+parser.add_argument("duration", nargs="?", default=99999999,
+    type=positive_nonzero_int,
+    help="duration of trace, in seconds")
+args = parser.parse_args()
+duration = int(args.duration)
+interval = args.interval if args.interval else duration
+num_prints = args.count
+min_age_ns = 1e6 * args.older
+if duration < interval * (num_prints - 1):
+    print("error: the snapshots must be within the duration", file=stderr)
+    exit(1)
+debug = 0
+
+# signal handler
+def signal_ignore(signal, frame):
+    print()
+
+# define BPF program
+bpf_text = """
+#include <uapi/linux/ptrace.h>
+#include <linux/sched.h>
+
+struct key_t {
+    u32 pid;
+    u32 tgid;
+    int user_stack_id;
+    char name[TASK_COMM_LEN];
+};
+
+struct alloc_info_t {
+    u64 size;
+    u64 timestamp_ns;
+    int pid;
+    char name[TASK_COMM_LEN];
+};
+
+struct pid_bucket_t {
+    u32 pid;
+    u32 bucket;
+};
+
+struct pid_info_t {
+    s64 size;
+    char name[TASK_COMM_LEN];
+};
+
+// mallocstacks: bytes by stack
+BPF_HASH(bytes, struct key_t);
+BPF_HASH(samples, u32);
+BPF_STACK_TRACE(stack_traces, STACK_STORAGE_SIZE);
+
+// memleak: outstanding allocations by address
+BPF_HASH(sizes, u64);
+BPF_HASH(allocs, u64, struct alloc_info_t);
+BPF_HASH(memptrs, u64, u64);
+// Outstanding bytes per pid and age bucket, as in memleak: bucket 0 holds
+// the allocations made before the cutoff of the first snapshot, bucket k
+// those made between the cutoffs of snapshots k - 1 and k
+BPF_HASH(outstanding, struct pid_bucket_t, struct pid_info_t, 65536);
+// The cutoff of the first snapshot, in monotonic nanoseconds
+BPF_ARRAY(first_cutoff, u64, 1);
+// The allocations counted, and those lost because a map was full
+BPF_ARRAY(counts, u64, 2);
+
+static inline void count_allocation(int lost) {
+    u64 *count = counts.lookup(&lost);
+    if (count != 0)
+        __sync_fetch_and_add(count, 1);
+}
+
+static inline u32 age_bucket(u64 timestamp_ns) {
+    int zero = 0;
+    u64 *cutoff_ns = first_cutoff.lookup(&zero);
+    if (cutoff_ns == 0 || timestamp_ns < *cutoff_ns)
+        return 0;
+    return (timestamp_ns - *cutoff_ns) / SNAPSHOT_INTERVAL_NS + 1;
+}
+
+static inline int gen_alloc_enter(struct pt_regs *ctx, size_t size) {
+    // the exit probes only record allocations whose entry was recorded
+    if (!(SCOPE_FILTER)) {
+        return 0;
+    }
+    u64 pid = bpf_get_current_pid_tgid();
+    u64 size64 = size;
+    sizes.update(&pid, &size64);
+    return 0;
+}
+
+static inline int gen_alloc_exit2(struct pt_regs *ctx, u64 address) {
+    u64 pid = bpf_get_current_pid_tgid();
+    u64 *size64 = sizes.lookup(&pid);
+    struct alloc_info_t info = {0};
+
+    if (size64 == 0)
+        return 0; // missed alloc entry
+
+    info.size = *size64;
+    info.pid = pid;
+    info.timestamp_ns = bpf_ktime_get_ns();
+    sizes.delete(&pid);
+    bpf_get_current_comm(&info.name, sizeof(info.name));
+
+    if (allocs.update(&address, &info) != 0) {
+        count_allocation(1);
+        return 0;
+    }
+
+    struct pid_info_t zero_info = {0};
+    struct pid_bucket_t key = {};
+    key.pid = info.pid;
+    key.bucket = age_bucket(info.timestamp_ns);
+    struct pid_info_t *pid_info = outstanding.lookup_or_init(&key, &zero_info);
+    if (pid_info == 0) {
+        // not counted, so neither is its free
+        allocs.delete(&address);
+        count_allocation(1);
+        return 0;
+    }
+    __sync_fetch_and_add(&pid_info->size, info.size);
+    bpf_get_current_comm(&pid_info->name, sizeof(pid_info->name));
+    count_allocation(0);
+    return 0;
+}
+
+static inline int gen_alloc_exit(struct pt_regs *ctx) {
+    return gen_alloc_exit2(ctx, PT_REGS_RC(ctx));
+}
+
+static inline int gen_free_enter(struct pt_regs *ctx, void *address) {
+    u64 addr = (u64)address;
+    struct alloc_info_t *info = allocs.lookup(&addr);
+    if (info == 0)
+        return 0;
+
+    struct pid_bucket_t key = {};
+    key.pid = info->pid;
+    key.bucket = age_bucket(info->timestamp_ns);
+    struct pid_info_t *pid_info = outstanding.lookup(&key);
+    if (pid_info != 0)
+        __sync_fetch_and_add(&pid_info->size, -(s64)info->size);
+
+    allocs.delete(&addr);
+    return 0;
+}
+
+static inline int stack_enter(struct pt_regs *ctx, size_t size) {
+    u32 pid = bpf_get_current_pid_tgid();
+    u32 tgid = bpf_get_current_pid_tgid() >> 32;
+
+    // decide whether this call is sampled, before walking the stack
+    u64 zero = 0, *val;
+    u64 weight = size;
+    SAMPLE_FILTER
+
+    struct key_t key = {};
+    key.pid = pid;
+    key.tgid = tgid;
+    key.user_stack_id = USER_STACK_GET;
+    bpf_get_current_comm(&key.name, sizeof(key.name));
+
+    val = bytes.lookup_or_init(&key, &zero);
+    (*val) += weight;
+    return 0;
+}
+
+int malloc_enter(struct pt_regs *ctx, size_t size) {
+    if (!(SCOPE_FILTER)) {
+        return 0;
+    }
+    stack_enter(ctx, size);
+    return gen_alloc_enter(ctx, size);
+}
+
+int malloc_exit(struct pt_regs *ctx) {
+    return gen_alloc_exit(ctx);
+}
+
+int free_enter(struct pt_regs *ctx, void *address) {
+    return gen_free_enter(ctx, address);
+}
+
+int calloc_enter(struct pt_regs *ctx, size_t nmemb, size_t size) {
+    return gen_alloc_enter(ctx, nmemb * size);
+}
+
+int calloc_exit(struct pt_regs *ctx) {
+    return gen_alloc_exit(ctx);
+}
+
+int realloc_enter(struct pt_regs *ctx, void *ptr, size_t size) {
+    gen_free_enter(ctx, ptr);
+    return gen_alloc_enter(ctx, size);
+}
+
+int realloc_exit(struct pt_regs *ctx) {
+    return gen_alloc_exit(ctx);
+}
+
+int posix_memalign_enter(struct pt_regs *ctx, void **memptr, size_t alignment,
+                         size_t size) {
+    u64 memptr64 = (u64)(size_t)memptr;
+    u64 pid = bpf_get_current_pid_tgid();
+
+    memptrs.update(&pid, &memptr64);
+    return gen_alloc_enter(ctx, size);
+}
+
+int posix_memalign_exit(struct pt_regs *ctx) {
+    u64 pid = bpf_get_current_pid_tgid();
+    u64 *memptr64 = memptrs.lookup(&pid);
+    void *addr;
+
+    if (memptr64 == 0)
+        return 0;
+
+    memptrs.delete(&pid);
+
+    if (bpf_probe_read(&addr, sizeof(void*), (void*)(size_t)*memptr64))
+        return 0;
+
+    u64 addr64 = (u64)(size_t)addr;
+    return gen_alloc_exit2(ctx, addr64);
+}
+
+int aligned_alloc_enter(struct pt_regs *ctx, size_t alignment, size_t size) {
+    return gen_alloc_enter(ctx, size);
+}
+
+int aligned_alloc_exit(struct pt_regs *ctx) {
+    return gen_alloc_exit(ctx);
+}
+
+int valloc_enter(struct pt_regs *ctx, size_t size) {
+    return gen_alloc_enter(ctx, size);
+}
+
+int valloc_exit(struct pt_regs *ctx) {
+    return gen_alloc_exit(ctx);
+}
+
+int memalign_enter(struct pt_regs *ctx, size_t alignment, size_t size) {
+    return gen_alloc_enter(ctx, size);
+}
+
+int memalign_exit(struct pt_regs *ctx) {
+    return gen_alloc_exit(ctx);
+}
+
+int pvalloc_enter(struct pt_regs *ctx, size_t size) {
+    return gen_alloc_enter(ctx, size);
+}
+
+int pvalloc_exit(struct pt_regs *ctx) {
+    return gen_alloc_exit(ctx);
+}
+"""
+
+# set sampling: every N-th call (scaled up when printing), or every time the
+# per-thread byte count crosses a multiple of the threshold
+if args.sample_bytes > 0:
+    sample_filter = """
+    u64 *acc = samples.lookup_or_init(&pid, &zero);
+    (*acc) += size;
+    if (*acc < SAMPLE_BYTES) {
+        return 0;
+    }
+    weight = (*acc / SAMPLE_BYTES) * SAMPLE_BYTES;
+    (*acc) -= weight;
+    """.replace('SAMPLE_BYTES', str(args.sample_bytes))
+    weight_scale = 1
+elif args.sample_rate > 1:
+    sample_filter = """
+    u64 *count = samples.lookup_or_init(&pid, &zero);
+    (*count)++;
+    if (*count < SAMPLE_RATE) {
+        return 0;
+    }
+    (*count) = 0;
+    """.replace('SAMPLE_RATE', str(args.sample_rate))
+    weight_scale = args.sample_rate
+else:
+    sample_filter = ""
+    weight_scale = 1
+bpf_text = bpf_text.replace('SAMPLE_FILTER', sample_filter)
+bpf_text = scope_declarations(args.cgroup) + bpf_text
+bpf_text = bpf_text.replace('SCOPE_FILTER',
+                            scope_filter(args.pid, args.cgroup))
+
+bpf_text = bpf_text.replace('SNAPSHOT_INTERVAL_NS', str(int(interval * 1e9)))
+
+# set stack storage size
+bpf_text = bpf_text.replace('STACK_STORAGE_SIZE', str(args.stack_storage_size))
+
+# handle stack args
+user_stack_get = \
+    "stack_traces.get_stackid(ctx, BPF_F_REUSE_STACKID | BPF_F_USER_STACK)"
+bpf_text = bpf_text.replace('USER_STACK_GET', user_stack_get)
+
+if (debug):
+    print(bpf_text)
+
+# initialize BPF, one probe set shared by both reports
+b = BPF(text=bpf_text)
+set_cgroup(b, args.cgroup)
+
+# The snapshots are taken at the end of the duration and every interval
+# before it; the first cutoff is set before the probes are attached, so that
+# every allocation traced falls into the right bucket
+first_snapshot = duration - interval * (num_prints - 1)
+start_ns = BPF.monotonic_time()
+b["first_cutoff"][0] = b["first_cutoff"].Leaf(
+    max(0, start_ns + int(first_snapshot * 1e9 - min_age_ns)))
+
+# the same allocator functions as memleak
+for sym in ("malloc", "calloc", "realloc", "posix_memalign", "valloc",
+            "memalign", "pvalloc", "aligned_alloc"):
+    try:
+        b.attach_uprobe(name="c", sym=sym, fn_name=sym + "_enter")
+        b.attach_uretprobe(name="c", sym=sym, fn_name=sym + "_exit")
+    except Exception:
+        # aligned_alloc was only added in C11
+        if sym != "aligned_alloc":
+            raise
+b.attach_uprobe(name="c", sym="free", fn_name="free_enter")
+if b.num_open_uprobes() == 0:
+    print("error: 0 functions traced. Exiting.", file=stderr)
+    exit(1)
+
+def print_outstanding(snapshot, elapsed):
+    print("[memusage]")
+    alloc_info = {}
+    # Only the allocations before the cutoff of this snapshot are old enough
+    for key, info in b.get_table("outstanding").items():
+        if key.bucket > snapshot or info.size == 0:
+            continue
+        if key.pid in alloc_info:
+            alloc_info[key.pid].update(info.size)
+        else:
+            alloc_info[key.pid] = Allocation(info.size, info.name.decode(),
+                                             key.pid)
+    to_show = sorted((alloc for alloc in alloc_info.values()
+                      if alloc.size > 0),
+                     key=lambda a: a.size, reverse=True)[:args.top]
+    for alloc in to_show:
+        if alloc.pid != os.getpid():
+            # The snapshot time is the base of the stack, as in memleak
+            print("%d$$$%ds$$$%s" % (alloc.size, elapsed,
+                                     alloc.name + "(" + str(alloc.pid) + ")"))
+    # Flush each snapshot so that it can be consumed as it is produced
+    sys.stdout.flush()
+
+try:
+    for snapshot in range(num_prints):
+        elapsed = first_snapshot + snapshot * interval
+        sleep(max(0, start_ns / 1e9 + elapsed - BPF.monotonic_time() / 1e9))
+        print_outstanding(snapshot, elapsed)
+except KeyboardInterrupt:
+    # as cleanup can take many seconds, trap Ctrl-C:
+    signal.signal(signal.SIGINT, signal_ignore)
+
+# mallocstacks section
+print("[mallocstacks]")
+missing_stacks = 0
+has_enomem = False
+stack_traces = b.get_table("stack_traces")
+for k, v in b.get_table("bytes").items():
+    # handle get_stackid errors
+    if (k.user_stack_id < 0 and k.user_stack_id != -errno.EFAULT):
+        missing_stacks += 1
+        if k.user_stack_id == -errno.ENOMEM:
+            has_enomem = True
+        continue
+
+    if k.pid != os.getpid():
+        user_stack = list(stack_traces.walk(k.user_stack_id))
+        line = [k.name.decode()] + \
+            [b.sym(addr, k.tgid) for addr in reversed(user_stack)]
+        print("%d$$$%s" % (v.value * weight_scale, ";".join(line)))
+
+sys.stdout.flush()
+
+if missing_stacks > 0:
+    enomem_str = "" if not has_enomem else \
+        " Consider increasing --stack-storage-size."
+    print("WARNING: %d stack traces could not be displayed.%s" %
+        (missing_stacks, enomem_str),
+        file=stderr)
+
+# The allocations missing from the memusage snapshots, as the maps were full
+print("Counted %d allocations, lost %d" %
+      (b["counts"][0].value, b["counts"][1].value), file=stderr)
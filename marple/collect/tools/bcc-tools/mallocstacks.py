@@ -3,7 +3,8 @@
 # mallocstacks    Trace libc malloc() and show stacks and total bytes.
 #                 For Linux, uses BCC, eBPF.
 #
-# USAGE: mallocstacks [-h] [-p PID | -t TID] [-f]
+# USAGE: mallocstacks [-h] [-p PIDS | -t TID] [--cgroup CGROUP] [-f]
+#                     [-s SAMPLE_RATE | -b SAMPLE_BYTES]
 #                     [--stack-storage-size STACK_STORAGE_SIZE]
 #                     [-m MIN_BLOCK_TIME] [-M MAX_BLOCK_TIME]
 #                     [duration]
@@ -27,6 +28,8 @@ import errno
 import signal
 import os
 
+from scope import pid_list, scope_declarations, scope_filter, set_cgroup
+
 # arg validation
 def positive_int(val):
     try:
@@ -53,6 +56,8 @@ examples = """examples:
     ./mallocstacks -M 10000    # only trace I/O less than 10000 usec
     ./mallocstacks -p 185      # only trace threads for PID 185
     ./mallocstacks -t 188      # only trace thread 188
+    ./mallocstacks -s 10       # only record every 10th malloc() per thread
+    ./mallocstacks -b 524288   # record a stack every 512 KB per thread
 """
 parser = argparse.ArgumentParser(
     description="Summarize libc malloc() bytes by stack trace",
@@ -61,12 +66,24 @@ parser = argparse.ArgumentParser(
 thread_group = parser.add_mutually_exclusive_group()
 # Note: this script provides --pid and --tid flags but their arguments are
 # referred to internally using kernel nomenclature: TGID and PID.
-thread_group.add_argument("-p", "--pid", metavar="PID", dest="tgid",
-    help="trace this PID only", type=positive_int)
+thread_group.add_argument("-p", "--pid", metavar="PIDS", dest="tgid",
+    help="trace these PIDs only (comma-separated)", type=pid_list)
 thread_group.add_argument("-t", "--tid", metavar="TID", dest="pid",
     help="trace this TID only", type=positive_int)
+parser.add_argument("--cgroup",
+    help="trace the processes in this cgroup v2 directory and below "
+         "only")
 parser.add_argument("-f", "--folded", action="store_true",
     help="output folded format")
+sample_group = parser.add_mutually_exclusive_group()
+sample_group.add_argument("-s", "--sample-rate", default=1,
+    type=positive_nonzero_int,
+    help="record every N-th malloc() per thread to decrease the overhead; "
+         "byte counts are scaled back up by N")
+sample_group.add_argument("-b", "--sample-bytes", default=0,
+    type=positive_int,
+    help="record a stack each time a thread crosses a multiple of this many "
+         "allocated bytes, attributing the multiple to that stack")
 parser.add_argument("--stack-storage-size", default=2048,
     type=positive_nonzero_int,
     help="the number of unique stack traces that can be stored and "
@@ -97,6 +114,7 @@ struct key_t {
     char name[TASK_COMM_LEN];
 };
 BPF_HASH(bytes, struct key_t);
+BPF_HASH(samples, u32);
 BPF_STACK_TRACE(stack_traces, STACK_STORAGE_SIZE);
 
 int trace_malloc(struct pt_regs *ctx, size_t size) {
@@ -107,8 +125,12 @@ int trace_malloc(struct pt_regs *ctx, size_t size) {
         return 0;
     }
 
-    // create map key
+    // decide whether this call is sampled, before walking the stack
     u64 zero = 0, *val;
+    u64 weight = size;
+    SAMPLE_FILTER
+
+    // create map key
     struct key_t key = {};
 
     key.pid = pid;
@@ -117,7 +139,7 @@ int trace_malloc(struct pt_regs *ctx, size_t size) {
     bpf_get_current_comm(&key.name, sizeof(key.name));
 
     val = bytes.lookup_or_init(&key, &zero);
-    (*val) += size;
+    (*val) += weight;
     return 0;
 }
 
@@ -125,9 +147,12 @@ int trace_malloc(struct pt_regs *ctx, size_t size) {
 
 # set thread filter
 thread_context = ""
-if args.tgid is not None:
-    thread_context = "PID %d" % args.tgid
-    thread_filter = 'tgid == %d' % args.tgid
+if args.tgid is not None or args.cgroup is not None:
+    thread_context = ", ".join(
+        (["PID " + ",".join(map(str, args.tgid))] if args.tgid else []) +
+        (["cgroup " + args.cgroup] if args.cgroup else []))
+    thread_filter = scope_filter(args.tgid, args.cgroup)
+    bpf_text = scope_declarations(args.cgroup) + bpf_text
 elif args.pid is not None:
     thread_context = "TID %d" % args.pid
     thread_filter = 'pid == %d' % args.pid
@@ -136,6 +161,37 @@ else:
     thread_filter = '1'
 bpf_text = bpf_text.replace('THREAD_FILTER', thread_filter)
 
+# set sampling: every N-th call (scaled up when printing), or every time the
+# per-thread byte count crosses a multiple of the threshold
+if args.sample_bytes > 0:
+    sample_context = "every %d bytes" % args.sample_bytes
+    sample_filter = """
+    u64 *acc = samples.lookup_or_init(&pid, &zero);
+    (*acc) += size;
+    if (*acc < SAMPLE_BYTES) {
+        return 0;
+    }
+    weight = (*acc / SAMPLE_BYTES) * SAMPLE_BYTES;
+    (*acc) -= weight;
+    """.replace('SAMPLE_BYTES', str(args.sample_bytes))
+    weight_scale = 1
+elif args.sample_rate > 1:
+    sample_context = "every %d calls" % args.sample_rate
+    sample_filter = """
+    u64 *count = samples.lookup_or_init(&pid, &zero);
+    (*count)++;
+    if (*count < SAMPLE_RATE) {
+        return 0;
+    }
+    (*count) = 0;
+    """.replace('SAMPLE_RATE', str(args.sample_rate))
+    weight_scale = args.sample_rate
+else:
+    sample_context = "every call"
+    sample_filter = ""
+    weight_scale = 1
+bpf_text = bpf_text.replace('SAMPLE_FILTER', sample_filter)
+
 # set stack storage size
 bpf_text = bpf_text.replace('STACK_STORAGE_SIZE', str(args.stack_storage_size))
 
@@ -150,6 +206,7 @@ if (debug):
 
 # initialize BPF
 b = BPF(text=bpf_text)
+set_cgroup(b, args.cgroup)
 if args.pid is not None:
     tpid = args.pid
 else:
@@ -162,8 +219,8 @@ if matched == 0:
 
 # header
 if not folded:
-    print("Tracing libc malloc() bytes (us) of %s by %s stack" %
-        (thread_context, stack_context), end="")
+    print("Tracing libc malloc() bytes (us) of %s by %s stack, sampling %s" %
+        (thread_context, stack_context, sample_context), end="")
     if duration < 99999999:
         print(" for %d secs." % duration)
     else:
@@ -200,13 +257,13 @@ for k, v in sorted(bytemap.items(), key=lambda bytemap: bytemap[1].value):
             # print folded stack output
             line = [k.name.decode()] + \
                 [b.sym(addr, k.tgid) for addr in reversed(user_stack)]
-            print("%d$$$%s" % (v.value, ";".join(line)))
+            print("%d$$$%s" % (v.value * weight_scale, ";".join(line)))
     else:
         # print default multi-line stack output
         for addr in user_stack:
             print("    %s" % b.sym(addr, k.tgid))
         print("    %-16s %s (%d)" % ("-", k.name.decode(), k.pid))
-        print("        %d\n" % v.value)
+        print("        %d\n" % (v.value * weight_scale))
 
 if missing_stacks > 0:
     enomem_str = "" if not has_enomem else \
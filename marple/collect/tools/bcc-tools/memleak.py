@@ -3,9 +3,9 @@
 # memleak   Trace and display outstanding allocations to detect
 #           memory leaks in user-mode processes and the kernel.
 #
-# USAGE: memleak [-h] [-p PID] [-t] [-a] [-o OLDER] [-c COMMAND]
+# USAGE: memleak [-h] [-p PIDS] [--cgroup CGROUP] [-t] [-a] [-o OLDER] [-c COMMAND]
 #                [--combined-only] [-s SAMPLE_RATE] [-T TOP] [-z MIN_SIZE]
-#                [-Z MAX_SIZE] [-O OBJ]
+#                [-Z MAX_SIZE] [-O OBJ] [-d DURATION]
 #                [interval] [count]
 #
 # Licensed under the Apache License, Version 2.0 (the "License")
@@ -14,13 +14,14 @@
 
 from bcc import BPF
 from time import sleep
-from datetime import datetime
 import resource
 import argparse
 import subprocess
 import os
 import sys
 
+from scope import pid_list, scope_declarations, scope_filter, set_cgroup
+
 
 class Allocation(object):
     def __init__(self, size, name, pid):
@@ -51,6 +52,11 @@ EXAMPLES:
         allocations that are at least one minute (60 seconds) old
 ./memleak -s 5
         Trace roughly every 5th allocation, to reduce overhead
+./memleak -T 10 5 12
+        Print a time-stamped snapshot of the 10 processes with the most
+        outstanding bytes every 5 seconds, for a minute
+./memleak -d 7 5 2
+        Print snapshots 5 seconds apart, the last one 7 seconds in
 """
 
 description = """
@@ -83,8 +89,17 @@ parser.add_argument("-z", "--min-size", type=int,
                     help="capture only allocations larger than this size")
 parser.add_argument("-Z", "--max-size", type=int,
                     help="capture only allocations smaller than this size")
+parser.add_argument("-p", "--pid", type=pid_list,
+                    help="trace these processes only (comma-separated PIDs)")
+parser.add_argument("--cgroup",
+                    help="trace the processes in this cgroup v2 directory "
+                         "and below only")
 parser.add_argument("-O", "--obj", type=str, default="c",
                     help="attach to allocator functions in the specified object")
+parser.add_argument("-d", "--duration", type=int,
+                    help="seconds until the last snapshot, the others being "
+                         "interval seconds apart before it (default: "
+                         "interval times count)")
 
 args = parser.parse_args()
 
@@ -92,7 +107,8 @@ trace_all = args.trace
 interval = args.interval
 min_age_ns = 1e6 * args.older
 sample_every_n = args.sample_rate
-num_prints = args.count
+num_prints = args.count if args.count else 1
+duration = args.duration if args.duration else interval * num_prints
 top_stacks = args.top
 min_size = args.min_size
 max_size = args.max_size
@@ -101,6 +117,10 @@ obj = args.obj
 if min_size is not None and max_size is not None and min_size > max_size:
     print("min_size (-z) can't be greater than max_size (-Z)")
     exit(1)
+if interval <= 0 or duration < interval * (num_prints - 1):
+    print("the snapshots must be a positive interval apart, within the "
+          "duration (-d)")
+    exit(1)
 
 bpf_source = """
 #include <uapi/linux/ptrace.h>
@@ -113,12 +133,51 @@ struct alloc_info_t {
         char name[TASK_COMM_LEN];
 };
 
+struct pid_bucket_t {
+        u32 pid;
+        u32 bucket;
+};
+
+struct pid_info_t {
+        s64 size;
+        char name[TASK_COMM_LEN];
+};
+
 BPF_HASH(sizes, u64);
 //BPF_TABLE("hash", u64, struct alloc_info_t, allocs, 1);
 BPF_HASH(allocs, u64, struct alloc_info_t);
 BPF_HASH(memptrs, u64, u64);
+// Outstanding bytes per pid and age bucket, kept up to date so that a
+// snapshot only walks a few entries per process rather than every outstanding
+// allocation. Bucket 0 holds the allocations made before the cutoff of the
+// first snapshot, bucket k those made between the cutoffs of snapshots k - 1
+// and k, the cutoffs (snapshot time minus the minimum age) being
+// SNAPSHOT_INTERVAL_NS apart; so snapshot k counts the buckets up to k.
+BPF_HASH(outstanding, struct pid_bucket_t, struct pid_info_t, 65536);
+// The cutoff of the first snapshot, in monotonic nanoseconds
+BPF_ARRAY(first_cutoff, u64, 1);
+// The allocations counted, and those lost because a map was full
+BPF_ARRAY(counts, u64, 2);
+
+static inline void count_allocation(int lost) {
+        u64 *count = counts.lookup(&lost);
+        if (count != 0)
+                __sync_fetch_and_add(count, 1);
+}
+
+static inline u32 age_bucket(u64 timestamp_ns) {
+        int zero = 0;
+        u64 *cutoff = first_cutoff.lookup(&zero);
+        if (cutoff == 0 || timestamp_ns < *cutoff)
+                return 0;
+        return (timestamp_ns - *cutoff) / SNAPSHOT_INTERVAL_NS + 1;
+}
 
 static inline int gen_alloc_enter(struct pt_regs *ctx, size_t size) {
+        // the exit probes only record allocations whose entry was recorded
+        if (!(SCOPE_FILTER))
+                return 0;
+
         u64 pid = bpf_get_current_pid_tgid();
         u64 size64 = size;
         sizes.update(&pid, &size64);
@@ -139,7 +198,26 @@ static inline int gen_alloc_exit2(struct pt_regs *ctx, u64 address) {
         sizes.delete(&pid);
         bpf_get_current_comm(&info.name, sizeof(info.name));
 
-        allocs.update(&address, &info);
+        if (allocs.update(&address, &info) != 0) {
+                count_allocation(1);
+                return 0;
+        }
+
+        struct pid_info_t zero_info = {0};
+        struct pid_bucket_t key = {};
+        key.pid = info.pid;
+        key.bucket = age_bucket(info.timestamp_ns);
+        struct pid_info_t *pid_info = outstanding.lookup_or_init(&key,
+                                                                 &zero_info);
+        if (pid_info == 0) {
+                // not counted, so neither is its free
+                allocs.delete(&address);
+                count_allocation(1);
+                return 0;
+        }
+        __sync_fetch_and_add(&pid_info->size, info.size);
+        bpf_get_current_comm(&pid_info->name, sizeof(pid_info->name));
+        count_allocation(0);
 
         return 0;
 }
@@ -154,6 +232,13 @@ static inline int gen_free_enter(struct pt_regs *ctx, void *address) {
         if (info == 0)
                 return 0;
 
+        struct pid_bucket_t key = {};
+        key.pid = info->pid;
+        key.bucket = age_bucket(info->timestamp_ns);
+        struct pid_info_t *pid_info = outstanding.lookup(&key);
+        if (pid_info != 0)
+                __sync_fetch_and_add(&pid_info->size, -(s64)info->size);
+
         allocs.delete(&addr);
 
         return 0;
@@ -248,13 +333,27 @@ int pvalloc_exit(struct pt_regs *ctx) {
 """
 
 bpf_source = bpf_source.replace("SAMPLE_EVERY_N", str(sample_every_n))
+bpf_source = scope_declarations(args.cgroup) + bpf_source
+bpf_source = bpf_source.replace("SCOPE_FILTER",
+                                scope_filter(args.pid, args.cgroup))
 bpf_source = bpf_source.replace("PAGE_SIZE", str(resource.getpagesize()))
+bpf_source = bpf_source.replace("SNAPSHOT_INTERVAL_NS",
+                                str(int(interval * 1e9)))
 
 stack_flags = "BPF_F_REUSE_STACKID"
 stack_flags += "|BPF_F_USER_STACK"
 bpf_source = bpf_source.replace("STACK_FLAGS", stack_flags)
 
 bpf = BPF(text=bpf_source)
+set_cgroup(bpf, args.cgroup)
+
+# The snapshots are taken at the end of the duration and every interval
+# before it; the first cutoff is set before the probes are attached, so that
+# every allocation traced falls into the right bucket
+first_snapshot = duration - interval * (num_prints - 1)
+start_ns = BPF.monotonic_time()
+bpf["first_cutoff"][0] = bpf["first_cutoff"].Leaf(
+    max(0, start_ns + int(first_snapshot * 1e9 - min_age_ns)))
 
 
 def attach_probes(sym, fn_prefix=None, can_fail=False):
@@ -284,29 +383,35 @@ attach_probes("aligned_alloc", can_fail=True)  # added in C11
 bpf.attach_uprobe(name=obj, sym="free", fn_name="free_enter")
 
 
-def print_outstanding():
+def print_outstanding(snapshot, elapsed):
     alloc_info = {}
-    allocs = bpf["allocs"]
-    for address, info in sorted(allocs.items(), key=lambda a: a[1].size):
-        if BPF.monotonic_time() - min_age_ns < info.timestamp_ns:
+    # Only the allocations before the cutoff of this snapshot are old enough
+    for key, info in bpf["outstanding"].items():
+        if key.bucket > snapshot or info.size == 0:
             continue
-
-        if info.pid in alloc_info:
-            alloc_info[info.pid].update(info.size)
+        if key.pid in alloc_info:
+            alloc_info[key.pid].update(info.size)
         else:
-            alloc_info[info.pid] = Allocation(info.size,
-                                              info.name.decode(),
-                                              info.pid)
-    to_show = sorted(alloc_info.values(),
-                     key=lambda a: a.size, reverse=True)[:top_stacks + 1]
+            alloc_info[key.pid] = Allocation(info.size, info.name.decode(),
+                                             key.pid)
+    to_show = sorted((alloc for alloc in alloc_info.values() if alloc.size > 0),
+                     key=lambda a: a.size, reverse=True)[:top_stacks]
     for alloc in to_show:
         if alloc.pid != os.getpid():
             # @TODO: Better way to deal with pid and count so that the tooltip
             # @TODO: of the treemap will know
-            print("%d$$$%s" % (alloc.size,
-                               alloc.name + "(" + str(alloc.pid) + ")"))
+            # The snapshot time is the base of the stack
+            print("%d$$$%ds$$$%s" % (alloc.size, elapsed,
+                                     alloc.name + "(" + str(alloc.pid) + ")"))
+    # Flush each snapshot so that it can be consumed as it is produced
+    sys.stdout.flush()
+
 
+for snapshot in range(num_prints):
+    elapsed = first_snapshot + snapshot * interval
+    sleep(max(0, start_ns / 1e9 + elapsed - BPF.monotonic_time() / 1e9))
+    print_outstanding(snapshot, elapsed)
 
-sleep(interval)
-print_outstanding()
-sys.stdout.flush()
\ No newline at end of file
+# The allocations missing from the snapshots, as the maps were full
+print("Counted %d allocations, lost %d" %
+      (bpf["counts"][0].value, bpf["counts"][1].value), file=sys.stderr)
@@ -0,0 +1,57 @@
+#
+# scope     Limit the marple bcc tools to some processes and a cgroup.
+#
+# The tools take the same -p/--pid and --cgroup arguments, which are checked
+# in-kernel by the condition built here:
+#
+#   parser.add_argument("-p", "--pid", type=pid_list)
+#   bpf_text = scope_declarations(args.cgroup) + bpf_text
+#   bpf_text = bpf_text.replace('SCOPE_FILTER',
+#                               scope_filter(args.pid, args.cgroup))
+#   b = BPF(text=bpf_text)
+#   set_cgroup(b, args.cgroup)
+#
+# The cgroup is matched with bpf_current_task_under_cgroup(), so the processes
+# in its descendant cgroups are traced too (Linux 4.9+).
+#
+# Licensed under the Apache License, Version 2.0 (the "License")
+
+import argparse
+
+# The BPF_CGROUP_ARRAY holding the cgroup to trace
+CGROUP_TABLE = "scope_cgroup"
+
+
+def pid_list(val):
+    try:
+        pids = [int(pid) for pid in val.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be a comma-separated list of PIDs")
+    return pids
+
+def scope_declarations(cgroup):
+    """The BPF declarations the condition of scope_filter needs."""
+    if not cgroup:
+        return ""
+    return "BPF_CGROUP_ARRAY(%s, 1);\n" % CGROUP_TABLE
+
+def scope_filter(pids, cgroup):
+    """C condition for the current task being one of the processes and in the
+    cgroup (the path of a cgroup v2 directory) or one of its descendants,
+    whichever are given."""
+    conditions = []
+    if pids:
+        conditions.append(" || ".join(
+            "(bpf_get_current_pid_tgid() >> 32) == %d" % pid for pid in pids))
+    if cgroup:
+        # Negative if the table was not set, which traces nothing
+        conditions.append("%s.check_current_task(0) > 0" % CGROUP_TABLE)
+    if not conditions:
+        return "1"
+    return "(" + ") && (".join(conditions) + ")"
+
+def set_cgroup(b, cgroup):
+    """Point the condition of scope_filter at the cgroup, once the program is
+    loaded."""
+    if cgroup:
+        b[CGROUP_TABLE][0] = cgroup
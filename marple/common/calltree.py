@@ -0,0 +1,330 @@
+# -------------------------------------------------------------
+# calltree.py - call tree of stack data shared by the displays
+# October 2018
+# -------------------------------------------------------------
+
+"""
+A compact call tree for stack data.
+
+Stacks are merged into a prefix tree as they are read, so that it takes time
+in proportion to the frames of the stacks, and memory in proportion to the
+distinct call paths rather than the samples.
+Frame names are interned: each node stores the id of its name, its parent and
+depth, and its total weight (of the stacks through it) and self weight (of
+the stacks ending at it), in flat arrays indexed by node.
+The children of each node are indexed by a dict while the tree grows; once it
+is read, they are laid out contiguously in an array, ordered by name.
+
+Node 0 is the root, which has no name; every other node is created after its
+parent, so visiting nodes in index order visits parents first.
+
+The flame graph, the treemap and text reports all build on this tree.
+
+"""
+
+__all__ = (
+    'CallTree',
+)
+
+import array
+import collections
+import heapq
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+logger.debug('Entered module: %s', __name__)
+
+# The number of bits of a frame id in a child index key
+_FRAME_BITS = 32
+# The number of stacks read at a time, identical ones being merged before
+# they are added to the tree
+ADD_BATCH_SIZE = 1 << 20
+
+
+class CallTree:
+    """
+    A prefix tree of weighted stacks.
+
+    .. attribute:: names:
+        The interned frame names, by frame id.
+
+    """
+    ROOT = 0
+
+    def __init__(self):
+        """ Initialise a tree with only a root. """
+        self.names = []
+        self._ids = {}
+
+        # Per node: frame id, parent, depth, total weight and self weight
+        self._frame = array.array('l', [-1])
+        self._parent = array.array('l', [-1])
+        self._depth = array.array('l', [0])
+        self._total = array.array('q', [0])
+        self._self = array.array('q', [0])
+
+        # The child of each node, by (parent << _FRAME_BITS) | frame id
+        self._index = {}
+        # Children by node, laid out once the tree is read; None if stale
+        self._child_start = None
+        self._child_nodes = None
+
+    def __len__(self):
+        """ :return: The number of nodes, including the root. """
+        return len(self._frame)
+
+    def _intern(self, name):
+        """ :return: The frame id of a name, adding it if new. """
+        frame = self._ids.get(name)
+        if frame is None:
+            frame = self._ids[name] = len(self.names)
+            self.names.append(name)
+        return frame
+
+    def _child(self, parent, frame):
+        """ :return: The child of a node for a frame id, adding it if new. """
+        key = (parent << _FRAME_BITS) | frame
+        node = self._index.get(key)
+        if node is None:
+            node = self._index[key] = len(self._frame)
+            self._frame.append(frame)
+            self._parent.append(parent)
+            self._depth.append(self._depth[parent] + 1)
+            self._total.append(0)
+            self._self.append(0)
+            self._child_start = None
+        return node
+
+    def add(self, stack, weight=1):
+        """
+        Add a stack to the tree.
+
+        :param stack:
+            The frame names, outermost first.
+        :param weight:
+            The weight of the stack.
+
+        """
+        total = self._total
+        total[0] += weight
+        node = 0
+        for name in stack:
+            node = self._child(node, self._intern(name))
+            total[node] += weight
+        self._self[node] += weight
+
+    def add_all(self, datums):
+        """
+        Add stacks to the tree as they are read.
+
+        Stacks are read in batches, and each distinct stack of a batch is
+        added once, since samples tend to repeat the same few stacks.
+
+        :param datums:
+            An iterable of `data_io.StackDatum` objects.
+        :return:
+            The tree.
+
+        """
+        # The loop of add, with the lookups in locals
+        ids, names, index = self._ids, self.names, self._index
+        frames, parents, depths = self._frame, self._parent, self._depth
+        total, self_ = self._total, self._self
+        datums = iter(datums)
+        while True:
+            counts = collections.Counter()
+            for datum in itertools.islice(datums, ADD_BATCH_SIZE):
+                counts[datum.stack] += datum.weight
+            if not counts:
+                break
+            for stack, weight in counts.items():
+                total[0] += weight
+                node = 0
+                for name in stack:
+                    frame = ids.get(name)
+                    if frame is None:
+                        frame = ids[name] = len(names)
+                        names.append(name)
+                    key = (node << _FRAME_BITS) | frame
+                    child = index.get(key)
+                    if child is None:
+                        child = index[key] = len(frames)
+                        frames.append(frame)
+                        parents.append(node)
+                        depths.append(depths[node] + 1)
+                        total.append(0)
+                        self_.append(0)
+                    node = child
+                    total[node] += weight
+                self_[node] += weight
+        self._child_start = None
+        return self
+
+    def merge(self, other):
+        """
+        Add the stacks of another tree to this one.
+
+        :param other:
+            The :class:`CallTree` to merge in; it is left unchanged.
+        :return:
+            The tree.
+
+        """
+        # The node of this tree for each node of the other, parents first
+        mapping = array.array('l', [0]) * len(other)
+        self._total[0] += other._total[0]
+        self._self[0] += other._self[0]
+        for node in range(1, len(other)):
+            frame = self._intern(other.names[other._frame[node]])
+            mapped = mapping[node] = \
+                self._child(mapping[other._parent[node]], frame)
+            self._total[mapped] += other._total[node]
+            self._self[mapped] += other._self[node]
+        return self
+
+    def _folded_copy(self, kept):
+        """
+        Copy the tree, folding the self weight of each node that is not kept
+        into its nearest kept ancestor.
+
+        :param kept:
+            A callable that says whether a node is kept; the parent of a kept
+            node must be kept.
+        :return:
+            The new :class:`CallTree`.
+
+        """
+        tree = CallTree()
+        tree.names = list(self.names)
+        tree._ids = dict(self._ids)
+        tree._total[0] = self._total[0]
+        tree._self[0] = self._self[0]
+        mapping = array.array('l', [0]) * len(self)
+        for node in range(1, len(self)):
+            parent = mapping[self._parent[node]]
+            if kept(node):
+                mapped = mapping[node] = tree._child(parent,
+                                                     self._frame[node])
+                tree._total[mapped] = self._total[node]
+            else:
+                mapped = mapping[node] = parent
+            tree._self[mapped] += self._self[node]
+        return tree
+
+    def truncated(self, max_depth):
+        """
+        :param max_depth:
+            The greatest depth to keep.
+        :return:
+            A new tree of the frames up to the given depth; the weight of the
+            deeper frames is counted as self weight of their ancestor at that
+            depth.
+
+        """
+        depths = self._depth
+        return self._folded_copy(lambda node: depths[node] <= max_depth)
+
+    def pruned(self, max_nodes):
+        """
+        :param max_nodes:
+            The greatest number of nodes to keep, not counting the root.
+        :return:
+            A new tree of the heaviest nodes; the weight of the others is
+            counted as self weight of their nearest ancestor kept.
+
+        """
+        if len(self) - 1 <= max_nodes:
+            return self._folded_copy(lambda node: True)
+        # A node is no heavier than its parent, which comes first on ties, so
+        # the heaviest nodes include their ancestors
+        total = self._total
+        heaviest = set(heapq.nlargest(
+            max_nodes, range(1, len(self)),
+            key=lambda node: (total[node], -node)))
+        return self._folded_copy(heaviest.__contains__)
+
+    def _layout_children(self):
+        """ Lay out the children of each node contiguously, by name. """
+        # Siblings are sorted by the rank of their names
+        rank = array.array('l', [0]) * len(self.names)
+        for position, frame in enumerate(sorted(range(len(self.names)),
+                                                key=self.names.__getitem__)):
+            rank[frame] = position
+        frames = self._frame
+        counts = array.array('l', [0]) * (len(self) + 1)
+        for parent in self._parent[1:]:
+            counts[parent + 1] += 1
+        for node in range(len(self)):
+            counts[node + 1] += counts[node]
+        start = array.array('l', counts)
+
+        nodes = array.array('l', [0]) * (len(self) - 1)
+        for node in range(1, len(self)):
+            parent = self._parent[node]
+            nodes[counts[parent]] = node
+            counts[parent] += 1
+        for node in range(len(self)):
+            if start[node + 1] - start[node] > 1:
+                nodes[start[node]:start[node + 1]] = array.array('l', sorted(
+                    nodes[start[node]:start[node + 1]],
+                    key=lambda child: rank[frames[child]]))
+        self._child_start = start
+        self._child_nodes = nodes
+
+    def children(self, node):
+        """ :return: The children of a node, ordered by name. """
+        if self._child_start is None:
+            self._layout_children()
+        return self._child_nodes[self._child_start[node]:
+                                 self._child_start[node + 1]]
+
+    def name(self, node):
+        """ :return: The frame name of a node, or None for the root. """
+        frame = self._frame[node]
+        return self.names[frame] if frame >= 0 else None
+
+    def parent(self, node):
+        """ :return: The parent of a node, or -1 for the root. """
+        return self._parent[node]
+
+    def depth(self, node):
+        """ :return: The depth of a node, 0 for the root. """
+        return self._depth[node]
+
+    def total(self, node=ROOT):
+        """ :return: The weight of the stacks through a node. """
+        return self._total[node]
+
+    def self_weight(self, node):
+        """ :return: The weight of the stacks ending at a node. """
+        return self._self[node]
+
+    def stack(self, node):
+        """ :return: The frame names from the root to a node, as a tuple. """
+        names = []
+        while node > 0:
+            names.append(self.names[self._frame[node]])
+            node = self._parent[node]
+        return tuple(reversed(names))
+
+    def folded(self):
+        """
+        Generate the distinct stacks of the tree, depth first and by name.
+
+        :return:
+            A generator of (stack, self weight) tuples, for each node with
+            self weight.
+
+        """
+        path = []
+        pending = [(self.ROOT, 0)]
+        while pending:
+            node, depth = pending.pop()
+            if node != self.ROOT:
+                del path[depth - 1:]
+                path.append(self.names[self._frame[node]])
+            if self._self[node]:
+                yield tuple(path), self._self[node]
+            pending.extend((child, depth + 1)
+                           for child in reversed(self.children(node)))
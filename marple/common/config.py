@@ -8,6 +8,7 @@ Interacts with the MARPLE config file.
 
 The config file is located in ~/.marpleconfig.
 If no config file exists, the default one will be copied to the config location.
+Options the config file lacks are read from the default one.
 The default config file can be found in the marple package (with __main__.py)
 
 """
@@ -35,7 +36,9 @@ if not os.path.exists(CONFIG_FILE):
     copyfile(DEFAULTS_FILE, CONFIG_FILE)
 
 config = configparser.ConfigParser()
-config.read(CONFIG_FILE)
+# Options missing from the user's file, e.g. ones added since it was copied,
+# take their default values
+config.read([DEFAULTS_FILE, CONFIG_FILE])
 
 
 def get_option_from_section(sec, opt, typ="string"):
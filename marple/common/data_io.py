@@ -148,24 +148,31 @@ class PointDatum(typing.NamedTuple):
         The dependent variable value.
     .. attribute:: info:
         Additional info for the datapoint.
+    .. attribute:: weight:
+        The number of occurrences the datapoint stands for, e.g. the count of
+        a histogram bucket. Defaults to 1.
 
     """
     x: float
     y: float
     info: str
+    weight: float = 1
 
     def __str__(self):
         """
         Converts a datapoint to standard comma-separated value string format.
 
         The string does not have a line break at the end.
-            Format: <x>,<y>,<info>
+            Format: <x>,<y>,<info>[,<weight>]
             Note that the info field cannot contain commas. Use semicolons as
             separators if necessary.
+            The weight is only written if it is not 1.
 
         """
-        return consts.field_separator.join((str(self.x), str(self.y),
-                                            self.info))
+        fields = (str(self.x), str(self.y), self.info)
+        if self.weight != 1:
+            fields += (str(self.weight),)
+        return consts.field_separator.join(fields)
 
     @staticmethod
     def from_string(string):
@@ -184,7 +191,12 @@ class PointDatum(typing.NamedTuple):
 
         """
         try:
-            x, y, info = string.strip().split(consts.field_separator)
+            fields = string.strip().split(consts.field_separator)
+            if len(fields) == 4:
+                x, y, info, weight = fields
+                return PointDatum(x=float(x), y=float(y), info=info,
+                                  weight=float(weight))
+            x, y, info = fields
             return PointDatum(x=float(x), y=float(y), info=info)
         except IndexError as ie:
             raise exceptions.DatatypeException(
@@ -289,6 +301,29 @@ class Data:
         self.interface = interface
         self.datatype = None  # Will be set by subclasses
         self.data_options = data_options
+        # Notes on how the data was collected, included in the header if any
+        self.annotations = {}
+
+    def record_loss(self, lost, recorded):
+        """
+        Record in the header how many samples or events the collection tool
+        dropped, e.g. because its buffers overflowed.
+
+        :param lost:
+            The number of samples or events dropped.
+        :param recorded:
+            The number of samples or events recorded.
+
+        """
+        total = lost + recorded
+        self.annotations["loss"] = {
+            "lost": lost,
+            "recorded": recorded,
+            "ratio": lost / total if total else 0.0,
+        }
+        if lost:
+            logger.warning("Interface %s lost %d of %d samples or events",
+                           self.interface.value, lost, total)
 
     def header_dict(self):
         """
@@ -308,6 +343,8 @@ class Data:
             "datatype": self.datatype,
             "data options": self.data_options._asdict(),
         }
+        if self.annotations:
+            header_dict["annotations"] = self.annotations
         return header_dict
 
     def to_string(self):
@@ -355,9 +392,14 @@ class StackData(Data):
         """
         .. attribute:: weight_units:
             the units for the weight (calls, bytes etc)
+        .. attribute:: snapshots:
+            whether the stacks are snapshots of a state, based at the time
+            of their snapshot, e.g. the memory outstanding; each snapshot
+            includes what the earlier ones held, so they cannot be added up
 
         """
         weight_units: str
+        snapshots: bool = False
 
     DEFAULT_OPTIONS = DataOptions(weight_units="samples")
 
@@ -367,6 +409,23 @@ class StackData(Data):
         super().__init__(datum_generator, start, end, interface, data_options)
         self.datatype = consts.Datatypes.STACK.value
 
+    def summable_datums(self):
+        """
+        :return:
+            An iterable of the datum objects whose weights can be added up:
+            all of them, or for snapshots only those of the last snapshot.
+
+        """
+        if self.data_options is None or not self.data_options.snapshots:
+            return self.datum_generator
+        last, base = [], None
+        for datum in self.datum_generator:
+            # The snapshots follow one another, each with its own base
+            if datum.stack[:1] != base:
+                last, base = [], datum.stack[:1]
+            last.append(datum)
+        return last
+
 
 class EventData(Data):
     """ Encapsulate event data - i.e. events in time. """
@@ -396,12 +455,17 @@ class PointData(Data):
             labels for the x and y axes respectively
         .. attribute:: x_units, y_units:
             units for the x and y axes respectively
+        .. attribute:: x_bucket:
+            0 if each datum is one event at x, otherwise the width of the x
+            buckets the events were counted in: each datum is then the
+            number of events (its freq) in the bucket starting at x
 
         """
         x_label: str
         y_label: str
         x_units: str
         y_units: str
+        x_bucket: float = 0
 
     DEFAULT_OPTIONS = DataOptions("x label", "y label", "x units", "y units")
 
@@ -437,6 +501,8 @@ class Writer:
         self.filename = filename
         self.metaheader = dict()
         self.file = None
+        # Index of the next section in the metaheader
+        self._index = 0
 
     def __enter__(self):
         """ Context manager for writer. """
@@ -511,6 +577,21 @@ class Writer:
             header["end byte"] = end_byte
             self.metaheader[index] = header
 
+    @util.log(logger)
+    def write_section(self, data):
+        """
+        Write a single data object to the data file, after any already written.
+
+        Allows sections to be written as soon as they are available, so that
+        their data need not be kept in memory until the others are ready.
+
+        :param data:
+            A StackData, EventData, or PointData object.
+
+        """
+        self._write_section(self._index, data)
+        self._index += 1
+
     @util.log(logger)
     def write(self, data_objs):
         """
@@ -522,8 +603,8 @@ class Writer:
             An iterator of `Data` objects.
 
         """
-        for index, data in enumerate(data_objs):
-            self._write_section(index, data)
+        for data in data_objs:
+            self.write_section(data)
 
 
 class Reader:
@@ -0,0 +1,82 @@
+# -------------------------------------------------------------
+# downsample.py - reduces series to what a display can show
+# October 2018
+# -------------------------------------------------------------
+
+"""
+Downsampling of long series for plotting.
+
+A series with more points than the pixels it is drawn across is reduced by
+splitting its x range into buckets, one per pixel, and keeping the points at
+which the series is lowest and highest in each bucket, so that its visual
+extremes survive.
+The points kept are whole points of the series, so series stacked on each
+other can be reduced together by keeping the extremes of their total.
+
+"""
+
+__all__ = (
+    'min_max',
+)
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.debug('Entered module: %s', __name__)
+
+
+def _first_in_segments(matches, segments):
+    """
+    :param matches:
+        The ascending indices of the points that match.
+    :param segments:
+        The non-decreasing segment of each point.
+    :return:
+        The first index in each segment with a match.
+
+    """
+    matched_segments = segments[matches]
+    first = np.ones(len(matches), dtype=bool)
+    first[1:] = matched_segments[1:] != matched_segments[:-1]
+    return matches[first]
+
+
+def min_max(x_values, y_values, buckets):
+    """
+    Select the points of a series to draw.
+
+    :param x_values:
+        The x values of the series, in ascending order.
+    :param y_values:
+        The y values of the series, of the same length.
+    :param buckets:
+        The number of buckets, e.g. the pixel width of the plot.
+    :return:
+        The indices of the points to keep, in ascending order: the first and
+        last points, and the first lowest and first highest point in each
+        bucket; all the indices if there are no more than two per bucket.
+
+    """
+    x_values = np.asarray(x_values)
+    y_values = np.asarray(y_values)
+    if len(x_values) <= 2 * buckets or x_values[-1] == x_values[0]:
+        return np.arange(len(x_values))
+
+    # The bucket of each point, each bucket spanning an equal range of x
+    edges = np.linspace(x_values[0], x_values[-1], buckets + 1)
+    bucket = np.minimum(np.searchsorted(edges, x_values, side="right") - 1,
+                        buckets - 1)
+    # As x is in ascending order, each bucket is a run of points
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    segments = np.repeat(np.arange(len(starts)),
+                         np.diff(np.r_[starts, len(x_values)]))
+
+    lowest = np.minimum.reduceat(y_values, starts)[segments]
+    highest = np.maximum.reduceat(y_values, starts)[segments]
+    keep = np.concatenate((
+        [0, len(x_values) - 1],
+        _first_in_segments(np.flatnonzero(y_values == lowest), segments),
+        _first_in_segments(np.flatnonzero(y_values == highest), segments)))
+    return np.unique(keep)
@@ -0,0 +1,112 @@
+# -------------------------------------------------------------
+# test_calltree.py - test module for the call tree
+# October 2018
+# -------------------------------------------------------------
+
+""" Tests the call tree of stack data. """
+
+import unittest
+from unittest import mock
+
+from marple.common import calltree, data_io
+
+
+def _tree(*stacks):
+    """ :return: A tree of (weight, stack) pairs. """
+    return calltree.CallTree().add_all(
+        data_io.StackDatum(weight, stack) for weight, stack in stacks)
+
+
+class AddTest(unittest.TestCase):
+    """ Test adding stacks to the tree. """
+
+    def test_add_all(self):
+        tree = _tree((1, ('main', 'b', 'c')),
+                     (2, ('main', 'a')),
+                     (3, ('main', 'b', 'c')))
+
+        self.assertEqual(5, len(tree))
+        self.assertEqual(6, tree.total())
+        self.assertEqual(["main", "b", "c", "a"], tree.names)
+
+        main, = tree.children(tree.ROOT)
+        self.assertEqual(["a", "b"],
+                         [tree.name(node) for node in tree.children(main)])
+        self.assertEqual(6, tree.total(main))
+        self.assertEqual(0, tree.self_weight(main))
+        c = tree.children(tree.children(main)[1])[0]
+        self.assertEqual(('main', 'b', 'c'), tree.stack(c))
+        self.assertEqual(4, tree.self_weight(c))
+        self.assertEqual(3, tree.depth(c))
+
+    def test_batches(self):
+        """ Test that stacks are counted across batches. """
+        with mock.patch("marple.common.calltree.ADD_BATCH_SIZE", 2):
+            tree = _tree(*[(1, ('main', 'a'))] * 5)
+
+        self.assertEqual(3, len(tree))
+        self.assertEqual(5, tree.self_weight(2))
+
+    def test_add(self):
+        tree = calltree.CallTree()
+        tree.add(('main', 'a'), 2)
+        self.assertEqual(["a"], [tree.name(node) for node in
+                                 tree.children(1)])
+        # The children are laid out again once the tree has grown
+        tree.add(('main', 'b'))
+
+        self.assertEqual(["a", "b"],
+                         [tree.name(node) for node in tree.children(1)])
+        self.assertEqual(3, tree.total(1))
+
+    def test_merge(self):
+        tree = _tree((1, ('main', 'a')), (2, ('main',)))
+        other = _tree((4, ('main', 'b')), (8, ('main', 'a')))
+
+        tree.merge(other)
+
+        self.assertEqual(15, tree.total())
+        self.assertEqual([(('main',), 2), (('main', 'a'), 9),
+                          (('main', 'b'), 4)], list(tree.folded()))
+        self.assertEqual(12, other.total())
+
+
+class ReduceTest(unittest.TestCase):
+    """ Test truncating and pruning the tree. """
+
+    tree = _tree((1, ('main', 'a', 'b', 'c')),
+                 (2, ('main', 'a', 'd')),
+                 (10, ('main', 'e')))
+
+    def test_truncated(self):
+        truncated = self.tree.truncated(2)
+
+        self.assertEqual(4, len(truncated))
+        self.assertEqual([(('main', 'a'), 3), (('main', 'e'), 10)],
+                         list(truncated.folded()))
+        self.assertEqual(13, truncated.total())
+
+    def test_pruned(self):
+        pruned = self.tree.pruned(3)
+
+        self.assertEqual(4, len(pruned))
+        self.assertEqual([(('main', 'a'), 3), (('main', 'e'), 10)],
+                         list(pruned.folded()))
+
+    def test_pruned_all(self):
+        self.assertEqual(list(self.tree.folded()),
+                         list(self.tree.pruned(100).folded()))
+
+    def test_folded(self):
+        self.assertEqual([(('main', 'a', 'b', 'c'), 1),
+                          (('main', 'a', 'd'), 2),
+                          (('main', 'e'), 10)],
+                         list(self.tree.folded()))
+
+    def test_empty(self):
+        tree = calltree.CallTree()
+
+        self.assertEqual(1, len(tree))
+        self.assertEqual(0, tree.total())
+        self.assertEqual([], list(tree.folded()))
+        self.assertEqual(0, len(tree.children(tree.ROOT)))
@@ -92,6 +92,13 @@ class PointDatumTest(_DatatypeBaseTest):
         self.assertEqual(expected, actual, msg='Expected {}, got {}'
                          .format(expected, actual))
 
+    def test_weighted(self):
+        """Test weighted datapoints are converted to and from strings."""
+        dp = data_io.PointDatum(0.0, 0.0, 'info', 12.0)
+        expected = self.standard_field + consts.field_separator + "12.0"
+        self.assertEqual(expected, str(dp))
+        self.check_from_str(expected, dp)
+
 
 class StackDatumTest(_DatatypeBaseTest):
     """Test stack data are correctly converted to/from strings."""
@@ -152,6 +159,25 @@ class StackDatumTest(_DatatypeBaseTest):
                          .format(expected, actual))
 
 
+class StackDataTest(unittest.TestCase):
+    """ Test adding up stack data. """
+
+    datums = [data_io.StackDatum(1, ('5s', 'a')),
+              data_io.StackDatum(2, ('5s', 'b')),
+              data_io.StackDatum(3, ('10s', 'a'))]
+
+    def test_summable(self):
+        data = data_io.StackData(iter(self.datums), None, None, None)
+        self.assertEqual(self.datums, list(data.summable_datums()))
+
+    def test_snapshots(self):
+        """ Test that only the last of the snapshots is added up. """
+        options = data_io.StackData.DataOptions("bytes", snapshots=True)
+        data = data_io.StackData(iter(self.datums), None, None, None,
+                                 options)
+        self.assertEqual(self.datums[2:], list(data.summable_datums()))
+
+
 class EventDatumTest(_DatatypeBaseTest):
     """Test sched event data are correctly converted to/from strings."""
 
@@ -437,3 +463,63 @@ class CPELTest(SchedTest):
 
         # Despite the same timing, there were two events so number should be two
         self.assertEqual(self._get_nr_of_entries(filename, 5), 2)
+
+    def test_event_entries(self):
+        """Check the packed event entries split the time and refer to ids."""
+        filename = self._TEST_DIR + "create_scheddata_test_entries.cpel"
+        event = EventDatum(time=(5 << 32) + 7, type='e', connected=None,
+                           specific_datum={'pid': 'p', 'comm': 'c', 'cpu': 'u'})
+        writer = cpel_writer.CpelWriter([event, event._replace(type='f')],
+                                        track='cpu')
+        writer.write(filename)
+
+        label_offset = writer.string_table['c(p)']
+        self.assertEqual([(5, 7, 0, 0, label_offset),
+                          (5, 7, 0, 1, label_offset)],
+                         writer.event_data.tolist())
+        with open(filename, "rb") as file_:
+            self.assertEqual(
+                struct.pack(">LLLLL", 5, 7, 0, 1, label_offset),
+                file_.read()[-20:])
+
+    def test_events_sorted(self):
+        """Check events are written in time order, ties in input order."""
+        events = [EventDatum(time=time, type=type_, connected=None,
+                             specific_datum={'pid': 'p', 'comm': 'c',
+                                             'cpu': 'u'})
+                  for time, type_ in ((3, 'a'), (1, 'b'), (3, 'c'), (2, 'd'))]
+        writer = cpel_writer.CpelWriter(events, track='pid')
+
+        self.assertEqual([(0, 1, 0, 1), (0, 2, 0, 3), (0, 3, 0, 0),
+                          (0, 3, 0, 2)],
+                         [entry[:4] for entry in writer.event_data.tolist()])
+
+    def test_spilled_runs(self):
+        """Check merging runs from disk gives the same file as in memory."""
+        events = [EventDatum(time=(time * 7919) % 50, type='e',
+                             connected=None,
+                             specific_datum={'pid': str(time % 3), 'comm': 'c',
+                                             'cpu': 'u'})
+                  for time in range(100)]
+        with mock.patch("marple.display.tools.g2.cpel_writer.datetime") as dt:
+            dt.now.return_value.timestamp.return_value = 0
+            files = []
+            for run_size, buffer_size in ((1000, 1000), (7, 10), (10, 1)):
+                filename = self._TEST_DIR + "runs{}.cpel".format(run_size)
+                with mock.patch("marple.display.tools.g2.cpel_writer."
+                                "RUN_SIZE", run_size), \
+                        mock.patch("marple.display.tools.g2.cpel_writer."
+                                   "MERGE_BUFFER_SIZE", buffer_size):
+                    with cpel_writer.CpelWriter(events, track='cpu') as writer:
+                        runs = [run_file for run_file, _ in writer._runs]
+                        writer.write(filename)
+                self.assertEqual(100, writer.no_of_events)
+                # The runs are deleted once the writer is closed
+                self.assertTrue(all(run_file.closed for run_file in runs))
+                self.assertEqual([], writer._runs)
+                with open(filename, "rb") as file_:
+                    files.append(file_.read())
+
+        self.assertEqual(0, len(writer.event_data))
+        self.assertEqual(files[0], files[1])
+        self.assertEqual(files[0], files[2])
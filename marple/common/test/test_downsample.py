@@ -0,0 +1,45 @@
+# -------------------------------------------------------------
+# test_downsample.py - test module for downsampling series
+# October 2018
+# -------------------------------------------------------------
+
+""" Tests the downsampling of series for plotting. """
+
+import unittest
+
+import numpy as np
+
+from marple.common import downsample
+
+
+class MinMaxTest(unittest.TestCase):
+    """ Test keeping the extremes of each bucket. """
+
+    def test_short(self):
+        """ Test that series with few points are kept whole. """
+        self.assertEqual([0, 1, 2, 3],
+                         downsample.min_max([0, 1, 2, 3], [1, 2, 1, 2],
+                                            2).tolist())
+
+    def test_extremes(self):
+        x_values = np.arange(12)
+        y_values = [5, 1, 9, 5, 5, 5,
+                    5, 5, 7, 0, 0, 5]
+
+        keep = downsample.min_max(x_values, y_values, 2)
+
+        # The first and last points, and the first lowest and highest in each
+        # half
+        self.assertEqual([0, 1, 2, 8, 9, 11], keep.tolist())
+
+    def test_flat(self):
+        """ Test that a constant series keeps one point per bucket. """
+        keep = downsample.min_max(np.arange(100), np.ones(100), 10)
+
+        self.assertEqual(11, len(keep))
+        self.assertEqual(99, keep[-1])
+
+    def test_same_x(self):
+        keep = downsample.min_max(np.zeros(10), np.arange(10), 2)
+
+        self.assertEqual(list(range(10)), keep.tolist())
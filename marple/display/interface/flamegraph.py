@@ -1,12 +1,19 @@
 # -------------------------------------------------------------
-# flamegraph.py - interacts with the flame graph tool
+# flamegraph.py - renders stack data as a flame graph
 # June-July 2018 - Franz Nowak, Hrutvik Kanabar
 # -------------------------------------------------------------
 """
-Class that interacts with the flamegraph tool.
+Renders stack data as an interactive flame graph.
 
 Implements the GenericDiaplay interface to display an interactive flamegraph
 in the browser.
+The stacks are merged into a call tree once (see
+:class:`marple.common.calltree.CallTree`), and the frames are laid out in
+a single traversal of it, skipping the subtrees of frames narrower than the
+minimum width, so rendering takes time in proportion to the frames shown
+rather than the samples collected.
+The SVG, with its script for zooming and searching, follows the format of
+Brendan Gregg's flamegraph.pl, including its colour palettes.
 
 """
 
@@ -14,25 +21,318 @@ __all__ = (
     "Flamegraph",
 )
 
-import collections
+import functools
+import html
 import logging
 import os
+import re
 import subprocess
 from typing import NamedTuple
 
 from marple.common import (
+    calltree,
     config,
     consts,
     file,
-    util,
-    paths
+    util
 )
 from marple.display.interface.generic_display import GenericDisplay
 
 logger = logging.getLogger(__name__)
 logger.debug('Entered module: %s', __name__)
 
-FLAMEGRAPH_DIR = paths.MARPLE_DIR + "/display/tools/flamegraph/flamegraph.pl"
+# Layout of the image, in pixels, as in flamegraph.pl
+IMAGE_WIDTH = 1200
+FRAME_HEIGHT = 16
+FONT_SIZE = 12
+# Average width of a character, relative to the font size
+FONT_WIDTH = 0.59
+X_PAD = 10
+# Space for the title above the frames, and the details line below
+Y_PAD_TOP = FONT_SIZE * 3
+Y_PAD_BOTTOM = FONT_SIZE * 2 + 10
+
+# Size of the buffer the SVG is written through, in bytes
+WRITE_BUFFER_SIZE = 1 << 20
+
+_SVG_HEADER = """\
+<?xml version="1.0" standalone="no"?>
+<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" \
+"http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">
+<svg version="1.1" width="{width}" height="{height}" \
+onload="init(evt)" viewBox="0 0 {width} {height}" \
+xmlns="http://www.w3.org/2000/svg">
+<defs>
+<linearGradient id="background" y1="0" y2="1" x1="0" x2="0">
+<stop stop-color="#eeeeee" offset="5%" />
+<stop stop-color="#eeeeb0" offset="95%" />
+</linearGradient>
+</defs>
+<style type="text/css">
+text {{ font-family: Verdana; font-size: {font_size}px; fill: rgb(0,0,0); }}
+.func_g:hover {{ stroke: black; stroke-width: 0.5; cursor: pointer; }}
+</style>
+<script type="text/ecmascript">
+<![CDATA[{script}]]>
+</script>
+<rect x="0" y="0" width="{width}" height="{height}" \
+fill="url(#background)" />
+<text text-anchor="middle" x="{middle}" y="{title_y}" \
+style="font-size: {title_size}px">Flame Graph</text>
+<text id="details" x="{x_pad}" y="{details_y}"> </text>
+<text id="unzoom" x="{x_pad}" y="{title_y}" onclick="unzoom()" \
+style="opacity: 0.0; cursor: pointer">Reset Zoom</text>
+<text id="search" x="{search_x}" y="{title_y}" onclick="search_prompt()" \
+style="opacity: 0.1; cursor: pointer">Search</text>
+<text id="matched" x="{search_x}" y="{details_y}"> </text>
+"""
+
+_FRAME = """\
+<g class="func_g" onmouseover="s(this)" onmouseout="c()" onclick="zoom(this)">
+<title>{title}</title><rect x="{x:.1f}" y="{y:.1f}" width="{width:.1f}" \
+height="{height:.1f}" fill="{fill}" rx="2" ry="2" />
+<text x="{text_x:.1f}" y="{text_y:.1f}">{text}</text>
+</g>
+"""
+
+# Zooming into a frame stretches it and its descendants to the full width
+# and greys out its ancestors; searching highlights the frames matching a
+# regular expression and shows the proportion of samples they cover
+_SCRIPT = """
+var details, searchbtn, unzoombtn, matchedtxt, svg, searching = 0;
+var xpad = %(x_pad)d, fontsize = %(font_size)d, fontwidth = %(font_width)s;
+function init(evt) {
+    details = document.getElementById("details").firstChild;
+    searchbtn = document.getElementById("search");
+    unzoombtn = document.getElementById("unzoom");
+    matchedtxt = document.getElementById("matched");
+    svg = document.getElementsByTagName("svg")[0];
+}
+function frames() { return document.getElementsByClassName("func_g"); }
+function child(e, name) { return e.getElementsByTagName(name)[0]; }
+function frame_name(e) {
+    return child(e, "title").textContent.replace(/ \\([^(]*\\)$/, "");
+}
+function s(e) { details.nodeValue = "Function: " + child(e, "title").textContent; }
+function c() { details.nodeValue = " "; }
+function orig(e, attr) {
+    if (!e.hasAttribute("data-" + attr))
+        e.setAttribute("data-" + attr, e.getAttribute(attr));
+    return parseFloat(e.getAttribute("data-" + attr));
+}
+function restore(e, attr) {
+    if (e.hasAttribute("data-" + attr))
+        e.setAttribute(attr, e.getAttribute("data-" + attr));
+}
+function update_text(e) {
+    var r = child(e, "rect"), t = child(e, "text");
+    var w = parseFloat(r.getAttribute("width")) - 3;
+    var name = frame_name(e);
+    t.setAttribute("x", parseFloat(r.getAttribute("x")) + 3);
+    if (w < 2 * fontsize * fontwidth) { t.textContent = ""; return; }
+    var chars = Math.floor(w / (fontsize * fontwidth));
+    t.textContent = name.length <= chars ? name :
+        name.substring(0, chars - 2) + "..";
+}
+function zoom(node) {
+    var rect = child(node, "rect");
+    var x = orig(rect, "x"), width = orig(rect, "width");
+    var y = parseFloat(rect.getAttribute("y"));
+    var ratio = (svg.width.baseVal.value - 2 * xpad) / width;
+    unzoombtn.style.opacity = "1.0";
+    var all = frames();
+    for (var i = 0; i < all.length; i++) {
+        var e = all[i], r = child(e, "rect");
+        var ex = orig(r, "x"), ew = orig(r, "width");
+        var ey = parseFloat(r.getAttribute("y"));
+        e.style.display = "block";
+        e.style.opacity = "1.0";
+        if (ey > y && ex <= x + 0.0001 && ex + ew >= x + width - 0.0001) {
+            // an ancestor: stretch it across, faded
+            e.style.opacity = "0.5";
+            r.setAttribute("x", xpad);
+            r.setAttribute("width", svg.width.baseVal.value - 2 * xpad);
+        } else if (ey <= y && ex >= x - 0.0001 &&
+                   ex + ew <= x + width + 0.0001) {
+            r.setAttribute("x", (ex - x) * ratio + xpad);
+            r.setAttribute("width", ew * ratio);
+        } else {
+            e.style.display = "none";
+        }
+        update_text(e);
+    }
+}
+function unzoom() {
+    unzoombtn.style.opacity = "0.0";
+    var all = frames();
+    for (var i = 0; i < all.length; i++) {
+        var e = all[i], r = child(e, "rect");
+        e.style.display = "block";
+        e.style.opacity = "1.0";
+        restore(r, "x");
+        restore(r, "width");
+        update_text(e);
+    }
+}
+function reset_search() {
+    var all = frames();
+    for (var i = 0; i < all.length; i++) restore(child(all[i], "rect"), "fill");
+}
+function search_prompt() {
+    if (searching) {
+        reset_search();
+        searching = 0;
+        searchbtn.style.opacity = "0.1";
+        searchbtn.firstChild.nodeValue = "Search";
+        matchedtxt.style.opacity = "0.0";
+        matchedtxt.firstChild.nodeValue = "";
+        return;
+    }
+    var term = prompt("Enter a search term (regexp allowed, eg: ^ext4_)", "");
+    if (term != null) search(term);
+}
+function search(term) {
+    var re = new RegExp(term), all = frames(), matches = {}, maxwidth = 0;
+    reset_search();
+    for (var i = 0; i < all.length; i++) {
+        var r = child(all[i], "rect");
+        var x = orig(r, "x"), w = orig(r, "width");
+        // the root frame spans the whole graph
+        if (w > maxwidth) maxwidth = w;
+        if (!re.test(frame_name(all[i]))) continue;
+        orig(r, "fill");
+        r.setAttribute("fill", "rgb(230,0,230)");
+        // keep the widest match at each position, to count it once
+        if (!(x in matches) || w > matches[x]) matches[x] = w;
+    }
+    searching = 1;
+    searchbtn.style.opacity = "1.0";
+    searchbtn.firstChild.nodeValue = "Reset Search";
+    // add up the matches, skipping those nested in the previous one
+    var xs = Object.keys(matches).map(parseFloat).sort(function (a, b) {
+        return a - b;
+    });
+    var count = 0, end = 0;
+    for (var j = 0; j < xs.length; j++) {
+        if (xs[j] + 0.0001 < end) continue;
+        count += matches[xs[j]];
+        end = xs[j] + matches[xs[j]];
+    }
+    matchedtxt.style.opacity = "1.0";
+    matchedtxt.firstChild.nodeValue = "Matched: " +
+        (maxwidth ? (100 * count / maxwidth).toFixed(1) : "0.0") + "%%";
+}
+""" % {"x_pad": X_PAD, "font_size": FONT_SIZE, "font_width": FONT_WIDTH}
+
+
+def _namehash(name):
+    """
+    Hash a function name to a number in [0, 1], weighting early characters
+    over later ones, as flamegraph.pl does, so that a function gets the same
+    colour in every flame graph.
+
+    """
+    # If a module name is present, only its first character is kept
+    name = re.sub(r".(.*?)`", "", name, count=1)
+    vector, weight, maximum, mod = 0.0, 1.0, 1.0, 10
+    for char in name:
+        vector += (ord(char) % mod) / (mod - 1) * weight
+        mod += 1
+        maximum += weight
+        weight *= 0.70
+        if mod > 12:
+            break
+    return 1 - vector / maximum
+
+
+def _palette_for(coloring, name):
+    """
+    :return:
+        The colour palette for a function, resolving the palettes of
+        flamegraph.pl that choose one by the kind of function.
+
+    """
+    if coloring == "java":
+        if name.endswith("_[j]"):
+            return "green"
+        if name.endswith("_[i]"):
+            return "aqua"
+        if re.match(r"L?(java|org|com|io|sun)/", name):
+            return "green"
+        if name.endswith("_[k]"):
+            return "orange"
+        return "yellow" if "::" in name else "red"
+    if coloring == "perl":
+        if "::" in name:
+            return "yellow"
+        if "Perl" in name or ".pl" in name:
+            return "green"
+        return "orange" if name.endswith("_[k]") else "red"
+    if coloring == "js":
+        if name.endswith("_[j]"):
+            return "green" if "/" in name else "aqua"
+        if "::" in name:
+            return "yellow"
+        if re.search(r"/.*\.js", name):
+            return "green"
+        if ":" in name:
+            return "aqua"
+        if name == " ":
+            return "green"
+        return "orange" if "_[k]" in name else "red"
+    if coloring == "wakeup":
+        return "aqua"
+    if coloring == "chain":
+        return "aqua" if "_[w]" in name else "blue"
+    return coloring
+
+
+@functools.lru_cache(maxsize=None)
+def _color(coloring, name):
+    """
+    Choose the colour of a frame.
+
+    :param coloring:
+        The palette, as for the --color option of flamegraph.pl.
+    :param name:
+        The name of the function.
+    :return:
+        The colour, as an SVG rgb() value.
+
+    """
+    v1 = _namehash(name)
+    v2 = v3 = _namehash(name[::-1])
+    palette = _palette_for(coloring, name)
+
+    if palette == "hot":
+        rgb = 205 + int(50 * v3), int(230 * v1), int(55 * v2)
+    elif palette == "mem":
+        rgb = 0, 190 + int(50 * v2), int(210 * v1)
+    elif palette == "io":
+        shade = 80 + int(60 * v1)
+        rgb = shade, shade, 190 + int(55 * v2)
+    elif palette == "red":
+        shade = 50 + int(80 * v1)
+        rgb = 200 + int(55 * v1), shade, shade
+    elif palette == "green":
+        shade = 50 + int(60 * v1)
+        rgb = shade, 200 + int(55 * v1), shade
+    elif palette == "blue":
+        shade = 80 + int(60 * v1)
+        rgb = shade, shade, 205 + int(50 * v1)
+    elif palette == "yellow":
+        shade = 175 + int(55 * v1)
+        rgb = shade, shade, 50 + int(20 * v1)
+    elif palette == "purple":
+        shade = 190 + int(65 * v1)
+        rgb = shade, 80 + int(60 * v1), shade
+    elif palette == "aqua":
+        rgb = 50 + int(60 * v1), 165 + int(55 * v1), 165 + int(55 * v1)
+    elif palette == "orange":
+        rgb = 190 + int(65 * v1), 90 + int(65 * v1), 0
+    else:
+        rgb = 0, 0, 0
+    return "rgb({},{},{})".format(*rgb)
 
 
 class Flamegraph(GenericDisplay):
@@ -44,8 +344,11 @@ class Flamegraph(GenericDisplay):
         """
         - coloring: can be hot (default), mem, io, wakeup, chain, java, js,
                     perl, red, green, blue, aqua, yellow, purple, orange
+        - min_width: frames narrower than this many pixels are left out,
+                     with all the frames above them
         """
         coloring: str
+        min_width: float = 0.1
 
     def __init__(self, data):
         """
@@ -61,42 +364,126 @@ class Flamegraph(GenericDisplay):
 
         coloring = config.get_option_from_section(
             consts.DisplayOptions.FLAMEGRAPH.value, "coloring")
-        self.display_options = self.DisplayOptions(coloring)
+        min_width = config.get_option_from_section(
+            consts.DisplayOptions.FLAMEGRAPH.value, "min_width", "float")
+        self.display_options = self.DisplayOptions(coloring, min_width)
         self.svg_temp_file = str(file.TempFileName())
 
+    def _build_tree(self):
+        """
+        Merge the stacks into a call tree.
+
+        :return:
+            The :class:`calltree.CallTree` of the stacks.
+
+        """
+        return calltree.CallTree().add_all(self.data.summable_datums())
+
+    def _layout(self, tree):
+        """
+        Lay out the frames wide enough to show, in one traversal of the tree.
+
+        Siblings are ordered by name, as in flamegraph.pl; the subtrees of
+        frames narrower than the minimum width are not visited.
+
+        :param tree:
+            The call tree.
+        :return:
+            A list of (name, value, depth, offset) tuples, for each frame
+            shown, the offset being the total value of the frames to its left;
+            and the greatest depth.
+
+        """
+        if tree.total() == 0:
+            return [], 0
+        # The smallest value of a frame that is shown
+        min_value = tree.total() * self.display_options.min_width / \
+            (IMAGE_WIDTH - 2 * X_PAD)
+
+        frames = []
+        max_depth = 0
+        stack = [(tree.ROOT, 0)]
+        while stack:
+            node, offset = stack.pop()
+            value, depth = tree.total(node), tree.depth(node)
+            frames.append((tree.name(node) or "all", value, depth, offset))
+            max_depth = max(max_depth, depth)
+            shown = [child for child in tree.children(node)
+                     if tree.total(child) >= min_value]
+            # Pushed right to left, so that they are popped left to right
+            child_offset = offset + sum(tree.total(child) for child in shown)
+            for child in reversed(shown):
+                child_offset -= tree.total(child)
+                stack.append((child, child_offset))
+        return frames, max_depth
+
+    def _write_svg(self, out, frames, max_depth, total):
+        """
+        Write the flame graph as SVG.
+
+        :param out:
+            The (buffered) file to write to.
+        :param frames:
+            The frames shown, as laid out by :meth:`_layout`.
+        :param max_depth:
+            The greatest depth of a frame.
+        :param total:
+            The total weight of the stacks.
+
+        """
+        height = (max_depth + 1) * FRAME_HEIGHT + Y_PAD_TOP + Y_PAD_BOTTOM
+        out.write(_SVG_HEADER.format(
+            width=IMAGE_WIDTH, height=height, font_size=FONT_SIZE,
+            script=_SCRIPT, middle=IMAGE_WIDTH // 2, title_y=FONT_SIZE * 2,
+            title_size=FONT_SIZE + 5, x_pad=X_PAD,
+            details_y=height - Y_PAD_BOTTOM / 2 + 5,
+            search_x=IMAGE_WIDTH - X_PAD - 100))
+
+        scale = (IMAGE_WIDTH - 2 * X_PAD) / total
+        units = self.data_options.weight_units
+        # The root frame is at the bottom
+        bottom = height - Y_PAD_BOTTOM
+        for name, value, depth, offset in frames:
+            x = X_PAD + offset * scale
+            width = value * scale
+            y = bottom - (depth + 1) * FRAME_HEIGHT
+
+            # Truncate the label to the frame, or leave it out if too narrow
+            chars = int((width - 3) / (FONT_SIZE * FONT_WIDTH))
+            if chars < 3:
+                text = ""
+            elif len(name) > chars:
+                text = name[:chars - 2] + ".."
+            else:
+                text = name
+
+            out.write(_FRAME.format(
+                title=html.escape("{} ({} {}, {:.2f}%)".format(
+                    name, value, units, 100 * value / total)),
+                x=x, y=y, width=width, height=FRAME_HEIGHT - 1,
+                fill=_color(self.display_options.coloring, name),
+                text_x=x + 3, text_y=y + FRAME_HEIGHT - 5,
+                text=html.escape(text)))
+        out.write("</svg>\n")
+
     @util.log(logger)
     def _make(self):
         """
-        Uses Brendan Gregg's flamegraph tool to convert data to flamegraph.
+        Render the data to an SVG flame graph.
+
+        :return:
+            The number of frames drawn.
 
         """
-        stacks_temp_file = str(file.TempFileName())
-        counts = collections.Counter()
-
-        stack_data = self.data.datum_generator
-        for stack in stack_data:
-            new_counts = collections.Counter({stack.stack: stack.weight})
-            counts += new_counts
-
-        with open(stacks_temp_file, "w") as out:
-            for stack, count in counts.items():
-                out.write(";".join(stack) + " {}\n".format(count))
-
-        with open(self.svg_temp_file, "w") as out:
-            if self.display_options.coloring:
-                sp = subprocess.Popen(
-                        [FLAMEGRAPH_DIR, "--color=" +
-                         self.display_options.coloring,
-                         "--countname=" + self.data_options.weight_units,
-                         stacks_temp_file], stdout=out)
-            else:
-                sp = subprocess.Popen([FLAMEGRAPH_DIR, stacks_temp_file],
-                                      stdout=out)
-        # Wait for the subprocess to generate the svg file so the show method
-        # doesn't try to open it while it's being written to
-        sp.wait()
+        tree = self._build_tree()
+        frames, max_depth = self._layout(tree)
+        with open(self.svg_temp_file, "w",
+                  buffering=WRITE_BUFFER_SIZE) as out:
+            if not frames:
+                logger.warning("No stacks to draw")
+            self._write_svg(out, frames, max_depth, tree.total() or 1)
 
-        return counts  # for testing
+        return len(frames)  # for testing
 
     @util.log(logger)
     @util.Override(GenericDisplay)
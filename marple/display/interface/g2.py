@@ -79,8 +79,9 @@ class G2(GenericDisplay):
 
         # We create a generator that yields EventDatum from
         event_generator = self.data.datum_generator
-        writer = CpelWriter(event_generator, self.display_options.track)
-        writer.write(str(tmp_cpel))
+        with CpelWriter(event_generator,
+                        self.display_options.track) as writer:
+            writer.write(str(tmp_cpel))
 
         try:
             subprocess.call([g2_path, "--cpel-input", str(tmp_cpel)])
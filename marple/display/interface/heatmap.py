@@ -13,6 +13,23 @@ Two classes are provided for modifying the graph:
 The class :class:`HeatMap` encapsulates the heat map itself,
 and allows construction and displaying of the figure.
 
+The datapoints are read once into NumPy arrays, and binned by computing the
+index of each point's bin directly, so building the histogram takes linear
+time; the number of bins is capped by a budget, so the memory for the
+histogram is bounded whatever the range of the data.
+
+As the view is scrolled or zoomed, the image is redrawn for the visible part
+of the x-axis only, at a constant number of bins across it.
+Wide views are taken from a pyramid of histograms, each level merging pairs
+of x bins of the one below, so they cost about as much as the bins shown;
+views narrower than the bins of the full histogram are binned afresh from
+the datapoints in them, found by bisecting the points sorted by x, so detail
+is not limited by the bin budget.
+
+The hover annotation is blitted: the rest of the figure is cached as a
+background after each full draw, and only the annotation is drawn over it,
+and only when the cursor moves to another bin.
+
 """
 
 __all__ = (
@@ -21,6 +38,7 @@ __all__ = (
     'HeatMap',
 )
 
+import itertools
 import logging
 import math
 from typing import NamedTuple
@@ -78,11 +96,18 @@ class GraphParameters(NamedTuple):
         (i.e. more zoomed in)
     .. attribute:: y_res:
         The resolution on the y-axis - larger means greater resolution.
+        With a log-scale y-axis, the number of bins per factor of ten.
+    .. attribute:: max_bins:
+        The greatest number of histogram bins, bounding its memory.
+    .. attribute:: log_y:
+        Whether the y-axis bins are on a log scale, e.g. for latencies.
 
     """
     figure_size: float
     scale: float
     y_res: float
+    max_bins: int = 4000000
+    log_y: bool = False
 
 
 class HeatMap(GenericDisplay):
@@ -136,7 +161,12 @@ class HeatMap(GenericDisplay):
             consts.DisplayOptions.HEATMAP.value, "scale", typ="float")
         y_res = config.get_option_from_section(
             consts.DisplayOptions.HEATMAP.value, "y_res", typ="float")
-        parameters = GraphParameters(figure_size, scale, y_res)
+        max_bins = config.get_option_from_section(
+            consts.DisplayOptions.HEATMAP.value, "max_bins", typ="int")
+        log_y = config.get_option_from_section(
+            consts.DisplayOptions.HEATMAP.value, "log_y", typ="bool")
+        parameters = GraphParameters(figure_size, scale, y_res, max_bins,
+                                     log_y)
         normalise = config.get_option_from_section(
             consts.DisplayOptions.HEATMAP.value, "normalised", typ="bool")
         colorbar = "No. of occurrences"
@@ -144,24 +174,43 @@ class HeatMap(GenericDisplay):
             self.DisplayOptions(colorbar, parameters, normalise)
 
         self.params = self.display_options.parameters
-        self.x_data, self.y_data = self._get_data(
+        self.x_data, self.y_data, self.weights = self._get_data(
             data.datum_generator, self.display_options.normalise)
 
         # Get values calculated from data
         self.data_stats = self._get_data_stats()
+        self.x_edges, self.y_edges = self._get_bin_edges()
+
+        # The datapoints sorted by x, with their y bins, for re-binning
+        self.sorted_x = None
+        self.sorted_y_index = None
+        self.sorted_weights = None
+        # The counts at each x resolution, and the x bin edges shown
+        self.pyramid = None
+        self.view_x_edges = None
+        # The figure without the annotation, and the bin annotated
+        self.background = None
+        self.annotated_bin = None
 
         # Plot, set viewport, set axes limits
         self.axes, self.figure = self._create_axes()
         self.heatmap, self.image = self._plot_histogram()
+        # Counts up whenever the heatmap shown is replaced
+        self.generation = 0
         self.pos = self._ViewportPosition(self.data_stats.x_delta,
                                           self.data_stats.y_delta)
         self._set_axes_limits()
 
         # Add features - colorbar, sliders, annotations
-        self._add_colorbar()
+        self.colorbar = self._add_colorbar()
         self._create_sliders()
         self._add_annotations()
 
+        # Redraw the visible part of the x-axis whenever it changes
+        self._show_window()
+        self.axes.callbacks.connect("xlim_changed",
+                                    lambda axes: self._show_window())
+
     # The method below are not class/static methods as we would like a
     # HeatMap instance to be created before they are used.
 
@@ -182,7 +231,8 @@ class HeatMap(GenericDisplay):
         .. attribute:: x_bins, x_bin_size:
             The number of bins on the x-axis, and their size.
         .. attribute:: y_bins, y_bin_size:
-            The number of bins on the y-axis, and their size.
+            The number of bins on the y-axis, and their size; with a log-scale
+            y-axis, the size is the ratio of the bounds of each bin.
         .. attribute:: x_delta, y_delta:
             Delta values for x-axis and y-axis respectively.
             These are useful values for calculating
@@ -195,9 +245,9 @@ class HeatMap(GenericDisplay):
         x_max: float
         y_max: float
         y_median: float
-        x_bins: float
+        x_bins: int
         x_bin_size: float
-        y_bins: float
+        y_bins: int
         y_bin_size: float
         x_delta: float
         y_delta: float
@@ -222,6 +272,8 @@ class HeatMap(GenericDisplay):
 
         File is generated from writing :class:`PointDatum` objects to strings,
         one on each line.
+        Weighted datapoints (e.g. the buckets of a histogram collected
+        in-kernel) count as that many occurrences.
 
         :param data:
             A generator that returns the lines for the section we want to
@@ -230,24 +282,27 @@ class HeatMap(GenericDisplay):
             True if x values should be normalised to start from zero.
 
         :return:
-            A pair of sequences: x values, y values.
+            A triple of arrays: x values, y values, weights. The weights are
+            None if every datapoint has a weight of 1.
 
         """
-        x_values = []
-        y_values = []
-        for datum in data:
-            x_values.append(datum.x)
-            y_values.append(datum.y)
-        # x_values = [dp.x for dp in data] can't be used since we got a gen
-        # y_values = [dp.y for dp in data]
-
-        if not x_values or not y_values:
+        # The generator is read once, straight into an array of
+        # (x, y, weight) rows
+        values = np.fromiter(
+            itertools.chain.from_iterable(
+                (datum.x, datum.y, datum.weight) for datum in data),
+            dtype=float).reshape(-1, 3)
+
+        if not values.size:
             raise ValueError("No data in input file.")
+        x_values, y_values, weights = values.T
         if normalised:
             # Normalize x-axis values to start from zero
-            x_values = [x - min(x_values) for x in x_values]
+            x_values = x_values - x_values.min()
+        if (weights == 1).all():
+            weights = None
 
-        return x_values, y_values
+        return x_values, y_values, weights
 
     def _create_axes(self):
         """
@@ -285,19 +340,44 @@ class HeatMap(GenericDisplay):
 
         """
         # Determine minimum, maximum, median
-        x_min, x_max = min(self.x_data), max(self.x_data)
-        y_min, y_max = min(self.y_data), max(self.y_data)
-        y_med = np.median(self.y_data).item()
-
-        # Determine no. bins and bin size
-        x_bins = max(self.params.scale * self.params.figure_size, x_max)
-        y_bins = y_max / (y_med / self.params.y_res)
-        x_bin_size = (x_max - x_min) / x_bins
-        y_bin_size = (y_max - y_min) / y_bins
+        x_min, x_max = np.min(self.x_data).item(), np.max(self.x_data).item()
+        y_min, y_max = np.min(self.y_data).item(), np.max(self.y_data).item()
+        if self.weights is None:
+            y_med = np.median(self.y_data).item()
+        else:
+            y_med = self._weighted_median(self.y_data, self.weights)
+
+        # Determine no. bins: at least enough to fill the screen at the
+        # scale, and up to one per unit of x, within the budget
+        visible_bins = self.params.scale * self.params.figure_size
+        x_range = x_max - x_min
+        if self.params.log_y:
+            y_bins = self.params.y_res * math.log10(y_max / y_min) \
+                if y_min > 0 else 1
+        elif y_med > 0:
+            y_bins = y_max / (y_med / self.params.y_res)
+        else:
+            y_bins = visible_bins
+        y_bins = min(max(math.ceil(y_bins), 1), self.params.max_bins)
+        x_bins = max(visible_bins, x_range)
+        x_bins = max(min(math.ceil(x_bins), self.params.max_bins // y_bins),
+                     1)
+
+        # Determine bin size, giving each bin a size even if all the
+        # datapoints have the same value
+        x_bin_size = (x_range or 1) / x_bins
+        if self.params.log_y:
+            y_bin_size = (y_max / y_min) ** (1 / y_bins) if y_min > 0 else 1
+        else:
+            y_bin_size = ((y_max - y_min) or 1) / y_bins
 
         # Get delta values
-        x_delta = self.params.scale * self.params.figure_size * x_bin_size
-        y_delta = self.params.scale * self.params.figure_size * y_bin_size
+        x_delta = visible_bins * x_bin_size
+        if self.params.log_y:
+            # The whole y-axis is shown on a log scale
+            y_delta = y_max
+        else:
+            y_delta = visible_bins * y_bin_size
 
         return self._DataStats(x_min=x_min, x_max=x_max, y_min=y_min,
                                y_max=y_max, y_median=y_med, x_bins=x_bins,
@@ -305,24 +385,215 @@ class HeatMap(GenericDisplay):
                                y_bin_size=y_bin_size, x_delta=x_delta,
                                y_delta=y_delta)
 
+    @staticmethod
+    def _weighted_median(values, weights):
+        """
+        Determine the median of weighted values.
+
+        :param values:
+            The values.
+        :param weights:
+            The weight of each value.
+        :return:
+            The smallest value such that at least half of the total weight is
+            on values no greater than it.
+
+        """
+        order = np.argsort(values)
+        cumulative = np.cumsum(np.asarray(weights, dtype=float)[order])
+        middle = np.searchsorted(cumulative, cumulative[-1] / 2)
+        return np.asarray(values, dtype=float)[order][middle].item()
+
+    def _get_bin_edges(self):
+        """
+        Determine the edges of the histogram bins.
+
+        :return:
+            A pair of arrays: the edges of the x-axis bins, and of the y-axis
+            bins, each one longer than the number of bins.
+
+        """
+        stats = self.data_stats
+        x_edges = stats.x_min + stats.x_bin_size * np.arange(stats.x_bins + 1)
+        if self.params.log_y and stats.y_min > 0:
+            y_edges = stats.y_min * \
+                stats.y_bin_size ** np.arange(stats.y_bins + 1)
+        else:
+            y_edges = stats.y_min + \
+                stats.y_bin_size * np.arange(stats.y_bins + 1)
+        return x_edges, y_edges
+
+    def _bin_indices(self):
+        """
+        Compute the bin of each datapoint.
+
+        :return:
+            A pair of arrays: the x-axis and y-axis bin of each datapoint.
+
+        """
+        stats = self.data_stats
+        x_index = (self.x_data - stats.x_min) / stats.x_bin_size
+        if self.params.log_y and stats.y_min > 0:
+            y_index = np.log(self.y_data / stats.y_min) / \
+                math.log(stats.y_bin_size)
+        else:
+            y_index = (self.y_data - stats.y_min) / stats.y_bin_size
+        return (self._snap_to_edges(self.x_data, x_index, self.x_edges),
+                self._snap_to_edges(self.y_data, y_index, self.y_edges))
+
+    @staticmethod
+    def _snap_to_edges(values, index, edges):
+        """
+        Correct bin indices computed in floating point against the edges of
+        the bins.
+
+        :param values:
+            The values binned.
+        :param index:
+            The bin of each value, as computed, in floating point.
+        :param edges:
+            The edges of the bins.
+        :return:
+            The bin of each value, as an integer array; the maximum values
+            fall in the last bin.
+
+        """
+        last = len(edges) - 2
+        index = np.clip(index.astype(np.intp), 0, last)
+        index -= (values < edges[index]) & (index > 0)
+        index += (values >= edges[index + 1]) & (index < last)
+        return index
+
+    def _histogram(self):
+        """
+        Count the (weighted) datapoints in each bin, and keep the datapoints
+        sorted by x for re-binning.
+
+        :return:
+            The counts, as an array of shape (x bins, y bins).
+
+        """
+        x_index, y_index = self._bin_indices()
+        shape = (self.data_stats.x_bins, self.data_stats.y_bins)
+        counts = np.bincount(np.ravel_multi_index((x_index, y_index), shape),
+                             weights=self.weights,
+                             minlength=shape[0] * shape[1])
+
+        # Stable, so x values that are already in order sort quickly
+        order = np.argsort(self.x_data, kind="stable")
+        self.sorted_x = self.x_data[order]
+        self.sorted_y_index = y_index[order]
+        self.sorted_weights = \
+            None if self.weights is None else self.weights[order]
+
+        return counts.reshape(shape)
+
+    @staticmethod
+    def _build_pyramid(counts):
+        """
+        Build coarser and coarser histograms from a histogram.
+
+        :param counts:
+            The histogram, as an array of shape (x bins, y bins).
+        :return:
+            A list of histograms, starting with the one given, each one
+            merging pairs of x bins of the one before, down to a single x bin.
+
+        """
+        pyramid = [counts]
+        while len(counts) > 1:
+            if len(counts) % 2:
+                counts = np.concatenate(
+                    (counts, np.zeros((1, counts.shape[1]))))
+            counts = counts[0::2] + counts[1::2]
+            pyramid.append(counts)
+        return pyramid
+
+    def _window_histogram(self, x_low, x_high):
+        """
+        Count the datapoints in a window of the x-axis.
+
+        :param x_low, x_high:
+            The bounds of the window.
+        :return:
+            A pair: the counts, as an array of shape (x bins, y bins), with
+            about as many x bins as the view shows; and the edges of the x
+            bins, which cover the window.
+
+        """
+        stats = self.data_stats
+        view_bins = max(int(2 * self.params.scale * self.params.figure_size),
+                        1)
+        width = (x_high - x_low) / view_bins
+
+        if width >= stats.x_bin_size:
+            # The coarsest level of the pyramid at least as fine as the view
+            level = min(int(math.log2(width / stats.x_bin_size)),
+                        len(self.pyramid) - 1)
+            counts = self.pyramid[level]
+            size = stats.x_bin_size * 2 ** level
+            first = min(max(int((x_low - stats.x_min) // size), 0),
+                        len(counts) - 1)
+            last = min(max(math.ceil((x_high - stats.x_min) / size),
+                           first + 1), len(counts))
+            return (counts[first:last],
+                    stats.x_min + size * np.arange(first, last + 1))
+
+        # Finer than the full histogram: bin the datapoints in the window
+        low, high = np.searchsorted(self.sorted_x, x_low, side="left"), \
+            np.searchsorted(self.sorted_x, x_high, side="right")
+        edges = x_low + width * np.arange(view_bins + 1)
+        values = self.sorted_x[low:high]
+        x_index = self._snap_to_edges(values, (values - x_low) / width, edges)
+        weights = None if self.sorted_weights is None \
+            else self.sorted_weights[low:high]
+        counts = np.bincount(
+            x_index * stats.y_bins + self.sorted_y_index[low:high],
+            weights=weights, minlength=view_bins * stats.y_bins)
+        return counts.reshape(view_bins, stats.y_bins), edges
+
+    def _show_window(self):
+        """ Redraw the image for the visible part of the x-axis. """
+        counts, x_edges = self._window_histogram(*self.axes.get_xlim())
+        self.heatmap, self.view_x_edges = counts, x_edges
+        self.generation += 1
+        if self.params.log_y:
+            # A mesh cannot change shape, so is replaced
+            self.image.remove()
+            self.image = self.axes.pcolormesh(x_edges, self.y_edges,
+                                              counts.T, cmap='OrRd')
+            self.colorbar.update_normal(self.image)
+        else:
+            self.image.set_data(counts.T)
+            self.image.set_extent([x_edges[0], x_edges[-1],
+                                   self.y_edges[0], self.y_edges[-1]])
+            self.image.set_clim(0, counts.max() or 1)
+
     def _plot_histogram(self):
         """
-        Plot the histogram.
+        Plot the histogram, over the whole x-axis at the resolution of the
+        view.
 
         :return:
-            The resulting heat map and the resulting AxesImage.
+            The counts shown and the resulting image.
 
         """
-        # Get histogram
-        heatmap, xedges, yedges = np.histogram2d(self.x_data, self.y_data,
-                                                 bins=(self.data_stats.x_bins,
-                                                       self.data_stats.y_bins))
-        extent = [xedges[0], xedges[-1], yedges[0], yedges[-1]]
+        self.pyramid = self._build_pyramid(self._histogram())
+        heatmap, self.view_x_edges = self._window_histogram(
+            self.data_stats.x_min, self.data_stats.x_max)
 
         # Plot data - use OrRd (OrangeRed colour scheme)
         # heatmap.T transposes the heatmap ndarray
-        image = self.axes.imshow(heatmap.T, cmap='OrRd', extent=extent,
-                                 origin='lower', aspect='auto')
+        if self.params.log_y:
+            # Log-scale bins are not evenly spaced, so are drawn as a mesh
+            image = self.axes.pcolormesh(self.view_x_edges, self.y_edges,
+                                         heatmap.T, cmap='OrRd')
+            self.axes.set_yscale('log')
+        else:
+            extent = [self.view_x_edges[0], self.view_x_edges[-1],
+                      self.y_edges[0], self.y_edges[-1]]
+            image = self.axes.imshow(heatmap.T, cmap='OrRd', extent=extent,
+                                     origin='lower', aspect='auto')
 
         return heatmap, image
 
@@ -350,6 +621,10 @@ class HeatMap(GenericDisplay):
         """ Redraw the graph """
         self.figure.canvas.draw_idle()
 
+    def _shown_bin_width(self):
+        """ :return: The width of the x-axis bins shown. """
+        return self.view_x_edges[1] - self.view_x_edges[0]
+
     def _create_sliders(self):
         """ Create sliders that allow the user to scroll the axes. """
         # Create sliders for scrollable axes
@@ -362,29 +637,46 @@ class HeatMap(GenericDisplay):
             self.data_stats.x_max - self.data_stats.x_delta)
         x_slider_pos.valtext.set_visible(False)
 
-        y_slider = plt.axes([0.2, 0.9, 0.6, 0.015])
-        y_slider_pos = widgets.Slider(
-            y_slider, 'Position of y-axis\n/ ' + self.labels.y_units,
-            self.data_stats.y_min + self.data_stats.y_delta,
-            self.data_stats.y_max - self.data_stats.y_delta)
-        y_slider_pos.valtext.set_visible(False)
+        # A log-scale y-axis is shown whole
+        y_slider_pos = None
+        if not self.params.log_y:
+            y_slider = plt.axes([0.2, 0.9, 0.6, 0.015])
+            y_slider_pos = widgets.Slider(
+                y_slider, 'Position of y-axis\n/ ' + self.labels.y_units,
+                self.data_stats.y_min + self.data_stats.y_delta,
+                self.data_stats.y_max - self.data_stats.y_delta)
+            y_slider_pos.valtext.set_visible(False)
 
         def update(val):
             """ Update the axes on slider change """
             # Determine new positions
-            self.pos = self._ViewportPosition(x=x_slider_pos.val,
-                                              y=y_slider_pos.val)
+            pos = self._ViewportPosition(
+                x=x_slider_pos.val,
+                y=y_slider_pos.val if y_slider_pos else self.pos.y)
+            # Moves of less than a bin would draw the same image
+            if abs(pos.x - self.pos.x) < self._shown_bin_width() and \
+                    abs(pos.y - self.pos.y) < self.data_stats.y_bin_size:
+                return
+            self.pos = pos
             self._set_axes_limits()
             self._redraw()
 
         # Listeners for slider changes
         x_slider_pos.on_changed(update)
-        y_slider_pos.on_changed(update)
+        if y_slider_pos:
+            y_slider_pos.on_changed(update)
 
     def _add_colorbar(self):
-        """ Add a colorbar scale to the graph. """
+        """
+        Add a colorbar scale to the graph.
+
+        :return:
+            The colorbar.
+
+        """
         colorbar = self.axes.figure.colorbar(self.image, ax=self.axes)
         colorbar.ax.set_ylabel(self.display_options.colorbar)
+        return colorbar
 
     def _add_annotations(self):
         """
@@ -396,37 +688,67 @@ class HeatMap(GenericDisplay):
         """
         # xy=(0, 0) is the inital annotation position (in data units)
         # xytext=(5,7) is the constant offset of the annotation display
+        # Animated artists are left out of full draws, and blitted instead
         annot = self.axes.annotate("", xy=(0, 0), xytext=(5, 7),
                                    xycoords="data", textcoords="offset points",
-                                   bbox=dict(boxstyle="square"))
+                                   bbox=dict(boxstyle="square"),
+                                   animated=True)
 
         annot.set_visible(False)
+        canvas = self.figure.canvas
+
+        def blit():
+            """ Draw the annotation over the background. """
+            if self.background is None or \
+                    not getattr(canvas, "supports_blit", False):
+                self._redraw()
+                return
+            canvas.restore_region(self.background)
+            self.axes.draw_artist(annot)
+            canvas.blit(self.figure.bbox)
+
+        def on_draw(event):
+            """ Cache the background after a full draw. """
+            if getattr(canvas, "supports_blit", False):
+                self.background = canvas.copy_from_bbox(self.figure.bbox)
+                self.axes.draw_artist(annot)
 
         def hover(event):
             """ Update the figure on hover. """
             # Check if mouse is within axes
             if event.inaxes == self.axes:
                 # Compute which bins we are in
-                x_bin = int(math.floor((event.xdata - self.data_stats.x_min) /
-                                       self.data_stats.x_bin_size))
-                y_bin = int(math.floor((event.ydata - self.data_stats.y_min) /
-                                       self.data_stats.y_bin_size))
+                x_bin = min(max(np.searchsorted(
+                    self.view_x_edges, event.xdata, side="right") - 1, 0),
+                            len(self.heatmap) - 1)
+                y_bin = min(max(np.searchsorted(
+                    self.y_edges, event.ydata, side="right") - 1, 0),
+                            self.data_stats.y_bins - 1)
+                # The same bin, in the same image, is already annotated
+                current = (x_bin, y_bin, self.generation)
+                if current == self.annotated_bin:
+                    return
+                self.annotated_bin = current
 
                 # Update annotation text to reflect
-                text = "Bin (x-axis): {:.2g} - {:.2g} units\n" \
-                       "Bin (y-axis): {:.4g} - {:.4g} units\n" \
-                       "Count: {}".format(x_bin,
-                                          x_bin + self.data_stats.x_bin_size,
-                                          y_bin,
-                                          y_bin + self.data_stats.y_bin_size,
-                                          self.heatmap[x_bin, y_bin])
+                text = "Bin (x-axis): {:.4g} - {:.4g} {}\n" \
+                       "Bin (y-axis): {:.4g} - {:.4g} {}\n" \
+                       "Count: {:g}".format(self.view_x_edges[x_bin],
+                                            self.view_x_edges[x_bin + 1],
+                                            self.labels.x_units,
+                                            self.y_edges[y_bin],
+                                            self.y_edges[y_bin + 1],
+                                            self.labels.y_units,
+                                            self.heatmap[x_bin, y_bin])
                 annot.xy = (event.xdata, event.ydata)
                 annot.set_text(text)
                 annot.get_bbox_patch().set_alpha(0.4)
                 annot.set_visible(True)
-                self._redraw()
-            else:
+                blit()
+            elif annot.get_visible():
+                self.annotated_bin = None
                 annot.set_visible(False)
-                self._redraw()
+                blit()
 
-        self.figure.canvas.mpl_connect("motion_notify_event", hover)
+        canvas.mpl_connect("draw_event", on_draw)
+        canvas.mpl_connect("motion_notify_event", hover)
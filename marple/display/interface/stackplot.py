@@ -7,11 +7,18 @@ Class that interacts with the flamegraph tool.
 
 Implements the GenericDiaplay interface to display an interactive matplotlib
 stackplot figure.
+The datapoints are pivoted into a matrix of the y value of each label at each
+x, from which the top labels are picked and the rest summed as "other", with
+array operations.
+Only the visible points are drawn, downsampled to the lowest and highest
+stack in each pixel's width (see :mod:`marple.common.downsample`), and
+redrawn on zooming, so drawing costs the same however long the recording.
 
 """
 
 __all__ = ("StackPlot", )
 
+import itertools
 import logging
 from typing import NamedTuple
 
@@ -21,6 +28,7 @@ import numpy as np
 from marple.common import (
     config,
     consts,
+    downsample,
     util
 )
 from marple.display.interface.generic_display import GenericDisplay
@@ -38,8 +46,12 @@ class StackPlot(GenericDisplay):
         """
         - top_processes: the number of processes to be displayed in the
                          stackplot
+        - top_by: "step" to show the top processes at each x value, or
+                  "total" to show the processes with the top totals over all
+                  x values
         """
         top_processes: int
+        top_by: str = "step"
 
     @util.log(logger)
     def __init__(self, data):
@@ -56,128 +68,134 @@ class StackPlot(GenericDisplay):
 
         top_processes = config.get_option_from_section(
             consts.DisplayOptions.STACKPLOT.value, "top", typ="int")
-        self.display_options = self.DisplayOptions(top_processes)
-
-        # Read the data into a dict
-        datapoints = {}
-        for point in data.datum_generator:
-            if point.x not in datapoints:
-                datapoints[point.x] = []
-            datapoints[point.x].append((point.y, point.info))
-
-        # Collapse same labels at same x
-        self._collapse_labels(datapoints)
-
-        # Set of unique labels that will be displayed
-        seen_labels = set()
-
-        # Dict of x-coord to other points not in the top n at that x
-        other = {}
-
-        for x in datapoints:
-            # Sort tuples at each time step by memory and take top elements
-            data_descending = sorted(datapoints[x],
-                                     key=lambda z: z[0],
-                                     reverse=True)
-
-            # Only keep first n at each time step
-            datapoints[x] = data_descending[0:self.display_options
-                                                  .top_processes]
-
-            # Sum the rest of the values separately, as "other"
-            if x not in other:
-                try:
-                    other[x] = np.sum(z[0] for z in
-                                      data_descending[self.display_options
-                                                          .top_processes:])
-                except IndexError as ie:
-                    raise IndexError("Not enough data to display stackplot "
-                                     "with {} rows, use smaller number. {}"
-                                     .format(self.display_options
-                                                 .top_processes,
-                                             ie.args))
-
-            # Keep track of the labels that are in use in top n
-            seen_labels = seen_labels.union(set(z[1] for z in datapoints[x]))
-
-        # Insert the missing datapoints
-        self._add_missing_datapoints(datapoints, seen_labels)
-
-        # Sort again
-        for x in datapoints:
-            datapoints[x] = sorted(datapoints[x],
-                                   key=lambda z: z[1],
-                                   reverse=True)
-
-        y_values_list = []
-        # @@@ separate other and tuple_list into different for loops
-        for index in range(len(seen_labels)+1):
-            values = []
-            for x, tuple_list in datapoints.items():
-                if index == 0:
-                    values.append(other[x])
-                else:
-                    values.append(tuple_list[index-1][0])
-            y_values_list.append(values)
-
-        labels_list = ["other"]
-        for _, tuple_list in datapoints.items():
-            for(_, label) in tuple_list:
-                labels_list.append(label)
-            break
+        top_by = config.get_option_from_section(
+            consts.DisplayOptions.STACKPLOT.value, "top_by")
+        self.display_options = self.DisplayOptions(top_processes, top_by)
+
+        x_values, matrix, labels = self._pivot(data.datum_generator)
+        shown, y_values = self._top(matrix, self.display_options)
+
+        # Labels in descending order, after "other" at the bottom
+        order = sorted(range(len(shown)), key=lambda i: labels[shown[i]],
+                       reverse=True)
 
         # Create the data to be plotted
-        self.x_values = sorted(time for time in datapoints)
-        self.y_values = np.stack(y_values_list)
-        self.labels = labels_list
+        self.x_values = x_values
+        other = np.maximum(matrix.sum(axis=0) - y_values.sum(axis=0), 0)
+        self.y_values = np.vstack((other, y_values[order]))
+        self.labels = ["other"] + [labels[shown[i]] for i in order]
 
     @staticmethod
-    def _collapse_labels(datapoints):
+    def _pivot(datapoints):
         """
-        Collapses unique labels at each x-coordinate.
+        Pivot labelled datapoints into a matrix.
 
-        Takes a dict representing a 2d graph with labels and makes the labels
-            unique for each x coordinate by adding the y values for the same
-            label. MODIFIES THE DICT PASSED AS AN ARGUMENT.
+        The y values of the same label at the same x are added together.
 
         :param datapoints:
-            A dict with x-coordinates as keys and tuples of (y,label) as values.
+            An iterable of `data_io.PointDatum` objects, the info being the
+            label.
+        :return:
+            A triple: the distinct x values, in ascending order; a matrix of
+            the y value of each label (row) at each x (column), 0 where the
+            label has no datapoint; and the labels of the rows.
 
         """
-        # e.g.  in:     x1 -> (y1, label1), (y2, label2), (y3, label1)
-        #       out:    x1 -> (y1+y3, label1), (y2, label2)
-
-        for x in datapoints:
-            # use dict to make labels at each x unique and add y's
-            points = {}
-            for (y, label) in datapoints[x]:
-                if label not in points:
-                    points[label] = y
-                else:
-                    points[label] += y
-
-            # Convert back to list of tuples and modify the input dict
-            datapoints[x] = [(y, label) for label, y in points.items()]
+        # Each label is coded by its order of appearance
+        codes = {}
+        values = np.fromiter(
+            itertools.chain.from_iterable(
+                (point.x, point.y, codes.setdefault(point.info, len(codes)))
+                for point in datapoints),
+            dtype=float).reshape(-1, 3)
+        x_values, x_codes = np.unique(values[:, 0], return_inverse=True)
+
+        shape = (len(codes), len(x_values))
+        matrix = np.bincount(
+            values[:, 2].astype(np.intp) * shape[1] + x_codes,
+            weights=values[:, 1], minlength=shape[0] * shape[1])
+        return x_values, matrix.reshape(shape), list(codes)
 
     @staticmethod
-    def _add_missing_datapoints(datapoints, seen_labels):
+    def _top(matrix, options):
         """
-        Adds datapoints to the graph to make it plottable.
+        Select the top labels of a matrix.
+
+        :param matrix:
+            The y value of each label (row) at each x (column).
+        :param options:
+            The :class:`StackPlot.DisplayOptions` giving the number of labels
+            and how to rank them.
+        :return:
+            A pair: the rows of the labels shown, in ascending order; and
+            their y values, 0 at each x where a label is not in the top
+            (so that its value counts as other).
 
-        Stackplot can only be plotted if there are the same number of (y,
-        label) for each x, so add (0.0, label) where necessary, so that all
-        seen labels exist at each x. MODIFIES THE DICT PASSED AS AN ARGUMENT.
+        """
+        top = options.top_processes
+        if top <= 0:
+            return np.arange(0), np.zeros((0, matrix.shape[1]))
+        if top >= len(matrix):
+            return np.arange(len(matrix)), matrix
+
+        if options.top_by == "total":
+            shown = np.sort(np.argpartition(-matrix.sum(axis=1),
+                                            top - 1)[:top])
+            return shown, matrix[shown]
+
+        # The top rows at each x, in no particular order
+        top_rows = np.argpartition(-matrix, top - 1, axis=0)[:top]
+        mask = np.zeros(matrix.shape, dtype=bool)
+        mask[top_rows, np.arange(matrix.shape[1])] = True
+        # Where fewer labels than the top have a value, the rest of the top
+        # rows are arbitrary zeros
+        mask &= matrix > 0
+        shown = np.flatnonzero(mask.any(axis=1))
+        return shown, np.where(mask[shown], matrix[shown], 0.0)
+
+    def _visible_points(self, x_low, x_high, buckets):
+        """
+        Select the points to draw for a range of x values.
+
+        :param x_low, x_high:
+            The range of x values visible.
+        :param buckets:
+            The number of buckets to downsample to, e.g. the width of the plot
+            in pixels.
+        :return:
+            A pair: the x values to draw, and the y values of each label at
+            them. The points just outside the range are included, so that the
+            stacks reach its edges.
 
-        :param datapoints:
-            A dict with x-coordinates as keys and tuples of (y,label) as values.
-        :param seen_labels:
-            The set of labels that need to exist at each x.
+        """
+        first = max(np.searchsorted(self.x_values, x_low, side="left") - 1, 0)
+        last = np.searchsorted(self.x_values, x_high, side="right") + 1
+        x_values = self.x_values[first:last]
+        y_values = self.y_values[:, first:last]
+        # The stacks are kept whole where their total is lowest and highest
+        keep = downsample.min_max(x_values, y_values.sum(axis=0), buckets)
+        return x_values[keep], y_values[:, keep]
+
+    def _draw(self, ax, colors=None):
+        """
+        Draw the visible part of the stackplot.
+
+        :param ax:
+            The axes to draw on.
+        :param colors:
+            The colours of the labels, or None for the first draw, which also
+            labels the stacks.
+        :return:
+            The collections drawn.
 
         """
-        for x, data_tuple_list in datapoints.items():
-            labels_at_key = set(tup[1] for tup in data_tuple_list)
-            for _label in seen_labels - labels_at_key:
-                datapoints[x].append((0.0, _label))
+        x_low, x_high = ax.get_xlim() if colors is not None else \
+            (-np.inf, np.inf)
+        buckets = max(int(ax.get_window_extent().width), 1)
+        x_values, y_values = self._visible_points(x_low, x_high, buckets)
+        if colors is None:
+            return ax.stackplot(x_values, y_values, labels=self.labels)
+        return ax.stackplot(x_values, y_values, colors=colors)
 
     @util.log(logger)
     @util.Override(GenericDisplay)
@@ -187,12 +205,25 @@ class StackPlot(GenericDisplay):
 
         try:
             # Create the plot, ordering by time coordinates
-            ax.stackplot(self.x_values, self.y_values, labels=self.labels)
+            drawn = self._draw(ax)
 
         except KeyError as ke:
             raise KeyError("Not enough information to create a stackplot. "
                            "Need at least two samples. {}".format(ke.args))
 
+        if len(self.x_values) > 1:
+            # Fix the range, so redrawing does not rescale it
+            ax.set_xlim(self.x_values[0], self.x_values[-1])
+        colors = [collection.get_facecolor()[0] for collection in drawn]
+
+        def redraw(axes):
+            """ Draw the points visible after zooming or panning. """
+            for collection in drawn:
+                collection.remove()
+            drawn[:] = self._draw(axes, colors)
+
+        ax.callbacks.connect("xlim_changed", redraw)
+
         # Set legend, inverting the elements to have "other" at the bottom
         handles, labels = ax.get_legend_handles_labels()
         ax.legend(handles[::-1], labels[::-1])
@@ -7,6 +7,13 @@ Class that displays data as a treemap.
 
 Implements the GenericDiaplay interface to display an interactive treemap
 in the browser.
+The stacks are merged into a call tree (see
+:class:`marple.common.calltree.CallTree`), cut at the treemap depth and
+pruned to a budget of nodes, the weight of the frames left out being shown
+as an `[other]` node beside the frames kept.
+The tree is embedded in a self-contained HTML page as nested JSON, and laid
+out in the browser, one level at a time, by a small script of its own, so
+the page needs no network access.
 
 """
 
@@ -14,37 +21,153 @@ __all__ = (
     'Treemap',
 )
 
+import html
+import json
 import logging
 import os
 import subprocess
 from typing import NamedTuple
 
 from marple.common import (
+    calltree,
     file,
     util,
     consts,
     config
 )
 from marple.display.interface.generic_display import GenericDisplay
-from marple.display.tools.d3plus import d3IpyPlus as d3
 
 logger = logging.getLogger(__name__)
 logger.debug('Entered module: %s', __name__)
 
+# Size of the treemap, in pixels
+IMAGE_WIDTH = 1200
+IMAGE_HEIGHT = 700
+
+# The name of the node for the weight of the frames left out
+OTHER = "[other]"
+
+# Nodes are {"n": name, "v": total weight, "c": [children]}; clicking a node
+# shows its children, and clicking the path above goes back up
+_SCRIPT = """
+var data = %(data)s, units = %(units)s, path = [data];
+function worst(sum, max, min, side) {
+    var sum2 = sum * sum, side2 = side * side;
+    return Math.max(side2 * max / sum2, sum2 / (side2 * min));
+}
+function squarify(areas, x, y, w, h) {
+    var rects = [], i = 0;
+    while (i < areas.length) {
+        var side = Math.min(w, h), sum = 0, max = 0, min = Infinity;
+        var best = Infinity, j = i;
+        // Fill a row along the short side while it makes squarer rectangles
+        while (j < areas.length) {
+            var a = areas[j];
+            var r = worst(sum + a, Math.max(max, a), Math.min(min, a), side);
+            if (j > i && r > best) break;
+            sum += a; max = Math.max(max, a); min = Math.min(min, a);
+            best = r; j++;
+        }
+        var thick = sum / side, offset = 0;
+        for (var k = i; k < j; k++) {
+            var length = areas[k] / sum * side;
+            rects.push(w >= h ? [x, y + offset, thick, length]
+                              : [x + offset, y, length, thick]);
+            offset += length;
+        }
+        if (w >= h) { x += thick; w -= thick; } else { y += thick; h -= thick; }
+        i = j;
+    }
+    return rects;
+}
+function color(name) {
+    var hash = 0;
+    for (var i = 0; i < name.length; i++)
+        hash = (hash * 31 + name.charCodeAt(i)) | 0;
+    return "hsl(" + (Math.abs(hash) %% 360) + ",60%%,70%%)";
+}
+function label(node) {
+    return node.n + " (" + node.v + " " + units + ", " +
+        (100 * node.v / data.v).toFixed(2) + "%%)";
+}
+function draw() {
+    var map = document.getElementById("map");
+    var top = path[path.length - 1];
+    map.textContent = "";
+    var crumbs = document.getElementById("path");
+    crumbs.textContent = "";
+    path.forEach(function (node, depth) {
+        var crumb = document.createElement("span");
+        crumb.textContent = (depth ? " > " : "") + node.n;
+        crumb.onclick = function () { path.length = depth + 1; draw(); };
+        crumbs.appendChild(crumb);
+    });
+    var children = (top.c || []).filter(function (child) { return child.v > 0; })
+        .sort(function (a, b) { return b.v - a.v; });
+    var scale = map.clientWidth * map.clientHeight / top.v;
+    var rects = squarify(children.map(function (child) {
+        return child.v * scale;
+    }), 0, 0, map.clientWidth, map.clientHeight);
+    children.forEach(function (child, i) {
+        var cell = document.createElement("div"), rect = rects[i];
+        cell.className = "cell" + (child.c ? " parent" : "");
+        cell.style.left = rect[0] + "px";
+        cell.style.top = rect[1] + "px";
+        cell.style.width = Math.max(rect[2] - 1, 0) + "px";
+        cell.style.height = Math.max(rect[3] - 1, 0) + "px";
+        cell.style.background = color(child.n);
+        cell.textContent = child.n;
+        cell.title = label(child);
+        cell.onmouseover = function () {
+            document.getElementById("details").textContent = label(child);
+        };
+        if (child.c)
+            cell.onclick = function () { path.push(child); draw(); };
+        map.appendChild(cell);
+    });
+}
+"""
+
+_HTML = """\
+<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Treemap</title>
+<style>
+body {{ font-family: Verdana; font-size: 12px; }}
+#path span {{ cursor: pointer; }}
+#map {{ position: relative; width: {width}px; height: {height}px; }}
+.cell {{ position: absolute; overflow: hidden; padding: 2px;
+         box-sizing: border-box; border: 1px solid white; }}
+.parent {{ cursor: pointer; }}
+</style>
+<script>{script}</script>
+</head>
+<body onload="draw()">
+<div id="path"></div>
+<div id="map"></div>
+<div id="details">{title}</div>
+</body>
+</html>
+"""
+
 
 class Treemap(GenericDisplay):
     """
     The class representing treemaps.
 
     """
-    # @TODO: Add more options (look at how the treemap is initialised)
     class DisplayOptions(NamedTuple):
         """
         Options:
             - depth: the maximum depth of the treemap (max number of elements
                      in a stack);
+            - max_nodes: the maximum number of nodes in the treemap; the
+                         lightest are merged into `[other]` nodes
         """
         depth: int
+        max_nodes: int = 5000
     _DEFAULT_OPTIONS = DisplayOptions(depth=25)
 
     def __init__(self, data):
@@ -61,79 +184,84 @@ class Treemap(GenericDisplay):
 
         depth = config.get_option_from_section(
             consts.DisplayOptions.TREEMAP.value, "depth", typ="int")
-        self.display_options = self.DisplayOptions(depth)
+        max_nodes = config.get_option_from_section(
+            consts.DisplayOptions.TREEMAP.value, "max_nodes", typ="int")
+        self.display_options = self.DisplayOptions(depth, max_nodes)
 
-    @util.log(logger)
-    def _generate_csv(self, out_file):
+    def _build_tree(self):
         """
-        Creates a semicolon separated file using the data in self.data.
-        The output format will be:
-            - first line: Represents the columns (header); first column will
-                          represent the value of the stack line; the rest of the
-                          columns will be numbers from 1 to the maximum stack
-                          depth, representing the groups we use for creating the
-                          hierarchies;
-            - next lines: values of the above columns, separated by semicolons;
-                          the values for the groups will be the function at that
-                          depth; group priorities are from left to right,
-                          so group 1 has a higher priority (will be displayed
-                          over in the treemap) than group 2 (see bellow)
-                          example: bytes;1;2;3 -- first row
-                                   5;firefox;[unknown];libxul.so -- second row
-
-        :param out_file: a semicolon separated file generated from the in_file;
-                         expects an absolute path
-        :raises ValueError: in case the file is not in an accepted format
-        :returns max_depth: the maximum depth of the stack
+        Merge the stacks into a call tree, within the depth and the node
+        budget.
+
+        :return:
+            The :class:`calltree.CallTree` to show.
 
         """
+        tree = calltree.CallTree().add_all(self.data.summable_datums())
+        return tree.truncated(self.display_options.depth).pruned(
+            self.display_options.max_nodes)
 
-        with open(out_file, "w") as out:
-            # Header of the csv; example: value;1;2;3;4;5...
-            out.write(
-                self.data_options.weight_units + ";" +
-                ";".join(
-                    [str(i) for i in range(1, self.display_options.depth + 1)])
-                + "\n")
-
-            for line in self.data.datum_generator:
-                # Write to the temp CSV file in the required format
-                out.write(
-                    str(line.weight) + ';' +
-                    ';'.join(line.stack[0:self.display_options.depth]) + '\n')
+    @staticmethod
+    def _to_json(tree):
+        """
+        Convert a call tree to nested JSON objects.
+
+        :param tree:
+            The :class:`calltree.CallTree` to convert.
+        :return:
+            The root object: each object has the name ("n") and total weight
+            ("v") of its node, and, if the node has children, their objects
+            ("c"), with an `[other]` object for any weight of the node not in
+            its children.
 
-    @util.Override(GenericDisplay)
-    @util.log(logger)
-    def show(self):
         """
-        Displays the input stack as a treemap using the d3IpyPlus tool.
+        nodes = [{"n": "all", "v": tree.total()}]
+        # Parents come before their children
+        for node in range(1, len(tree)):
+            item = {"n": tree.name(node), "v": tree.total(node)}
+            nodes.append(item)
+            nodes[tree.parent(node)].setdefault("c", []).append(item)
+        for node, item in enumerate(nodes):
+            if "c" in item and tree.self_weight(node):
+                item["c"].append({"n": OTHER, "v": tree.self_weight(node)})
+        return nodes[0]
 
-        Creates the ids and the columns that are passed in the treemap object,
-        which is used to generate a html file that is to be displayed.
+    @util.log(logger)
+    def _generate_html(self, out_file):
         """
+        Write the treemap as a self-contained HTML page.
 
-        # Temp file for the csv file
-        temp_file = str(file.TempFileName())
-        self._generate_csv(temp_file)
+        :param out_file:
+            The path of the page to write.
+        :return:
+            The number of nodes in the treemap.
 
-        # Generate the ids we use for the hierarchies and the columns of the
-        # input file
-        ids = [str(i) for i in range(1, self.display_options.depth + 1)]
-        cols = [self.data_options.weight_units] + ids
+        """
+        tree = self._build_tree()
+        data = json.dumps(self._to_json(tree), separators=(",", ":"))
+        units = json.dumps(self.data_options.weight_units)
+        # Keep frame names from closing the script
+        script = (_SCRIPT % {"data": data, "units": units}).replace(
+            "</", "<\\/")
 
-        # Retrieve data from the temporary file that holds the csv format
-        # that d3 uses
-        data = d3.from_csv(temp_file, ';', columns=cols)
+        with open(out_file, "w") as out:
+            out.write(_HTML.format(
+                width=IMAGE_WIDTH, height=IMAGE_HEIGHT, script=script,
+                title=html.escape("{} {} in {} frames".format(
+                    tree.total(), self.data_options.weight_units,
+                    len(tree) - 1))))
 
-        # Create the treemap with the supplied display options
-        tmap = d3.TreeMap(id=ids[0:self.display_options.depth],
-                          value=self.data_options.weight_units,
-                          color=self.data_options.weight_units,
-                          legend=True, width=700)
+        return len(tree)  # for testing
 
+    @util.Override(GenericDisplay)
+    @util.log(logger)
+    def show(self):
+        """
+        Displays the input stack as a treemap in the browser.
+
+        """
         temp_display_file = str(file.TempFileName())
-        with open(temp_display_file, "w") as out:
-            out.write(tmap.dump_html(data))
+        self._generate_html(temp_display_file)
 
         username = os.environ['SUDO_USER']
         subprocess.call(["su", "-", "-c", "firefox " +
@@ -5,7 +5,6 @@
 
 """ Tests the flamegraph interface. """
 
-import collections
 import unittest
 from io import StringIO
 from unittest import mock
@@ -59,78 +58,81 @@ class MakeTest(_FlamegraphBaseTest):
         data_io.StackDatum(3, ('A1', 'A2', 'A3'))
     ]
 
-    test_stack_data = data_io.StackData(test_stack_datums, None, None, None,
-                                        data_io.StackData.DataOptions("kb"))
+    def _flamegraph(self, datums, min_width=0.1):
+        fg = object.__new__(flamegraph.Flamegraph)
+        fg.display_options = flamegraph.Flamegraph.DisplayOptions(
+            "hot", min_width)
+        fg.data_options = data_io.StackData.DataOptions("kb")
+        fg.data = data_io.StackData(iter(datums), None, None, None,
+                                    fg.data_options)
+        return fg
+
+    def test_build_tree(self):
+        tree = self._flamegraph(self.test_stack_datums)._build_tree()
+
+        self.assertEqual(6, tree.total())
+        self.assertEqual(["A1", "B1"],
+                         [tree.name(child) for child in tree.children(0)])
+        self.assertEqual(8, len(tree))
+
+    def test_layout(self):
+        """ Test that frames are laid out left to right, by name. """
+        fg = self._flamegraph(self.test_stack_datums)
+        frames, max_depth = fg._layout(fg._build_tree())
+
+        self.assertEqual(4, max_depth)
+        self.assertEqual(
+            [("all", 6, 0, 0), ("A1", 4, 1, 0), ("A2", 4, 2, 0),
+             ("A3", 4, 3, 0), ("B1", 2, 1, 4), ("B2", 2, 2, 4),
+             ("B3", 2, 3, 4), ("B4", 2, 4, 4)],
+            frames)
+
+    def test_prune(self):
+        """ Test that narrow frames are left out with their callees. """
+        datums = [data_io.StackDatum(10000, ('wide', 'callee')),
+                  data_io.StackDatum(1, ('narrow', 'callee'))]
+        fg = self._flamegraph(datums, min_width=1)
+        frames, max_depth = fg._layout(fg._build_tree())
+
+        self.assertEqual(["all", "wide", "callee"],
+                         [frame[0] for frame in frames])
+        self.assertEqual(2, max_depth)
 
-    expected = collections.Counter({('A1', 'A2', 'A3'): 4,
-                                    ('B1', 'B2', 'B3', 'B4'): 2})
-
-    expected_temp_file = "A1;A2;A3 4\n" \
-                         "B1;B2;B3;B4 2\n"
-
-    @mock.patch('marple.display.interface.flamegraph.file')
-    @mock.patch('builtins.open')
-    @mock.patch('marple.display.interface.flamegraph.subprocess')
-    def test_no_options(self, subproc_mock, open_mock, temp_file_mock):
-        """ Test without display options """
-        temp_file_mock.TempFileName.return_value.__str__.return_value = \
-            "test_temp_file"
-
-        fg = flamegraph.Flamegraph(self.test_stack_data)
-
-        context_mock1, context_mock2 = mock.MagicMock(), mock.MagicMock()
-        file_mock1, file_mock2 = StringIO(""), StringIO("")
-        open_mock.side_effect = [context_mock1, context_mock2]
-        context_mock1.__enter__.return_value = file_mock1
-        context_mock2.__enter__.return_value = file_mock2
-
-        actual = fg._make()
-
-        temp_file_mock.TempFileName.return_value.__str__.\
-            assert_has_calls((mock.call(), mock.call()))
-        open_mock.assert_has_calls([
-            mock.call("test_temp_file", "w"),
-            mock.call("test_temp_file", "w")
-        ])
-        self.assertEqual(file_mock1.getvalue(), self.expected_temp_file)
-
-        subproc_mock.Popen.assert_called_once_with(
-            [flamegraph.FLAMEGRAPH_DIR, "--color=hot", "--countname=kb",
-             "test_temp_file"],
-            stdout=file_mock2
-        )
-        self.assertEqual(self.expected, actual)
-
-    @mock.patch('marple.display.interface.flamegraph.file')
     @mock.patch('builtins.open')
-    @mock.patch('marple.display.interface.flamegraph.subprocess')
-    def test_with_coloring(self, subproc_mock, open_mock, temp_file_mock):
-        """ Test with a options """
-        temp_file_mock.TempFileName.return_value.__str__.return_value = \
-            "test_temp_file"
-
-        fg = flamegraph.Flamegraph(self.test_stack_data)
-
-        context_mock1, context_mock2 = mock.MagicMock(), mock.MagicMock()
-        file_mock1, file_mock2 = StringIO(""), StringIO("")
-        open_mock.side_effect = [context_mock1, context_mock2]
-        context_mock1.__enter__.return_value = file_mock1
-        context_mock2.__enter__.return_value = file_mock2
-
-        actual = fg._make()
-
-        temp_file_mock.TempFileName.return_value.__str__.\
-            assert_has_calls((mock.call(), mock.call()))
-        open_mock.assert_has_calls([
-            mock.call("test_temp_file", "w"),
-            mock.call("test_temp_file", "w")
-        ])
-        self.assertEqual(file_mock1.getvalue(), self.expected_temp_file)
-        subproc_mock.Popen.assert_called_once_with(
-            [flamegraph.FLAMEGRAPH_DIR, '--color=hot', '--countname=kb',
-             'test_temp_file'], stdout=file_mock2
-        )
-        self.assertEqual(self.expected, actual)
+    def test_svg(self, open_mock):
+        """ Test writing the frames, with their colours and labels. """
+        datums = [data_io.StackDatum(3, ('main', 'a<b>')),
+                  data_io.StackDatum(1, ('main',))]
+        fg = self._flamegraph(datums)
+        fg.svg_temp_file = "test_svg_file"
+        out = StringIO()
+        open_mock.return_value.__enter__.return_value = out
+
+        self.assertEqual(3, fg._make())
+
+        open_mock.assert_called_once_with(
+            "test_svg_file", "w", buffering=flamegraph.WRITE_BUFFER_SIZE)
+        svg = out.getvalue()
+        self.assertTrue(svg.endswith("</svg>\n"))
+        self.assertEqual(3, svg.count('<g class="func_g"'))
+        self.assertIn("<title>a&lt;b&gt; (3 kb, 75.00%)</title>", svg)
+        self.assertIn('fill="{}"'.format(flamegraph._color("hot", "main")),
+                      svg)
+        # Javascript for zooming and searching is embedded
+        self.assertIn("function zoom(node)", svg)
+        self.assertIn("function search(term)", svg)
+
+    def test_colors(self):
+        """ Test the palettes of flamegraph.pl. """
+        self.assertEqual(flamegraph._color("hot", "func"),
+                         flamegraph._color("hot", "func"))
+        red, green, _ = map(int, flamegraph._color("hot", "func")[4:-1]
+                            .split(","))
+        self.assertGreaterEqual(red, 205)
+        # Kernel frames of Java profiles are orange
+        self.assertTrue(flamegraph._color("java", "vfs_read_[k]")
+                        .endswith(",0)"))
+        self.assertEqual("rgb(0,0,0)", flamegraph._color("unknown", "func"))
 
 
 class ShowTest(_FlamegraphBaseTest):
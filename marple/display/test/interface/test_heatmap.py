@@ -8,6 +8,8 @@
 import unittest
 from unittest import mock
 
+import numpy as np
+
 from marple.common import data_io
 from marple.display.interface import heatmap
 
@@ -66,12 +68,13 @@ class GetDataTest(_BaseHeatMapTest):
         hm = object.__new__(heatmap.HeatMap)
 
         # Test that correct data is produced
-        x, y = hm._get_data((
+        x, y, weights = hm._get_data((
             data_io.PointDatum(1.0, 2.0, 'info1'),
             data_io.PointDatum(3.0, 4.0, 'info2')),
             normalised=False)
-        self.assertEqual(x, [1.0, 3.0])
-        self.assertEqual(y, [2.0, 4.0])
+        self.assertEqual(x.tolist(), [1.0, 3.0])
+        self.assertEqual(y.tolist(), [2.0, 4.0])
+        self.assertIsNone(weights)
 
     def test_simple_time_data(self):
         """
@@ -83,12 +86,31 @@ class GetDataTest(_BaseHeatMapTest):
         hm = object.__new__(heatmap.HeatMap)
 
         # Test that correct data is produced
-        x, y = hm._get_data((
+        x, y, weights = hm._get_data((
             data_io.PointDatum(1.0, 2.0, 'info1'),
             data_io.PointDatum(3.0, 4.0, 'info2')),
             normalised=True)
-        self.assertEqual(x, [0.0, 2.0])
-        self.assertEqual(y, [2.0, 4.0])
+        self.assertEqual(x.tolist(), [0.0, 2.0])
+        self.assertEqual(y.tolist(), [2.0, 4.0])
+        self.assertIsNone(weights)
+
+    def test_weighted_data(self):
+        """
+        Ensure HeatMap._get_data() method keeps the weights of histogram
+        datapoints.
+
+        """
+        # Create blank heatmap object to access methods
+        hm = object.__new__(heatmap.HeatMap)
+
+        # Test that correct data is produced
+        x, y, weights = hm._get_data((
+            data_io.PointDatum(1.0, 2.0, 'info1', 10),
+            data_io.PointDatum(3.0, 4.0, 'info2')),
+            normalised=False)
+        self.assertEqual(x.tolist(), [1.0, 3.0])
+        self.assertEqual(y.tolist(), [2.0, 4.0])
+        self.assertEqual(weights.tolist(), [10, 1])
 
 
 class GetDataStatsTest(_BaseHeatMapTest):
@@ -102,11 +124,144 @@ class GetDataStatsTest(_BaseHeatMapTest):
         hm = object.__new__(heatmap.HeatMap)
         hm.x_data = self.test_x_data
         hm.y_data = self.test_y_data
+        hm.weights = None
         hm.params = self.test_params
 
         actual = hm._get_data_stats()
         self.assertEqual(self.test_comps, actual)
 
+    def test_weighted_median(self):
+        """
+        Ensure HeatMap._get_data_stats() takes the median over the weights.
+
+        """
+        hm = object.__new__(heatmap.HeatMap)
+        hm.x_data = self.test_x_data
+        hm.y_data = self.test_y_data
+        hm.weights = [1, 1, 1, 1, 10]
+        hm.params = self.test_params
+
+        actual = hm._get_data_stats()
+        self.assertEqual(10.0, actual.y_median)
+
+    def test_bin_budget(self):
+        """
+        Ensure HeatMap._get_data_stats() keeps the number of bins within the
+        budget, however wide the range of x values.
+
+        """
+        hm = object.__new__(heatmap.HeatMap)
+        hm.x_data = [0.0, 0.0, 1e12]
+        hm.y_data = [1.0, 1.0, 2.0]
+        hm.weights = None
+        hm.params = heatmap.GraphParameters(10, 10, 8, max_bins=10000)
+
+        actual = hm._get_data_stats()
+        self.assertEqual(16, actual.y_bins)
+        self.assertEqual(625, actual.x_bins)
+        self.assertEqual(1.6e9, actual.x_bin_size)
+
+    def test_log_y(self):
+        """
+        Ensure HeatMap._get_data_stats() gives y_res log-scale bins per factor
+        of ten.
+
+        """
+        hm = object.__new__(heatmap.HeatMap)
+        hm.x_data = [0.0, 1.0]
+        hm.y_data = [1.0, 1000.0]
+        hm.weights = None
+        hm.params = heatmap.GraphParameters(10, 10, 5, log_y=True)
+
+        actual = hm._get_data_stats()
+        self.assertEqual(15, actual.y_bins)
+        self.assertAlmostEqual(10 ** 0.2, actual.y_bin_size)
+
+
+class HistogramTest(_BaseHeatMapTest):
+    def _heatmap(self, x_data, y_data, weights=None, log_y=False):
+        hm = object.__new__(heatmap.HeatMap)
+        hm.x_data = np.array(x_data)
+        hm.y_data = np.array(y_data)
+        hm.weights = None if weights is None else np.array(weights)
+        hm.params = heatmap.GraphParameters(1, 2, 1, log_y=log_y)
+        hm.data_stats = hm._get_data_stats()
+        hm.x_edges, hm.y_edges = hm._get_bin_edges()
+        return hm
+
+    def test_histogram(self):
+        """
+        Ensure HeatMap._histogram() counts weighted datapoints in their bins,
+        as numpy.histogram2d would.
+
+        """
+        x_data, y_data = [0.0, 0.5, 1.0, 1.0], [1.0, 1.0, 1.5, 2.0]
+        hm = self._heatmap(x_data, y_data, weights=[1, 2, 3, 4])
+
+        expected, x_edges, y_edges = np.histogram2d(
+            x_data, y_data, bins=(hm.x_edges, hm.y_edges),
+            weights=[1, 2, 3, 4])
+        np.testing.assert_array_equal(expected, hm._histogram())
+        self.assertEqual(10, hm._histogram().sum())
+
+    def test_pyramid(self):
+        """
+        Ensure HeatMap._build_pyramid() merges pairs of x bins, level by
+        level.
+
+        """
+        counts = np.arange(10).reshape(5, 2)
+        pyramid = heatmap.HeatMap._build_pyramid(counts)
+
+        self.assertEqual([5, 3, 2, 1], [len(level) for level in pyramid])
+        np.testing.assert_array_equal([[2, 4], [10, 12], [8, 9]],
+                                      pyramid[1])
+        np.testing.assert_array_equal([[20, 25]], pyramid[-1])
+
+    def _windowed(self):
+        """ :return: A heat map of 1000 points, 1/256 apart, in 4 x bins. """
+        hm = self._heatmap(np.arange(1000.0) / 256, np.ones(1000))
+        hm.pyramid = hm._build_pyramid(hm._histogram())
+        return hm
+
+    def test_window_coarse(self):
+        """
+        Ensure HeatMap._window_histogram() takes wide views from the pyramid.
+
+        """
+        hm = self._windowed()
+        hm.params = heatmap.GraphParameters(1, 0.5, 1)
+
+        counts, edges = hm._window_histogram(0.0, 999 / 256)
+
+        self.assertEqual(3, len(hm.pyramid))
+        self.assertEqual([[1000]], counts.tolist())
+        np.testing.assert_allclose([0.0, 999 / 256], edges)
+
+    def test_window_fine(self):
+        """
+        Ensure HeatMap._window_histogram() re-bins the points of narrow views.
+
+        """
+        hm = self._windowed()
+
+        counts, edges = hm._window_histogram(128 / 256, 132 / 256)
+
+        # 4 bins (2 * scale * figure size) of a point each, the point at the
+        # upper bound falling in the last
+        self.assertEqual([[1], [1], [1], [2]], counts.tolist())
+        np.testing.assert_allclose(np.arange(128, 133) / 256, edges)
+
+    def test_log_histogram(self):
+        """
+        Ensure HeatMap._histogram() bins y values on a log scale.
+
+        """
+        hm = self._heatmap([0.0, 1.0, 1.0], [1.0, 10.0, 100.0], log_y=True)
+
+        np.testing.assert_allclose([1.0, 10.0, 100.0], hm.y_edges)
+        np.testing.assert_array_equal([[1, 0], [0, 2]], hm._histogram())
+
 
 class SetAxesLimitsTest(_BaseHeatMapTest):
     def test_set_malformed_axes_limits(self):
@@ -163,11 +318,10 @@ class SetAxesLimitsTest(_BaseHeatMapTest):
 
 
 class InitTest(_BaseHeatMapTest):
-    @mock.patch('marple.display.interface.heatmap.np')
     @mock.patch('marple.display.interface.heatmap.plt')
     @mock.patch('marple.display.interface.heatmap.widgets.Slider')
     @mock.patch('marple.display.interface.heatmap.config')
-    def test_init(self, config_mock, slider_mock, pyplot_mock, numpy_mock):
+    def test_init(self, config_mock, slider_mock, pyplot_mock):
         """
         Test the __init__ method of the HeatMap class - stub out all external
         methods, and ensure correct API calls are made.
@@ -181,33 +335,24 @@ class InitTest(_BaseHeatMapTest):
             Mock class for the matplotlib.widgets.Slider class.
         :param pyplot_mock:
             Mock class for the matplotlib.pyplot package
-        :param numpy_mock:
-            Mock class for the numpy package.
 
         """
         # Create pyplot mocks
         axes_mock = pyplot_mock.gca.return_value
         fig_mock = pyplot_mock.gcf.return_value
         image_mock = axes_mock.imshow.return_value
+        axes_mock.get_xlim.return_value = (1.0, 5.0)
         xslide_mock, yslide_mock = mock.MagicMock(), mock.MagicMock()
         pyplot_mock.axes.side_effect = [xslide_mock, yslide_mock]
 
-        # Create numpy mocks
-        median_item = mock.MagicMock()
-        median_item.item.return_value = 8.0
-        numpy_mock.median.return_value = median_item
-        hm_mock, xedges_mock, yedges_mock = \
-            mock.MagicMock(), mock.MagicMock(), mock.MagicMock()
-        numpy_mock.histogram2d.return_value = \
-            (hm_mock, xedges_mock, yedges_mock)
-
         # Create slider mocks
         xslide_pos_mock, yslide_pos_mock = mock.MagicMock(), mock.MagicMock()
         slider_mock.side_effect = [xslide_pos_mock, yslide_pos_mock]
 
         # Create config mocks
         config_mock.get_option_from_section.side_effect = \
-            [10.0, 10.0, 8.0, False] # fig_size, scale, y_res, normalise
+            [10.0, 10.0, 8.0, 4000000, False, False]
+        # fig_size, scale, y_res, max_bins, log_y, normalise
 
         # RUN TRHOUGH INIT - CHECK VALUES/FUNCTION CALLS ARE AS EXPECTED
         hm = heatmap.HeatMap(self.test_data_obj)
@@ -217,8 +362,8 @@ class InitTest(_BaseHeatMapTest):
         self.assertEqual(hm.params, self.test_params)
 
         # Check _get_data()
-        self.assertEqual(hm.x_data, self.test_x_data)
-        self.assertEqual(hm.y_data, self.test_y_data)
+        self.assertEqual(hm.x_data.tolist(), self.test_x_data)
+        self.assertEqual(hm.y_data.tolist(), self.test_y_data)
 
         # Check _get_data_stats()
         self.assertEqual(hm.data_stats, self.test_comps)
@@ -237,17 +382,23 @@ class InitTest(_BaseHeatMapTest):
         self.assertEqual(fig_mock, hm.figure)
 
         # Check _plot_histogram()
-        numpy_mock.histogram2d.assert_called_once_with(
-            self.test_x_data, self.test_y_data, bins=(self.test_comps.x_bins,
-                                                      self.test_comps.y_bins))
+        self.assertEqual(8, len(hm.pyramid))
+        self.assertEqual((200, 10), hm.heatmap.shape)
+        self.assertEqual(5, hm.heatmap.sum())
         axes_mock.imshow.assert_called_once_with(
-            hm_mock.T, cmap="OrRd",
-            extent=[xedges_mock[0], xedges_mock[-1],
-                    yedges_mock[0], yedges_mock[-1]],
+            mock.ANY, cmap="OrRd", extent=[1.0, 5.0, 6.0, 10.0],
             origin="lower", aspect="auto")
-        self.assertEqual(hm_mock, hm.heatmap)
+        np.testing.assert_array_equal(hm.heatmap.T,
+                                      axes_mock.imshow.call_args[0][0])
         self.assertEqual(image_mock, hm.image)
 
+        # Check _show_window()
+        image_mock.set_extent.assert_called_once_with([1.0, 5.0, 6.0, 10.0])
+        self.assertEqual(1, hm.generation)
+        image_mock.set_clim.assert_called_once_with(0, 1)
+        axes_mock.callbacks.connect.assert_called_once_with("xlim_changed",
+                                                            mock.ANY)
+
         # Check viewport position
         self.assertEqual(hm.pos, heatmap.HeatMap._ViewportPosition(
              self.test_comps.x_delta, self.test_comps.y_delta))
@@ -286,7 +437,92 @@ class InitTest(_BaseHeatMapTest):
         # Check _add_annotations()
         axes_mock.annotate.assert_called_once_with(
             "", xy=(0, 0), xytext=(5, 7), xycoords="data",
-            textcoords="offset points", bbox=dict(boxstyle="square"))
+            textcoords="offset points", bbox=dict(boxstyle="square"),
+            animated=True)
         annot_mock = axes_mock.annotate.return_value
         annot_mock.set_visible.assert_called_once_with(False)
-        fig_mock.canvas.mpl_connect.assert_called_once()
+        self.assertEqual(
+            ["draw_event", "motion_notify_event"],
+            [call[0][0] for call in fig_mock.canvas.mpl_connect.call_args_list])
+
+
+class HoverTest(_BaseHeatMapTest):
+    """ Test the blitted hover annotations. """
+
+    def setUp(self):
+        super().setUp()
+        self.hm = object.__new__(heatmap.HeatMap)
+        self.hm.axes = mock.MagicMock()
+        self.hm.figure = mock.MagicMock()
+        self.hm.labels = self.test_labels
+        self.hm.data_stats = self.test_comps._replace(y_bins=2)
+        self.hm.view_x_edges = np.array([0.0, 1.0, 2.0])
+        self.hm.y_edges = np.array([0.0, 1.0, 2.0])
+        self.hm.heatmap = np.array([[1, 2], [3, 4]])
+        self.hm.generation = 0
+        self.hm.background = None
+        self.hm.annotated_bin = None
+        self.canvas = self.hm.figure.canvas
+        self.canvas.supports_blit = True
+
+        self.hm._add_annotations()
+        self.annot = self.hm.axes.annotate.return_value
+        self.annot.get_visible.return_value = True
+        callbacks = dict(call[0] for call in
+                         self.canvas.mpl_connect.call_args_list)
+        self.on_draw = callbacks["draw_event"]
+        self.hover = callbacks["motion_notify_event"]
+
+    def _event(self, x, y):
+        return mock.Mock(inaxes=self.hm.axes, xdata=x, ydata=y)
+
+    def test_blit(self):
+        """ Test that only the annotation is drawn, over the background. """
+        self.on_draw(None)
+        self.hover(self._event(1.5, 0.5))
+
+        self.canvas.restore_region.assert_called_once_with(
+            self.canvas.copy_from_bbox.return_value)
+        self.canvas.blit.assert_called_once_with(self.hm.figure.bbox)
+        self.canvas.draw_idle.assert_not_called()
+        self.assertIn("Count: 3", self.annot.set_text.call_args[0][0])
+
+    def test_same_bin(self):
+        """ Test that moving within a bin draws nothing. """
+        self.on_draw(None)
+        self.hover(self._event(1.5, 0.5))
+        self.hover(self._event(1.7, 0.2))
+        self.hover(self._event(0.5, 0.2))
+
+        self.assertEqual(2, self.canvas.blit.call_count)
+        self.assertEqual(2, self.annot.set_text.call_count)
+
+    def test_new_heatmap(self):
+        """ Test that the same bin is annotated again in a new heatmap. """
+        self.on_draw(None)
+        self.hover(self._event(1.5, 0.5))
+        # A new array may reuse the memory, and so the id, of the old one
+        self.hm.heatmap[1, 0] = 5
+        self.hm.generation += 1
+        self.hover(self._event(1.5, 0.5))
+
+        self.assertEqual(2, self.annot.set_text.call_count)
+        self.assertIn("Count: 5", self.annot.set_text.call_args[0][0])
+
+    def test_leave(self):
+        """ Test that the annotation is hidden on leaving the axes. """
+        self.on_draw(None)
+        self.hover(self._event(1.5, 0.5))
+        self.hover(mock.Mock(inaxes=None))
+
+        self.annot.set_visible.assert_called_with(False)
+        self.assertEqual(2, self.canvas.blit.call_count)
+
+    def test_no_blit(self):
+        """ Test falling back to full draws without blitting. """
+        self.canvas.supports_blit = False
+        self.on_draw(None)
+        self.hover(self._event(1.5, 0.5))
+
+        self.canvas.blit.assert_not_called()
+        self.canvas.draw_idle.assert_called_once_with()
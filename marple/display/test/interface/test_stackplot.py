@@ -0,0 +1,94 @@
+# -------------------------------------------------------------
+# test_stackplot.py - test module for the stackplot interface
+# October 2018
+# -------------------------------------------------------------
+
+""" Tests the construction of stackplots. """
+
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from marple.common import data_io
+from marple.display.interface import stackplot
+
+
+class StackPlotTest(unittest.TestCase):
+    """ Test pivoting the datapoints and picking the top labels. """
+
+    datapoints = (
+        data_io.PointDatum(2.0, 1.0, "a"),
+        data_io.PointDatum(1.0, 5.0, "b"),
+        data_io.PointDatum(1.0, 3.0, "a"),
+        data_io.PointDatum(2.0, 4.0, "c"),
+        data_io.PointDatum(1.0, 1.0, "c"),
+        data_io.PointDatum(1.0, 1.0, "c"),
+    )
+
+    @mock.patch('marple.display.interface.stackplot.config')
+    def _stackplot(self, top, top_by, config_mock):
+        config_mock.get_option_from_section.side_effect = [top, top_by]
+        data = data_io.PointData(iter(self.datapoints), None, None, None)
+        return stackplot.StackPlot(data)
+
+    def test_pivot(self):
+        x_values, matrix, labels = stackplot.StackPlot._pivot(
+            self.datapoints)
+
+        self.assertEqual([1.0, 2.0], x_values.tolist())
+        self.assertEqual(["a", "b", "c"], labels)
+        # The values of "c" at x = 1 are added together
+        self.assertEqual([[3.0, 1.0], [5.0, 0.0], [2.0, 4.0]],
+                         matrix.tolist())
+
+    def test_top_by_step(self):
+        """ Test that labels in the top at any x are shown. """
+        plot = self._stackplot(1, "step")
+
+        self.assertEqual(["other", "c", "b"], plot.labels)
+        self.assertEqual([1.0, 2.0], plot.x_values.tolist())
+        # "c" is not in the top at x = 1, so counts as other there
+        np.testing.assert_array_equal([[5.0, 1.0], [0.0, 4.0], [5.0, 0.0]],
+                                      plot.y_values)
+
+    def test_top_by_step_zeros(self):
+        """ Test that labels with no value are never in the top. """
+        matrix = np.array([[0.0, 0.0], [0.0, 0.0], [3.0, 0.0], [5.0, 0.0],
+                           [0.0, 4.0]])
+        options = stackplot.StackPlot.DisplayOptions(2, "step")
+
+        shown, values = stackplot.StackPlot._top(matrix, options)
+
+        # Only the last label has a value at x = 2
+        self.assertEqual([2, 3, 4], shown.tolist())
+        np.testing.assert_array_equal(matrix[2:], values)
+
+    def test_top_by_total(self):
+        """ Test that the labels with the top totals are shown. """
+        plot = self._stackplot(2, "total")
+
+        self.assertEqual(["other", "c", "b"], plot.labels)
+        np.testing.assert_array_equal([[3.0, 1.0], [2.0, 4.0], [5.0, 0.0]],
+                                      plot.y_values)
+
+    def test_all_shown(self):
+        plot = self._stackplot(5, "step")
+
+        self.assertEqual(["other", "c", "b", "a"], plot.labels)
+        np.testing.assert_array_equal([0.0, 0.0], plot.y_values[0])
+
+    def test_visible_points(self):
+        """ Test that the visible range is downsampled by its total. """
+        plot = object.__new__(stackplot.StackPlot)
+        plot.x_values = np.arange(20.0)
+        plot.y_values = np.vstack((np.ones(20), np.arange(20.0) % 3))
+
+        x_values, y_values = plot._visible_points(5.5, 14.5, 2)
+
+        # The points either side of the range are kept, as are the extremes
+        self.assertEqual([5.0, 6.0, 11.0, 12.0, 15.0],
+                         x_values.tolist())
+        self.assertEqual((2, 5), y_values.shape)
+        self.assertEqual([2.0, 0.0, 2.0, 0.0, 0.0],
+                         y_values[1].tolist())
@@ -1,9 +1,10 @@
+import json
 import os
 import shutil
 import unittest
 from unittest import mock
 
-from marple.common import data_io, consts
+from marple.common import calltree, data_io
 from marple.display.interface import treemap
 
 
@@ -29,98 +30,111 @@ class TreemapTest(unittest.TestCase):
         """Per-test tear-down"""
         shutil.rmtree(self._TEST_DIR)
 
-    def _get_output(self, data):
-        csv = self._TEST_DIR + "csv"
-
-        self.tmap.data = data
-        self.tmap._generate_csv(csv)
-
-        with open(csv, "r") as file_:
-            return file_.read()
-
-    def test_create_treemap_csv_multidigit(self):
+    def _get_json(self, datums, depth=25, max_nodes=5000):
+        self.tmap.display_options = treemap.Treemap.DisplayOptions(
+            depth, max_nodes)
+        self.tmap.data = data_io.StackData(iter(datums), None, None, None,
+                                           None)
+        try:
+            return self.tmap._to_json(self.tmap._build_tree())
+        finally:
+            self.tmap.display_options = treemap.Treemap.DisplayOptions(25)
+
+    def test_json(self):
         """
-        Tests multidigit weight values
+        Tests that stacks are merged into nested nodes
 
         """
-        # The expected output
-        expected = self.tmap.data_options.weight_units + ";" + \
-                   ';'.join([str(i) for i in
-                             range(1, self.tmap.display_options.depth + 1)]) + \
-                   '\n' + \
-                   "1;pname;call1;call2\n" \
-                   "2;pname;call3;call4\n"
-
-        # Get the output from a collapsed stack (first line in inpt is the
-        # empty header
-        datum_generator = (
+        datums = (
             data_io.StackDatum(1, ('pname', 'call1', 'call2')),
-            data_io.StackDatum(2, ('pname', 'call3', 'call4'))
+            data_io.StackDatum(2, ('pname', 'call3')),
+            data_io.StackDatum(3, ('pname', 'call1', 'call2'))
         )
 
-        data = data_io.StackData(datum_generator, None, None, None, None)
+        self.assertEqual(
+            {"n": "all", "v": 6, "c": [
+                {"n": "pname", "v": 6, "c": [
+                    {"n": "call1", "v": 4, "c": [{"n": "call2", "v": 4}]},
+                    {"n": "call3", "v": 2}]}]},
+            self._get_json(datums))
 
-        outpt = self._get_output(data)
-
-        # Check that we got the desired output
-        self.assertEqual(expected, outpt)
-
-    def test_create_treemap_csv_different_stack_lengths(self):
+    def test_json_other(self):
         """
-        Again, tests multidigit weights, now with bigger input
+        Tests that the weight cut by the depth and the node budget is shown
+        as [other] nodes
 
         """
-        # The expected output
-        expected = self.tmap.data_options.weight_units + ";" + \
-                   ';'.join([str(i) for i in
-                             range(1, self.tmap.display_options.depth + 1)]) + \
-                   '\n' + \
-                   "1;pname;call1;call2;call3\n" \
-                   "2;pname;call1\n" \
-                   "3;pname;call1;call2\n"
-
-        data = iter(("00000" + consts.field_separator
-                     + "pname;call1;call2;call3;call4;call5\n",
-                     "000000000" + consts.field_separator + "pname;call1;call2\n",
-                     "000" + consts.field_separator + "pname;call1;call2;call3"))
-        datum_generator = (
-            data_io.StackDatum(1, ('pname', 'call1', 'call2', 'call3')),
-            data_io.StackDatum(2, ('pname', 'call1')),
-            data_io.StackDatum(3, ('pname', 'call1', 'call2'))
+        datums = (
+            data_io.StackDatum(1, ('pname', 'call1', 'call2')),
+            data_io.StackDatum(2, ('pname', 'call3')),
+            data_io.StackDatum(5, ('pname',))
         )
 
-        data = data_io.StackData(datum_generator, None, None, None, None)
+        self.assertEqual(
+            {"n": "all", "v": 8, "c": [
+                {"n": "pname", "v": 8, "c": [
+                    {"n": "call3", "v": 2},
+                    {"n": treemap.OTHER, "v": 6}]}]},
+            self._get_json(datums, depth=2, max_nodes=2))
 
-        out = self._get_output(data)
+    def test_generate_html(self):
+        """
+        Tests that the page embeds the tree, and loads nothing from the network
 
-        # Check that we got the desired output
-        self.assertEqual(expected, out)
+        """
+        page = self._TEST_DIR + "treemap.html"
+        self.tmap.data = data_io.StackData(
+            iter((data_io.StackDatum(1, ('pname', '</script>')),)),
+            None, None, None, None)
+
+        self.assertEqual(3, self.tmap._generate_html(page))
+
+        with open(page) as file_:
+            html = file_.read()
+        self.assertNotIn("http", html)
+        self.assertNotIn("</script>\"", html)
+        self.assertEqual(1, html.count("</script>"))
+        data = html[html.index("var data = ") + 11:
+                    html.index(", units")].replace("<\\/", "</")
+        self.assertEqual("</script>", json.loads(data)["c"][0]["c"][0]["n"])
 
-    @mock.patch("builtins.open")
     @mock.patch("os.environ")
-    @mock.patch("marple.display.interface.treemap.Treemap._generate_csv")
-    @mock.patch("marple.display.tools.d3plus.d3IpyPlus.from_csv", return_value="")
-    @mock.patch("subprocess.Popen")
-    @mock.patch("marple.display.tools.d3plus.d3IpyPlus.TreeMap.dump_html",
-                return_value="")
-    def test_show_function(self, mock_dump, mock_popen, mock_from_csv,
-                           mock_gen_csv, os_mock, mock_open):
+    @mock.patch("marple.display.interface.treemap.Treemap._generate_html")
+    @mock.patch("marple.display.interface.treemap.file")
+    @mock.patch("subprocess.call")
+    def test_show_function(self, mock_call, file_mock, mock_gen_html,
+                           os_mock):
         """
-        Tests the right parameters for various functions used by the show
-        function
+        Tests that the page is generated and opened in the browser
 
-        :param mock_dump: mock for dump_html
-        :param mock_popen: mock for popen
-        :param mock_from_csv: mock for csv
-        :param mock_gen_csv: mock for _generate_csv
+        :param mock_call: mock for subprocess.call
+        :param file_mock: mock for the file module
+        :param mock_gen_html: mock for _generate_html
         :param os_mock: mock for environ
         :return:
         # """
+        file_mock.TempFileName.return_value = "test_page"
+        os_mock.__getitem__.return_value = "test_user"
+
         self.tmap.show()
 
-        # Right columns, also implies right ids (since they are the same
-        # but without the 'value' field
-        self.assertEqual(mock_from_csv.call_args[1]['columns'],
-                         [self.tmap.data_options.weight_units] +
-                         [str(x) for x in
-                          range(1, self.tmap.display_options.depth + 1)])
+        mock_gen_html.assert_called_once_with("test_page")
+        mock_call.assert_called_once_with(
+            ["su", "-", "-c", "firefox test_page", "test_user"])
+
+    def test_pruned_tree(self):
+        """
+        Tests that the tree is cut to the node budget
+
+        """
+        self.tmap.display_options = treemap.Treemap.DisplayOptions(25, 1)
+        self.tmap.data = data_io.StackData(
+            iter((data_io.StackDatum(1, ('a', 'b', 'c')),)),
+            None, None, None, None)
+        try:
+            tree = self.tmap._build_tree()
+        finally:
+            self.tmap.display_options = treemap.Treemap.DisplayOptions(25)
+
+        self.assertIsInstance(tree, calltree.CallTree)
+        self.assertEqual(2, len(tree))
@@ -8,21 +8,41 @@ Saves data objects into a file.
 
 Gets the data that was collected by an interface module and converted into
 formatted objects and writes them into a file that was provided by the user.
+The track and label of each event are worked out once, the string table is
+built up in a `bytearray`, and the event entries are packed into big-endian
+NumPy structured arrays.
+G2 needs the events in time order, which the input need not be in, so the
+entries are sorted in runs of at most :data:`RUN_SIZE` events; if there is
+more than one run, each is spilled to a temporary file, and the runs are
+merged into the event section a block at a time, so that the memory used does
+not grow with the number of events. The temporary files are deleted by
+:meth:`CpelWriter.close`, which the writer calls when used as a context
+manager.
 
 """
 __all__ = (
     'CpelWriter',
 )
 
+import array
 import logging
 import struct
+import tempfile
 from datetime import datetime
 
+import numpy as np
+
 from marple.common import util
 
 logger = logging.getLogger(__name__)
 logger.debug('Entered module: %s', __name__)
 
+# The number of events sorted in memory at a time (20 bytes each)
+RUN_SIZE = 1 << 20
+
+# The number of events read from all the runs at a time when merging them
+MERGE_BUFFER_SIZE = 1 << 20
+
 
 class CpelWriter:
     """A class that takes event data and converts it to a CPEL file."""
@@ -40,6 +60,11 @@ class CpelWriter:
     #     name, 4 for length info and for the event section, 4 for ticks per us.
     _SECTION_HEADER_LENGTHS = {1: 0, 2: 68, 3: 68, 4: 68, 5: 72}
 
+    # _EVENT_ENTRY: the layout of an entry in the event section (20b).
+    _EVENT_ENTRY = np.dtype([("time_high", ">u4"), ("time_low", ">u4"),
+                             ("track", ">u4"), ("event_code", ">u4"),
+                             ("event_datum", ">u4")])
+
     def __init__(self, event_objects, track):
         """
         Initialise the input data and read in the data
@@ -63,14 +88,12 @@ class CpelWriter:
 
         # Create attributes for string section data
         self.string_table = {}
-        self._string_resource = ""
+        self._string_resource = bytearray()
         short_table_name = self._FILE_STRING_TABLE_NAME.rstrip("\x00")
         self.string_table[short_table_name] = 0
-        self._string_resource += short_table_name
+        self._string_resource += short_table_name.encode("ascii")
         self.section_length[1] = len(short_table_name)
-        self.string_table["%s"] = self.section_length[1] + 1
-        self._string_resource += ("\x00" + "%s")
-        self.section_length[1] += (len("%s") + 1)
+        self._insert_string("%s")
 
         # Dict for symbol table section
         self.symbol_table = {}
@@ -85,14 +108,40 @@ class CpelWriter:
         self.track_definitions_dict = {}
         self.track_def_index = 0
 
-        # List of events for event section
-        self.event_data = []
+        # Structured array of the entries for the event section, sorted by
+        #   time, unless there were too many to keep in memory
+        self.event_data = np.empty(0, dtype=self._EVENT_ENTRY)
+        # The temporary files of the sorted runs of entries, if any, with the
+        #   number of entries in each
+        self._runs = []
+        self.no_of_events = 0
 
         # Int counting the number of sections in the file
         self.no_of_sections = 0
 
         # fill the above data structures with data from event input.
-        self._collect()
+        try:
+            self._collect()
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        """ Context manager for the writer. """
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """ Delete the temporary files, see :meth:`close`. """
+        self.close()
+
+    def close(self):
+        """
+        Closes the temporary files of the runs of entries, deleting them.
+
+        """
+        for run_file, _ in self._runs:
+            run_file.close()
+        self._runs = []
 
     def _decide_track_label(self, event_object):
         """
@@ -125,23 +174,11 @@ class CpelWriter:
 
         """
         if string_key not in self.string_table:
+            encoded = string_key.encode("ascii")
             self.string_table[string_key] = self.section_length[1] + 1
-            self.section_length[1] += (len(string_key) + 1)
-            self._string_resource += ("\x00" + string_key)
-
-    def _insert_object_strings(self, event_object):
-        """
-        Puts the string resources of the event object into the string table.
-
-        :param event_object:
-            A reference to the currently processed event object.
-
-        """
-        # insert datum, track, event_type (not time)
-        track, label = self._decide_track_label(event_object)
-        self._insert_string(label)
-        self._insert_string(track)
-        self._insert_string(event_object.type)
+            self.section_length[1] += (len(encoded) + 1)
+            self._string_resource += b"\x00"
+            self._string_resource += encoded
 
     def _insert_object_symbols(self, event_object):
         """
@@ -152,82 +189,208 @@ class CpelWriter:
         """
         raise NotImplementedError("Method insert symbols not implemented.")
 
-    def _insert_object_event_def(self, event_object):
+    def _insert_event_def(self, event_type):
         """
-        Puts the event into the event definition attribute.
+        Puts the event type into the event definition attribute.
 
-        :param event_object:
-            A reference to the currently processed event object.
+        :param event_type:
+            The type of the currently processed event object.
+        :return:
+            The event code of the event type.
 
         """
         # event_code event_offset datum_offset (4 bytes each)
-        if event_object.type not in self.event_definitions_dict:
-            self.event_definitions_dict[event_object.type] = \
-                self.event_def_index
+        if event_type not in self.event_definitions_dict:
+            self.event_definitions_dict[event_type] = self.event_def_index
             self.event_def_index += 1
 
             # add 3 x 4 = 12 (bytes) to the obj def section length
             self.section_length[3] += 12
+        return self.event_definitions_dict[event_type]
 
-    def _insert_object_track_def(self, event_object):
+    def _insert_track_def(self, track):
         """
         Puts the track into the track definition attribute.
 
-        :param event_object:
-            A reference to the currently processed event object.
+        :param track:
+            The track of the currently processed event object.
+        :return:
+            The id of the track.
 
         """
         # track_id track_format_offset (4 bytes each)
-
-        track, _ = self._decide_track_label(event_object)
         if track not in self.track_definitions_dict:
-            self.track_definitions_dict[track] = \
-                self.track_def_index
+            self.track_definitions_dict[track] = self.track_def_index
             self.track_def_index += 1
 
             # add 2 x 4 = 8 (bytes) to the track def section length
             self.section_length[4] += 8
+        return self.track_definitions_dict[track]
 
-    def _insert_object_event_data(self, event_object):
+    def _collect(self):
         """
-        Puts event data into the event attribute.
+        Processes the data and puts it into data structures.
 
-        :param event_object:
-            A reference to the currently processed event object.
-                time: string("d+.d+")
+        """
+        strings = self.string_table
+        event_codes = self.event_definitions_dict
+        track_ids = self.track_definitions_dict
 
+        # time (from object), then track_id (from track_def_dict) event_code
+        #   (from event_def_dict) event_datum (from string table) per event
+        times = array.array("Q")
+        entries = array.array("I")
+        for event_object in self.event_objects:
+            track, label = self._decide_track_label(event_object)
+            event_type = event_object.type
+
+            # insert datum, track, event_type (not time)
+            for string in (label, track, event_type):
+                if string not in strings:
+                    self._insert_string(string)
+            # self._insert_object_symbols(event_object)
+            event_code = event_codes.get(event_type)
+            if event_code is None:
+                event_code = self._insert_event_def(event_type)
+            track_id = track_ids.get(track)
+            if track_id is None:
+                track_id = self._insert_track_def(track)
+
+            times.append(event_object.time)
+            entries.extend((track_id, event_code, strings[label]))
+            if len(times) == RUN_SIZE:
+                self._spill(self._sort_run(times, entries))
+                times = array.array("Q")
+                entries = array.array("I")
+
+        self.event_data = self._sort_run(times, entries)
+        if self._runs:
+            self._spill(self.event_data)
+            self.event_data = np.empty(0, dtype=self._EVENT_ENTRY)
+        else:
+            self.no_of_events = len(self.event_data)
+
+        # add 5 x 4 = 20 (bytes) per event to the event data section length
+        self.section_length[5] += self._EVENT_ENTRY.itemsize * \
+            self.no_of_events
+
+        # strings, event definitions, track definitions and events
+        self.no_of_sections += 4
+
+    def _sort_run(self, times, entries):
         """
-        # time,time (from object) track_id (from track_def_dict) event_code (
-        #   from event_def_dict) event_datum (from string table) (4 bytes each)
+        Packs a run of event entries, sorted by time.
 
-        track, label = self._decide_track_label(event_object)
-        self.event_data.append(
-            (event_object.time,
-             self.track_definitions_dict[track],
-             self.event_definitions_dict[event_object.type],
-             self.string_table[label])
-        )
+        :param times:
+            An array of the times of the events.
+        :param entries:
+            An array of the track id, event code and event datum of each
+            event, one after the other.
+        :return:
+            A structured array of the entries, in time order, with events at
+            the same time kept in the order they came in.
 
-        # add 5 x 4 = 20 (bytes) to the event data section length
-        self.section_length[5] += 20
+        """
+        times = np.frombuffer(times, dtype=np.ulonglong)
+        entries = np.frombuffer(entries, dtype=np.uintc).reshape(-1, 3)
+        order = np.argsort(times, kind="mergesort")
 
-    def _collect(self):
+        run = np.empty(len(times), dtype=self._EVENT_ENTRY)
+        run["time_high"], run["time_low"] = self._convert_time(times[order])
+        run["track"] = entries[order, 0]
+        run["event_code"] = entries[order, 1]
+        run["event_datum"] = entries[order, 2]
+        return run
+
+    def _spill(self, run):
         """
-        Processes the data and puts it into data structures.
+        Writes a sorted run of entries to a temporary file.
+
+        The files are deleted when they are closed, by :meth:`close`.
+
+        :param run:
+            The structured array of the entries.
 
         """
-        # sequence of all the functions needed
-        insert_functions = [self._insert_object_strings,
-                            # self._insert_object_symbols
-                            self._insert_object_event_def,
-                            self._insert_object_track_def,
-                            self._insert_object_event_data]
+        if len(run):
+            run_file = tempfile.TemporaryFile("w+b")
+            run_file.write(run.data)
+            run_file.flush()
+            self._runs.append((run_file, len(run)))
+            self.no_of_events += len(run)
 
-        for event_object in self.event_objects:
-            for fn in insert_functions:
-                fn(event_object)
+    @staticmethod
+    def _times(entries):
+        """
+        :param entries:
+            A structured array of event entries.
+        :return:
+            An array of their times, joined back into 64 bit numbers.
 
-        self.no_of_sections += len(insert_functions)
+        """
+        return (entries["time_high"].astype(np.uint64) << np.uint64(32)) | \
+            entries["time_low"].astype(np.uint64)
+
+    def _read_block(self, run_file, start, count):
+        """
+        :param run_file:
+            The temporary file of a run of entries.
+        :param start:
+            The index of the first entry to read.
+        :param count:
+            The most entries to read.
+        :return:
+            A structured array of the entries read.
+
+        """
+        run_file.seek(start * self._EVENT_ENTRY.itemsize)
+        return np.fromfile(run_file, dtype=self._EVENT_ENTRY, count=count)
+
+    def _merge_runs(self):
+        """
+        Merges the sorted runs of entries from their files.
+
+        Each step reads a block from each run, up to the least (time, run)
+        that any of the blocks ends on, without the run ending too; no entry
+        left is before it, so the entries up to it can be sorted and written.
+        The blocks are read into memory rather than mapped, so that nothing
+        keeps the files once they are closed.
+
+        :return:
+            A generator of structured arrays of entries, in time order.
+
+        """
+        block_size = max(MERGE_BUFFER_SIZE // len(self._runs), 1)
+        starts = [0] * len(self._runs)
+
+        while True:
+            blocks = [self._read_block(run_file, start, block_size)
+                      for (run_file, _), start in zip(self._runs, starts)]
+            block_times = [self._times(block) for block in blocks]
+            bound = min(((times[-1], index) for index, times in
+                         enumerate(block_times)
+                         if starts[index] + len(times) < self._runs[index][1]),
+                        default=None)
+
+            pieces, piece_times = [], []
+            for index, (block, times) in enumerate(zip(blocks, block_times)):
+                if bound is None:
+                    taken = len(times)
+                else:
+                    # Ties at the bound go to the runs that came in first
+                    taken = np.searchsorted(
+                        times, bound[0],
+                        side="right" if index <= bound[1] else "left")
+                pieces.append(block[:taken])
+                piece_times.append(times[:taken])
+                starts[index] += taken
+
+            order = np.argsort(np.concatenate(piece_times), kind="mergesort")
+            # Joining the blocks may change them to the native byte order
+            yield np.concatenate(pieces)[order].astype(self._EVENT_ENTRY,
+                                                       copy=False)
+            if bound is None:
+                return
 
     def _write_file_header(self, file_descriptor):
         """Writes the file header into the Cpel file."""
@@ -275,7 +438,7 @@ class CpelWriter:
             The file descriptor of the file to be written to.
 
         """
-        file_descriptor.write(bytearray(self._string_resource, "ascii"))
+        file_descriptor.write(self._string_resource)
 
     def _write_symbols(self):
         """
@@ -304,14 +467,12 @@ class CpelWriter:
         # };
 
         # sort by value (index) and write into file
-        for event_format_offset, event_code in sorted(
-                self.event_definitions_dict.items(),
-                key=(lambda x: x[1])):
-
-            event_format = self.string_table[event_format_offset]
-            event_data_format = self.string_table["%s"]
-            file_descriptor.write(struct.pack(">LLL", event_code,
-                                              event_format, event_data_format))
+        event_data_format = self.string_table["%s"]
+        file_descriptor.write(b"".join(
+            struct.pack(">LLL", event_code, self.string_table[event_format],
+                        event_data_format)
+            for event_format, event_code in sorted(
+                self.event_definitions_dict.items(), key=(lambda x: x[1]))))
 
     def _write_track_def(self, file_descriptor):
         """
@@ -326,13 +487,11 @@ class CpelWriter:
         #     unsigned long track_format_offset_in_string_table;
         # };
 
-        # Sort by value (id) and write into file
-        for track_format_offset, track_id in sorted(
-                self.track_definitions_dict.items(),
-                key=(lambda x: x[0])):
-
-            track_format = self.string_table[track_format_offset]
-            file_descriptor.write(struct.pack(">LL", track_id, track_format))
+        # Sort by key (track) and write into file
+        file_descriptor.write(b"".join(
+            struct.pack(">LL", track_id, self.string_table[track_format])
+            for track_format, track_id in sorted(
+                self.track_definitions_dict.items(), key=(lambda x: x[0]))))
 
     def _write_events(self, file_descriptor):
         """
@@ -349,13 +508,14 @@ class CpelWriter:
         # 	unsigned long event_datum;
         # };
 
-        for time, track_id, event_code, event_datum in self.event_data:
+        # The entries are already packed big-endian, with the time split up
+        #   into two 32 bit unsigned longs
+        if not self._runs:
+            file_descriptor.write(self.event_data.data)
+            return
 
-            # Split time up into two 32 bit unsigned longs
-            times = self._convert_time(time)
-            data = struct.pack(">LLLLL", times[0], times[1], track_id,
-                               event_code, event_datum)
-            file_descriptor.write(data)
+        for entries in self._merge_runs():
+            file_descriptor.write(entries.data)
 
     def _write_section_header(self, no_of_entries, file_descriptor,
                               event_section=False):
@@ -383,10 +543,10 @@ class CpelWriter:
         Splits a 64 bit number into two 32 bit numbers.
 
         :param time:
-            A positive 64 bit number.
+            A positive 64 bit number, or an array of them.
 
         :return:
-            A list of two unsigned 32 bit numbers.
+            A list of two unsigned 32 bit numbers, or of two arrays of them.
 
         """
         times = [time >> 32, time & 2 ** 32 - 1]
@@ -395,9 +555,8 @@ class CpelWriter:
     def _pad_strings(self):
         """Makes sure the string section is padded to the nearest four bytes"""
         padnum = 4 - (len(self._string_resource) % 4)
-        for _ in range(padnum):
-            self._string_resource += "\x00"
-            self.section_length[1] += 1
+        self._string_resource += b"\x00" * padnum
+        self.section_length[1] += padnum
 
     @util.log(logger)
     def write(self, filename):
@@ -433,7 +592,7 @@ class CpelWriter:
             # Event Section
             self._write_tld(5, self.section_length[5] +
                             self._SECTION_HEADER_LENGTHS[5], file_)
-            self._write_section_header(len(self.event_data), file_,
+            self._write_section_header(self.no_of_events, file_,
                                        event_section=True)
             self._write_events(file_)
 